@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import calendar
 import datetime
+from email.utils import formatdate
+from email.utils import parsedate_to_datetime
 
 from general_helpers import iso_to_gregorian
 from general_helpers import NRtoDay
@@ -56,26 +59,82 @@ def call_check_extension(var=None):
     return dict(view=view, error=error, error_msg=error_msg)
 
 
+def _get_data_versioned(cache_key, f, tags, time_expire):
+    """
+        Returns data with a version, cached under tags
+        :param cache_key: string
+        :param f: function returning data
+        :param tags: list of cache tags
+        :param time_expire: int - seconds
+        :return: dict {'data', 'version', 'modified'}
+    """
+    # Don't cache when running tests
+    if web2pytest.is_running_under_test(request, request.application):
+        return os_cache_manager.get_versioned(f)
+
+    return os_cache_manager.get_tagged_versioned(cache_key, f, tags, time_expire=time_expire)
+
+
+def _check_not_modified(versioned):
+    """
+        Set ETag & Last-Modified headers and respond with 304 Not Modified
+        when the client already has this version of the data
+        :param versioned: dict returned by _get_data_versioned()
+        :return: None
+    """
+    # JSON and XML are different representations, so they get different ETags
+    etag = '"' + versioned['version'] + '-' + str(request.extension) + '"'
+    modified = versioned['modified']
+
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = formatdate(calendar.timegm(modified.utctimetuple()),
+                                                   usegmt=True)
+    # Clients may store responses, but should check whether they're still current
+    response.headers['Cache-Control'] = 'no-cache'
+
+    not_modified = False
+    if request.env.http_if_none_match:
+        etags = [e.strip() for e in request.env.http_if_none_match.split(',')]
+        not_modified = '*' in etags or etag in etags or 'W/' + etag in etags
+    elif request.env.http_if_modified_since:
+        try:
+            since = parsedate_to_datetime(request.env.http_if_modified_since)
+            if since.tzinfo:
+                since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            not_modified = since >= modified
+        except (TypeError, ValueError, IndexError):
+            pass
+
+    if not_modified:
+        raise HTTP(304, **response.headers)
+
+
 def _schedule_get(year, week, sorting, TeacherID, ClassTypeID, LocationID, LevelID):
     # classes
     data = dict()
     data['classes'] = dict()
+    date_from = iso_to_gregorian(int(year), int(week), 1)
+    date_until = iso_to_gregorian(int(year), int(week), 7)
+
+    class_schedule = ClassSchedule(
+        date_from,
+        filter_id_school_classtype=ClassTypeID,
+        filter_id_school_location=LocationID,
+        filter_id_school_level=LevelID,
+        filter_id_teacher=TeacherID,
+        filter_public=True,
+        sorting=sorting
+    )
+
+    # Fetch the whole week using one query
+    classes_week = class_schedule.get_range_list(date_from, date_until)
+
     for day in range(1, 8):
         date = iso_to_gregorian(int(year), int(week), int(day))
 
-        class_schedule = ClassSchedule(
-            date,
-            filter_id_school_classtype=ClassTypeID,
-            filter_id_school_location=LocationID,
-            filter_id_school_level=LevelID,
-            filter_id_teacher=TeacherID,
-            filter_public=True,
-            sorting=sorting
-        )
-
         key = str(NRtoDay(day))
 
-        class_data = dict(classes=class_schedule.get_day_list(),
+        class_data = dict(classes=classes_week[date],
                           date=date)
 
         data['classes'][key] = class_data
@@ -227,6 +286,10 @@ def schedule_get():
     else:
         response.view = result['view']
 
+    ## allow all domains to request this resource
+    ## Only enable when you really need it, server side implementation is recommended.
+    response.headers["Access-Control-Allow-Origin"] = "*"
+
     if ( 'user' in request.vars and
          'key' in request.vars and
          'year' in request.vars and
@@ -268,20 +331,27 @@ def schedule_get():
                 LevelID = int(request.vars['LevelID'])
 
 
-            # Don't cache when running tests
-            if web2pytest.is_running_under_test(request, request.application):
-                data = _schedule_get(year, week, sorting, TeacherID, ClassTypeID, LocationID, LevelID)
-            else:
-                cache_key = 'openstudio_api_schedule_get_' + str(year) + '_' + \
-                            'week_' + str(week) + '_' + \
-                            'sorting_' + sorting + '_' + \
-                            'TeacherID_' + str(TeacherID) + '_' + \
-                            'ClassTypeID_' + str(ClassTypeID) + '_' + \
-                            'LocationID_' + str(LocationID) + '_' + \
-                            'LevelID_' + str(LevelID)
-                data = cache.ram(cache_key,
-                                 lambda: _schedule_get(year, week, sorting, TeacherID, ClassTypeID, LocationID, LevelID),
-                                 time_expire=cache_2_min)
+            cache_key = 'openstudio_api_schedule_get_' + str(year) + '_' + \
+                        'week_' + str(week) + '_' + \
+                        'sorting_' + sorting + '_' + \
+                        'TeacherID_' + str(TeacherID) + '_' + \
+                        'ClassTypeID_' + str(ClassTypeID) + '_' + \
+                        'LocationID_' + str(LocationID) + '_' + \
+                        'LevelID_' + str(LevelID)
+            # Tag with each date in this week, so changes to a class on one day only clear
+            # the weeks containing that day
+            tags = ['schedule_api']
+            for day in range(1, 8):
+                tags.append('schedule_api_' + str(iso_to_gregorian(year, week, day)))
+
+            versioned = _get_data_versioned(
+                cache_key,
+                lambda: _schedule_get(year, week, sorting, TeacherID, ClassTypeID, LocationID, LevelID),
+                tags,
+                cache_2_min
+            )
+            _check_not_modified(versioned)
+            data = versioned['data']
 
         except ValueError:
             data = T("Value error")
@@ -289,11 +359,6 @@ def schedule_get():
         data = T("Missing value: user, key, year and week are required values, \
                   one or more was missing in your request.")
 
-    ## allow all domains to request this resource
-    ## Only enable when you really need it, server side implementation is recommended.
-    response.headers["Access-Control-Allow-Origin"] = "*"
-
-
     return dict(data=data)
 
 
@@ -412,9 +477,10 @@ def schedule_get_days():
                         'ClassTypeID_' + str(ClassTypeID) + '_' + \
                         'LocationID_' + str(LocationID) + '_' + \
                         'LevelID_' + str(LevelID)
-            classes = cache.ram(cache_key,
-                             lambda: class_schedule.get_day_list(),
-                             time_expire=CACHE_LONG)
+            classes = os_cache_manager.get_tagged(cache_key,
+                                                  lambda: class_schedule.get_day_list(),
+                                                  ['schedule_api', 'schedule_api_' + str(current_date)],
+                                                  time_expire=CACHE_LONG)
 
         data['schedule'].append({
             'classes': classes,
@@ -641,16 +707,13 @@ def workshops_get():
         return auth_result['message']
 
 
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        data = _workshops_get()
-    else:
-        cache_key = 'openstudio_workshops_api_workshops_get'
-        data = cache.ram(cache_key,
-                         lambda: _workshops_get(),
-                         time_expire=CACHE_LONG)
+    versioned = _get_data_versioned('openstudio_workshops_api_workshops_get',
+                                    lambda: _workshops_get(),
+                                    ['workshops'],
+                                    CACHE_LONG)
+    _check_not_modified(versioned)
 
-    return data
+    return versioned['data']
 
 
 def workshop_get():
@@ -935,16 +998,13 @@ def school_subscriptions_get():
     if not auth_result['authenticated']:
         return auth_result['message']
 
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        data = _school_subscriptions_get()
-    else:
-        cache_key = 'openstudio_school_subcriptions_api_get'
-        data = cache.ram(cache_key,
-                         lambda: _school_subscriptions_get(),
-                         time_expire=CACHE_LONG)
+    versioned = _get_data_versioned('openstudio_school_subcriptions_api_get',
+                                    lambda: _school_subscriptions_get(),
+                                    ['school_subscriptions'],
+                                    CACHE_LONG)
+    _check_not_modified(versioned)
 
-    return {'data':data}
+    return {'data':versioned['data']}
 
 
 def _school_classcards_get(var=None):
@@ -1018,16 +1078,13 @@ def school_classcards_get():
     if not auth_result['authenticated']:
         return auth_result['message']
 
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        data = _school_classcards_get()
-    else:
-        cache_key = 'openstudio_school_classcards_api_get'
-        data = cache.ram(cache_key,
-                         lambda: _school_classcards_get(),
-                         time_expire=CACHE_LONG)
+    versioned = _get_data_versioned('openstudio_school_classcards_api_get',
+                                    lambda: _school_classcards_get(),
+                                    ['school_classcards'],
+                                    CACHE_LONG)
+    _check_not_modified(versioned)
 
-    return {'data':data}
+    return {'data':versioned['data']}
 
 
 def _school_teachers_get_classtypes(teID):
@@ -1129,22 +1186,23 @@ def school_teachers_get():
     if not auth_result['authenticated']:
         return auth_result['message']
 
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        data = _school_teachers_get_by_classtype(request.vars['ctID'])
+    if 'ClassTypeID' in request.vars:
+        ctID = request.vars['ClassTypeID']
+        cache_key = 'openstudio_school_teachers_api_get_ClassTypeID_' + ctID
     else:
-        if 'ClassTypeID' in request.vars:
-            ctID = request.vars['ClassTypeID']
-            cache_key = 'openstudio_school_teachers_api_get_ClassTypeID_' + ctID
-        else:
-            ctID = None
-            cache_key = 'openstudio_school_teachers_api_get_all'
+        ctID = None
+        cache_key = 'openstudio_school_teachers_api_get_all'
 
-        data = cache.ram(cache_key,
-                         lambda: _school_teachers_get_by_classtype(ctID),
-                         time_expire=CACHE_LONG)
+    if web2pytest.is_running_under_test(request, request.application):
+        ctID = request.vars['ctID']
+
+    versioned = _get_data_versioned(cache_key,
+                                    lambda: _school_teachers_get_by_classtype(ctID),
+                                    ['school_teachers'],
+                                    CACHE_LONG)
+    _check_not_modified(versioned)
 
-    return {'data':data}
+    return {'data':versioned['data']}
 
 
 def _school_classtypes_get(var=None):
@@ -1204,14 +1262,10 @@ def school_classtypes_get():
     if not auth_result['authenticated']:
         return auth_result['message']
 
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        data = _school_classtypes_get()
-    else:
-        cache_key = 'openstudio_school_classtypes_api_get_all'
-
-        data = cache.ram(cache_key,
-                         lambda: _school_classtypes_get(),
-                         time_expire=CACHE_LONG)
+    versioned = _get_data_versioned('openstudio_school_classtypes_api_get_all',
+                                    lambda: _school_classtypes_get(),
+                                    ['school_classtypes'],
+                                    CACHE_LONG)
+    _check_not_modified(versioned)
 
-    return {'data':data}
+    return {'data':versioned['data']}
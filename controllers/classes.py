@@ -2188,18 +2188,16 @@ def reservations_export_mailinglist():
     """
         Excel export mailing list
     """
+    from openstudio.os_export import OsExport
+
     clsID = request.vars['clsID']
     date_formatted = request.vars['date']
     date = datestr_to_python(DATE_FORMAT, request.vars['date'])
 
-    ##
-    # Create filestream
-    ##
-    stream = io.BytesIO()
-
     ##
     # Create Excel workbook
     ##
+    export = OsExport()
     wb = openpyxl.workbook.Workbook(write_only=True)
     title = 'Reservations ' + date_formatted
     ws = wb.create_sheet(title=title)
@@ -2235,14 +2233,9 @@ def reservations_export_mailinglist():
             row.email
         ])
 
-    wb.save(stream)
-
     fname = T('MailingList.xlsx')
 
-    response.headers['Content-Type'] = 'application/vnd.ms-excel'
-    response.headers['Content-disposition'] = 'attachment; filename=' + fname
-
-    return stream.getvalue()
+    return export.stream(export.excel_workbook(wb), fname)
 
 
 
@@ -3241,7 +3234,7 @@ def attendance_remove():
     cache_clear_customers_classcards(cuID)
 
     # Clear api cache to refresh available spaces
-    cache_clear_classschedule_api()
+    cache_clear_classschedule_api(date=clatt.ClassDate)
 
 
     if clatt.customers_classcards_id:
@@ -865,8 +865,6 @@ def add():
     db.auth_user.password.default = generate_password(30)
     db.auth_user.customer.default = True
 
-    crud.settings.create_onaccept = [cache_clear_customers]
-
     if request.vars['teacher'] == 'True':
         response.subtitle = T("Add a teacher")
         db.auth_user.teacher.default = True
@@ -930,15 +928,6 @@ def add_get_back(var=None):
     )
 
 
-def cache_clear_customers(var=None):
-    """
-    Clear customers cache after adding a customer
-    """
-    from openstudio.os_cache_manager import OsCacheManager
-    ocm = OsCacheManager()
-    ocm.clear_customers()
-
-
 @auth.requires(auth.has_membership(group_id='Admins') or \
                 auth.has_permission('create', 'auth_user'))
 def add_redirect_on_create():
@@ -1031,7 +1020,6 @@ def edit():
 
     crud.messages.submit_button = T('Save')
     crud.messages.record_updated = T('Saved')
-    crud.settings.update_onaccept = [cache_clear_customers]
 
     # Clear teachers cache if we're updating a teacher
     if row.teacher:
@@ -1376,163 +1364,29 @@ def classcards_count_classes(row):
                auth.has_permission('update', 'auth_user'))
 def export_excel():
     """
-        valid export_types include: payment_summary, mailinglist, attendance_list, customers_list, subscription_list
-    """
-    export_type = request.vars['export']
-
-    # create filestream
-    stream = io.BytesIO()
-
-    if export_type.lower() == "customers_list":
-        # create dictionary to lookup latest subscription values
-        if export_type.lower() == 'customers_list':
-            result = db.executesql("""SELECT cu.id,
-                                             ssu.name,
-                                             cs.startdate,
-                                             cs.enddate,
-                                             pm.Name
-                                       FROM auth_user cu
-                LEFT JOIN customers_subscriptions cs
-                ON cs.auth_customer_id = cu.id
-                LEFT JOIN
-                (SELECT auth_customer_id, school_subscriptions_id, max(startdate) as startdate, enddate
-                FROM customers_subscriptions GROUP BY auth_customer_id) chk
-                ON cu.id = chk.auth_customer_id
-                LEFT JOIN
-                (SELECT id, name FROM school_subscriptions) ssu
-                ON ssu.id = cs.school_subscriptions_id
-                LEFT JOIN payment_methods pm ON cs.payment_methods_id = pm.id
-                WHERE cs.startdate = chk.startdate OR cs.startdate IS NULL """)
-
-            fname = T("Customers list") + '.xlsx'
-            title = 'Customers list'
-        cu_mem_dict = dict()
-        for record in result:
-            subscription = record[1] or ""
-            start = record[2] or ""
-            end = record[3] or ""
-            payment_method = record[4] or ""
-            cu_mem_dict[record[0]] = [subscription, start, end, payment_method]
-
-        bd_dict = dict()
-        rows = db().select(db.customers_payment_info.ALL)
-        for row in rows:
-            bd_dict[row.auth_customer_id] = [
-                                          row.AccountNumber,
-                                          row.AccountHolder,
-                                          row.BankName,
-                                          row.BankLocation ]
-
-        # Create the workbook
-        wb = openpyxl.workbook.Workbook(write_only=True)
-        ws = wb.create_sheet(title=title)
-        headers = [ "id",
-                    "First name",
-                    "Last name",
-                    "Date of birth",
-                    "Gender",
-                    "Address",
-                    "Postal code",
-                    "City",
-                    "Country",
-                    "Email",
-                    "Newsletter",
-                    "Telephone",
-                    "Mobile",
-                    "Key",
-                    "Location",
-                    "Subscription",
-                    "Startdate",
-                    "Enddate",
-                    "Payment",
-                    "AccountNR",
-                    "AccountHolder",
-                    "BankName",
-                    "BankLocation"]
-        ws.append(headers)
-
-        query = (db.auth_user.trashed == False)
-        rows = db(query).select(db.auth_user.ALL,
-                                db.school_locations.Name,
-                left=[db.school_locations.on(db.auth_user.school_locations_id==\
-                                             db.school_locations.id)])
-        for row in rows:
-            customers_id = row.auth_user.id
-            if export_type.lower() == 'subscription_list' and \
-                customers_id not in cu_mem_dict:
-                # subscription list, if no subscription --> check the next customer.
-                continue
-            else:
-                data = [ row.auth_user.id,
-                         row.auth_user.first_name,
-                         row.auth_user.last_name,
-                         row.auth_user.date_of_birth,
-                         row.auth_user.gender,
-                         row.auth_user.address,
-                         row.auth_user.postcode,
-                         row.auth_user.city,
-                         row.auth_user.country,
-                         row.auth_user.email,
-                         row.auth_user.newsletter,
-                         row.auth_user.phone,
-                         row.auth_user.mobile,
-                         row.auth_user.keynr,
-                         row.school_locations.Name,
-                         cu_mem_dict[customers_id][0],
-                         cu_mem_dict[customers_id][1],
-                         cu_mem_dict[customers_id][2],
-                         cu_mem_dict[customers_id][3]]
-                if not bd_dict.get(customers_id, None) is None:
-                    data.append(bd_dict[customers_id][0])
-                    data.append(bd_dict[customers_id][1])
-                    data.append(bd_dict[customers_id][2])
-                    data.append(bd_dict[customers_id][3])
-
-                ws.append(data)
-
-        wb.save(stream)
-
-        response.headers['Content-Type']='application/vnd.ms-excel'
-        response.headers['Content-disposition']='attachment; filename=' + fname
-
-        return stream.getvalue()
-
-
-    elif export_type.lower() == "mailing_list":
-        wb = openpyxl.workbook.Workbook(write_only=True)
-        # write the sheet for all mail addresses
-        ws = wb.create_sheet(title="All customers")
-        today = datetime.date.today()
-        query = ((db.auth_user.trashed == False) &
-                 (db.auth_user.id > 1))
-        rows = db(query).select(db.auth_user.first_name,
-                                db.auth_user.last_name,
-                                db.auth_user.email)
-        for row in rows:
-            ws.append([row.first_name,
-                       row.last_name,
-                       row.email])
-        # All newsletter
-        ws = wb.create_sheet(title="Newsletter")
-        today = datetime.date.today()
-        query = ((db.auth_user.trashed == False) &
-                 (db.auth_user.newsletter == True) &
-                 (db.auth_user.id > 1))
-        rows = db(query).select(db.auth_user.first_name,
-                                db.auth_user.last_name,
-                                db.auth_user.email)
-        for row in rows:
-            ws.append([row.first_name,
-                       row.last_name,
-                       row.email])
+        valid export_types include: customers_list, mailing_list
+        Exports for a large number of customers are created in the background,
+        unless the background var is 'no'.
+    """
+    from openstudio.os_export import OsExport
+
+    export_type = request.vars['export'].lower()
 
-        fname = T("Mailinglist") + '.xlsx'
-        wb.save(stream)
+    export = OsExport()
+    customers = Customers()
+    if not request.vars['background'] == 'no' and \
+       customers.count_export() > export.background_rows:
+        export.queue(export_type)
+
+        session.flash = SPAN(
+            T("Started creating export.. "),
+            T("a download link will be shown on this page when it's ready.")
+        )
+        redirect(URL('exports', 'index'))
 
-        response.headers['Content-Type']='application/vnd.ms-excel'
-        response.headers['Content-disposition']='attachment; filename=' + fname
+    fname, sheets = export.get_sheets(export_type)
 
-        return stream.getvalue()
+    return export.stream(export.excel(sheets), fname)
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -5542,6 +5396,32 @@ def load_list():
                             limitby=limitby,
                             orderby=orderby)
 
+    if list_type == 'selfcheckin_checkin':
+        # Get booking options for all customers on this page at once
+        from openstudio.os_attendance_helper import AttendanceHelper
+
+        page_customer_ids = [row.id for row in rows[:items_per_page]]
+        ah = AttendanceHelper()
+        booking_options = ah.get_customers_class_booking_options(clsID,
+                                                                 date,
+                                                                 page_customer_ids,
+                                                                 trial=True,
+                                                                 list_type='selfcheckin')
+
+        query = (db.classes_attendance.classes_id == clsID) & \
+                (db.classes_attendance.ClassDate == date) & \
+                (db.classes_attendance.auth_customer_id.belongs(page_customer_ids))
+        checked_in = set([r.auth_customer_id for r in
+                          db(query).select(db.classes_attendance.auth_customer_id)])
+
+        # For self check-in display of subscriptions can be configured by the user.
+        show_subscriptions_prop = 'selfcheckin_show_subscriptions'
+        show_subscriptions = get_sys_property(show_subscriptions_prop)
+        if show_subscriptions:
+            show_subscriptions = True
+        else:
+            show_subscriptions = False
+
     table_class = 'table table-hover'
     table = TABLE(_class=table_class)
     for i, row in enumerate(rows.render()):
@@ -5551,19 +5431,13 @@ def load_list():
         cuID = row.id
 
         # get subscription for customer
-        customer = Customer(cuID)
         if list_type == 'selfcheckin_checkin':
-            # For self check-in display of subscriptions can be configured by the user.
-            show_subscriptions_prop = 'selfcheckin_show_subscriptions'
-            show_subscriptions = get_sys_property(show_subscriptions_prop)
-            if show_subscriptions:
-                subscriptions = True
-            else:
-                subscriptions = False
-
-            subscr_cards = customer.get_subscriptions_and_classcards_formatted(date,
-                                                                               show_subscriptions=subscriptions)
+            subscr_cards = load_list_get_selfcheckin_subscriptions_and_classcards(
+                booking_options[cuID],
+                show_subscriptions
+            )
         else:
+            customer = Customer(cuID)
             subscr_cards = customer.get_subscriptions_and_classcards_formatted(date)
 
 
@@ -5615,7 +5489,8 @@ def load_list():
             buttons = TD(load_list_get_selfcheckin_checkin_buttons(
                 row,
                 clsID,
-                date_formatted),
+                date_formatted,
+                cuID in checked_in),
                 _class='table-vertical-align-middle')
         elif list_type == 'classes_manage_reservation':
             buttons = TD(load_list_get_reservation_list_buttons(
@@ -5800,17 +5675,69 @@ def load_list_get_attendance_list_buttons(row,
         return ''
 
 
+def load_list_get_selfcheckin_subscriptions_and_classcards(options, show_subscriptions):
+    """
+        Returns subscriptions and class cards for the selfcheckin_checkin list type
+        :param options: booking options returned by
+        AttendanceHelper.get_customers_class_booking_options()
+    """
+    subscriptions = DIV()
+    if show_subscriptions:
+        for subscription in options['subscriptions']:
+            if subscription['Unlimited']:
+                subscr_credits = T('Unlimited')
+            else:
+                subscr_credits = SPAN(subscription['Credits'], ' ', T('Credits'))
+
+            subscriptions.append(SPAN(subscription['Name'], XML(' &bull; '), subscr_credits))
+            if not subscription['Allowed']:
+                subscriptions.append(SPAN(' | ', T("Not allowed for this class"), _class='bold'))
+            elif subscription['Blocked']:
+                subscriptions.append(SPAN(' | ', T("Blocked"), _class='bold'))
+            subscriptions.append(BR())
+
+    classcards = DIV()
+    for classcard in options['classcards']:
+        remaining_classes = classcard['ClassesRemaining']
+        if not remaining_classes:
+            continue
+
+        try:
+            enddate = classcard['Enddate'].strftime(DATE_FORMAT)
+        except AttributeError:
+            enddate = T('No expiry')
+
+        classcards.append(SPAN(classcard['Name'], XML(' &bull; '),
+                               T('expires'), ' ',
+                               enddate, XML(' &bull; ')))
+        if classcard['Unlimited']:
+            classcards.append(T('Unlimited'))
+        else:
+            classcards.append(SPAN(remaining_classes, ' ', T("Classes remaining")))
+        if not classcard['Allowed']:
+            classcards.append(SPAN(' | ', T("Not allowed for this class"), _class='bold'))
+        classcards.append(BR())
+
+    subscr_cards = TABLE(_class='grey small_font')
+    if subscriptions.components:
+        subscr_cards.append(TR(subscriptions))
+    if classcards.components:
+        subscr_cards.append(TR(classcards))
+    if show_subscriptions and not subscriptions.components and not classcards.components:
+        subscr_cards.append(DIV(T("No subscription or class card"),
+                                _class='red'))
+
+    return subscr_cards
+
+
 def load_list_get_selfcheckin_checkin_buttons(row,
                                               clsID,
-                                              date_formatted):
+                                              date_formatted,
+                                              checked_in):
     """
         Returns buttons for the selfcheckin_checkin list type
     """
-    date = datestr_to_python(DATE_FORMAT, date_formatted)
-    check = db.classes_attendance(auth_customer_id=row.id,
-                                  classes_id=clsID,
-                                  ClassDate=date)
-    if not check:
+    if not checked_in:
         url = URL('selfcheckin', 'checkin_booking_options',
                   vars={'cuID':row.id,
                         'clsID':clsID,
@@ -6896,14 +6823,9 @@ def barcode_label():
         Preview barcode label
     """
     from openstudio.os_customer import Customer
-    from openstudio.os_cache_manager import OsCacheManager
 
     cuID = request.vars['cuID']
     customer = Customer(cuID)
     barcode_label = customer.get_barcode_label()
 
-    # Clear PoS barcode label cache
-    ocm = OsCacheManager()
-    ocm.clear_customers()
-
     return barcode_label
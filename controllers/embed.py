@@ -42,14 +42,18 @@ def classes():
                                 filter_id_school_level='',
                                 filter_id_teacher=filter_id_teacher)
 
+    end_date = start_date + datetime.timedelta(days=6)
+    classes_days = classes_get_days(start_date,
+                                    end_date,
+                                    filter_id_school_classtype=filter_id_school_classtype,
+                                    filter_id_school_location=filter_id_school_location,
+                                    filter_id_school_level='',
+                                    filter_id_teacher=filter_id_teacher)
+
     days = []
     for day in range(0, 7):
         date = start_date + datetime.timedelta(days=day)
-        classes_list = classes_get_day(date,
-                                       filter_id_school_classtype=filter_id_school_classtype,
-                                       filter_id_school_location=filter_id_school_location,
-                                       filter_id_school_level='',
-                                       filter_id_teacher=filter_id_teacher)
+        classes_list = classes_days[date]
 
         days.append(dict(date=date, weekday=date.isoweekday(), classes=classes_list))
 
@@ -265,19 +269,21 @@ def classes_get_week_browser(date):
     return DIV(buttons, ' ', today, _class='shop-classes-week-chooser')
 
 
-def classes_get_day(date,
-                    filter_id_school_classtype,
-                    filter_id_school_location,
-                    filter_id_school_level,
-                    filter_id_teacher):
+def classes_get_days(date_from,
+                     date_until,
+                     filter_id_school_classtype,
+                     filter_id_school_location,
+                     filter_id_school_level,
+                     filter_id_teacher):
     """
-        :param weekday: ISO weekday (1-7)
-        :return: List of classes for day
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :return: dict {date: List of classes for day}
     """
     from openstudio.os_class_schedule import ClassSchedule
 
     cs = ClassSchedule(
-        date,
+        date_from,
         filter_id_school_classtype = filter_id_school_classtype,
         filter_id_school_location = filter_id_school_location,
         filter_id_school_level = filter_id_school_level,
@@ -285,4 +291,4 @@ def classes_get_day(date,
         filter_public = True,
         sorting = 'starttime' )
 
-    return cs.get_day_list()
\ No newline at end of file
+    return cs.get_range_list(date_from, date_until)
\ No newline at end of file
@@ -989,18 +989,19 @@ def mail_activity_attendance():
     if len(to) < 1:
         session.flash = T("Please check the teachers' email address(es).")
     else:
-        check = current.mail.send(
-            to=to,
-            subject=subject,
-            # If reply_to is omitted, then mail.settings.sender is used
-            reply_to=None,
-            message=message
-        )
+        from openstudio.os_mail_outbox import OsMailOutbox
+
+        outbox = OsMailOutbox()
+        for email in to:
+            outbox.queue(
+                to=email,
+                subject=subject,
+                # If reply_to is omitted, then mail.settings.sender is used
+                reply_to=None,
+                message=message
+            )
 
-        if check:
-            session.flash = T("Successfully sent mail")
-        else:
-            session.flash = T("Unable to send mail")
+        session.flash = T("Mail queued for sending")
 
     redirect(URL('activities', vars={'wsID': wsID}))
 
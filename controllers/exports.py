@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from openstudio.os_export import OsExport
+
+@auth.requires_login()
+def index():
+    """
+        List exports created in the background for the logged in user
+    """
+    response.title = T('Exports')
+    response.subtitle = T('Created in the background')
+    response.view = 'general/only_content.html'
+
+    query = (db.sys_exports.auth_user_id == auth.user.id)
+    rows = db(query).select(db.sys_exports.ALL,
+                            orderby=~db.sys_exports.CreatedOn,
+                            limitby=(0, 25))
+
+    header = THEAD(TR(
+        TH(T('Created')),
+        TH(T('File')),
+        TH(T('Status')),
+        TH(T('Finished')),
+        TH(),
+    ))
+
+    table = TABLE(header, _class='table table-hover table-striped')
+    for i, row in enumerate(rows):
+        repr_row = list(rows[i:i + 1].render())[0]
+
+        download = ''
+        if row.Status == 'finished':
+            download = os_gui.get_button(
+                'download',
+                URL('download', vars={'seID': row.id}),
+                title=T('Download'),
+                _class='pull-right'
+            )
+
+        table.append(TR(
+            TD(repr_row.CreatedOn),
+            TD(row.FileName or ''),
+            TD(repr_row.Status),
+            TD(repr_row.FinishedOn or ''),
+            TD(download)
+        ))
+
+    if not rows:
+        table = T("No exports have been created in the background yet.")
+
+    content = DIV(table,
+                  P(T("Exports are deleted after"), ' ', OsExport.retention_days, ' ', T("days."),
+                    _class='text-muted'))
+
+    return dict(content=content)
+
+
+@auth.requires_login()
+def download():
+    """
+        Download an export created in the background
+    """
+    seID = request.vars['seID']
+
+    row = db.sys_exports(seID)
+    if not row or \
+       not row.Status == 'finished' or \
+       not row.auth_user_id == auth.user.id:
+        raise HTTP(404)
+
+    filename, stream = db.sys_exports.ExportFile.retrieve(row.ExportFile)
+
+    response.headers['Content-Type'] = 'application/vnd.ms-excel'
+    response.headers['Content-disposition'] = 'attachment; filename=' + row.FileName
+
+    return response.stream(stream, request=request)
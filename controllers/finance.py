@@ -9,8 +9,6 @@ from openstudio.os_invoice import Invoice
 from openstudio.os_invoices import Invoices
 from openstudio.os_school_subscription import SchoolSubscription
 
-import csv
-import io
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -513,7 +511,12 @@ def batch_content_get_export(pbID):
         A(os_gui.get_fa_icon('fa-star-o'), T('First'), _href=URL('export_csv', vars={'pbID':pbID,
                                                                                      'first':True})),
         A(os_gui.get_fa_icon('fa-repeat'), T('Recurring'), _href=URL('export_csv', vars={'pbID':pbID,
-                                                                                         'recurring':True}))
+                                                                                         'recurring':True})),
+        A(os_gui.get_fa_icon('fa-file-code-o'), T('SEPA XML'), _href=URL('export_sepa', vars={'pbID':pbID})),
+        A(os_gui.get_fa_icon('fa-star-o'), T('SEPA XML - First'), _href=URL('export_sepa', vars={'pbID':pbID,
+                                                                                                 'first':True})),
+        A(os_gui.get_fa_icon('fa-repeat'), T('SEPA XML - Recurring'), _href=URL('export_sepa', vars={'pbID':pbID,
+                                                                                                     'recurring':True}))
     ]
 
     for link in links:
@@ -822,16 +825,36 @@ def generate_batch_items_invoices(pbID,
         )
     ]
 
-    rows = db(query).select(db.invoices.ALL,
-                            db.invoices_amounts.ALL,
-                            # db.invoices_items_customers_subscriptions.ALL,
-                            db.customers_payment_info.ALL,
-                            db.customers_payment_info_mandates.ALL,
-                            db.school_locations.Name,
-                            db.auth_user.id,
-                            left=left,
-                            orderby=db.auth_user.id)
+    # Fetch invoices in chunks, so memory use doesn't depend on the size of the batch
+    chunk_size = 500
+    offset = 0
+    while True:
+        rows = db(query).select(db.invoices.ALL,
+                                db.invoices_amounts.ALL,
+                                # db.invoices_items_customers_subscriptions.ALL,
+                                db.customers_payment_info.ALL,
+                                db.customers_payment_info_mandates.ALL,
+                                db.school_locations.Name,
+                                db.auth_user.id,
+                                left=left,
+                                orderby=db.auth_user.id|
+                                        db.invoices.id|
+                                        db.customers_payment_info.id|
+                                        db.customers_payment_info_mandates.id,
+                                limitby=(offset, offset + chunk_size))
+
+        generate_batch_items_invoices_insert(pbID, pb, currency, rows)
+
+        if len(rows) < chunk_size:
+            break
+
+        offset += chunk_size
 
+
+def generate_batch_items_invoices_insert(pbID, pb, currency, rows):
+    """
+        Write invoices in rows to db.payment_batches_items
+    """
     for row in rows:
         cuID = row.auth_user.id
         csID = ""
@@ -1100,11 +1123,9 @@ def get_batch_items(pbID, display=False, first=False, recurring=False):
     return bi
 
 
-@auth.requires(auth.has_membership(group_id='Admins') or \
-               auth.has_permission('read', 'payment_batches'))
-def export_csv():
+def export_get_first_recurring():
     """
-        Exports batch to CSV format
+    :return: tuple (first, recurring) - booleans from request.vars
     """
     first = False
     recurring= False
@@ -1113,76 +1134,135 @@ def export_csv():
     if request.vars['recurring']:
         recurring = True
 
+    return first, recurring
+
+
+def export_get_fname(pb, first, recurring, extension):
+    """
+    :param pb: PaymentBatch object
+    :return: file name for batch export
+    """
+    batch_name = pb.row.Name.replace(' ', '_')
+    fname = 'Batch_' + str(pb.id) + '_' + batch_name
+    if first:
+        fname += '_FRST'
+    if recurring:
+        fname += '_RCUR'
+    fname += '.' + extension
+
+    return fname
+
+
+def export_stream(chunks, fname, content_type):
+    """
+    Writes chunks to a temporary file and streams it to the client,
+    so the export never has to be held in memory as a whole
+    :param chunks: iterable of strings
+    :return: None
+    """
+    import tempfile
+
+    stream = tempfile.TemporaryFile()
+    for chunk in chunks:
+        stream.write(chunk.encode('utf-8'))
+    stream.seek(0)
+
+    response.headers['Content-Type'] = content_type
+    response.headers['Content-disposition'] = 'attachment; filename=' + fname
+
+    return response.stream(stream, request=request)
+
+
+@auth.requires(auth.has_membership(group_id='Admins') or \
+               auth.has_permission('read', 'payment_batches'))
+def export_csv():
+    """
+        Exports batch to CSV format
+    """
+    from openstudio.os_payment_batch import PaymentBatch
+
+    first, recurring = export_get_first_recurring()
+
     pbID = request.vars['pbID']
-    pb = db.payment_batches(pbID)
+    pb = PaymentBatch(pbID)
 
     # log to database
     db.payment_batches_exports.insert(payment_batches_id=pbID,
                                       FirstCustomers=first,
                                       RecurringCustomers=recurring)
 
-    # create writer and buffer to hold data
-    stream = io.StringIO()
-    writer = csv.writer(stream)
-
-    # write the header
-    writer.writerow(['customers_id',
-                     'SubscriptionID',
-                     'Account holder',
-                     'Bank Location',
-                     'Currency',
-                     'Amount',
-                     'Account number',
-                     'BIC',
-                     'Mandate Signature Date',
-                     'Mandate Reference',
-                     'Description',
-                     'Execution Date',
-                     'Location'])
-
-    batch_items = get_batch_items(pbID, first=first, recurring=recurring)
-    for item in batch_items:
-        customers_id = item['cuID']
-        customer_subscriptions_id = item['csID']
-        account_holder = item['account_holder']
-        bank_location = item['bank_location']
-        currency = item['currency']
-        amount = item['amount']
-        account_number = item['account_number']
-        bic = item['bic']
-        mandate_signature_date = item['mandate_signature_date']
-        mandate_reference = item['mandate_reference']
-        description = item['description']
-        execution_date = item['execution_date']
-
-        row = [ customers_id,
-                customer_subscriptions_id,
-                account_holder,
-                bank_location,
-                currency,
-                amount,
-                account_number,
-                bic,
-                mandate_signature_date,
-                mandate_reference,
-                description,
-                execution_date ]
-        if session.show_location:
-            row.append(item.get('location', ''))
-
-        writer.writerow(row)
-
-    batch_name = pb.Name.replace(' ', '_')
-    fname = 'Batch_' + pbID + '_' + batch_name
-    if first:
-        fname += '_FRST'
-    if recurring:
-        fname += '_RCUR'
-    fname += '.csv'
-    response.headers['Content-Type']='application/vnd.ms-excel'
-    response.headers['Content-disposition']='attachment; filename=' + fname
+    chunks = pb.export_csv(first=first,
+                           recurring=recurring,
+                           show_location=bool(session.show_location))
+
+    return export_stream(chunks,
+                         export_get_fname(pb, first, recurring, 'csv'),
+                         'application/vnd.ms-excel')
+
+
+@auth.requires(auth.has_membership(group_id='Admins') or \
+               auth.has_permission('read', 'payment_batches'))
+def export_sepa():
+    """
+        Exports batch as SEPA direct debit message (pain.008.001.02)
+    """
+    from openstudio.os_payment_batch import PaymentBatch
+
+    first, recurring = export_get_first_recurring()
+
+    pbID = request.vars['pbID']
+    pb = PaymentBatch(pbID)
+
+    errors = pb.get_sepa_errors(first=first, recurring=recurring)
+    if errors:
+        return export_sepa_get_errors(pbID, errors)
+
+    # log to database
+    db.payment_batches_exports.insert(payment_batches_id=pbID,
+                                      FirstCustomers=first,
+                                      RecurringCustomers=recurring)
+
+    chunks = pb.export_sepa(first=first, recurring=recurring)
+
+    return export_stream(chunks,
+                         export_get_fname(pb, first, recurring, 'xml'),
+                         'application/xml')
+
+
+def export_sepa_get_errors(pbID, errors):
+    """
+    :param pbID: db.payment_batches.id
+    :param errors: list returned by PaymentBatch.get_sepa_errors()
+    :return: page listing the items that can't be exported to SEPA XML
+    """
+    response.title = T('Batch')
+    response.subtitle = T('SEPA XML export')
+    response.view = 'general/only_content.html'
+
+    header = THEAD(TR(TH(T('Line')),
+                      TH(T('Customer')),
+                      TH(T('Account holder')),
+                      TH(T('Errors'))))
+    table = TABLE(header, _class='table table-striped table-hover')
+
+    for error in errors:
+        if error['cuID']:
+            customer = A(error['cuID'],
+                         _href=URL('customers', 'bankaccount', vars={'cuID': error['cuID']}))
+        else:
+            customer = T('Settings')
+
+        table.append(TR(TD(error['line'] or ''),
+                        TD(customer),
+                        TD(error['account_holder']),
+                        TD(UL([LI(e) for e in error['errors']]))))
+
+    content = DIV(P(T("The batch can't be exported to SEPA XML, please correct the following items")),
+                  table)
+
+    back = os_gui.get_button('back', URL('batch_content', vars={'pbID': pbID}))
 
-    return stream.getvalue()
+    return dict(content=content, back=back)
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -11,7 +11,6 @@ from openstudio.os_customer import Customer
 from decimal import Decimal, ROUND_HALF_UP
 
 import io
-import weasyprint
 import openpyxl
 
 
@@ -1533,118 +1532,13 @@ def list_payments():
     return dict(content=grid)
 
 
-def pdf_template_get_logo(var=None):
-    """
-        Returns logo for pdf template
-    """
-    branding_logo = os.path.join(request.folder,
-                                 'static',
-                                 'plugin_os-branding',
-                                 'logos',
-                                 'branding_logo_invoices.png')
-    if os.path.isfile(branding_logo):
-        abs_url = '%s://%s/%s/%s' % (request.env.wsgi_url_scheme,
-                                     request.env.http_host,
-                                     'static',
-                        'plugin_os-branding/logos/branding_logo_invoices.png')
-        logo_img = IMG(_src=abs_url)
-
-    else:
-        logo_img = ''
-
-    return logo_img
-
-
 def pdf_template(iID):
     """
         Print friendly display of invoice
     """
-    response.view = 'templates/invoices/default.html'
-    iID = request.vars['iID']
+    invoice = Invoice(iID)
 
-    # get the invoice
-    invoice = db.invoices(iID)
-    # get invoice items
-    query = (db.invoices_items.invoices_id == iID)
-    items = db(query).select(db.invoices_items.ALL,
-                             orderby=db.invoices_items.Sorting).render()
-    # get customer info
-    # query = (db.invoices_customers.invoices_id == invoice.id)
-    # cuID = db(query).select(db.invoices_customers.auth_customer_id).first().auth_customer_id
-    # print cuID
-    #
-    # query = (db.auth_user.id == cuID)
-    # customer = db(query).select(db.auth_user.company,
-    #                             db.auth_user.first_name,
-    #                             db.auth_user.last_name,
-    #                             db.auth_user.address,
-    #                             db.auth_user.city,
-    #                             db.auth_user.postcode,
-    #                             db.auth_user.country,
-    #                             db.auth_user.email,
-    #                             db.auth_user.phone,
-    #                             db.auth_user.mobile).first()
-
-    # get amounts
-    query = (db.invoices_amounts.invoices_id == iID)
-    amounts = db(query).select(db.invoices_amounts.ALL)
-    amounts = list(amounts[0:1].render())[0] # make the generator output stuff
-
-    i = Invoice(iID)
-    amounts_vat = i.get_amounts_tax_rates(formatted=True)
-
-    # Company info
-    try:
-        organization = ORGANIZATIONS[ORGANIZATIONS['default']]
-
-        company_name = organization['Name']
-        company_address = organization['Address']
-        company_email = organization['Email'] or ''
-        company_phone = organization['Phone'] or ''
-        company_registration = organization['Registration'] or ''
-        company_tax_registration = organization['TaxRegistration'] or ''
-        company_terms_conditions_url = organization['TermsConditionsURL']
-    except KeyError:
-        company_name = ''
-        company_address = ''
-        company_email = ''
-        company_phone = ''
-        company_registration = ''
-        company_tax_registration = ''
-        company_terms_conditions_url = ''
-
-    studio = {}
-    studio['name']         = company_name
-    studio['address']      = XML(company_address)
-    studio['email']        = company_email
-    studio['phone']        = company_phone
-    studio['registration'] = company_registration
-    studio['tax_registration'] = company_tax_registration
-
-    base_url = 'http%s://%s' % (request.is_https and 's' or '',
-                                request.env.http_host)
-
-    logo = pdf_template_get_logo()
-
-    # print studio
-    # print invoice
-    # print items
-    # print amounts
-    # print amounts_vat
-    # print customer
-    # print logo
-    # print base_url
-
-    html = response.render('templates/invoices/default.html',
-                           dict(invoice     = invoice,
-                                items       = items,
-                                amounts     = amounts,
-                                amounts_vat = amounts_vat,
-                                studio      = studio,
-                                logo        = logo,
-                                base_url    = base_url))
-
-    return html
+    return invoice.get_pdf_template()
 
 
 # No decorator here, permissions are checked inside the function
@@ -1663,17 +1557,11 @@ def pdf():
     if not permission:
         return T("Not authorized")
 
-    html = pdf_template(iID)
-
     fname = 'Invoice_' + invoice.invoice.InvoiceID + '.pdf'
     response.headers['Content-Type']='application/pdf'
     response.headers['Content-disposition']='attachment; filename=' + fname
-    # return pyfpdf_from_html(html)
 
-    stream = io.BytesIO()
-    invoice = weasyprint.HTML(string=html).write_pdf(stream)
-
-    return stream.getvalue()
+    return invoice.get_pdf()
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -1704,25 +1592,22 @@ def export_invoices():
     if form.process().accepted:
         response.flash = T("Form accepted")
 
-        stream = export_invoices_get_export(
+        from openstudio.os_export import OsExport
+
+        rows = export_invoices_get_export(
             form.vars.from_date,
             form.vars.until_date,
             form.vars.invoices_groups_id,
-            form.vars.filetype,
             form.vars.include_subscriptions
         )
 
+        export = OsExport()
         if form.vars.filetype == 'excel':
-            fname = "Invoices.xlsx"
-            response.headers['Content-Type']='application/vnd.ms-excel'
-            response.headers['Content-disposition']='attachment; filename=' + fname
+            stream = export.excel([('Invoices', rows)])
+            return export.stream(stream, "Invoices.xlsx")
         else:
-            fname = "Invoices.csv"
-            response.headers['Content-Type']='text/csv'
-            response.headers['Content-disposition']='attachment; filename=' + fname
-
-        return stream.getvalue()
-        #response.stream(stream, attachment=True, filename=fname)
+            stream = export.csv(rows, delimiter='\t')
+            return export.stream(stream, "Invoices.csv", 'csv')
 
 
     # form.process() has to be called before creating a custom form
@@ -1739,22 +1624,11 @@ def export_invoices():
                 menu=menu)
 
 
-def export_invoices_get_export(from_date, until_date, invoices_groups_id, filetype='excel', include_subscriptions=True):
+def export_invoices_get_export(from_date, until_date, invoices_groups_id, include_subscriptions=True):
     """
         Invoices export
+        :return: generator of lists - header followed by a row for each invoice item
     """
-
-    if filetype == 'excel':
-        # create filestream
-        stream = io.BytesIO()
-        wb = openpyxl.workbook.Workbook(write_only=True)
-        ws = wb.create_sheet(title='Invoices')
-    else:
-        import csv
-        # create filestream
-        stream = io.StringIO()
-        csv_writer = csv.writer(stream, delimiter='\t')
-
     header = [
         'InvoiceID',
         'CustomerID',
@@ -1784,10 +1658,7 @@ def export_invoices_get_export(from_date, until_date, invoices_groups_id, filety
         'Payment date(s)'
     ]
 
-    if filetype == 'excel':
-        ws.append(header)
-    else:
-        csv_writer.writerow(header)
+    yield header
 
 
     where_query = "i.DateCreated >= '{from_date}'".format(from_date=from_date)
@@ -1856,18 +1727,7 @@ def export_invoices_get_export(from_date, until_date, invoices_groups_id, filety
         rows = db.executesql(query)
 
         for row in rows:
-            unicode_list = []
-            for item in row:
-                try:
-                    unicode_list.append(item.encode('utf-8'))
-                except:
-                    unicode_list.append(item)
-
-
-            if filetype == 'excel':
-                ws.append(unicode_list)
-            else:
-                csv_writer.writerow(unicode_list)
+            yield list(row)
 
 
         # While loop control
@@ -1876,12 +1736,6 @@ def export_invoices_get_export(from_date, until_date, invoices_groups_id, filety
         i += 1
 
 
-    if filetype == 'excel':
-        wb.save(stream)
-
-    return stream
-
-
 def export_invoices_payments_get_form(from_date_default, form_type='invoices'):
     """
         :param from_date_default: datetime.date
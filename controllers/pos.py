@@ -317,6 +317,42 @@ def get_class_booking_options():
     return dict(options = options)
 
 
+@auth.requires_login(otherwise=return_json_login_error)
+def get_class_booking_options_customers():
+    """
+    List booking options for a class for multiple customers
+    request.vars['cuIDs'] is a comma separated list of customer ids
+    :return: dict {cuID: options}
+    """
+    set_headers()
+    permission_result = check_permission()
+    if not permission_result['permission']:
+        return return_json_permissions_error()
+
+    from openstudio.os_attendance_helper import AttendanceHelper
+
+    clsID = request.vars['clsID']
+    cuIDs = request.vars['cuIDs'] or ''
+    if isinstance(cuIDs, list):
+        cuIDs = ','.join(cuIDs)
+    customer_ids = [int(cuID) for cuID in cuIDs.split(',') if cuID.strip().isdigit()]
+
+    complementary_permission = (auth.has_membership(group_id='Admins') or
+                                auth.has_permission('complementary', 'classes_attendance'))
+
+    ah = AttendanceHelper()
+    options = ah.get_customers_class_booking_options(
+        clsID,
+        TODAY_LOCAL,
+        customer_ids,
+        trial=True,
+        complementary=complementary_permission,
+        list_type='pos'
+    )
+
+    return dict(options = options)
+
+
 @auth.requires_login(otherwise=return_json_login_error)
 def customer_class_booking_create():
     """
@@ -784,7 +820,11 @@ def get_customers_thumbnail_url(row_data):
 @auth.requires_login(otherwise=return_json_login_error)
 def get_customers():
     """
-    Get non trashed customers from cache
+    Get non trashed customers from the customers directory
+    The version of the directory is returned in the X-Customers-Directory-Version
+    header, the body holds the customers for compatibility with existing clients.
+    Pass "since" with a version returned earlier to get changes since then, the
+    response then contains version, reload, customers (changed) & deleted (ids)
     """
     # forget session
     set_headers()
@@ -794,76 +834,99 @@ def get_customers():
 
     session.forget(response)
 
+    since = request.vars['since']
+    if since:
+        return _get_customers(since)
+
     # Don't cache when running tests
     if web2pytest.is_running_under_test(request, request.application):
         data = _get_customers()
     else:
-        cache_key = 'openstudio_pos_get_customers'
-        data = cache.ram(cache_key,
-                         lambda: _get_customers(),
-                         time_expire=600)
+        # The version changes with every change to a customer, so entries
+        # for old versions are never served again and simply expire
+        from openstudio.os_pos_customers_directory import PosCustomersDirectory
 
-    return data
+        version = PosCustomersDirectory().get_version()
+        cache_key = 'openstudio_pos_get_customers_directory_' + str(version)
+        data = os_cache_manager.get_tagged(cache_key,
+                                           lambda: _get_customers(),
+                                           ['pos_customers'],
+                                           time_expire=600)
 
+    response.headers['X-Customers-Directory-Version'] = str(data['version'])
+    response.headers['Access-Control-Expose-Headers'] = 'X-Customers-Directory-Version'
 
-def _get_customers(var=None):
+    return data['customers']
+
+
+@auth.requires_login(otherwise=return_json_login_error)
+def search_customers():
     """
-    List not trashed customers
+    Prefix search for customers on name, email & barcode id
     """
-    query = (db.auth_user.customer == True) & \
-            (db.auth_user.trashed == False)
+    set_headers()
+    permission_result = check_permission()
+    if not permission_result['permission']:
+        return return_json_permissions_error()
 
-    rows = db(query).select(
-        db.auth_user.id,
-        db.auth_user.first_name,
-        db.auth_user.last_name,
-        db.auth_user.display_name,
-        db.auth_user.email,
-        # db.auth_user.gender,
-        db.auth_user.date_of_birth,
-        # db.auth_user.address,
-        # db.auth_user.postcode,
-        # db.auth_user.city,
-        # db.auth_user.country,
-        # db.auth_user.phone,
-        db.auth_user.mobile,
-        # db.auth_user.emergency,
-        # db.auth_user.company,
-        db.auth_user.thumbsmall,
-        db.auth_user.thumblarge,
-        db.auth_user.barcode_id,
-    )
+    from openstudio.os_pos_customers_directory import PosCustomersDirectory
 
-    customers = {}
+    session.forget(response)
 
-    for row in rows:
-        date_of_birth = None
-        if row.date_of_birth:
-            date_of_birth = row.date_of_birth.strftime(DATE_FORMAT)
+    try:
+        limit = min(int(request.vars['limit'] or 20), 100)
+    except ValueError:
+        limit = 20
+
+    directory = PosCustomersDirectory()
+    rows = directory.search(request.vars['search'], limit=limit)
+
+    return dict(customers=[_get_customers_directory_data(row) for row in rows])
 
-        customers[row.id] = {
-            'id': row.id,
-            'first_name': row.first_name,
-            'last_name': row.last_name,
-            'display_name': row.display_name,
-            'search_name': row.display_name.lower() if row.display_name else "",
-            'email': row.email,
-            # 'gender': row.gender,
-            'date_of_birth': date_of_birth,
-            # 'address': row.address,
-            # 'postcode': row.postcode,
-            # 'city': row.city,
-            # 'country': row.country,
-            # 'phone': row.phone,
-            'mobile': row.mobile,
-            # 'emergency': row.emergency,
-            # 'company': row.company,
-            'thumbsmall': get_customers_thumbnail_url(row.thumbsmall),
-            'thumblarge': get_customers_thumbnail_url(row.thumblarge),
-            'barcode_id': row.barcode_id
-        }
 
-    return customers
+def _get_customers_directory_data(row):
+    """
+    :param row: gluon.dal.row of db.pos_customers_directory
+    :return: dict - customer data
+    """
+    date_of_birth = None
+    if row.date_of_birth:
+        date_of_birth = row.date_of_birth.strftime(DATE_FORMAT)
+
+    return {
+        'id': row.auth_user_id,
+        'first_name': row.first_name,
+        'last_name': row.last_name,
+        'display_name': row.display_name,
+        'search_name': row.search_name or "",
+        'email': row.email,
+        'date_of_birth': date_of_birth,
+        'mobile': row.mobile,
+        'thumbsmall': get_customers_thumbnail_url(row.thumbsmall),
+        'thumblarge': get_customers_thumbnail_url(row.thumblarge),
+        'barcode_id': row.barcode_id
+    }
+
+
+def _get_customers(since=None):
+    """
+    List not trashed customers
+    :param since: version of directory; when set, return only changes since that version
+    :return: dict with keys version, reload, customers & deleted
+    """
+    from openstudio.os_pos_customers_directory import PosCustomersDirectory
+
+    directory = PosCustomersDirectory()
+    changes = directory.get_changes(since)
+
+    customers = {}
+    for row in changes['customers']:
+        customers[row.auth_user_id] = _get_customers_directory_data(row)
+
+    return dict(version=changes['version'],
+                reload=changes['reload'],
+                customers=customers,
+                deleted=changes['deleted'])
 
 
 @auth.requires_login(otherwise=return_json_login_error)
@@ -1272,7 +1335,7 @@ def delete_class_attendance():
     cache_clear_customers_classcards(cuID)
 
     # Clear api cache to refresh available spaces
-    cache_clear_classschedule_api()
+    cache_clear_classschedule_api(date=clatt.ClassDate)
 
 
     if clatt.customers_classcards_id:
@@ -1293,16 +1356,11 @@ def create_customer():
     if not permission_result['permission']:
         return return_json_permissions_error()
 
-    from openstudio.os_cache_manager import OsCacheManager
-
-    ocm = OsCacheManager()
-
     db.auth_user.password.requires = None
     print(request.vars)
 
     result = db.auth_user.validate_and_insert(**request.vars)
     print(result)
-    ocm.clear_customers()
 
     customer_data = ''
     error = False
@@ -1353,10 +1411,6 @@ def update_customer():
     if not permission_result['permission']:
         return return_json_permissions_error()
 
-    from openstudio.os_cache_manager import OsCacheManager
-
-    ocm = OsCacheManager()
-
     db.auth_user.password.requires = None
     print(request.vars)
 
@@ -1387,7 +1441,6 @@ def update_customer():
     if cuID:
         query = (db.auth_user.id == cuID)
         result = db(query).validate_and_update(**request.vars)
-        ocm.clear_customers()
         print(result)
         error = False
         if result.errors:
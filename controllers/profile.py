@@ -593,13 +593,8 @@ def me():
                    formstyle='divs')
 
     if form.process().accepted:
-        from openstudio.os_cache_manager import OsCacheManager
         response.flash = T('Saved')
 
-
-        ocm = OsCacheManager()
-        ocm.clear_customers()
-
         if _next:
             redirect(_next)
 
@@ -1955,6 +1950,7 @@ def privacy_download():
     :return: xlsx document containing all data of an account
     """
     from openstudio.os_customer_export import CustomerExport
+    from openstudio.os_export import OsExport
 
     # Check whether the privacy feature is enabled
     features = db.customers_profile_features(1)
@@ -1965,10 +1961,8 @@ def privacy_download():
     stream = ce.excel()
 
     fname = 'customer_data.xlsx'
-    response.headers['Content-Type'] = 'application/vnd.ms-excel'
-    response.headers['Content-disposition'] = 'attachment; filename=' + fname
 
-    return stream.getvalue()
+    return OsExport().stream(stream, fname)
 
 
 @auth.requires_login()
@@ -4,6 +4,7 @@ from general_helpers import datestr_to_python
 from general_helpers import get_label
 from general_helpers import get_submenu
 from general_helpers import get_months_list
+from general_helpers import NRtoMonth
 from general_helpers import get_last_day_month
 from general_helpers import get_classname
 from general_helpers import User_helpers
@@ -1667,6 +1668,7 @@ def subscriptions_new_export_mailinglist():
     :return:
     """
     from openstudio.os_reports import Reports
+    from openstudio.os_export import OsExport
 
     reports = Reports()
 
@@ -1704,26 +1706,14 @@ def subscriptions_new_export_mailinglist():
      ]
     rows = db.executesql(query, fields=fields)
 
-    # create filestream
-    stream = io.BytesIO()
-
-    # Create the workbook
-    wb = openpyxl.workbook.Workbook(write_only=True)
-    ws = wb.create_sheet(title='Mailinglist')
-
-
-    for row in rows:
-        ws.append([row.auth_user.first_name,
-                   row.auth_user.last_name,
-                   row.auth_user.email])
+    mailinglist = [[row.auth_user.first_name,
+                    row.auth_user.last_name,
+                    row.auth_user.email] for row in rows]
 
+    export = OsExport()
     fname = T("Mailinglist") + '.xlsx'
-    wb.save(stream)
-
-    response.headers['Content-Type']='application/vnd.ms-excel'
-    response.headers['Content-disposition']='attachment; filename=' + fname
 
-    return stream.getvalue()
+    return export.stream(export.excel([('Mailinglist', mailinglist)]), fname)
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -2255,31 +2245,22 @@ def subscriptions_overview_export_mailinglist():
     """
         Export mailinglist based on subscriptions overview
     """
+    from openstudio.os_export import OsExport
+
     ssuID = request.vars['ssuID']
     year  = session.reports_subscriptions_year
     month = session.reports_subscriptions_month
 
-    # create filestream
-    stream = io.BytesIO()
-
-    # Create the workbook
-    wb = openpyxl.workbook.Workbook(write_only=True)
-    ws = wb.create_sheet(title='Mailinglist')
-
     rows = subscriptions_overview_customers_get_rows(ssuID)
 
-    for row in rows:
-        ws.append([row.auth_user.first_name,
-                   row.auth_user.last_name,
-                   row.auth_user.email])
+    mailinglist = [[row.auth_user.first_name,
+                    row.auth_user.last_name,
+                    row.auth_user.email] for row in rows]
 
+    export = OsExport()
     fname = T("Mailinglist") + '.xlsx'
-    wb.save(stream)
-
-    response.headers['Content-Type']='application/vnd.ms-excel'
-    response.headers['Content-disposition']='attachment; filename=' + fname
 
-    return stream.getvalue()
+    return export.stream(export.excel([('Mailinglist', mailinglist)]), fname)
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -2943,6 +2924,10 @@ def attendance_classes_get_content(date_start, date_end, slID, soID):
                           TH('Revenue'),
                           TH()))
     table = TABLE(header, _class='table table-hover table-striped')
+
+    reports = Reports()
+    classes_revenue = reports.get_classes_revenue(date_start, date_end)
+
     # Find all classes starting on the first day of the month
     while current_date <= date_end:
         # get list of today's classes.
@@ -2957,7 +2942,9 @@ def attendance_classes_get_content(date_start, date_end, slID, soID):
         rows = class_schedule.get_day_rows()
         for i, row in enumerate(rows):
             repr_row = list(rows[i:i + 1].render())[0]
-            revenue = teacher_classes_get_class_revenue_total(row.classes.id, current_date)
+            revenue = teacher_classes_get_class_revenue_from_totals(classes_revenue,
+                                                                    row.classes.id,
+                                                                    current_date)
 
             if row.classes_otc.Status == 'cancelled':
                 if row.classes_otc.Description:
@@ -5443,6 +5430,14 @@ def teacher_classes():
         revenue_ex_vat = 0
         revenue_vat = 0
 
+        classes_revenue = {}
+        if revenue_permission:
+            reports = Reports()
+            classes_revenue = reports.get_classes_revenue(
+                datetime.date(date.year, date.month, 1),
+                last_day
+            )
+
         for each_day in range(1,last_day.day+1):
             # list days
             day = datetime.date(session.reports_te_classes_year,
@@ -5465,7 +5460,9 @@ def teacher_classes():
                 class_revenue = ''
                 if revenue_permission:
                     result = class_schedule._get_day_row_teacher_roles(row, repr_row)
-                    revenue = teacher_classes_get_class_revenue_total(row.classes.id, day)
+                    revenue = teacher_classes_get_class_revenue_from_totals(classes_revenue,
+                                                                            row.classes.id,
+                                                                            day)
                     revenue_in_vat += revenue['revenue_in_vat']
                     revenue_ex_vat += revenue['revenue_ex_vat']
                     revenue_vat += revenue['revenue_vat']
@@ -5601,40 +5598,33 @@ def teacher_classes_class_revenue():
 
     table = TABLE(header, _class='table table-hover teacher-classes-revenue')
 
+    clsID = int(clsID)
+    reports = Reports()
+    attendance_revenue = reports.get_classes_revenue_attendance(date, date, [clsID])
+
+    zero = dict(revenue_in_vat=Decimal(0),
+                revenue_ex_vat=Decimal(0),
+                revenue_vat=Decimal(0))
+    total = dict(zero)
+
     rows = teacher_classes_get_class_revenue_rows(clsID, date)
     for i, row in enumerate(rows):
         repr_row = list(rows[i:i + 1].render())[0]
 
-        ex_vat = 0
-        vat = 0
-        in_vat = 0
+        revenue = attendance_revenue.get(row.classes_attendance.id, zero)
+        ex_vat = revenue['revenue_ex_vat']
+        vat = revenue['revenue_vat']
+        in_vat = revenue['revenue_in_vat']
+        for key in total:
+            total[key] += revenue[key]
+
         description = ''
         if row.classes_attendance.AttendanceType is None:
             # Subscription
-            revenue = teacher_classes_get_class_revenue_subscription(row, date)
-            ex_vat = revenue['revenue_ex_vat']
-            vat = revenue['revenue_vat']
-            in_vat = revenue['revenue_in_vat']
             description = SPAN(repr_row.customers_subscriptions.school_subscriptions_id,
                                _title=row.customers_subscriptions.id)
-        elif row.classes_attendance.AttendanceType == 1:
-            # Trial
-            revenue = teacher_classes_get_class_revenue_dropin_trial(row, date)
-            ex_vat = revenue['revenue_ex_vat']
-            vat = revenue['revenue_vat']
-            in_vat = revenue['revenue_in_vat']
-        elif row.classes_attendance.AttendanceType == 2:
-            # Drop in
-            revenue = teacher_classes_get_class_revenue_dropin_trial(row, date)
-            ex_vat = revenue['revenue_ex_vat']
-            vat = revenue['revenue_vat']
-            in_vat = revenue['revenue_in_vat']
         elif row.classes_attendance.AttendanceType == 3:
             # Class pass
-            revenue = teacher_classes_get_class_revenue_classcard(row)
-            ex_vat = revenue['revenue_ex_vat']
-            vat = revenue['revenue_vat']
-            in_vat = revenue['revenue_in_vat']
             description = SPAN(repr_row.customers_classcards.school_classcards_id,
                                _title=T('Card') +  ' ' + str(row.customers_classcards.id))
 
@@ -5649,17 +5639,14 @@ def teacher_classes_class_revenue():
 
         table.append(tr)
 
-
-
     # totals
-    result = teacher_classes_get_class_revenue_total(clsID, date)
     tfoot = TFOOT(TR(TD(),
                      TD(),
                      TD(),
                      TH(T('Total')),
-                     TH(SPAN(CURRSYM, ' ', format(result['revenue_ex_vat'], '.2f'))),
-                     TH(SPAN(CURRSYM, ' ', format(result['revenue_vat'], '.2f'))),
-                     TH(SPAN(CURRSYM, ' ', format(result['revenue_in_vat'], '.2f'))),
+                     TH(SPAN(CURRSYM, ' ', format(total['revenue_ex_vat'], '.2f'))),
+                     TH(SPAN(CURRSYM, ' ', format(total['revenue_vat'], '.2f'))),
+                     TH(SPAN(CURRSYM, ' ', format(total['revenue_in_vat'], '.2f'))),
                      ))
 
     table.append(tfoot)
@@ -5698,231 +5685,16 @@ def teacher_classes_get_class_revenue_rows(clsID, date):
     return rows
 
 
-def teacher_classes_get_class_revenue_total(clsID, date):
+def teacher_classes_get_class_revenue_from_totals(classes_revenue, clsID, date):
     """
+    :param classes_revenue: dict returned by Reports.get_classes_revenue()
     :param clsID: db.classes.id
     :param date: class date
     :return: total revenue
     """
-    rows = teacher_classes_get_class_revenue_rows(clsID, date)
-
-    total_revenue_in_vat = Decimal(0)
-    total_revenue_ex_vat = Decimal(0)
-    total_revenue_vat = Decimal(0)
-
-    for row in rows:
-        if row.classes_attendance.AttendanceType is None:
-            # Subscription
-            result = teacher_classes_get_class_revenue_subscription(row, date)
-            total_revenue_in_vat += result['revenue_in_vat']
-            total_revenue_ex_vat += result['revenue_ex_vat']
-            total_revenue_vat += result['revenue_vat']
-        elif row.classes_attendance.AttendanceType == 1:
-            # Trial
-            result = teacher_classes_get_class_revenue_dropin_trial(row, date)
-            total_revenue_in_vat += result['revenue_in_vat']
-            total_revenue_ex_vat += result['revenue_ex_vat']
-            total_revenue_vat += result['revenue_vat']
-        elif row.classes_attendance.AttendanceType == 2:
-            # Drop in
-            result = teacher_classes_get_class_revenue_dropin_trial(row, date)
-            total_revenue_in_vat += result['revenue_in_vat']
-            total_revenue_ex_vat += result['revenue_ex_vat']
-            total_revenue_vat += result['revenue_vat']
-        elif row.classes_attendance.AttendanceType == 3:
-            # Class card
-            result = teacher_classes_get_class_revenue_classcard(row)
-            total_revenue_in_vat += result['revenue_in_vat']
-            total_revenue_ex_vat += result['revenue_ex_vat']
-            total_revenue_vat += result['revenue_vat']
-
-    return dict(revenue_in_vat = total_revenue_in_vat,
-                revenue_ex_vat = total_revenue_ex_vat,
-                revenue_vat = total_revenue_vat)
-
-
-def teacher_classes_get_class_revenue_classcard(row):
-    """
-        :param row: row from db.classes_attendance with left join on db.customers_subscriptions
-        :return: Revenue for class taken on a card
-    """
-    ccdID = row.classes_attendance.customers_classcards_id
-    classcard = CustomerClasscard(ccdID)
-
-    query = (db.invoices_items_customers_classcards.customers_classcards_id == ccdID)
-    left = [
-        db.invoices_items.on(
-            db.invoices_items.invoices_id ==
-            db.invoices.id
-        ),
-        db.invoices_items_customers_classcards.on(
-            db.invoices_items_customers_classcards.invoices_items_id ==
-            db.invoices_items.id
-        )
-    ]
-
-    rows = db(query).select(
-        db.invoices_items.invoices_id,
-        db.invoices_items_customers_classcards.ALL,
-        left=left
-    )
-
-    if not rows:
-        revenue_in_vat = 0
-        revenue_ex_vat = 0
-        revenue_vat = 0
-    else:
-        row = rows.first()
-        invoice = Invoice(row.invoices_items.invoices_id)
-
-        amounts = invoice.get_amounts()
-
-        price_in_vat = amounts.TotalPriceVAT
-        price_ex_vat = amounts.TotalPrice
-
-        # Divide by classes taken on card
-        if classcard.unlimited:
-            # Count all classes taken on card
-            query = (db.classes_attendance.customers_classcards_id == ccdID)
-            count_classes = db(query).count()
-
-            revenue_in_vat = price_in_vat / count_classes
-            revenue_ex_vat = price_ex_vat / count_classes
-            revenue_vat = revenue_in_vat - revenue_ex_vat
-        else:
-            revenue_in_vat = price_in_vat / classcard.classes
-            revenue_ex_vat = price_ex_vat / classcard.classes
-            revenue_vat = revenue_in_vat - revenue_ex_vat
-
-    return dict(revenue_in_vat=revenue_in_vat,
-                revenue_ex_vat=revenue_ex_vat,
-                revenue_vat=revenue_vat)
-
-
-def teacher_classes_get_class_revenue_dropin_trial(row, date):
-    """
-        :param row: row from db.classes_attendance with left join on db.customers_subscriptions
-        :param date: date of class
-        :param product_type: 'dropin' or 'trial'
-        :return : revenue for a drop in or trial class
-    """
-    query = (db.invoices_items_classes_attendance.classes_attendance_id == row.classes_attendance.id)
-    left = [
-        db.invoices_items.on(
-            db.invoices_items_classes_attendance.invoices_items_id ==
-            db.invoices_items.id
-        )
-    ]
-    rows = db(query).select(
-        db.invoices_items.ALL,
-        left=left
-    )
-
-    if not rows:
-        price_in_vat = 0
-        price_ex_vat = 0
-        vat = 0
-    else:
-        invoice_item = rows.first()
-
-        price_in_vat = invoice_item.TotalPriceVAT
-        price_ex_vat = invoice_item.TotalPrice
-        vat = invoice_item.VAT
-
-
-
-    # cls = Class(row.classes_attendance.classes_id, date)
-    # prices = cls.get_price()
-    #
-    # if product_type == 'dropin':
-    #     price_in_vat = prices['dropin']
-    #     tax_percentage = prices['dropin_tax_percentage']
-    #     tax_rates_id = prices['dropin_tax_rates_id']
-    #
-    # elif product_type == 'trial':
-    #     price_in_vat = prices['trial']
-    #     tax_percentage = prices['trial_tax_percentage']
-    #     tax_rates_id = prices['dropin_tax_rates_id']
-    #
-    # if not price_in_vat:
-    #     # Check if a price is defined
-    #     price_in_vat = 0
-    #     price_ex_vat = 0
-    #     vat = 0
-    # else:
-    #     if tax_percentage:
-    #         # Check if a vat percentage is defined
-    #         price_ex_vat = price_in_vat / (1 + (tax_percentage / 100))
-    #         vat = price_in_vat - price_ex_vat
-    #     else:
-    #         price_ex_vat = price_in_vat
-    #         vat = 0
-
-    return dict(revenue_in_vat=price_in_vat or 0,
-                revenue_ex_vat=price_ex_vat or 0,
-                revenue_vat=vat or 0)
-
-
-def teacher_classes_get_class_revenue_subscription(row, date):
-    """
-        :param row: row from db.classes_attendance with left join on db.customers_subscriptions
-        :return: Revenue by subscription
-    """
-    first_day = datetime.date(date.year, date.month, 1)
-    last_day  = get_last_day_month(date)
-
-    # Get number of classes on subscription this month
-    query = (db.classes_attendance.customers_subscriptions_id == row.customers_subscriptions.id) & \
-            (db.classes_attendance.ClassDate >= first_day) & \
-            (db.classes_attendance.ClassDate <= last_day)
-    classes_taken = db(query).count()
-    # Get price for subscription invoice
-
-    csID = row.customers_subscriptions.id
-    subscr_month = date.month
-    subscr_year  = date.year
-
-    query = (db.invoices_items_customers_subscriptions.customers_subscriptions_id == csID) & \
-            (db.invoices.SubscriptionMonth == subscr_month) & \
-            (db.invoices.SubscriptionYear == subscr_year)
-
-    left = [
-        db.invoices_amounts.on(
-            db.invoices_amounts.invoices_id ==
-            db.invoices.id
-        ),
-        db.invoices_items.on(
-            db.invoices_items.invoices_id ==
-            db.invoices.id
-        ),
-        db.invoices_items_customers_subscriptions.on(
-             db.invoices_items_customers_subscriptions.invoices_items_id ==
-             db.invoices_items.id
-        )
-    ]
-
-    rows = db(query).select(db.invoices.ALL,
-                            db.invoices_amounts.ALL,
-                            left=left)
-
-    if not rows:
-        revenue_in_vat = 0
-        revenue_ex_vat = 0
-        revenue_vat = 0
-    else:
-        row = rows.first()
-        price_in_vat = row.invoices_amounts.TotalPriceVAT
-        price_ex_vat = row.invoices_amounts.TotalPrice
-
-        # Divide by classes taken on subscription in month
-        revenue_in_vat = price_in_vat / classes_taken
-        revenue_ex_vat = price_ex_vat / classes_taken
-        revenue_vat = revenue_in_vat - revenue_ex_vat
-
-
-    return dict(revenue_in_vat = revenue_in_vat,
-                revenue_ex_vat = revenue_ex_vat,
-                revenue_vat = revenue_vat)
+    return classes_revenue.get((clsID, date), dict(revenue_in_vat = Decimal(0),
+                                                   revenue_ex_vat = Decimal(0),
+                                                   revenue_vat = Decimal(0)))
 
 
 @auth.requires(auth.has_membership(group_id='Admins') or \
@@ -6143,6 +5915,7 @@ def retention_get_menu(page=None):
     pages = [
         (['retention_rate', T('Retention rate'), URL('reports',"retention_rate")]),
         (['dropoff_rate', T('Drop off rate'), URL('reports',"dropoff_rate")]),
+        (['retention_cohorts', T('Cohorts'), URL('reports',"retention_cohorts")]),
         ]
 
     return get_submenu(pages,
@@ -6151,20 +5924,171 @@ def retention_get_menu(page=None):
                        htype='tabs')
 
 
+@auth.requires(auth.has_membership(group_id='Admins') or \
+               auth.has_permission('read', 'reports_retention'))
+def retention_cohorts():
+    """
+        Cohorts of customers by month of their first class, with the
+        percentage of each cohort attending classes in the following months
+    """
+    from openstudio.os_retention import OsRetention
+
+    response.title = T('Reports')
+    response.subtitle = T('Retention cohorts')
+    response.view = 'reports/subscriptions.html'
+
+    first_day_this_month = datetime.date(TODAY_LOCAL.year, TODAY_LOCAL.month, 1)
+    date_from_default = datetime.date(TODAY_LOCAL.year - 1, TODAY_LOCAL.month, 1)
+    date_until_default = first_day_this_month - datetime.timedelta(days=1)
+
+    date_from = retention_get_parameter_or_session('date_from', date_from_default, 'reports_rc_date_from')
+    date_until = retention_get_parameter_or_session('date_until', date_until_default, 'reports_rc_date_until')
+
+    horizons = [6, 12, 24, 36]
+    if 'horizon' in request.vars:
+        session.reports_rc_horizon = int(request.vars['horizon'])
+    horizon = session.reports_rc_horizon or 12
+
+    form = SQLFORM.factory(
+        Field('date_from', 'date',
+              default=date_from,
+              requires=IS_DATE_IN_RANGE(format=DATE_FORMAT,
+                                        minimum=datetime.date(1900, 1, 1),
+                                        maximum=datetime.date(2999, 1, 1)),
+              represent=represent_date,
+              label=T('First cohort')),
+        Field('date_until', 'date',
+              default=date_until,
+              requires=IS_DATE_IN_RANGE(format=DATE_FORMAT,
+                                        minimum=datetime.date(1900, 1, 1),
+                                        maximum=datetime.date(2999, 1, 1)),
+              represent=represent_date,
+              label=T('Last cohort')),
+        Field('horizon', 'integer',
+              default=horizon,
+              requires=IS_IN_SET(horizons, zero=None),
+              label=T('Months')),
+        submit_button=T("Run report"),
+        formstyle='divs'
+        )
+
+    submit = form.element('input[type=submit]')
+    submit['_class'] = ' pull-right'
+
+    form = DIV(DIV(LABEL(form.custom.label.date_from),
+                   form.custom.widget.date_from,
+                   _class='col-md-3'),
+               DIV(LABEL(form.custom.label.date_until),
+                   form.custom.widget.date_until,
+                   _class="col-md-3"),
+               DIV(LABEL(form.custom.label.horizon),
+                   form.custom.widget.horizon,
+                   _class="col-md-3"),
+               _class='row')
+
+    retention = OsRetention()
+    cohorts = retention.get_cohorts(date_from, date_until, horizon)
+
+    info = SPAN(T('Customers by month of their first class using a subscription or class card, '
+                  'and the percentage of them attending classes in the months after.'),
+                _class='grey')
+    content = DIV(info, retention_cohorts_get_table(cohorts, retention.get_curve(cohorts)))
+
+    menu = retention_get_menu(request.function)
+
+    links = [A(SPAN(os_gui.get_fa_icon('fa-table'), ' ',
+                    T('Retention cohorts')),
+               _href=URL('retention_cohorts_export'))]
+
+    export = os_gui.get_dropdown_menu(
+        links=links,
+        btn_text='',
+        btn_icon='download',
+        menu_class='pull-right')
+
+    return dict(form=form,
+                menu=menu,
+                content=content,
+                export=export,
+                run_report=submit)
+
+
+def retention_cohorts_get_table(cohorts, curve):
+    """
+        Builds the cohort table for the retention cohorts page
+
+        :param cohorts: list of dicts returned by OsRetention.get_cohorts()
+        :param curve: list of dicts returned by OsRetention.get_curve()
+    """
+    def format_rate(rate):
+        return format(rate * 100, '.2f') + '%'
+
+    header = THEAD(TR(TH(T('Cohort')), TH(T('Customers'))))
+    for offset in range(len(curve)):
+        header[0].append(TH(T('Month'), ' ', offset))
+
+    table = TABLE(header, _class="table table-hover table-condensed small")
+
+    for cohort in cohorts:
+        tr = TR(TD(NRtoMonth(cohort['month'].month), ' ', cohort['month'].year),
+                TD(cohort['size']))
+        for active, rate in zip(cohort['active'], cohort['retention']):
+            if active is None:
+                tr.append(TD())
+            else:
+                tr.append(TD(format_rate(rate), _title=active))
+        table.append(tr)
+
+    retention = TR(TH(T('Retention')), TH())
+    dropoff = TR(TH(T('Drop off')), TH())
+    for point in curve:
+        retention.append(TH(format_rate(point['retention']), _title=point['active']))
+        dropoff.append(TH(format_rate(point['dropoff'])))
+
+    table.append(TFOOT(retention, dropoff))
+
+    return table
+
+
 @auth.requires(auth.has_membership(group_id='Admins') or \
                    auth.has_permission('read', 'reports_retention'))
-def retention_rate_export():
+def retention_cohorts_export():
     """
-        Exports the retention or the dropoff based on the session parameters
+        Exports the retention cohorts based on the session parameters
     """
-    # create filestream
-    stream = io.BytesIO()
+    from openstudio.os_export import OsExport
+    from openstudio.os_retention import OsRetention
 
-    # init the workbook and the two sheets
-    wb = openpyxl.workbook.Workbook(write_only=True)
+    if not session.reports_rc_date_from:
+        redirect(URL('retention_cohorts'))
 
-    # compute the retention based on the parameters
-    helper = AttendanceHelper()
+    retention = OsRetention()
+    cohorts = retention.get_cohorts(session.reports_rc_date_from,
+                                    session.reports_rc_date_until,
+                                    session.reports_rc_horizon or 12)
+    horizon = range(len(cohorts[0]['active'])) if cohorts else []
+
+    def get_sheet(key):
+        yield ['Cohort', 'Customers'] + ['Month %s' % offset for offset in horizon]
+        for cohort in cohorts:
+            yield [cohort['month'].strftime('%Y-%m'), cohort['size']] + cohort[key]
+
+    sheets = [("Retention", get_sheet('retention')),
+              ("Customers", get_sheet('active'))]
+
+    export = OsExport()
+    fname = T("Retention cohorts") + '.xlsx'
+
+    return export.stream(export.excel(sheets), fname)
+
+
+@auth.requires(auth.has_membership(group_id='Admins') or \
+                   auth.has_permission('read', 'reports_retention'))
+def retention_rate_export():
+    """
+        Exports the retention or the dropoff based on the session parameters
+    """
+    from openstudio.os_export import OsExport
 
     # attendee lists for both windows
     attendees_first_window, attendees_second_window = retention_get_windows(session.reports_rr_p1_start,
@@ -6174,22 +6098,17 @@ def retention_rate_export():
 
     intersection = set(attendees_first_window) & set(attendees_second_window)
 
-    # export the loyal customers
-    retention_export_table("Retention", intersection, wb)
+    # the loyal customers
+    sheets = [("Retention", retention_export_table(intersection))]
 
-    # export the dropped off customers
+    # the dropped off customers
     dropped_off_customers = set(attendees_first_window) - set(intersection)
-    retention_export_table("Drop off", dropped_off_customers, wb)
-
-    # save the workbook to the stream
-    wb.save(stream)
+    sheets.append(("Drop off", retention_export_table(dropped_off_customers)))
 
-    # set the response headers
+    export = OsExport()
     fname = T("Retention rate") + '.xlsx'
-    response.headers['Content-Type']='application/vnd.ms-excel'
-    response.headers['Content-disposition']='attachment; filename=' + fname
 
-    return stream.getvalue()
+    return export.stream(export.excel(sheets), fname)
 
 
 def retention_get_windows(p1_start, p1_end, p2_start, p2_end):
@@ -6205,41 +6124,45 @@ def retention_get_windows(p1_start, p1_end, p2_start, p2_end):
     return attendees_first_window, attendees_second_window
 
 
-def retention_export_table(title, customer_ids, workbook):
+def retention_export_table(customer_ids, chunk_size=1000):
     """
         Exports the retention data
 
-        :param title: the title of the sheet where the data is exported
         :param customer_ids the customers to export
-        :param workbook: the workbook that will contain the sheet
+        :param chunk_size: number of customers to select at once
+        :return: generator of lists - header followed by a row for each customer
     """
-    sheet = workbook.create_sheet(title=title)
-
-    headers = [
+    yield [
         'Customer ID',
         'Customer Name',
         'Email',
         'Last Date'
     ]
 
-    sheet.append(headers)
-
     helper = AttendanceHelper()
 
-    rows = db(db.auth_user.id.belongs(customer_ids)).select(db.auth_user.ALL,
+    # Select customers in chunks, in order of name
+    rows = db(db.auth_user.id.belongs(customer_ids)).select(db.auth_user.id,
                                                             orderby=db.auth_user.display_name)
+    customer_ids = [row.id for row in rows]
 
-    last_attendances = helper.get_last_attendance(customer_ids)
+    for i in range(0, len(customer_ids), chunk_size):
+        ids = customer_ids[i:i + chunk_size]
 
-    for row in rows:
-        fields = [
-            row.id,
-            row.display_name,
-            row.email,
-            last_attendances[row.id]
-        ]
+        rows = db(db.auth_user.id.belongs(ids)).select(db.auth_user.id,
+                                                       db.auth_user.display_name,
+                                                       db.auth_user.email,
+                                                       orderby=db.auth_user.display_name)
+
+        last_attendances = helper.get_last_attendance(ids)
 
-        sheet.append(fields)
+        for row in rows:
+            yield [
+                row.id,
+                row.display_name,
+                row.email,
+                last_attendances[row.id]
+            ]
 
 
 def retention_get_parameter_or_session(parameter, default_value, session_parameter=None):
@@ -6369,7 +6292,28 @@ def customers_inactive_delete():
     date = datestr_to_python(DATE_FORMAT, date_formatted)
 
     customers = Customers()
-    nr_deleted = customers.delete_inactive_after_date(date)
+    chunk_size = 500
+    ids = customers.list_inactive_ids_after_date(date)
+    if len(ids) > chunk_size:
+        # Delete in the background, in chunks
+        scheduler.queue_task(
+            'customers_inactive_delete',
+            pvars={
+                'date': date.strftime('%Y-%m-%d'),
+                'chunk_size': chunk_size,
+            },
+            stop_time=datetime.datetime.now() + datetime.timedelta(hours=1),
+            last_run_time=datetime.datetime(1963, 8, 28, 14, 30),
+            timeout=3600, # run for max. one hour.
+        )
+
+        session.flash = SPAN(
+            T("Started deleting customers.. "),
+            T("please refresh this page in a few minutes.")
+        )
+    else:
+        nr_deleted = customers.delete_inactive_after_date(date, chunk_size=chunk_size, ids=ids)
+
+        session.flash = SPAN(T("Deleted"), ' ', nr_deleted, ' ', T('customers'))
 
-    session.flash = SPAN(T("Deleted"), ' ', nr_deleted, ' ', T('customers'))
     redirect(URL('customers_inactive'))
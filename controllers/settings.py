@@ -42,7 +42,10 @@ def system_get_menu(page):
         URL('system_organizations')],
         ['system_workflow',
         T('Workflow'),
-        URL('system_workflow')]
+        URL('system_workflow')],
+        ['system_database',
+        T('Database'),
+        URL('system_database')]
     ]
 
     return os_gui.get_submenu(pages, page, horizontal=True, htype='tabs')
@@ -322,6 +325,74 @@ def system_storage():
                 left_sidebar_enabled=True)
 
 
+@auth.requires(auth.has_membership(group_id='Admins') or
+               auth.has_permission('read', 'settings'))
+def system_database():
+    """
+        Shows declared secondary indexes and query plans of hot queries
+    """
+    response.title = T("System Settings")
+    response.subtitle = T("Database")
+    response.view = 'general/tabs_menu.html'
+
+    table = TABLE(THEAD(TR(TH(T("Table")),
+                           TH(T("Fields")),
+                           TH(T("Index")),
+                           TH(T("Status")))),
+                  _class='table table-striped table-hover')
+    for name, tablename, fields in os_db_indexes.get_declared():
+        if os_db_indexes.exists(name, tablename):
+            status = os_gui.get_label('success', T("Created"))
+        else:
+            status = os_gui.get_label('warning', T("Missing"))
+
+        table.append(TR(TD(tablename),
+                        TD(', '.join(fields)),
+                        TD(name),
+                        TD(status)))
+
+    apply = os_gui.get_button('noicon',
+                              URL('system_database_indexes_apply'),
+                              title=T("Create missing indexes"),
+                              btn_class='btn-primary',
+                              _class='pull-right')
+
+    content = DIV(os_gui.get_box_table(T("Indexes"), table,
+                                       show_footer=True,
+                                       footer_content=apply))
+
+    for query in os_db_indexes.explain():
+        plan = query['plan']
+        columns = list(plan[0].keys()) if plan else []
+
+        plan_table = TABLE(THEAD(TR(*[TH(column) for column in columns])),
+                           _class='table table-condensed')
+        for row in plan:
+            plan_table.append(TR(*[TD(row[column]) for column in columns]))
+
+        content.append(os_gui.get_box(query['description'],
+                                      DIV(PRE(query['sql']), plan_table),
+                                      box_class='box-default'))
+
+    menu = system_get_menu(request.function)
+
+    return dict(content=content,
+                menu=menu)
+
+
+@auth.requires(auth.has_membership(group_id='Admins') or
+               auth.has_permission('update', 'settings'))
+def system_database_indexes_apply():
+    """
+        Create declared indexes missing in the database
+    """
+    created = os_db_indexes.apply(force=True)
+
+    session.flash = T("Created indexes") + ': ' + str(len(created))
+
+    redirect(URL('system_database'))
+
+
 @auth.requires(auth.has_membership(group_id='Admins') or \
                 auth.has_permission('read', 'sys_organizations'))
 def system_organizations():
@@ -622,6 +693,9 @@ def financial_get_menu(page=None):
              ['financial_dd_categories',
               T('Direct debit extra'),
               URL('financial_dd_categories')],
+             ['financial_direct_debit',
+              T('Direct debit'),
+              URL('financial_direct_debit')],
              ['financial_teacher_payments',
               T('Teacher payments'),
               URL('financial_teacher_payments')]
@@ -684,6 +758,61 @@ def financial_teacher_payments():
                 save=submit)
 
 
+@auth.requires(auth.has_membership(group_id='Admins') or
+               auth.has_permission('read', 'settings'))
+def financial_direct_debit():
+    """
+        Settings for direct debit (creditor information used in SEPA exports)
+    """
+    response.title = T('Financial Settings')
+    response.subtitle = T('Direct debit')
+    response.view = 'general/tabs_menu.html'
+
+    properties = [
+        ['DirectDebitCreditorName', T('Creditor name')],
+        ['DirectDebitCreditorIBAN', T('Creditor IBAN')],
+        ['DirectDebitCreditorBIC', T('Creditor BIC')],
+        ['DirectDebitCreditorID', T('Creditor identifier')],
+    ]
+
+    fields = []
+    for sys_property, label in properties:
+        fields.append(Field(sys_property,
+                            default=get_sys_property(sys_property),
+                            label=label))
+
+    form = SQLFORM.factory(
+        *fields,
+        submit_button=T("Save"),
+        separator=' ',
+        formstyle='bootstrap3_stacked')
+
+    result = set_form_id_and_get_submit_button(form, 'MainForm')
+    form = result['form']
+    submit = result['submit']
+
+    if form.accepts(request.vars, session):
+        for sys_property, label in properties:
+            set_sys_property(
+                sys_property,
+                request.vars[sys_property]
+            )
+
+        # Clear cache
+        cache_clear_sys_properties()
+        # User feedback
+        session.flash = T('Saved')
+        # reload so the user sees how the values are stored in the db now
+        redirect(URL('financial_direct_debit'))
+
+    menu = financial_get_menu(request.function)
+
+    return dict(content=DIV(DIV(form, _class="col-md-6"),
+                            _class='row'),
+                menu=menu,
+                save=submit)
+
+
 @auth.requires(auth.has_membership(group_id='Admins') or
                auth.has_permission('read', 'settings_finance'))
 def financial_costcenters():
@@ -3765,11 +3894,107 @@ def admin_redis_cache_clear():
     """
         Clears the cache
     """
-    cache.ram.clear(regex='.*')
+    cache_clear()
 
     redirect(URL('admin_redis_cache'))
 
 
+@auth.requires(auth.user_id == 1)
+def admin_query_profiles():
+    """
+        View queries of profiled requests
+    """
+    response.title = T("Sysadmin")
+    response.subtitle = T('Query profiles')
+    response.view = 'general/tabs_menu.html'
+
+    if session.os_query_profiler:
+        toggle_title = T('Stop profiling my requests')
+    else:
+        toggle_title = T('Profile my requests')
+
+    tools = DIV(
+        os_gui.get_button('noicon',
+                          URL('admin_query_profiles_toggle'),
+                          title=toggle_title,
+                          btn_size=''),
+        ' ',
+        os_gui.get_button('noicon',
+                          URL('admin_query_profiles_clear'),
+                          title=T('Clear profiles'),
+                          btn_size=''),
+    )
+
+    table = TABLE(THEAD(TR(TH(T('Time')),
+                           TH(T('URL')),
+                           TH(T('Queries')),
+                           TH(T('Query time (ms)')),
+                           TH(T('Request time (ms)')),
+                           TH(T('Duplicate queries')))),
+                  _class='table table-condensed table-hover')
+
+    for i, profile in enumerate(os_query_profiler.get_profiles()):
+        statements = TABLE(THEAD(TR(TH(T('Statement')),
+                                    TH(T('Count')),
+                                    TH(T('Time (ms)')),
+                                    TH(T('Called from')))),
+                           _class='table table-condensed')
+        for statement in profile['statements']:
+            statements.append(TR(TD(statement['sql']),
+                                 TD(statement['count']),
+                                 TD(statement['ms']),
+                                 TD(*[DIV(call_site) for call_site in statement['call_sites']])))
+
+        details_id = 'os-query_profile_' + str(i)
+        table.append(TR(TD(profile['time'].strftime(DATETIME_FORMAT)),
+                        TD(A(profile['url'],
+                             _href='#' + details_id,
+                             **{'_data-toggle': 'collapse'})),
+                        TD(profile['count']),
+                        TD(profile['ms_queries']),
+                        TD(profile['ms_request']),
+                        TD(profile['duplicates'])))
+        table.append(TR(TD(statements,
+                           _colspan=6,
+                           _id=details_id,
+                           _class='collapse')))
+
+    content = DIV(
+        H3(T('Tools')),
+        tools,
+        H3(T('Profiled requests')),
+        P(T('Sample rate'), ': ', os_query_profiler.sample_rate, ' - ',
+          T('Slow queries are logged in logs/queries.log when they take longer than'), ' ',
+          os_query_profiler.slow_query_ms, 'ms'),
+        table
+    )
+
+    menu = admin_get_menu(request.function)
+
+    return dict(content=content,
+                menu=menu)
+
+
+@auth.requires(auth.user_id == 1)
+def admin_query_profiles_toggle():
+    """
+        Enable or disable profiling all requests in this session
+    """
+    session.os_query_profiler = not session.os_query_profiler
+
+    redirect(URL('admin_query_profiles'))
+
+
+@auth.requires(auth.user_id == 1)
+def admin_query_profiles_clear():
+    """
+        Remove profiles from cache
+    """
+    os_query_profiler.clear()
+
+    redirect(URL('admin_query_profiles'))
+
+
 @auth.requires(auth.user_id == 1)
 def admin_storage_set_limit():
     """
@@ -4180,6 +4405,9 @@ def admin_get_menu(page):
     pages = [ ['admin_redis_cache',
                T('Redis cache'),
                URL('admin_redis_cache')],
+              ['admin_query_profiles',
+               T('Query profiles'),
+               URL('admin_query_profiles')],
               ['admin_storage_set_limit',
                T('Storage limit'),
                URL('admin_storage_set_limit')],
@@ -24,6 +24,37 @@ def test_create_invoices():
     ost.customers_subscriptions_create_invoices_for_month(year, month, description, invoice_date)
 
 
+@auth.requires(auth.user_id == 1)
+def test_create_invoices_per_subscription():
+    """
+    Function to create monthly invoices one subscription at a time,
+    to compare with the invoices created by the scheduler task
+    """
+    from openstudio.os_customer_subscription import CustomerSubscription
+    from general_helpers import get_last_day_month
+
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    year = int(request.vars['year'])
+    month = int(request.vars['month'])
+    description = request.vars['description']
+    invoice_date = request.vars['invoice_date'] or 'today'
+
+    firstdaythismonth = datetime.date(year, month, 1)
+    lastdaythismonth = get_last_day_month(firstdaythismonth)
+
+    query = (db.customers_subscriptions.Startdate <= lastdaythismonth) & \
+            ((db.customers_subscriptions.Enddate >= firstdaythismonth) |
+             (db.customers_subscriptions.Enddate == None))
+    rows = db(query).select(db.customers_subscriptions.id,
+                            orderby=db.customers_subscriptions.id)
+    for row in rows:
+        cs = CustomerSubscription(row.id)
+        cs.create_invoice_for_month(year, month, description, invoice_date)
+
+
 @auth.requires(auth.user_id == 1)
 def test_add_subscription_credits_for_month():
     """
@@ -39,5 +70,6 @@ def test_add_subscription_credits_for_month():
 
     year = request.vars['year']
     month = request.vars['month']
+    vectorized = request.vars['vectorized'] != 'False'
 
-    ost.customers_subscriptions_add_credits_for_month(year, month)
\ No newline at end of file
+    ost.customers_subscriptions_add_credits_for_month(year, month, vectorized=vectorized)
\ No newline at end of file
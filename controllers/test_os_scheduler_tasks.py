@@ -58,4 +58,169 @@ def email_trailcard_follow_up():
         redirect(URL('default', 'user', args=['not_authorized']))
 
     ost = OsSchedulerTasks()
-    return ost.email_trailcard_follow_up()
\ No newline at end of file
+    return ost.email_trailcard_follow_up()
+
+@auth.requires(auth.has_membership(group_id='Admins'))
+def classes_attendance_count_rebuild():
+    """
+    Function to expose class & method used by scheduler task
+    to recount attendance for class occurrences
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.classes_attendance_count_rebuild(request.vars['date_from'],
+                                                request.vars['date_until'])
+
+
+def classes_occurrences_rebuild():
+    """
+    Function to expose class & method used by scheduler task
+    to rebuild class occurrences
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.classes_occurrences_rebuild()
+
+
+def customers_inactive_delete():
+    """
+    Function to expose class & method used by scheduler task
+    to delete customers without activity after a date
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.customers_inactive_delete(request.vars['date'],
+                                         chunk_size=request.vars['chunk_size'] or 500,
+                                         dry_run=request.vars['dry_run'] or False)
+
+
+def exports_create():
+    """
+    Function to expose class & method used by scheduler task
+    to create an export in the background
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.exports_create(request.vars['seID'])
+
+
+def exports_delete_expired():
+    """
+    Function to expose class & method used by scheduler task
+    to delete expired background exports
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.exports_delete_expired()
+
+
+def customers_subscriptions_credits_balance_verify():
+    """
+    Function to expose class & method used by scheduler task
+    to verify credit balances of subscriptions
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.customers_subscriptions_credits_balance_verify(request.vars['repair'] or True)
+
+
+def invoices_render_pdfs():
+    """
+    Function to expose class & method used by scheduler task
+    to render PDF files for invoices in a period
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.invoices_render_pdfs(request.vars['date_from'],
+                                    request.vars['date_until'])
+
+
+def mail_outbox_send():
+    """
+    Function to expose class & method used by scheduler task
+    to send queued mails
+    """
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    ost = OsSchedulerTasks()
+    return ost.mail_outbox_send()
+
+
+class FakeMollieClient:
+    """
+    Local stand-in for mollie.api.client.Client
+    """
+    class _Resource:
+        def __init__(self, create=None, list=None):
+            self._create = create
+            self._list = list
+
+        def create(self, data):
+            return self._create(data)
+
+        def with_parent_id(self, parent_id):
+            return self
+
+        def list(self):
+            return self._list()
+
+    def __init__(self):
+        self.customers = self._Resource(create=lambda data: {'id': 'cst_test'})
+        self.customer_mandates = self._Resource(list=lambda: {
+            'count': 1,
+            '_embedded': {'mandates': [{'status': 'valid'}]}
+        })
+        self.payments = self._Resource(create=lambda data: {
+            'id': 'tr_test_' + str(data['metadata']['invoice_id'])
+        })
+        self.customer_payments = self._Resource(list=lambda: {
+            'count': 0,
+            '_embedded': {'payments': []}
+        })
+
+
+@auth.requires(auth.has_membership(group_id='Admins'))
+def customers_subscriptions_collect_mollie_recurring():
+    """
+    Function to expose class & method used by scheduler task
+    to collect recurring payments, using a fake Mollie client
+    """
+    from openstudio.os_customers_subscriptions_mollie_payments import CustomersSubscriptionsMolliePayments
+
+    if ( not web2pytest.is_running_under_test(request, request.application)
+         and not auth.has_membership(group_id='Admins') ):
+        redirect(URL('default', 'user', args=['not_authorized']))
+
+    csmp = CustomersSubscriptionsMolliePayments(
+        request.vars['year'],
+        request.vars['month'],
+        mollie_client=FakeMollieClient
+    )
+
+    if request.vars['retry']:
+        return csmp.retry(chunk_size=2, queue_chunks=False)
+
+    return csmp.collect(chunk_size=2, queue_chunks=False)
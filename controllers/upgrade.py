@@ -5,6 +5,11 @@ from general_helpers import get_ajax_loader
 
 from openstudio.os_workshop_product import WorkshopProduct
 from openstudio.os_invoice import Invoice
+from openstudio.os_classes_attendance_counts import ClassesAttendanceCounts
+from openstudio.os_pos_customers_directory import PosCustomersDirectory
+from openstudio.os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+from openstudio.os_classes_occurrences import ClassesOccurrences
+from openstudio.os_scheduler import OsScheduler
 
 from os_upgrade import set_version
 
@@ -36,18 +41,34 @@ def index():
             print(version)
             upgrade_to_202002()
             session.flash = T("Upgraded db to 2020.02")
+        if version < 2020.03:
+            print(version)
+            upgrade_to_202003()
+            session.flash = T("Upgraded db to 2020.03")
         else:
             session.flash = T('Already up to date')
 
         # always renew permissions for admin group after update
         set_permissions_for_admin_group()
 
+        # queue recurring tasks added after the first setup
+        OsScheduler().queue_missing_tasks()
+
+        # create declared indexes missing in the database
+        os_db_indexes.apply(force=True)
+
+        # always rebuild the credit balances of subscriptions
+        CustomersSubscriptionsCreditsBalances().rebuild()
+
+        # and the class occurrences
+        ClassesOccurrences().rebuild()
+
     set_version()
 
     ##
     # clear cache
     ##
-    cache.ram.clear(regex='.*')
+    cache_clear()
 
     # Back to square one
     to_login()
@@ -91,3 +112,14 @@ def upgrade_to_202002():
 -- Please replace this text with your own to follow up on trial products. --"""
     )
 
+
+def upgrade_to_202003():
+    """
+        Upgrade operations to 2020.03
+    """
+    # Count attendance for all classes, the counts are maintained when
+    # attendance changes from now on
+    ClassesAttendanceCounts().rebuild()
+
+    # Same for the PoS customers directory
+    PosCustomersDirectory().rebuild()
@@ -5,7 +5,10 @@ import string
 import random
 import pytz
 
+from gluon import current
 from openstudio.os_gui import OsGui
+from openstudio.os_cache_manager import OsCacheManager
+from openstudio.os_sys_properties import OsSysProperties
 from general_helpers import represent_validity_units
 from general_helpers import represent_subscription_units
 
@@ -153,35 +156,28 @@ def cache_clear(var_one=None, var_two=None):
         Clears all cache entries on disk & in ram
         # Takes arguments in case it's called from a crud form or SQLFORM.grid
     """
-    cache.ram.clear()
-    cache.disk.clear()
+    os_cache_manager.clear()
 
 
 def cache_clear_customers_memberships(cuID):
     """
         Clears memberships cache entries on disk & in ram
     """
-    cu_sub_regex = '.*openstudio_customer_get_memberships_on_date_' + str(cuID) + '*'
-    cache.ram.clear(regex=cu_sub_regex)
-    cache.disk.clear(regex=cu_sub_regex)
+    os_cache_manager.clear_customers_memberships(cuID)
 
 
 def cache_clear_customers_subscriptions(cuID):
     """
         Clears subscription cache entries on disk & in ram
     """
-    cu_sub_regex = '.*openstudio_customer_get_subscriptions_on_date_' + str(cuID) + '*'
-    cache.ram.clear(regex=cu_sub_regex)
-    cache.disk.clear(regex=cu_sub_regex)
+    os_cache_manager.clear_customers_subscriptions(cuID)
 
 
 def cache_clear_customers_classcards(cuID):
     """
         Clears subscription cache entries on disk & in ram
     """
-    cu_cc_regex = '.*openstudio_customer_get_classcards_' + str(cuID) + '*'
-    cache.ram.clear(regex=cu_cc_regex)
-    cache.disk.clear(regex=cu_cc_regex)
+    os_cache_manager.clear_customers_classcards(cuID)
 
 
 def cache_clear_classschedule(var_one=None, var_two=None):
@@ -189,21 +185,16 @@ def cache_clear_classschedule(var_one=None, var_two=None):
         Clears the class schedule cache 
         takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
     """
-    class_schedule_regex = '.*openstudio_classschedule_get_day_*'
-    cache.ram.clear(regex = class_schedule_regex)
-    cache.disk.clear(regex = class_schedule_regex)
+    os_cache_manager.clear_classschedule()
 
-    cache_clear_classschedule_api()
 
-
-def cache_clear_classschedule_api(var_one=None, var_two=None):
+def cache_clear_classschedule_api(var_one=None, var_two=None, date=None):
     """
         Clears the class schedule api cache
         takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
+        :param date: datetime.date - only clear entries containing classes on this date
     """
-    api_schedule_regex = '.*openstudio_api_schedule_get_*'
-    cache.ram.clear(regex=api_schedule_regex)
-    cache.disk.clear(regex=api_schedule_regex)
+    os_cache_manager.clear_classschedule_api(date=date)
 
 
 def cache_clear_classschedule_trend(var_one=None, var_two=None):
@@ -211,9 +202,7 @@ def cache_clear_classschedule_trend(var_one=None, var_two=None):
         Clears the class schedule trend column cache
         takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
     """
-    trend_regex = '.*openstudio_classschedule_trend_*'
-    cache.ram.clear(regex = trend_regex)
-    cache.disk.clear(regex = trend_regex)
+    os_cache_manager.clear_classschedule_trend()
 
 
 def cache_clear_sys_properties():
@@ -221,18 +210,14 @@ def cache_clear_sys_properties():
         Clears the sys_properties keys in cache
         :return: None
     """
-    sprop_regex = '.*openstudio_system_property_*'
-    cache.ram.clear(regex = sprop_regex)
-    cache.disk.clear(regex = sprop_regex)
+    os_cache_manager.clear_sys_properties()
 
 
 def cache_clear_menu_backend():
     """
         Clears the backend menu's in cache
     """
-    menu_regex = '.*openstudio_menu_backend_*'
-    cache.ram.clear(regex = menu_regex)
-    cache.disk.clear(regex = menu_regex)
+    os_cache_manager.clear_menu_backend()
 
 
 def cache_clear_workshops(var_one=None, var_two=None):
@@ -240,9 +225,7 @@ def cache_clear_workshops(var_one=None, var_two=None):
         Clears the workshops cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    workshops_regex = '.*openstudio_workshops_*'
-    cache.ram.clear(regex = workshops_regex)
-    cache.disk.clear(regex = workshops_regex)
+    os_cache_manager.clear_workshops()
 
 
 def cache_clear_school_subscriptions(var_one=None, var_two=None):
@@ -250,14 +233,7 @@ def cache_clear_school_subscriptions(var_one=None, var_two=None):
         Clears the school subscriptions cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    school_subscriptions_regex = '.*openstudio_school_subcriptions_api_*'
-    cache.ram.clear(regex = school_subscriptions_regex)
-    cache.disk.clear(regex = school_subscriptions_regex)
-
-    # Clear all customer subscriptions, as the cache also stores some school subscription info
-    cu_sub_regex = '.*openstudio_customer_get_subscriptions_on_date_*'
-    cache.ram.clear(regex=cu_sub_regex)
-    cache.disk.clear(regex=cu_sub_regex)
+    os_cache_manager.clear_school_subscriptions()
 
 
 def cache_clear_school_classcards(var_one=None, var_two=None):
@@ -265,9 +241,7 @@ def cache_clear_school_classcards(var_one=None, var_two=None):
         Clears the school classcards cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    school_classcards_regex = '.*openstudio_school_classcards_api_*'
-    cache.ram.clear(regex = school_classcards_regex)
-    cache.disk.clear(regex = school_classcards_regex)
+    os_cache_manager.clear_school_classcards()
 
 
 def cache_clear_school_teachers(var_one=None, var_two=None):
@@ -275,19 +249,15 @@ def cache_clear_school_teachers(var_one=None, var_two=None):
         Clears the school teachers (API) cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    school_teachers_api_regex = '.*openstudio_school_teachers_api_get'
-    cache.ram.clear(regex = school_teachers_api_regex)
-    cache.disk.clear(regex = school_teachers_api_regex)
+    os_cache_manager.clear_school_teachers()
 
 
 def cache_clear_school_classtypes(var_one=None, var_two=None):
     """
-        Clears the school teachers (API) cache
+        Clears the school classtypes (API) cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    school_teachers_api_regex = '.*openstudio_school_teachers_api_get'
-    cache.ram.clear(regex = school_teachers_api_regex)
-    cache.disk.clear(regex = school_teachers_api_regex)
+    os_cache_manager.clear_school_classtypes()
 
 
 def cache_clear_sys_organizations(var_one=None, var_two=None):
@@ -295,9 +265,7 @@ def cache_clear_sys_organizations(var_one=None, var_two=None):
         Clears the workshops cache
         # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
     """
-    sys_org_regex = '.*openstudio_sys_organizations*'
-    cache.ram.clear(regex = sys_org_regex)
-    cache.disk.clear(regex = sys_org_regex)
+    os_cache_manager.clear_sys_organizations()
 
 
 
@@ -306,34 +274,7 @@ def set_sys_property(property, value):
     :param property: string - name of sys property
     :return: None
     """
-    row = db.sys_properties(Property=property)
-    if not row:
-        db.sys_properties.insert(Property=property,
-                                 PropertyValue=value)
-    else:
-        row.PropertyValue = value
-        row.update_record()
-
-    # Clear cache
-    cache_clear_sys_properties()
-
-
-def _get_sys_property(value=None, value_type=None):
-    """
-        Returns the value of a property in db.sys_properties
-    """
-    property_value = None
-    row = db.sys_properties(Property=value)
-    if row:
-        property_value = row.PropertyValue
-
-    if value_type:
-        try:
-            return value_type(property_value)
-        except:
-            pass
-
-    return property_value
+    os_sys_properties.set(property, value)
 
 
 def get_sys_property(value=None, value_type=None):
@@ -342,17 +283,7 @@ def get_sys_property(value=None, value_type=None):
     :param value_type: Python data type eg. int
     :return: db.sys_properties.PropertyValue
     """
-    cache_key = 'openstudio_system_property_' + value
-
-    # Don't cache when running tests
-    if web2pytest.is_running_under_test(request, request.application):
-        sprop = _get_sys_property(value, value_type)
-    else:
-        sprop = cache.ram(cache_key,
-                          lambda: _get_sys_property(value, value_type),
-                          time_expire=CACHE_LONG)
-
-    return sprop
+    return os_sys_properties.get(value, value_type)
 
 
 def set_genders():
@@ -378,7 +309,8 @@ def set_message_statuses():
     """
         Returns a list of message statuses to use in OpenStudio
     """
-    statuses = [['sent', T("Sent")],
+    statuses = [['queued', T("Queued")],
+                ['sent', T("Sent")],
                 ['fail', T("Failed")],
                 ]
 
@@ -651,4 +583,9 @@ customers_orders_origins = set_customers_orders_origins()
 employee_expenses_statuses = set_employee_expenses_statuses()
 
 os_gui = OsGui()
+os_cache_manager = OsCacheManager()
+
+# All sys_properties are read using one query, shared by the process until a property changes
+os_sys_properties = OsSysProperties()
+current.sys_properties = os_sys_properties
 
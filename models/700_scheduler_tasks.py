@@ -1,8 +1,6 @@
 # # -*- coding: utf-8 -*-
 
 import datetime
-from mollie.api.client import Client
-from mollie.api.error import Error as MollieError
 
 from openstudio.os_customer_subscription import CustomerSubscription
 from openstudio.os_invoice import Invoice
@@ -17,6 +15,21 @@ def task_openstudio_daily():
     today = datetime.date.today()
     if today.day == 1:
         task_mollie_subscription_invoices_and_payments()
+    else:
+        # Collect payments that timed out or weren't collected yet
+        os_scheduler_tasks.customers_subscriptions_collect_mollie_recurring_retry()
+
+    # Repair attendance counts for upcoming classes
+    os_scheduler_tasks.classes_attendance_count_rebuild(date_from=today)
+
+    # Move the window of class occurrences forward
+    os_scheduler_tasks.classes_occurrences_rebuild()
+
+    # Repair credit balances of subscriptions that drifted from their mutations
+    os_scheduler_tasks.customers_subscriptions_credits_balance_verify()
+
+    # Remove background exports holding personal data
+    os_scheduler_tasks.exports_delete_expired()
 
     return 'Daily task - OK'
 
@@ -33,125 +46,7 @@ def task_mollie_subscription_invoices_and_payments():
         Create subscription invoices for subscriptions with payment method 100
         Collect payment for these invoices
     """
-    def send_mail_failed(cuID):
-        """
-            When a recurring payment fails, mail customer with request to pay manually
-        """
-        os_mail = OsMail()
-        msgID = os_mail.render_email_template('payment_recurring_failed')
-        os_mail.send_and_archive(msgID, cuID)
-
-    from openstudio.os_customer import Customer
-
-    # hostname
-    sys_hostname = get_sys_property('sys_hostname')
-    # set up Mollie
-    mollie = Client()
-    mollie_api_key = get_sys_property('mollie_website_profile')
-    mollie.set_api_key(mollie_api_key)
-    # set dates
-    today = datetime.date.today()
-    firstdaythismonth = datetime.date(today.year, today.month, 1)
-    lastdaythismonth = get_last_day_month(firstdaythismonth)
-
-    # call some function to do stuff
-
-    # find all active subscriptions with payment method 100 (Mollie)
-    query = (db.customers_subscriptions.payment_methods_id == 100) & \
-            (db.customers_subscriptions.Startdate <= lastdaythismonth) & \
-            ((db.customers_subscriptions.Enddate >= firstdaythismonth) |
-             (db.customers_subscriptions.Enddate == None))
-    rows = db(query).select(db.customers_subscriptions.ALL)
-
-    success = 0
-    failed = 0
-
-    # create invoices
-    for i, row in enumerate(rows):
-        cs = CustomerSubscription(row.id)
-        # This function returns the invoice id if it already exists
-        iID = cs.create_invoice_for_month(TODAY_LOCAL.year, TODAY_LOCAL.month)
-
-        #print 'invoice created'
-        #print iID
-
-        # Do we have an invoice?
-        if not iID:
-            continue
-
-        invoice = Invoice(iID)
-        # Only do something if the invoice status is sent
-        if not invoice.invoice.Status == 'sent':
-            continue
-
-        # We're good, continue processing
-        invoice_amounts = invoice.get_amounts()
-        #print invoice.invoice.InvoiceID
-        description = invoice.invoice.Description + ' - ' + invoice.invoice.InvoiceID
-        db.commit()
-
-        #create recurring payments using mandates
-        #subscription invoice
-        customer = Customer(row.auth_customer_id)
-        mollie_customer_id = customer.row.mollie_customer_id
-        mandates = customer.get_mollie_mandates()
-        valid_mandate = False
-        # set default recurring type, change to recurring if a valid mandate is found.
-        if mandates['count'] > 0:
-            # background payment
-            for mandate in mandates['_embedded']['mandates']:
-                if mandate['status'] == 'valid':
-                    valid_mandate = True
-                    break
-
-            if valid_mandate:
-                # Create recurring payment
-                try:
-                    webhook_url = URL('mollie', 'webhook', scheme='https', host=sys_hostname)
-                    payment = mollie.payments.create({
-                        'amount': {
-                            'currency': CURRENCY,
-                            'value': str(invoice_amounts.TotalPriceVAT)
-                        },
-                        'customerId': mollie_customer_id,
-                        'sequenceType': 'recurring',  # important
-                        'description': description,
-                        'webhookUrl': webhook_url,
-                        'metadata': {
-                            'invoice_id': invoice.invoice.id,
-                            'customers_orders_id': 'invoice' # This lets the webhook function know it's dealing with an invoice
-                        }
-                    })
-
-                    # link invoice to mollie_payment_id
-                    db.invoices_mollie_payment_ids.insert(
-                        invoices_id=invoice.invoice.id,
-                        mollie_payment_id=payment['id'],
-                        RecurringType='recurring',
-                        WebhookURL=webhook_url
-                    )
-
-                    success += 1
-
-                except MollieError as e:
-                    print(e)
-                    # send mail to ask customer to pay manually
-                    send_mail_failed(cs.auth_customer_id)
-
-                    failed += 1
-                    # return error
-                    # return 'API call failed: ' + e.message
-        else:
-            # send mail to ask customer to pay manually
-            send_mail_failed(cs.auth_customer_id)
-
-            failed +=1
-
-    # For scheduled tasks, db has to be committed manually
-    db.commit()
-
-    return T("Payments collected") + ': ' + str(success) + '<br>' + \
-        T("Payments failed to collect") + ': ' + str(failed)
+    return os_scheduler_tasks.customers_subscriptions_collect_mollie_recurring_current_month()
 
 
 def scheduler_task_test():
@@ -166,7 +61,17 @@ scheduler_tasks = {
     'customers_subscriptions_create_invoices_for_month': os_scheduler_tasks.customers_subscriptions_create_invoices_for_month,
     'customers_subscriptions_add_credits_for_month': os_scheduler_tasks.customers_subscriptions_add_credits_for_month,
     'customers_membership_renew_expired': os_scheduler_tasks.customers_memberships_renew_expired,
+    'classes_attendance_count_rebuild': os_scheduler_tasks.classes_attendance_count_rebuild,
+    'classes_occurrences_rebuild': os_scheduler_tasks.classes_occurrences_rebuild,
+    'customers_subscriptions_credits_balance_verify': os_scheduler_tasks.customers_subscriptions_credits_balance_verify,
+    'customers_inactive_delete': os_scheduler_tasks.customers_inactive_delete,
+    'exports_create': os_scheduler_tasks.exports_create,
+    'exports_delete_expired': os_scheduler_tasks.exports_delete_expired,
+    'invoices_render_pdfs': os_scheduler_tasks.invoices_render_pdfs,
+    'mail_outbox_send': os_scheduler_tasks.mail_outbox_send,
     'customers_subscriptions_collect_mollie_recurring_current_month': task_mollie_subscription_invoices_and_payments,
+    'customers_subscriptions_collect_mollie_recurring_chunk': os_scheduler_tasks.customers_subscriptions_collect_mollie_recurring_chunk,
+    'customers_subscriptions_collect_mollie_recurring_retry': os_scheduler_tasks.customers_subscriptions_collect_mollie_recurring_retry,
     'email_reminders_teachers_sub_request_open': os_scheduler_tasks.email_reminders_teachers_sub_request_open,
     'email_teachers_sub_requests_daily_summary': os_scheduler_tasks.email_teachers_sub_requests_daily_summary,
     'openstudio_test_task': task_openstudio_test
@@ -63,6 +63,17 @@ else:
     # session.connect(request, response, db = MEMDB(Client()))
     # ---------------------------------------------------------------------
 
+# -------------------------------------------------------------------------
+# Profile queries for a sample of requests (or all requests of a user
+# who enabled profiling), see settings/admin_query_profiles
+# -------------------------------------------------------------------------
+from openstudio.os_query_profiler import OsQueryProfiler
+
+os_query_profiler = OsQueryProfiler(db,
+                                    sample_rate=configuration.get('profiler.sample_rate'),
+                                    slow_query_ms=configuration.get('profiler.slow_query_ms'))
+os_query_profiler.install(force=bool(session.os_query_profiler))
+
 # if configuration.get('cache.cache') == 'redis':
 #     # If we have redis in the stack, let's use it for sessions
 #     from gluon.contrib.redis_utils import RConn
@@ -23,6 +23,15 @@ from general_helpers import create_employees_dict
 from general_helpers import create_locations_dict
 from general_helpers import create_classtypes_dict
 
+from openstudio.os_classes_attendance_counts import ClassesAttendanceCounts
+from openstudio.os_pos_customers_directory import PosCustomersDirectory
+from openstudio.os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+from openstudio.os_classes_occurrences import ClassesOccurrences
+from openstudio.os_permissions import OsPermissions
+from openstudio.os_db_indexes import OsDbIndexes
+from openstudio.os_retention import OsRetention
+from openstudio.os_class_permissions import OsClassPermissions
+
 
 # init scheduler
 scheduler = Scheduler(
@@ -31,6 +40,9 @@ scheduler = Scheduler(
     utc_time=True
 )
 
+# Secondary indexes, declared in define functions & created on migrate
+os_db_indexes = OsDbIndexes()
+
 # helper functions
 
 # Set global variable to show how many organizations we have
@@ -65,7 +77,10 @@ def get_organizations():
     else:
         cache_key = 'openstudio_sys_organizations'
 
-        organizations = cache.ram(cache_key, lambda: _get_organizations(), time_expire=CACHE_LONG)
+        organizations = os_cache_manager.get_tagged(cache_key,
+                                                    lambda: _get_organizations(),
+                                                    ['sys_organizations'],
+                                                    time_expire=CACHE_LONG)
 
     return organizations
 
@@ -447,7 +462,10 @@ def represent_message_status(value, row):
     """
         Represent status of sent mails
     """
-    if value == 'sent':
+    rvalue = ''
+    if value == 'queued':
+        rvalue = os_gui.get_label('default', T("Queued"))
+    elif value == 'sent':
         rvalue = os_gui.get_label('success', T("Sent"))
     elif value == 'fail':
         rvalue = os_gui.get_label('danger', T("Sending failed"))
@@ -2321,6 +2339,9 @@ def define_classes_otc():
               ),
     )
 
+    os_db_indexes.declare(db.classes_otc, ['ClassDate', 'classes_id'])
+
+
 def define_classes_otc_sub_avail():
     """
         Table to store the available requests for a class open to substitution
@@ -2547,6 +2568,8 @@ def define_classes_teachers():
             widget=os_datepicker_widget),
         )
 
+    os_db_indexes.declare(db.classes_teachers, ['classes_id', 'Startdate', 'Enddate'])
+
 
 def define_classes_open():
     db.define_table('classes_open',
@@ -2704,6 +2727,91 @@ def define_classes_attendance():
     except AttributeError:
         pass
 
+    # Keep db.classes_attendance_count up to date
+    attendance_counts = ClassesAttendanceCounts()
+    db.classes_attendance._after_insert.append(attendance_counts.after_insert)
+    db.classes_attendance._before_update.append(attendance_counts.before_update)
+    db.classes_attendance._after_update.append(attendance_counts.after_update)
+    db.classes_attendance._before_delete.append(attendance_counts.before_delete)
+    db.classes_attendance._after_delete.append(attendance_counts.after_delete)
+
+    # Clear cached retention analytics of closed months
+    retention = OsRetention()
+    db.classes_attendance._after_insert.append(retention.after_insert)
+    db.classes_attendance._before_update.append(retention.before_update)
+    db.classes_attendance._before_delete.append(retention.before_delete)
+    db.auth_user._before_delete.append(retention.before_delete_customers)
+
+    os_db_indexes.declare(db.classes_attendance, ['classes_id', 'ClassDate', 'BookingStatus'])
+    os_db_indexes.declare(db.classes_attendance, ['auth_customer_id', 'ClassDate'])
+
+
+def define_classes_attendance_count():
+    """
+        Number of bookings for each class occurrence, so checking whether a
+        class is full doesn't require counting classes_attendance.
+        Maintained by openstudio.os_classes_attendance_counts.ClassesAttendanceCounts
+    """
+    db.define_table('classes_attendance_count',
+        Field('classes_id', db.classes, required=True,
+            readable=False,
+            writable=False),
+        Field('ClassDate', 'date', required=True,
+            readable=False,
+            writable=False),
+        Field('Attendance', 'integer', # Status booked or attending
+            default=0),
+        Field('OnlineBooking', 'integer', # Online bookings not cancelled
+            default=0),
+        Field('Attending', 'integer', # Status attending
+            default=0),
+        )
+
+    # One row of counts for each class occurrence, also when the first bookings
+    # for an occurrence are made at the same time
+    os_db_indexes.declare(db.classes_attendance_count, ['classes_id', 'ClassDate'],
+                          unique=True)
+
+
+def define_pos_customers_directory():
+    """
+        Customers listed in the PoS, versioned so clients can fetch changes.
+        Maintained by openstudio.os_pos_customers_directory.PosCustomersDirectory
+    """
+    db.define_table('pos_customers_directory',
+        Field('auth_user_id', 'integer', required=True), # not a reference, rows are kept after deleting a customer
+        Field('Deleted', 'boolean',
+            default=False),
+        Field('first_name'),
+        Field('last_name'),
+        Field('display_name'),
+        Field('search_name'),
+        Field('email'),
+        Field('date_of_birth', 'date'),
+        Field('mobile'),
+        Field('thumbsmall'),
+        Field('thumblarge'),
+        Field('barcode_id'),
+        Field('Version', 'integer',
+            default=0),
+        )
+
+    # Sequence of versions of the directory, the id is the version
+    db.define_table('pos_customers_directory_version',
+        Field('CreatedOn', 'datetime'),
+        )
+
+    # Keep db.pos_customers_directory up to date
+    customers_directory = PosCustomersDirectory()
+    db.auth_user._after_insert.append(customers_directory.after_insert)
+    db.auth_user._before_update.append(customers_directory.before_update)
+    db.auth_user._after_update.append(customers_directory.after_update)
+    db.auth_user._before_delete.append(customers_directory.before_delete)
+    db.auth_user._after_delete.append(customers_directory.after_delete)
+
+    os_db_indexes.declare(db.pos_customers_directory, ['auth_user_id'], unique=True)
+    os_db_indexes.declare(db.pos_customers_directory, ['Version'])
+
 
 def represent_customer_subscription(value, row):
     """
@@ -2970,6 +3078,8 @@ def define_customers_subscriptions():
               ),
         singular=T("Subscription"), plural=T("Subscriptions"))
 
+    os_db_indexes.declare(db.customers_subscriptions, ['auth_customer_id', 'Startdate', 'Enddate'])
+
 
 def represent_customers_subscriptions_verified(value, row):
     """
@@ -3040,6 +3150,36 @@ def define_customers_subscriptions_credits():
             label=T('Expired'))
     )
 
+    # Keep db.customers_subscriptions_credits_balance up to date
+    credits_balances = CustomersSubscriptionsCreditsBalances()
+    db.customers_subscriptions_credits._after_insert.append(credits_balances.after_insert)
+    db.customers_subscriptions_credits._before_update.append(credits_balances.before_update)
+    db.customers_subscriptions_credits._after_update.append(credits_balances.after_update)
+    db.customers_subscriptions_credits._before_delete.append(credits_balances.before_delete)
+    db.customers_subscriptions_credits._after_delete.append(credits_balances.after_delete)
+
+    os_db_indexes.declare(db.customers_subscriptions_credits, ['customers_subscriptions_id', 'MutationType'])
+
+
+def define_customers_subscriptions_credits_balance():
+    """
+        Credit balance for each subscription, so the balance doesn't have to be
+        summed from all mutations in customers_subscriptions_credits.
+        Maintained by openstudio.os_customers_subscriptions_credits_balances.CustomersSubscriptionsCreditsBalances
+    """
+    db.define_table('customers_subscriptions_credits_balance',
+        Field('customers_subscriptions_id', db.customers_subscriptions, required=True,
+            readable=False,
+            writable=False),
+        Field('Balance', 'float',
+            default=0),
+        )
+
+    # One balance for each subscription, also when mutations for a subscription
+    # without a balance are inserted at the same time
+    os_db_indexes.declare(db.customers_subscriptions_credits_balance, ['customers_subscriptions_id'],
+                          unique=True)
+
 
 def represent_customers_subscriptions_credits_MutationType(value, row):
     """
@@ -3867,6 +4007,70 @@ def define_school_holidays_locations():
         Field('school_locations_id', db.school_locations))
 
 
+def define_classes_occurrences():
+    """
+        One row for each date a class takes place, with one time changes,
+        teachers and holidays applied.
+        Maintained by openstudio.os_classes_occurrences.ClassesOccurrences
+    """
+    db.define_table('classes_occurrences',
+        Field('classes_id', db.classes, required=True,
+            readable=False,
+            writable=False),
+        Field('ClassDate', 'date', required=True,
+            readable=False,
+            writable=False),
+        Field('Status'), # normal, open or cancelled
+        Field('Description'),
+        Field('school_locations_id', db.school_locations),
+        Field('school_classtypes_id', db.school_classtypes),
+        Field('school_levels_id', db.school_levels),
+        Field('sys_organizations_id', db.sys_organizations),
+        Field('Starttime', 'time'),
+        Field('Endtime', 'time'),
+        Field('Maxstudents', 'integer'),
+        Field('WalkInSpaces', 'integer'),
+        Field('auth_teacher_id', db.auth_user),
+        Field('teacher_role', 'integer'),
+        Field('auth_teacher_id2', db.auth_user),
+        Field('teacher_role2', 'integer'),
+        Field('school_holidays_id', db.school_holidays),
+        )
+
+    # Keep db.classes_occurrences up to date
+    occurrences = ClassesOccurrences()
+    db.classes._after_insert.append(occurrences.classes_after_insert)
+    db.classes._before_update.append(occurrences.classes_before_change)
+    db.classes._after_update.append(occurrences.classes_after_change)
+    db.classes._before_delete.append(occurrences.classes_before_change)
+    db.classes._after_delete.append(occurrences.classes_after_change)
+
+    db.classes_otc._after_insert.append(occurrences.classes_otc_after_insert)
+    db.classes_otc._before_update.append(occurrences.classes_otc_before_change)
+    db.classes_otc._after_update.append(occurrences.classes_otc_after_change)
+    db.classes_otc._before_delete.append(occurrences.classes_otc_before_change)
+    db.classes_otc._after_delete.append(occurrences.classes_otc_after_change)
+
+    db.classes_teachers._after_insert.append(occurrences.classes_teachers_after_insert)
+    db.classes_teachers._before_update.append(occurrences.classes_teachers_before_change)
+    db.classes_teachers._after_update.append(occurrences.classes_teachers_after_change)
+    db.classes_teachers._before_delete.append(occurrences.classes_teachers_before_change)
+    db.classes_teachers._after_delete.append(occurrences.classes_teachers_after_change)
+
+    db.school_holidays._before_update.append(occurrences.school_holidays_before_change)
+    db.school_holidays._after_update.append(occurrences.school_holidays_after_change)
+    db.school_holidays._before_delete.append(occurrences.school_holidays_before_change)
+    db.school_holidays._after_delete.append(occurrences.school_holidays_after_change)
+
+    db.school_holidays_locations._after_insert.append(occurrences.school_holidays_locations_after_insert)
+    db.school_holidays_locations._before_update.append(occurrences.school_holidays_locations_before_change)
+    db.school_holidays_locations._after_update.append(occurrences.school_holidays_locations_after_change)
+    db.school_holidays_locations._before_delete.append(occurrences.school_holidays_locations_before_change)
+    db.school_holidays_locations._after_delete.append(occurrences.school_holidays_locations_after_change)
+
+    os_db_indexes.declare(db.classes_occurrences, ['ClassDate', 'classes_id'])
+
+
 def represent_school_locations_ids(value, row):
     """
         Represent school_locations_ids
@@ -3940,6 +4144,53 @@ def define_customers_messages():
         )
 
 
+def define_mail_outbox():
+    """
+        Mails waiting to be sent by the mail_outbox_send scheduler task
+    """
+    statuses = [['queued', T("Queued")],
+                ['sent', T("Sent")],
+                ['failed', T("Failed")]]
+
+    db.define_table('mail_outbox',
+        Field('Recipient', required=True,
+            label=T("To")),
+        Field('Subject',
+            label=T("Subject")),
+        Field('Message', 'text',
+            label=T("Message")),
+        Field('ReplyTo',
+            label=T("Reply to")),
+        Field('customers_messages_id', db.customers_messages,
+            readable=False,
+            writable=False),
+        Field('Status',
+            default='queued',
+            requires=IS_IN_SET(statuses),
+            label=T("Status")),
+        Field('Attempts', 'integer',
+            default=0,
+            label=T("Attempts")),
+        Field('NextAttemptOn', 'datetime',
+            default=datetime.datetime.now(),
+            represent=represent_datetime,
+            label=T("Next attempt")),
+        Field('LastError', 'text',
+            label=T("Last error")),
+        Field('CreatedOn', 'datetime',
+            readable=False,
+            writable=False,
+            default=datetime.datetime.now(),
+            represent=represent_datetime),
+        Field('SentOn', 'datetime',
+            readable=False,
+            writable=False,
+            represent=represent_datetime),
+        )
+
+    os_db_indexes.declare(db.mail_outbox, ['Status', 'NextAttemptOn'])
+
+
 def define_payment_batches():
     loc_query = (db.school_locations.Archived == False)
     pc_query = (db.payment_categories.Archived == False)
@@ -4647,6 +4898,44 @@ def define_invoices_mollie_payment_ids():
     )
 
 
+def define_invoices_mollie_recurring_collection():
+    """
+        Progress of collecting recurring Mollie payments for subscription invoices,
+        so an interrupted collection can continue without paying twice.
+        Status is one of 'queued', 'processing', 'created', 'skipped' or 'failed'
+    """
+    db.define_table('invoices_mollie_recurring_collection',
+        Field('invoices_id', db.invoices,
+            readable=False,
+            writable=False),
+        Field('SubscriptionYear', 'integer',
+            readable=False,
+            writable=False),
+        Field('SubscriptionMonth', 'integer',
+            readable=False,
+            writable=False),
+        Field('Status',
+            default='queued',
+            readable=False,
+            writable=False),
+        Field('mollie_payment_id',
+            readable=False,
+            writable=False),
+        Field('Error', 'text',
+            readable=False,
+            writable=False),
+        Field('Attempts', 'integer',
+            readable=False,
+            writable=False,
+            default=0),
+        Field('UpdatedOn', 'datetime',
+            readable=False,
+            writable=False,
+            default=datetime.datetime.now(),
+            represent=represent_datetime)
+    )
+
+
 def represent_invoice_status(value, row):
     """
         Returns label for invoice status
@@ -4727,6 +5016,8 @@ def define_invoices_items():
             writable=False),
     )
 
+    os_db_indexes.declare(db.invoices_items, ['invoices_id'])
+
 
 def compute_invoice_item_total_price(row):
     """
@@ -5967,6 +6258,46 @@ def define_sys_files():
     )
 
 
+def define_sys_exports():
+    """
+        Exports created in the background by the exports_create scheduler task
+    """
+    statuses = [['queued', T("Queued")],
+                ['running', T("Running")],
+                ['finished', T("Finished")],
+                ['failed', T("Failed")]]
+
+    db.define_table('sys_exports',
+        Field('auth_user_id', db.auth_user,
+            readable=False,
+            writable=False),
+        Field('ExportType',
+            readable=False,
+            writable=False),
+        Field('Status',
+            default='queued',
+            requires=IS_IN_SET(statuses),
+            represent=lambda value, row: T(value.capitalize()) if value else '',
+            label=T("Status")),
+        Field('FileName',
+            label=T("File")),
+        Field('ExportFile', 'upload', autodelete=True,
+            readable=False,
+            writable=False),
+        Field('CreatedOn', 'datetime',
+            readable=False,
+            writable=False,
+            default=datetime.datetime.now(),
+            represent=represent_datetime,
+            label=T("Created")),
+        Field('FinishedOn', 'datetime',
+            readable=False,
+            writable=False,
+            represent=represent_datetime,
+            label=T("Finished")),
+    )
+
+
 def define_mailing_lists():
     """
         Define mailing lists table
@@ -6638,9 +6969,19 @@ auth.settings.extra_fields['auth_user'] = [
 
 auth.define_tables(username=False, signature=False)
 
+# Check groups & permissions of the logged in user without querying the auth tables
+os_permissions = OsPermissions(auth)
+os_permissions.install()
+for auth_table in [db.auth_group, db.auth_membership, db.auth_permission]:
+    auth_table._after_insert.append(os_permissions.after_insert)
+    auth_table._after_update.append(os_permissions.after_update)
+    auth_table._after_delete.append(os_permissions.after_delete)
+
 # Set format for auth_user.id
 db.auth_user._format = '%(display_name)s'
 
+define_pos_customers_directory()
+
 # set up email
 current.mail = mail
 
@@ -6661,6 +7002,7 @@ if not CURRENCY:
 define_sys_organizations()
 define_sys_api_users()
 define_sys_files()
+define_sys_exports()
 define_sys_accounting()
 define_sys_email_templates()
 define_sys_notifications()
@@ -6714,6 +7056,7 @@ define_customers_notes()
 define_customers_payment_info()
 define_customers_payment_info_mandates()
 define_customers_messages()
+define_mail_outbox()
 define_customers_memberships()
 define_customers_subscriptions()
 define_customers_subscriptions_paused()
@@ -6742,6 +7085,7 @@ define_classes_reservation()
 define_classes_reservation_cancelled()
 define_classes_waitinglist()
 define_classes_attendance()
+define_classes_attendance_count()
 define_classes_attendance_override()
 define_teachers_classtypes()
 define_classes_subteachers()
@@ -6749,10 +7093,26 @@ define_classes_notes()
 define_classes_schedule_counts()
 define_classes_school_subscriptions_groups()
 define_classes_school_classcards_groups()
+
+# Compiled class permissions of school subscriptions & class cards
+os_class_permissions = OsClassPermissions()
+for group_table in [db.school_subscriptions_groups,
+                    db.school_subscriptions_groups_subscriptions,
+                    db.classes_school_subscriptions_groups,
+                    db.school_classcards_groups,
+                    db.school_classcards_groups_classcards,
+                    db.classes_school_classcards_groups]:
+    group_table._after_insert.append(os_class_permissions.after_insert)
+    group_table._after_update.append(os_class_permissions.after_update)
+    group_table._after_delete.append(os_class_permissions.after_delete)
+db.classes._after_update.append(os_class_permissions.after_update_classes)
+db.classes._after_delete.append(os_class_permissions.after_delete)
+
 define_tasks()
 define_announcements()
 define_school_holidays()
 define_school_holidays_locations()
+define_classes_occurrences()
 define_schedule_classes_status()
 
 # teacher payment definitions (depend on classes and auth_user)
@@ -6765,6 +7125,7 @@ define_teachers_payment_attendance_lists_school_classtypes()
 define_teachers_payment_classes()
 
 define_customers_subscriptions_credits()
+define_customers_subscriptions_credits_balance()
 define_log_customers_accepted_documents()
 
 # order definitions
@@ -6810,6 +7171,7 @@ define_invoices_payments()
 define_invoices_customers()
 define_invoices_customers_orders()
 define_invoices_mollie_payment_ids()
+define_invoices_mollie_recurring_collection()
 # define_invoices_classes_attendance()
 # define_invoices_customers_memberships()
 # define_invoices_customers_subscriptions()
@@ -6842,6 +7204,14 @@ define_mollie_log_webhook()
 
 set_preferences_permissions()
 
+# Create declared secondary indexes on migrate
+if configuration.get('db.migrate') or \
+   web2pytest.is_running_under_test(request, request.application):
+    os_db_indexes.apply()
+else:
+    # Upserts don't work without the unique indexes they depend on
+    os_db_indexes.apply(unique_only=True)
+
 # some system maintendance
 create_admin_user_and_group()
 setup()
@@ -759,9 +759,10 @@ elif request.controller == 'ep':
 else:
     if auth.user:
         cache_key = 'openstudio_menu_backend_user_' + str(auth.user.id)
-        response.menu = cache.ram(cache_key,
-                                 lambda: get_backend_menu(),
-                                 time_expire=259200)
+        response.menu = os_cache_manager.get_tagged(cache_key,
+                                                    lambda: get_backend_menu(),
+                                                    ['menu_backend'],
+                                                    time_expire=259200)
     else:
         response.menu = ''
 
@@ -1073,147 +1073,258 @@ class AttendanceHelper:
         :param controller: web2py controller
         :return: list of booking options
         """
+        cuID = int(customer.cuID)
+
+        options = self.get_customers_class_booking_options(
+            clsID,
+            date,
+            [cuID],
+            trial=trial,
+            request_review=request_review,
+            complementary=complementary,
+            list_type=list_type
+        )
+
+        return options[cuID]
+
+
+    def get_customers_class_booking_options(self,
+                                            clsID,
+                                            date,
+                                            customer_ids,
+                                            trial=False,
+                                            request_review=False,
+                                            complementary=False,
+                                            list_type='shop'):
+        """
+        Booking options for multiple customers. Subscriptions, class cards,
+        memberships, permissions and prices of all customers are fetched
+        together, so the number of queries doesn't depend on the number of customers.
+        :param clsID: db.classes.id
+        :param date: datetime.date
+        :param customer_ids: list of db.auth_user.id
+        :param trial: bool
+        :param request_review: bool
+        :param complementary: bool
+        :param list_type: should be in ["shop", "attendance", "selfcheckin", "pos"]
+        :return: dict {auth_user.id: booking options}
+        """
         from .os_class import Class
-        from .os_customer_classcard import CustomerClasscard
-        from .os_customer_subscription import CustomerSubscription
-        from .os_school import School
-        from .os_school_subscription import SchoolSubscription
-        from .tools import OsTools
-        from general_helpers import get_last_day_month
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
 
         T = current.T
-        db = current.db
-        TODAY_LOCAL = current.TODAY_LOCAL
-        school = School()
-        os_tools = OsTools()
         get_sys_property = current.globalenv['get_sys_property']
 
-        options = {
-            'subscriptions': [],
-            'classcards': [],
-            'dropin': False,
-            'trial': False,
-            'complementary': False
-        }
-
-        # Subscriptions
-        subscriptions = customer.get_subscriptions_on_date(date)
-        subscription_ids = []
-        if subscriptions:
-            for subscription in subscriptions:
-                csID = subscription.customers_subscriptions.id
-                subscription_ids.append(subscription.school_subscriptions.id)
-                # Check remaining credits
-                credits = subscription.customers_subscriptions.CreditsRemaining or 0
-                recon_classes = subscription.school_subscriptions.ReconciliationClasses
-                # Create subscription object
-                cs = CustomerSubscription(csID)
+        clsID = int(clsID)
+        customer_ids = [int(cuID) for cuID in customer_ids]
+        if not customer_ids:
+            return {}
 
-                if list_type == 'shop':
-                    subscription_permission_check = not int(clsID) in cs.get_allowed_classes_booking(public_only=True)
-                else:
-                    # Attendance, PoS, Selfcheckin
-                    subscription_permission_check = not int(clsID) in cs.get_allowed_classes_attend(public_only=False)
+        cls = Class(clsID, date)
+        prices = cls.get_prices()
+        dropin_message = get_sys_property('shop_classes_dropin_message') or ''
+        reconcile_later = get_sys_property('system_enable_class_checkin_reconcile_later')
+
+        # Shop & back-end use different permissions
+        if list_type == 'shop':
+            permission = 'ShopBook'
+            public_only = True
+        else:
+            # Attendance, PoS, Selfcheckin
+            permission = 'Attend'
+            public_only = False
+
+        subscriptions = self._get_booking_options_subscriptions(customer_ids, date)
+        credits_balances = CustomersSubscriptionsCreditsBalances()
+        ssu_ids = set()
+        cs_ids = []
+        for rows in subscriptions.values():
+            for row in rows:
+                ssu_ids.add(row.school_subscriptions.id)
+                cs_ids.append(row.customers_subscriptions.id)
+
+        classcards = self._get_booking_options_classcards(customer_ids, date)
+        scd_ids = set()
+        ccd_ids = []
+        for rows in classcards.values():
+            for row in rows:
+                scd_ids.add(row.customers_classcards.school_classcards_id)
+                ccd_ids.append(row.customers_classcards.id)
+
+        allowed_subscriptions = set()
+        allowed_classcards = set()
+        if not public_only or cls.cls.AllowAPI:
+            allowed_subscriptions = self._get_booking_options_allowed_subscriptions(
+                clsID, ssu_ids, permission
+            )
+            allowed_classcards = self._get_booking_options_allowed_classcards(
+                clsID, scd_ids, permission
+            )
+
+        blocked = self._get_booking_options_blocked_subscriptions(cs_ids, date)
+        classes_used = self._get_booking_options_classcards_classes_used(ccd_ids)
 
-                allowed = True
-                if subscription_permission_check:
-                    allowed = False
+        members = set()
+        if prices['school_memberships_id']:
+            members = self._get_booking_options_members(
+                customer_ids, prices['school_memberships_id'], date
+            )
 
-                credits_remaining = credits > (recon_classes * -1)
+        shop_subscriptions = []
+        shop_classcards = []
+        if list_type == 'pos':
+            shop_subscriptions = self._get_booking_options_shop_subscriptions(clsID)
+            shop_classcards = self._get_booking_options_shop_classcards(clsID)
+
+        trial_customers = self._get_booking_options_trial_customers(customer_ids,
+                                                                    list_type,
+                                                                    trial)
+
+        under_review = set()
+        if request_review:
+            under_review = self._get_booking_options_under_review(clsID, date, customer_ids)
+
+        customers_options = {}
+        for cuID in customer_ids:
+            options = {
+                'subscriptions': [],
+                'classcards': [],
+                'dropin': False,
+                'trial': False,
+                'complementary': False
+            }
+
+            # Subscriptions
+            subscription_ids = []
+            for row in subscriptions.get(cuID, []):
+                csID = row.customers_subscriptions.id
+                subscription_ids.append(row.school_subscriptions.id)
+                # Check remaining credits
+                balance = row.customers_subscriptions_credits_balance.Balance
+                if balance is None:
+                    # No balance stored (yet), sum mutations
+                    credits = credits_balances.get(csID)
+                else:
+                    credits = round(balance, 1)
+                recon_classes = row.school_subscriptions.ReconciliationClasses or 0
 
                 options['subscriptions'].append({
                     'clsID': clsID,
                     'Type': 'subscription',
                     'id': csID,
-                    'auth_customer_id': subscription.customers_subscriptions.auth_customer_id,
-                    'Name': subscription.school_subscriptions.Name,
-                    'Allowed': allowed,
+                    'auth_customer_id': row.customers_subscriptions.auth_customer_id,
+                    'Name': row.school_subscriptions.Name,
+                    'Allowed': row.school_subscriptions.id in allowed_subscriptions,
                     'Credits': credits,
-                    'CreditsRemaining': credits_remaining,
-                    'Unlimited': subscription.school_subscriptions.Unlimited,
-                    'school_memberships_id': subscription.school_subscriptions.school_memberships_id,
-                    'Blocked': cs.get_blocked(date)
+                    'CreditsRemaining': credits > (recon_classes * -1),
+                    'Unlimited': row.school_subscriptions.Unlimited,
+                    'school_memberships_id': row.school_subscriptions.school_memberships_id,
+                    'Blocked': csID in blocked
                 })
 
-        # PoS Subscriptions (Add all subscriptions customer doesn't have as "shop item")
-        if list_type == "pos":
-            school_subscriptions = school.get_subscriptions(public_only=False)
-            for school_subscription in school_subscriptions:
+            # PoS Subscriptions (Add all subscriptions customer doesn't have as "shop item")
+            for shop_subscription in shop_subscriptions:
                 # Prevent showing already bought subscription as shop option for customer
-                if school_subscription.id not in subscription_ids:
-                    ssu = SchoolSubscription(school_subscription.id)
-                    first_next_month = get_last_day_month(TODAY_LOCAL) + datetime.timedelta(days=1)
-
-                    options['subscriptions'].append({
-                        'clsID': clsID,
-                        'Type': 'subscription_shop',
-                        'id': school_subscription.id,
-                        'Name': school_subscription.Name,
-                        'school_memberships_id': school_subscription.school_memberships_id,
-                        'Price': ssu.get_price_today_display(formatted=False),
-                        'PriceMonth': ssu.get_price_on_date(first_next_month, formatted=False)
-                    })
-
-        # class cards
-        classcards = customer.get_classcards(date)
-        classcard_ids = []
-        if classcards:
-            for classcard in classcards:
-                ccdID = classcard.customers_classcards.id
-                ccd = CustomerClasscard(ccdID)
-                classcard_ids.append(ccd.school_classcard.id)
-
-                classes_remaining = ccd.get_classes_remaining()
-
-                if list_type == 'shop':
-                    allowed_classes = ccd.get_allowed_classes_booking()
+                if shop_subscription['id'] not in subscription_ids:
+                    options['subscriptions'].append(dict(shop_subscription))
+
+            # class cards
+            classcard_ids = []
+            for row in classcards.get(cuID, []):
+                ccdID = row.customers_classcards.id
+                scdID = row.customers_classcards.school_classcards_id
+                classcard_ids.append(scdID)
+
+                if row.school_classcards.Unlimited:
+                    classes_remaining = 'unlimited'
                 else:
-                    allowed_classes = ccd.get_allowed_classes_attend(public_only=False)
-
-                allowed = True
-                if not int(clsID) in allowed_classes:
-                    allowed = False
+                    classes_remaining = (row.school_classcards.Classes or 0) - classes_used.get(ccdID, 0)
 
                 options['classcards'].append({
                     'clsID': clsID,
                     'Type': 'classcard',
                     'id': ccdID,
-                    'auth_customer_id': classcard.customers_classcards.auth_customer_id,
-                    'Name': classcard.school_classcards.Name,
-                    'Allowed': allowed,
-                    'Enddate': classcard.customers_classcards.Enddate,
+                    'auth_customer_id': row.customers_classcards.auth_customer_id,
+                    'Name': row.school_classcards.Name,
+                    'Allowed': scdID in allowed_classcards,
+                    'Enddate': row.customers_classcards.Enddate,
                     'ClassesRemaining': classes_remaining,
-                    'Unlimited': classcard.school_classcards.Unlimited,
-                    'school_memberships_id': classcard.school_classcards.school_memberships_id,
+                    'Unlimited': row.school_classcards.Unlimited,
+                    'school_memberships_id': row.school_classcards.school_memberships_id,
                 })
 
-        # PoS Subscriptions (Add all subscriptions customer doesn't have as "shop item")
-        if list_type == "pos":
-            school_classcards = school.get_classcards(public_only=False)
-            for school_classcard in school_classcards:
-                # Prevent showing already bought subscription as shop option for customer
-                if school_classcard.id not in classcard_ids:
-                    # ssu = SchoolSubscription(school_subscription.id)
-                    options['classcards'].append({
+            # PoS class cards (Add all cards customer doesn't have as "shop item")
+            for shop_classcard in shop_classcards:
+                # Prevent showing already bought card as shop option for customer
+                if shop_classcard['id'] not in classcard_ids:
+                    options['classcards'].append(dict(shop_classcard))
+
+            ## Dropin
+            has_membership = cuID in members
+            self._set_booking_options_dropin(options, clsID, prices, has_membership,
+                                             list_type, dropin_message)
+
+            # Trial
+            if cuID in trial_customers:
+                price = prices['trial'] or 0
+                membership_price = has_membership and prices['trial_membership']
+                if membership_price:
+                    price = prices['trial_membership']
+
+                options['trial'] = {
+                    'clsID': clsID,
+                    "Type": "trial",
+                    "Name": T('Trial'),
+                    "Price": price,
+                    "MembershipPrice": membership_price,
+                    "Message": get_sys_property('shop_classes_trial_message') or ''
+                }
+
+            # Request review
+            options['under_review'] = False
+            if request_review:
+                if cuID in under_review:
+                    options['under_review'] = True
+                else:
+                    options['request_review'] = {
                         'clsID': clsID,
-                        'Type': 'classcard_shop',
-                        'id': school_classcard.id,
-                        'Name': school_classcard.Name,
-                        'school_memberships_id': school_classcard.school_memberships_id,
-                        'Price': school_classcard.Price
-                    })
+                        "Type": "request_review",
+                        "Name": T('Request review'),
+                    }
 
-        # Get class prices
-        cls = Class(clsID, date)
-        prices = cls.get_prices()
+            # Complementary
+            if complementary:
+                options['complementary'] = {
+                    'clsID': clsID,
+                    "Type": "complementary",
+                    "Name": T('Complementary'),
+                }
 
-        ## Dropin
-        price = prices['dropin']
-        has_membership = False
-        if prices['school_memberships_id']:
-            # A membership price might be available
-            has_membership = customer.has_given_membership_on_date(prices['school_memberships_id'], date)
+            # Reconcile later
+            if reconcile_later:
+                options['reconcile_later'] = {
+                    'clsID': clsID,
+                    "Type": "reconcile_later",
+                    "Name": T('Reconcile later'),
+                }
+
+            customers_options[cuID] = options
+
+        return customers_options
 
+
+    def _set_booking_options_dropin(self, options, clsID, prices, has_membership, list_type, message):
+        """
+        Add drop-in options
+        :param options: dict - booking options for a customer
+        :param prices: dict returned by os_class.Class.get_prices()
+        :param has_membership: bool - customer has the membership required for membership prices
+        :param message: string - shop_classes_dropin_message
+        :return: None
+        """
+        T = current.T
+
+        price = prices['dropin']
         # MembershipPrice in option['dropin'] is a boolean
 
         if list_type != "pos":
@@ -1228,7 +1339,7 @@ class AttendanceHelper:
                     "Name": T('Drop-in'),
                     "Price": price,
                     "MembershipPrice": membership_price,
-                    "Message": get_sys_property('shop_classes_dropin_message') or ''
+                    "Message": message
                 }
         else:
             # List type "pos"
@@ -1245,7 +1356,7 @@ class AttendanceHelper:
                     "Name": T('Drop-in'),
                     "Price": price,
                     "MembershipPrice": membership_price,
-                    "Message": get_sys_property('shop_classes_dropin_message') or ''
+                    "Message": message
                 }
 
             else:
@@ -1259,7 +1370,7 @@ class AttendanceHelper:
                         "Name": T('Drop-in'),
                         "Price": prices['dropin_membership'],
                         "MembershipPrice": True,
-                        "Message": get_sys_property('shop_classes_dropin_message') or '',
+                        "Message": message,
                         "school_memberships_id": prices['school_memberships_id']
                     }
 
@@ -1269,147 +1380,314 @@ class AttendanceHelper:
                     "Name": T('Drop-in'),
                     "Price": prices['dropin'],
                     "MembershipPrice": False,
-                    "Message": get_sys_property('shop_classes_dropin_message') or ''
+                    "Message": message
                 }
 
 
-        # Trial
-        trial_option = self._get_customer_class_booking_option_trial(
-            clsID,
-            date,
-            customer,
-            prices,
-            list_type,
-            trial
-        )
-        print('trial option')
-        print(trial_option)
-        if trial_option:
-            options['trial'] = trial_option
-
-        # system_enable_class_checkin_trialclass = get_sys_property('system_enable_class_checkin_trialclass')
-        # shop_allow_trial_classes_for_existing_customers = get_sys_property('shop_allow_trial_classes_for_existing_customers')
-        #
-        # if trial and system_enable_class_checkin_trialclass:
-        #     if list_type == 'shop':
-        #         if shop_allow_trial_classes_for_existing_customers:
-        #             # Check if customer has or had a card or subscription
-        #             has_or_had_subscription = customer.get_has_or_had_subscription()
-        #             has_or_had_card = customer.get_has_or_had_classcard()
-        #
-        #             if has_or_had_card or has_or_had_subscription:
-        #
-        #
-        #
-        #     price = prices['trial'] or 0
-        #     membership_price = has_membership and prices['trial_membership']
-        #     if membership_price:
-        #         price = prices['trial_membership']
-        #
-        #     options['trial'] = {
-        #         'clsID': clsID,
-        #         "Type": "trial",
-        #         "Name": T('Trial'),
-        #         "Price": price,
-        #         "MembershipPrice": membership_price,
-        #         "Message": get_sys_property('shop_classes_trial_message') or ''
-        #     }
+    def _get_booking_options_subscriptions(self, customer_ids, date):
+        """
+        :param customer_ids: list of db.auth_user.id
+        :param date: datetime.date
+        :return: dict {auth_user.id: [rows]} - subscriptions on date with credit balance
+        """
+        db = current.db
 
-        # Request review
-        options['under_review'] = False
-        if request_review:
-            under_review = self._attendance_sign_in_check_under_review(
-                clsID,
-                customer.row.id,
-                date
+        left = [
+            db.school_subscriptions.on(
+                db.customers_subscriptions.school_subscriptions_id ==
+                db.school_subscriptions.id
+            ),
+            db.customers_subscriptions_credits_balance.on(
+                db.customers_subscriptions_credits_balance.customers_subscriptions_id ==
+                db.customers_subscriptions.id
             )
+        ]
 
-            if under_review:
-                options['under_review'] = True
-            else:
-                options['request_review'] = {
-                    'clsID': clsID,
-                    "Type": "request_review",
-                    "Name": T('Request review'),
-                }
+        query = (db.customers_subscriptions.auth_customer_id.belongs(customer_ids)) & \
+                (db.customers_subscriptions.Startdate <= date) & \
+                ((db.customers_subscriptions.Enddate >= date) |
+                 (db.customers_subscriptions.Enddate == None))
+
+        rows = db(query).select(db.customers_subscriptions.id,
+                                db.customers_subscriptions.auth_customer_id,
+                                db.school_subscriptions.id,
+                                db.school_subscriptions.Name,
+                                db.school_subscriptions.ReconciliationClasses,
+                                db.school_subscriptions.Unlimited,
+                                db.school_subscriptions.school_memberships_id,
+                                db.customers_subscriptions_credits_balance.Balance,
+                                left=left,
+                                orderby=db.customers_subscriptions.Startdate)
 
-        # Complementary
-        if complementary:
-            options['complementary'] = {
-                'clsID': clsID,
-                "Type": "complementary",
-                "Name": T('Complementary'),
-            }
+        data = {}
+        for row in rows:
+            data.setdefault(row.customers_subscriptions.auth_customer_id, []).append(row)
 
-        # Reconcile later
-        system_enable_class_checkin_reconcile_later = get_sys_property('system_enable_class_checkin_reconcile_later')
-        if system_enable_class_checkin_reconcile_later:
-            options['reconcile_later'] = {
+        return data
+
+
+    def _get_booking_options_classcards(self, customer_ids, date):
+        """
+        :param customer_ids: list of db.auth_user.id
+        :param date: datetime.date
+        :return: dict {auth_user.id: [rows]} - class cards on date,
+        same conditions as os_customer.Customer.get_classcards()
+        """
+        db = current.db
+
+        left = [
+            db.school_classcards.on(
+                db.customers_classcards.school_classcards_id ==
+                db.school_classcards.id
+            )
+        ]
+
+        query = (db.customers_classcards.auth_customer_id.belongs(customer_ids)) & \
+                (db.customers_classcards.Startdate <= date) & \
+                ((db.customers_classcards.Enddate >= date) |
+                 (db.customers_classcards.Enddate == None)) & \
+                ((db.school_classcards.Classes > db.customers_classcards.ClassesTaken) |
+                 (db.school_classcards.Classes == 0) |
+                 (db.school_classcards.Unlimited == True))
+
+        rows = db(query).select(db.customers_classcards.id,
+                                db.customers_classcards.auth_customer_id,
+                                db.customers_classcards.school_classcards_id,
+                                db.customers_classcards.Enddate,
+                                db.school_classcards.Name,
+                                db.school_classcards.Classes,
+                                db.school_classcards.Unlimited,
+                                db.school_classcards.school_memberships_id,
+                                left=left,
+                                orderby=db.customers_classcards.Enddate)
+
+        data = {}
+        for row in rows:
+            data.setdefault(row.customers_classcards.auth_customer_id, []).append(row)
+
+        return data
+
+
+    def _get_booking_options_allowed_subscriptions(self, clsID, ssu_ids, permission):
+        """
+        :param clsID: db.classes.id
+        :param ssu_ids: list of db.school_subscriptions.id
+        :param permission: string - 'ShopBook' or 'Attend'
+        :return: set of db.school_subscriptions.id allowed for class
+        """
+        os_class_permissions = current.globalenv['os_class_permissions']
+
+        return os_class_permissions.get_allowed_subscriptions(clsID, ssu_ids, permission)
+
+
+    def _get_booking_options_allowed_classcards(self, clsID, scd_ids, permission):
+        """
+        :param clsID: db.classes.id
+        :param scd_ids: list of db.school_classcards.id
+        :param permission: string - 'ShopBook' or 'Attend'
+        :return: set of db.school_classcards.id allowed for class
+        """
+        os_class_permissions = current.globalenv['os_class_permissions']
+
+        return os_class_permissions.get_allowed_classcards(clsID, scd_ids, permission)
+
+
+    def _get_booking_options_blocked_subscriptions(self, cs_ids, date):
+        """
+        :param cs_ids: list of db.customers_subscriptions.id
+        :param date: datetime.date
+        :return: set of db.customers_subscriptions.id blocked on date
+        """
+        db = current.db
+
+        if not cs_ids:
+            return set()
+
+        query = (db.customers_subscriptions_blocked.customers_subscriptions_id.belongs(cs_ids)) & \
+                (db.customers_subscriptions_blocked.Startdate <= date) & \
+                ((db.customers_subscriptions_blocked.Enddate >= date) |
+                 (db.customers_subscriptions_blocked.Enddate == None))
+        rows = db(query).select(db.customers_subscriptions_blocked.customers_subscriptions_id)
+
+        return set([row.customers_subscriptions_id for row in rows])
+
+
+    def _get_booking_options_classcards_classes_used(self, ccd_ids):
+        """
+        :param ccd_ids: list of db.customers_classcards.id
+        :return: dict {customers_classcards.id: number of classes taken}
+        """
+        db = current.db
+
+        if not ccd_ids:
+            return {}
+
+        count = db.classes_attendance.id.count()
+        query = (db.classes_attendance.customers_classcards_id.belongs(ccd_ids)) & \
+                (db.classes_attendance.BookingStatus != 'cancelled')
+        rows = db(query).select(db.classes_attendance.customers_classcards_id,
+                                count,
+                                groupby=db.classes_attendance.customers_classcards_id)
+
+        return {row.classes_attendance.customers_classcards_id: row[count] for row in rows}
+
+
+    def _get_booking_options_members(self, customer_ids, school_memberships_id, date):
+        """
+        :param customer_ids: list of db.auth_user.id
+        :param school_memberships_id: db.school_memberships.id
+        :param date: datetime.date
+        :return: set of db.auth_user.id with given membership on date
+        """
+        db = current.db
+
+        query = (db.customers_memberships.auth_customer_id.belongs(customer_ids)) & \
+                (db.customers_memberships.school_memberships_id == school_memberships_id) & \
+                (db.customers_memberships.Startdate <= date) & \
+                ((db.customers_memberships.Enddate >= date) |
+                 (db.customers_memberships.Enddate == None))
+        rows = db(query).select(db.customers_memberships.auth_customer_id)
+
+        return set([row.auth_customer_id for row in rows])
+
+
+    def _get_booking_options_shop_subscriptions(self, clsID):
+        """
+        :param clsID: db.classes.id
+        :return: list of subscription options to sell in the PoS
+        """
+        from .os_school import School
+        from .os_school_subscription import SchoolSubscription
+        from general_helpers import get_last_day_month
+
+        TODAY_LOCAL = current.TODAY_LOCAL
+
+        first_next_month = get_last_day_month(TODAY_LOCAL) + datetime.timedelta(days=1)
+
+        options = []
+        for school_subscription in School().get_subscriptions(public_only=False):
+            ssu = SchoolSubscription(school_subscription.id)
+            options.append({
                 'clsID': clsID,
-                "Type": "reconcile_later",
-                "Name": T('Reconcile later'),
-            }
+                'Type': 'subscription_shop',
+                'id': school_subscription.id,
+                'Name': school_subscription.Name,
+                'school_memberships_id': school_subscription.school_memberships_id,
+                'Price': ssu.get_price_today_display(formatted=False),
+                'PriceMonth': ssu.get_price_on_date(first_next_month, formatted=False)
+            })
 
+        return options
+
+
+    def _get_booking_options_shop_classcards(self, clsID):
+        """
+        :param clsID: db.classes.id
+        :return: list of class card options to sell in the PoS
+        """
+        from .os_school import School
+
+        options = []
+        for school_classcard in School().get_classcards(public_only=False):
+            options.append({
+                'clsID': clsID,
+                'Type': 'classcard_shop',
+                'id': school_classcard.id,
+                'Name': school_classcard.Name,
+                'school_memberships_id': school_classcard.school_memberships_id,
+                'Price': school_classcard.Price
+            })
 
         return options
 
 
-    def _get_customer_class_booking_option_trial(self, clsID, date, customer, prices, list_type, trial):
+    def _get_booking_options_trial_customers(self, customer_ids, list_type, trial):
         """
-        :param customer: os_customer obj
+        :param customer_ids: list of db.auth_user.id
         :param list_type: string
         :param trial: boolean
-        :return: checkin option
+        :return: set of db.auth_user.id to offer a trial class
         """
         from .tools import OsTools
+
+        db = current.db
         os_tools = OsTools()
-        T = current.T
 
         system_enable_class_checkin_trialclass = os_tools.get_sys_property(
             'system_enable_class_checkin_trialclass')
+
+        if not (trial and system_enable_class_checkin_trialclass == "on"):
+            return set()
+
+        customers = set(customer_ids)
+        if list_type != 'shop':
+            return customers
+
         shop_allow_trial_classes_for_existing_customers = os_tools.get_sys_property(
             'shop_allow_trial_classes_for_existing_customers')
 
-        if trial and system_enable_class_checkin_trialclass == "on":
-            if list_type == 'shop':
-                if not shop_allow_trial_classes_for_existing_customers == "on":
-                    # Check if customer has or had a card or subscription
-                    has_or_had_subscription = customer.get_has_or_had_subscription()
-                    has_or_had_card = customer.get_has_or_had_classcard()
+        if not shop_allow_trial_classes_for_existing_customers == "on":
+            # Remove customers who have or had a card or subscription
+            query = (db.customers_subscriptions.auth_customer_id.belongs(customer_ids))
+            rows = db(query).select(db.customers_subscriptions.auth_customer_id, distinct=True)
+            customers -= set([row.auth_customer_id for row in rows])
 
-                    if has_or_had_card or has_or_had_subscription:
-                        return
+            left = [
+                db.school_classcards.on(
+                    db.customers_classcards.school_classcards_id ==
+                    db.school_classcards.id
+                )
+            ]
+            query = (db.customers_classcards.auth_customer_id.belongs(customer_ids)) & \
+                    (db.school_classcards.Trialcard == False)
+            rows = db(query).select(db.customers_classcards.auth_customer_id,
+                                    left=left,
+                                    distinct=True)
+            customers -= set([row.auth_customer_id for row in rows])
+        else:
+            # Check trial class booking limit for shop
+            shop_classes_trial_limit = os_tools.get_sys_property('shop_classes_trial_limit')
+            if shop_classes_trial_limit:
+                # A limit has been set, count trial classes taken
+                count = db.classes_attendance.id.count()
+                query = (db.classes_attendance.auth_customer_id.belongs(customer_ids)) & \
+                        (db.classes_attendance.AttendanceType == 1)
+                rows = db(query).select(db.classes_attendance.auth_customer_id,
+                                        count,
+                                        groupby=db.classes_attendance.auth_customer_id)
+                for row in rows:
+                    # No trial class booking option if over limit
+                    if row[count] >= int(shop_classes_trial_limit):
+                        customers.discard(row.classes_attendance.auth_customer_id)
+
+        return customers
+
+
+    def _get_booking_options_under_review(self, clsID, date, customer_ids):
+        """
+        :param clsID: db.classes.id
+        :param date: datetime.date
+        :param customer_ids: list of db.auth_user.id
+        :return: set of db.auth_user.id with a check-in under review,
+        same check as _attendance_sign_in_check_under_review()
+        """
+        db = current.db
 
-                else:
-                    # Check trial class booking limit for shop
-                    shop_classes_trial_limit = os_tools.get_sys_property('shop_classes_trial_limit')
-                    if shop_classes_trial_limit:
-                        # A limit has been set, count trial classes taken
-                        trial_class_count = customer.get_trialclass_count()
-                        if trial_class_count >= int(shop_classes_trial_limit):
-                            # No trial class booking option if over limit
-                            return
-
-            price = prices['trial'] or 0
-            has_membership = False
-            if prices['school_memberships_id']:
-                has_membership = customer.has_given_membership_on_date(prices['school_memberships_id'], date)
-            membership_price = has_membership and prices['trial_membership']
-            if membership_price:
-                price = prices['trial_membership']
+        query = (db.classes_attendance.classes_id == clsID) & \
+                (db.classes_attendance.auth_customer_id.belongs(customer_ids)) & \
+                (db.classes_attendance.ClassDate == date) & \
+                (db.classes_attendance.BookingStatus != 'cancelled')
+        rows = db(query).select(db.classes_attendance.auth_customer_id,
+                                db.classes_attendance.AttendanceType,
+                                orderby=db.classes_attendance.id)
 
-            trial_option = {
-                'clsID': clsID,
-                "Type": "trial",
-                "Name": T('Trial'),
-                "Price": price,
-                "MembershipPrice": membership_price,
-                "Message": os_tools.get_sys_property('shop_classes_trial_message') or ''
-            }
+        attendance_types = {}
+        for row in rows:
+            attendance_types.setdefault(row.auth_customer_id, row.AttendanceType)
+
+        return set([cuID for cuID, attendance_type in attendance_types.items()
+                    if attendance_type == 5])
 
-            return trial_option
-        else:
-            return
 
     def get_customer_class_booking_options_formatted(self,
                                                      clsID,
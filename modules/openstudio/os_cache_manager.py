@@ -1,8 +1,213 @@
 # -*- coding: utf-8 -*-
 
+import time
+import threading
+
 from gluon import *
 
+
 class OsCacheManager:
+    """
+        Cache entries are registered under one or more tags when they're stored
+        using get_tagged(). Clearing a tag only deletes the keys registered for
+        that tag, instead of matching a regex against every key in the cache.
+    """
+    # Keys registered for each tag when cache.ram is used (in process),
+    # {tag key: {cache key: time the key expires}}.
+    # When redis is used as cache, tags are stored in redis sets.
+    _tags = {}
+    _tags_lock = threading.Lock()
+    _tags_pruned = 0
+
+    # Seconds between removing expired keys from the tags registered in process
+    prune_interval = 300
+    # Max number of keys registered for a tag in process. When more keys are
+    # registered, the keys expiring first are removed from cache.
+    max_keys_per_tag = 10000
+
+
+    def _get_tag_key(self, tag):
+        """
+        :param tag: string - tag name
+        :return: string - key used to store the tag
+        """
+        request = current.request
+
+        return 'w2p:%s:___openstudio_cache_tag:%s' % (request.application, tag)
+
+
+    def _get_redis(self):
+        """
+        :return: redis connection when redis is used as cache, otherwise None
+        """
+        cache = current.cache
+        redis_cache = getattr(cache, 'redis', None)
+        if redis_cache is None:
+            return None
+
+        return redis_cache.r_server
+
+
+    def is_shared(self):
+        """
+        :return: Boolean - True when cache entries & tags are shared between
+                 processes (redis), so clearing a tag applies to all workers
+        """
+        return self._get_redis() is not None
+
+
+    def _register_tags(self, key, tags, time_expire):
+        """
+        :param key: string - cache key
+        :param tags: list of strings - tags to register key under
+        :param time_expire: int - seconds
+        :return: None
+        """
+        r_server = self._get_redis()
+        if r_server:
+            tag_expire = max(time_expire or 0, current.CACHE_LONG)
+            pipe = r_server.pipeline()
+            for tag in tags:
+                tag_key = self._get_tag_key(tag)
+                pipe.sadd(tag_key, key)
+                pipe.expire(tag_key, tag_expire)
+            pipe.execute()
+        else:
+            cache = current.cache
+
+            now = time.time()
+            expires = now + time_expire if time_expire else float('inf')
+
+            removed = []
+            with self._tags_lock:
+                for tag in tags:
+                    keys = self._tags.setdefault(self._get_tag_key(tag), {})
+                    keys[key] = max(keys.get(key, 0), expires)
+                    if len(keys) > self.max_keys_per_tag:
+                        removed += self._remove_first_expiring(keys, len(keys) - self.max_keys_per_tag)
+
+                if now - OsCacheManager._tags_pruned > self.prune_interval:
+                    OsCacheManager._tags_pruned = now
+                    removed += self._remove_expired(now)
+
+            for removed_key in removed:
+                # Calling cache with f=None deletes the key
+                cache.ram(removed_key, None)
+
+
+    def _remove_first_expiring(self, keys, count):
+        """
+        Call with _tags_lock held
+        :param keys: dict {cache key: time the key expires} registered for a tag
+        :param count: int - number of keys to remove
+        :return: list of removed cache keys
+        """
+        removed = sorted(keys, key=lambda k: keys[k])[:count]
+        for key in removed:
+            del keys[key]
+
+        return removed
+
+
+    def _remove_expired(self, now):
+        """
+        Remove expired keys from all tags registered in process.
+        Call with _tags_lock held
+        :param now: float - time.time()
+        :return: list of removed cache keys
+        """
+        removed = []
+        for tag_key in list(self._tags):
+            keys = self._tags[tag_key]
+            expired = [key for key, expires in keys.items() if expires < now]
+            for key in expired:
+                del keys[key]
+            if not keys:
+                del self._tags[tag_key]
+            removed += expired
+
+        return removed
+
+
+    def get_tagged(self, key, f, tags, time_expire=None):
+        """
+        Get value from cache.ram, or store the result of f when the key isn't found
+        :param key: string - cache key
+        :param f: function - called to get the value when key isn't in cache
+        :param tags: list of strings - tags to register the key under
+        :param time_expire: int - seconds
+        :return: cached value
+        """
+        cache = current.cache
+
+        # Register before storing, so a clear in between can't be missed
+        self._register_tags(key, tags, time_expire)
+
+        return cache.ram(key, f, time_expire=time_expire)
+
+
+    def get_versioned(self, f):
+        """
+        :param f: function - returns the value to version
+        :return: dict {'data': value returned by f,
+                       'version': string - hash of value,
+                       'modified': datetime.datetime (UTC) - time the value was created}
+        """
+        import hashlib
+        import datetime
+
+        data = f()
+
+        return {
+            'data': data,
+            'version': hashlib.sha1(repr(data).encode('utf-8')).hexdigest(),
+            'modified': datetime.datetime.utcnow().replace(microsecond=0)
+        }
+
+
+    def get_tagged_versioned(self, key, f, tags, time_expire=None):
+        """
+        Like get_tagged(), but stores a version and modification time with the
+        value. Clearing a tag removes the value, so the next call creates a new
+        version.
+        :param key: string - cache key
+        :param f: function - called to get the value when key isn't in cache
+        :param tags: list of strings - tags to register the key under
+        :param time_expire: int - seconds
+        :return: dict returned by get_versioned()
+        """
+        return self.get_tagged(key + '_versioned',
+                               lambda: self.get_versioned(f),
+                               tags,
+                               time_expire=time_expire)
+
+
+    def clear_tags(self, *tags):
+        """
+        Delete all cache entries registered under the given tags
+        :param tags: strings - tag names
+        :return: None
+        """
+        cache = current.cache
+        r_server = self._get_redis()
+
+        for tag in tags:
+            tag_key = self._get_tag_key(tag)
+            if r_server:
+                pipe = r_server.pipeline()
+                pipe.smembers(tag_key)
+                pipe.delete(tag_key)
+                keys = pipe.execute()[0]
+                keys = [k.decode('utf-8') if isinstance(k, bytes) else k for k in keys]
+            else:
+                with self._tags_lock:
+                    keys = list(self._tags.pop(tag_key, {}))
+
+            for key in keys:
+                # Calling cache with f=None deletes the key
+                cache.ram(key, None)
+
+
     def clear(self, var_one=None, var_two=None):
         """
             Clears all cache entries on disk & in ram
@@ -13,18 +218,22 @@ class OsCacheManager:
         cache.ram.clear()
         cache.disk.clear()
 
+        prefix = self._get_tag_key('')
+        with self._tags_lock:
+            for tag_key in list(self._tags):
+                if tag_key.startswith(prefix):
+                    del self._tags[tag_key]
+
 
     def clear_customers(self, var_one=None, var_two=None):
         """
         Clear PoS customers cache
+        Not needed after changing a customer, the PoS customers directory is
+        updated by callbacks on db.auth_user and cached by version.
         Takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
         :return:
         """
-        cache = current.cache
-        # PoS
-        key = ".*openstudio_pos_get_customers"
-        cache.ram.clear(regex=key)
-        cache.disk.clear(regex=key)
+        self.clear_tags('pos_customers')
 
 
     def clear_auth_user_login_attempts(self, email):
@@ -35,40 +244,28 @@ class OsCacheManager:
         cache = current.cache
 
         failed_attempts_cache_key = "auth_login_failed_attempts_%s" % email
-        cache.ram.clear(regex=failed_attempts_cache_key)
+        cache.ram(failed_attempts_cache_key, None)
 
 
     def clear_customers_memberships(self, cuID):
         """
             Clears memberships cache entries on disk & in ram
         """
-        cache = current.cache
-
-        cu_sub_regex = '.*openstudio_customer_get_memberships_on_date_' + str(cuID) + '*'
-        cache.ram.clear(regex=cu_sub_regex)
-        cache.disk.clear(regex=cu_sub_regex)
+        self.clear_tags('customers_memberships_' + str(cuID))
 
 
     def clear_customers_subscriptions(self, cuID):
         """
             Clears subscription cache entries on disk & in ram
         """
-        cache = current.cache
-
-        cu_sub_regex = '.*openstudio_customer_get_subscriptions_on_date_' + str(cuID) + '*'
-        cache.ram.clear(regex=cu_sub_regex)
-        cache.disk.clear(regex=cu_sub_regex)
+        self.clear_tags('customers_subscriptions_' + str(cuID))
 
 
     def clear_customers_classcards(self, cuID):
         """
             Clears subscription cache entries on disk & in ram
         """
-        cache = current.cache
-
-        cu_cc_regex = '.*openstudio_customer_get_classcards_' + str(cuID) + '*'
-        cache.ram.clear(regex=cu_cc_regex)
-        cache.disk.clear(regex=cu_cc_regex)
+        self.clear_tags('customers_classcards_' + str(cuID))
 
 
     def clear_classschedule(self, var_one=None, var_two=None):
@@ -76,25 +273,21 @@ class OsCacheManager:
             Clears the class schedule cache
             takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
         """
-        cache = current.cache
-
-        class_schedule_regex = '.*openstudio_classschedule_get_day_*'
-        cache.ram.clear(regex=class_schedule_regex)
-        cache.disk.clear(regex=class_schedule_regex)
+        self.clear_tags('classschedule')
 
-        cache_clear_classschedule_api()
+        self.clear_classschedule_api()
 
 
-    def clear_classschedule_api(self, var_one=None, var_two=None):
+    def clear_classschedule_api(self, var_one=None, var_two=None, date=None):
         """
             Clears the class schedule api cache
             takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
+            :param date: datetime.date - only clear entries containing classes on this date
         """
-        cache = current.cache
-
-        api_schedule_regex = '.*openstudio_api_schedule_get_*'
-        cache.ram.clear(regex=api_schedule_regex)
-        cache.disk.clear(regex=api_schedule_regex)
+        if date:
+            self.clear_tags('schedule_api_' + str(date))
+        else:
+            self.clear_tags('schedule_api')
 
 
     def clear_classschedule_trend(self, var_one=None, var_two=None):
@@ -102,34 +295,50 @@ class OsCacheManager:
             Clears the class schedule trend column cache
             takes 2 dummy arguments in case it's called from a CRUD form or from SQLFORM.grid
         """
-        cache = current.cache
-
-        trend_regex = '.*openstudio_classschedule_trend_*'
-        cache.ram.clear(regex=trend_regex)
-        cache.disk.clear(regex=trend_regex)
+        self.clear_tags('classschedule_trend')
 
 
     def clear_sys_properties(self):
         """
-            Clears the sys_properties keys in cache
+            Clears the sys_properties snapshot
             :return: None
         """
-        cache = current.cache
+        from .os_sys_properties import OsSysProperties
 
-        sprop_regex = '.*openstudio_system_property_*'
-        cache.ram.clear(regex=sprop_regex)
-        cache.disk.clear(regex=sprop_regex)
+        sys_properties = getattr(current, 'sys_properties', None) or OsSysProperties()
+        sys_properties.clear()
 
 
     def clear_menu_backend(self):
         """
             Clears the backend menu's in cache
         """
-        cache = current.cache
+        self.clear_tags('menu_backend')
 
-        menu_regex = '.*openstudio_menu_backend_*'
-        cache.ram.clear(regex=menu_regex)
-        cache.disk.clear(regex=menu_regex)
+
+    def clear_permissions(self):
+        """
+            Clears the compiled groups & permissions of all users
+        """
+        self.clear_tags('permissions')
+
+
+    def clear_class_permissions(self):
+        """
+            Clears the class permissions of school subscriptions & class cards
+        """
+        self.clear_tags('class_permissions')
+
+
+    def clear_retention(self, months=None):
+        """
+            Clears the retention analytics cache
+            :param months: list of strings 'YYYY-MM' - only clear these months
+        """
+        if months:
+            self.clear_tags(*['retention_' + month for month in months])
+        else:
+            self.clear_tags('retention')
 
 
     def clear_workshops(self, var_one=None, var_two=None):
@@ -137,11 +346,7 @@ class OsCacheManager:
             Clears the workshops cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        workshops_regex = '.*openstudio_workshops_*'
-        cache.ram.clear(regex=workshops_regex)
-        cache.disk.clear(regex=workshops_regex)
+        self.clear_tags('workshops')
 
 
     def clear_school_subscriptions(self, var_one=None, var_two=None):
@@ -149,16 +354,8 @@ class OsCacheManager:
             Clears the school subscriptions cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        school_subscriptions_regex = '.*openstudio_school_subcriptions_api_*'
-        cache.ram.clear(regex=school_subscriptions_regex)
-        cache.disk.clear(regex=school_subscriptions_regex)
-
         # Clear all customer subscriptions, as the cache also stores some school subscription info
-        cu_sub_regex = '.*openstudio_customer_get_subscriptions_on_date_*'
-        cache.ram.clear(regex=cu_sub_regex)
-        cache.disk.clear(regex=cu_sub_regex)
+        self.clear_tags('school_subscriptions', 'customers_subscriptions')
 
 
     def clear_school_classcards(self, var_one=None, var_two=None):
@@ -166,11 +363,7 @@ class OsCacheManager:
             Clears the school classcards cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        school_classcards_regex = '.*openstudio_school_classcards_api_*'
-        cache.ram.clear(regex=school_classcards_regex)
-        cache.disk.clear(regex=school_classcards_regex)
+        self.clear_tags('school_classcards')
 
 
     def clear_school_teachers(self, var_one=None, var_two=None):
@@ -178,23 +371,16 @@ class OsCacheManager:
             Clears the school teachers (API) cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        school_teachers_api_regex = '.*openstudio_school_teachers_api_get'
-        cache.ram.clear(regex=school_teachers_api_regex)
-        cache.disk.clear(regex=school_teachers_api_regex)
+        self.clear_tags('school_teachers')
 
 
     def clear_school_classtypes(self, var_one=None, var_two=None):
         """
-            Clears the school teachers (API) cache
+            Clears the school classtypes (API) cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        school_teachers_api_regex = '.*openstudio_school_teachers_api_get'
-        cache.ram.clear(regex=school_teachers_api_regex)
-        cache.disk.clear(regex=school_teachers_api_regex)
+        # The teachers API also lists class types for each teacher
+        self.clear_tags('school_classtypes', 'school_teachers')
 
 
     def clear_sys_organizations(self, var_one=None, var_two=None):
@@ -202,8 +388,4 @@ class OsCacheManager:
             Clears the workshops cache
             # accepts two vars to the function can be called from SQLFORM.grid ondelete or crud functions
         """
-        cache = current.cache
-
-        sys_org_regex = '.*openstudio_sys_organizations*'
-        cache.ram.clear(regex=sys_org_regex)
-        cache.disk.clear(regex=sys_org_regex)
+        self.clear_tags('sys_organizations')
@@ -254,17 +254,20 @@ class Class:
         """
             Check whether or not this class is full
         """
+        from .os_classes_attendance_counts import ClassesAttendanceCounts
+
         db = current.db
         spaces = self.cls.Maxstudents
 
-        query = (db.classes_attendance.classes_id == self.clsID) & \
-                (db.classes_attendance.ClassDate == self.date)
-        if only_count_status:
-            query &= (db.classes_attendance.BookingStatus == only_count_status)
+        if only_count_status in (None, 'attending'):
+            counts = ClassesAttendanceCounts().get(self.clsID, self.date)
+            filled = counts['Attending'] if only_count_status else counts['Attendance']
         else:
-            query &= (db.classes_attendance.BookingStatus != 'cancelled')
+            query = (db.classes_attendance.classes_id == self.clsID) & \
+                    (db.classes_attendance.ClassDate == self.date) & \
+                    (db.classes_attendance.BookingStatus == only_count_status)
+            filled = db(query).count()
 
-        filled = db(query).count()
         full = True if filled >= spaces else False
 
         return full
@@ -274,14 +277,10 @@ class Class:
         """
             Check whether there are spaces left for online bookings
         """
-        db = current.db
+        from .os_classes_attendance_counts import ClassesAttendanceCounts
 
         spaces = self.cls.Maxstudents - self.cls.WalkInSpaces
-        query = (db.classes_attendance.classes_id == self.clsID) & \
-                (db.classes_attendance.ClassDate == self.date) & \
-                (db.classes_attendance.online_booking == True) & \
-                (db.classes_attendance.BookingStatus != 'cancelled')
-        filled = db(query).count()
+        filled = ClassesAttendanceCounts().get(self.clsID, self.date)['OnlineBooking']
 
         full = True if filled >= spaces else False
 
@@ -483,13 +482,9 @@ class Class:
         """
         :return: integer ; count of customers attending this class
         """
-        db = current.db
-
-        query = (db.classes_attendance.classes_id == self.clsID) & \
-                (db.classes_attendance.ClassDate == self.date) & \
-                (db.classes_attendance.BookingStatus != 'cancelled')
+        from .os_classes_attendance_counts import ClassesAttendanceCounts
 
-        return db(query).count()
+        return ClassesAttendanceCounts().get(self.clsID, self.date)['Attendance']
 
 
     def get_attendance_count_paying_customers(self):
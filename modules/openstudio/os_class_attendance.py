@@ -136,4 +136,4 @@ class ClassAttendance:
 
         # Clear api cache to refresh available spaces
         ocm = OsCacheManager()
-        ocm.clear_classschedule_api()
\ No newline at end of file
+        ocm.clear_classschedule_api(date=self.row.ClassDate)
\ No newline at end of file
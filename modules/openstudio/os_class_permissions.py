@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+from gluon import *
+
+
+class OsClassPermissions:
+    """
+        Maps of the classes that can be enrolled in, booked & attended using a
+        school subscription or class card, so checks don't query the group
+        tables for each subscription or card.
+
+        The maps are cached with a version under the 'class_permissions' tag,
+        which is cleared by callbacks on the subscription & class card group
+        tables and the class group links. Changes to AllowAPI of classes also
+        clear the tag, as the maps record which classes are public.
+    """
+    permission_fields = ['Enroll', 'ShopBook', 'Attend']
+
+
+    def __init__(self):
+        # Compiled maps, used during this request
+        self._compiled = {}
+
+
+    def _get_tables(self, kind):
+        """
+        :param kind: string - 'subscriptions' or 'classcards'
+        :return: tuple (link table, product field, class groups table, group field)
+        """
+        db = current.db
+
+        if kind == 'subscriptions':
+            return (db.school_subscriptions_groups_subscriptions,
+                    'school_subscriptions_id',
+                    db.classes_school_subscriptions_groups,
+                    'school_subscriptions_groups_id')
+        else:
+            return (db.school_classcards_groups_classcards,
+                    'school_classcards_id',
+                    db.classes_school_classcards_groups,
+                    'school_classcards_groups_id')
+
+
+    def _compile(self, kind):
+        """
+        :param kind: string - 'subscriptions' or 'classcards'
+        :return: dict {'permissions': {product id: {db.classes.id: {'Enroll': True,
+                                                                    'ShopBook': True,
+                                                                    'Attend': True}}},
+                       'public': set of db.classes.id with AllowAPI set}
+                 product id is a db.school_subscriptions.id or db.school_classcards.id
+                 Permissions that aren't granted are left out.
+        """
+        db = current.db
+
+        link_table, product_field, groups_table, group_field = self._get_tables(kind)
+
+        left = [db.classes.on(groups_table.classes_id == db.classes.id)]
+        query = (link_table[group_field] == groups_table[group_field])
+        rows = db(query).select(link_table[product_field],
+                                groups_table.classes_id,
+                                groups_table.Enroll,
+                                groups_table.ShopBook,
+                                groups_table.Attend,
+                                db.classes.AllowAPI,
+                                left=left)
+
+        permissions = {}
+        public = set()
+        for row in rows:
+            group_row = row[groups_table._tablename]
+            clsID = group_row.classes_id
+            class_permissions = permissions.setdefault(
+                row[link_table._tablename][product_field], {}
+            ).setdefault(clsID, {})
+
+            for field in self.permission_fields:
+                if group_row[field]:
+                    class_permissions[field] = True
+
+            if row.classes.AllowAPI:
+                public.add(clsID)
+
+        return {
+            'permissions': permissions,
+            'public': public
+        }
+
+
+    def get_compiled(self, kind):
+        """
+        :param kind: string - 'subscriptions' or 'classcards'
+        :return: dict returned by _compile(), from cache when available
+        """
+        request = current.request
+        os_cache_manager = current.globalenv['os_cache_manager']
+        web2pytest = current.globalenv['web2pytest']
+        CACHE_LONG = current.globalenv['CACHE_LONG']
+
+        if kind in self._compiled:
+            return self._compiled[kind]
+
+        # Don't cache between requests when running tests, groups are
+        # changed by the tests without callbacks in this process.
+        # Don't cache between requests when the cache isn't shared by workers.
+        if web2pytest.is_running_under_test(request, request.application) or \
+           not os_cache_manager.is_shared():
+            self._compiled[kind] = self._compile(kind)
+        else:
+            self._compiled[kind] = os_cache_manager.get_tagged_versioned(
+                'openstudio_class_permissions_' + kind,
+                lambda: self._compile(kind),
+                ['class_permissions'],
+                time_expire=CACHE_LONG
+            )['data']
+
+        return self._compiled[kind]
+
+
+    def _get_permissions(self, kind, product_id, public_only=True):
+        """
+        :param kind: string - 'subscriptions' or 'classcards'
+        :param product_id: db.school_subscriptions.id or db.school_classcards.id
+        :param public_only: Boolean - only include classes with AllowAPI set
+        :return: dict {db.classes.id: {'Enroll': True, 'ShopBook': True, 'Attend': True}}
+        """
+        compiled = self.get_compiled(kind)
+        permissions = compiled['permissions'].get(int(product_id), {})
+
+        if public_only:
+            public = compiled['public']
+            return dict([(clsID, dict(p)) for clsID, p in permissions.items() if clsID in public])
+
+        return dict([(clsID, dict(p)) for clsID, p in permissions.items()])
+
+
+    def get_subscription_permissions(self, ssuID, public_only=True):
+        """
+        :param ssuID: db.school_subscriptions.id
+        :param public_only: Boolean - only include classes with AllowAPI set
+        :return: dict {db.classes.id: {'Enroll': True, 'ShopBook': True, 'Attend': True}}
+        """
+        return self._get_permissions('subscriptions', ssuID, public_only=public_only)
+
+
+    def get_classcard_permissions(self, scdID, public_only=True):
+        """
+        :param scdID: db.school_classcards.id
+        :param public_only: Boolean - only include classes with AllowAPI set
+        :return: dict {db.classes.id: {'Enroll': True, 'ShopBook': True, 'Attend': True}}
+        """
+        return self._get_permissions('classcards', scdID, public_only=public_only)
+
+
+    def _get_allowed(self, kind, clsID, product_ids, permission):
+        """
+        :param kind: string - 'subscriptions' or 'classcards'
+        :param clsID: db.classes.id
+        :param product_ids: list of db.school_subscriptions.id or db.school_classcards.id
+        :param permission: string - 'Enroll', 'ShopBook' or 'Attend'
+        :return: set of product ids allowed for class
+        """
+        if not product_ids:
+            return set()
+
+        permissions = self.get_compiled(kind)['permissions']
+        clsID = int(clsID)
+
+        allowed = set()
+        for product_id in product_ids:
+            class_permissions = permissions.get(int(product_id), {}).get(clsID, {})
+            if class_permissions.get(permission):
+                allowed.add(product_id)
+
+        return allowed
+
+
+    def get_allowed_subscriptions(self, clsID, ssu_ids, permission):
+        """
+        :param clsID: db.classes.id
+        :param ssu_ids: list of db.school_subscriptions.id
+        :param permission: string - 'Enroll', 'ShopBook' or 'Attend'
+        :return: set of db.school_subscriptions.id allowed for class
+        """
+        return self._get_allowed('subscriptions', clsID, ssu_ids, permission)
+
+
+    def get_allowed_classcards(self, clsID, scd_ids, permission):
+        """
+        :param clsID: db.classes.id
+        :param scd_ids: list of db.school_classcards.id
+        :param permission: string - 'Enroll', 'ShopBook' or 'Attend'
+        :return: set of db.school_classcards.id allowed for class
+        """
+        return self._get_allowed('classcards', clsID, scd_ids, permission)
+
+
+    def clear(self):
+        """
+        Clear compiled class permissions
+        :return: None
+        """
+        os_cache_manager = current.globalenv['os_cache_manager']
+
+        self._compiled = {}
+        os_cache_manager.clear_class_permissions()
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for group tables
+        """
+        self.clear()
+
+
+    def after_update(self, dbset, fields):
+        """
+        _after_update callback for group tables
+        """
+        self.clear()
+
+
+    def after_delete(self, dbset):
+        """
+        _after_delete callback for group tables & db.classes
+        """
+        self.clear()
+
+
+    def after_update_classes(self, dbset, fields):
+        """
+        _after_update callback for db.classes
+        """
+        if 'AllowAPI' in fields:
+            self.clear()
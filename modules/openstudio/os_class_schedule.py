@@ -55,32 +55,47 @@ class ClassSchedule:
         return bookings_open
 
 
-    def _get_day_filter_query(self):
+    def _get_day_filter_query(self, occurrences=False):
         """
             Returns the filter query for the schedule
+            :param occurrences: Boolean - True to filter db.classes_occurrences (co),
+            which has one time changes and teachers applied already
         """
+        if occurrences:
+            teacher_id = 'co.auth_teacher_id'
+            teacher_id2 = 'co.auth_teacher_id2'
+            classtype_id = 'co.school_classtypes_id'
+            location_id = 'co.school_locations_id'
+            starttime = 'co.Starttime'
+        else:
+            teacher_id = '(CASE WHEN cotc.auth_teacher_id IS NULL \
+                           THEN clt.auth_teacher_id  \
+                           ELSE cotc.auth_teacher_id END)'
+            teacher_id2 = '(CASE WHEN cotc.auth_teacher_id2 IS NULL \
+                            THEN clt.auth_teacher_id2  \
+                            ELSE cotc.auth_teacher_id2 END)'
+            classtype_id = '(CASE WHEN cotc.school_classtypes_id IS NULL \
+                             THEN cla.school_classtypes_id  \
+                             ELSE cotc.school_classtypes_id END)'
+            location_id = '(CASE WHEN cotc.school_locations_id IS NULL \
+                            THEN cla.school_locations_id  \
+                            ELSE cotc.school_locations_id END)'
+            starttime = '(CASE WHEN cotc.Starttime IS NULL \
+                          THEN cla.Starttime  \
+                          ELSE cotc.Starttime END)'
+
         where = ''
 
         if self.filter_id_sys_organization:
             where += 'AND cla.sys_organizations_id = ' + str(self.filter_id_sys_organization) + ' '
         if self.filter_id_teacher:
-            where += 'AND ((CASE WHEN cotc.auth_teacher_id IS NULL \
-                            THEN clt.auth_teacher_id  \
-                            ELSE cotc.auth_teacher_id END) = '
-            where += str(self.filter_id_teacher) + ' '
-            where += 'OR (CASE WHEN cotc.auth_teacher_id2 IS NULL \
-                          THEN clt.auth_teacher_id2  \
-                          ELSE cotc.auth_teacher_id2 END) = '
-            where += str(self.filter_id_teacher) + ') '
+            where += 'AND (' + teacher_id + ' = ' + str(self.filter_id_teacher) + ' '
+            where += 'OR ' + teacher_id2 + ' = ' + str(self.filter_id_teacher) + ') '
         if self.filter_id_school_classtype:
-            where += 'AND (CASE WHEN cotc.school_classtypes_id IS NULL \
-                           THEN cla.school_classtypes_id  \
-                           ELSE cotc.school_classtypes_id END) = '
+            where += 'AND ' + classtype_id + ' = '
             where += str(self.filter_id_school_classtype) + ' '
         if self.filter_id_school_location:
-            where += 'AND (CASE WHEN cotc.school_locations_id IS NULL \
-                           THEN cla.school_locations_id  \
-                           ELSE cotc.school_locations_id END) = '
+            where += 'AND ' + location_id + ' = '
             where += str(self.filter_id_school_location) + ' '
         if self.filter_id_school_level:
             where += 'AND cla.school_levels_id = '
@@ -90,10 +105,8 @@ class ClassSchedule:
             where += "AND sl.AllowAPI = 'T' "
             where += "AND sct.AllowAPI = 'T' "
         if self.filter_starttime_from:
-            where += 'AND ((CASE WHEN cotc.Starttime IS NULL \
-                            THEN cla.Starttime  \
-                            ELSE cotc.Starttime END) >= '
-            where += "'" + str(self.filter_starttime_from) + "') "
+            where += 'AND ' + starttime + ' >= '
+            where += "'" + str(self.filter_starttime_from) + "' "
 
         return where
 
@@ -358,14 +371,19 @@ class ClassSchedule:
         if web2pytest.is_running_under_test(request, request.application):
             data = self._get_day_get_table_class_trend_data()
         else:
+            from .os_cache_manager import OsCacheManager
+
             twelve_hours = 12*60*60
-            cache = current.cache
+            ocm = OsCacheManager()
             DATE_FORMAT = current.DATE_FORMAT
             # A key that isn't cleared when schedule changes occur.
             cache_key = 'openstudio_classschedule_trend_get_day_table_' + \
                         self.date.strftime(DATE_FORMAT)
 
-            data = cache.ram(cache_key , lambda: self._get_day_get_table_class_trend_data(), time_expire=twelve_hours)
+            data = ocm.get_tagged(cache_key,
+                                  lambda: self._get_day_get_table_class_trend_data(),
+                                  ['classschedule_trend'],
+                                  time_expire=twelve_hours)
 
         return data
 
@@ -754,20 +772,9 @@ class ClassSchedule:
                     END AS teacher_role2,
                sho.id,
                sho.Description,
-                /* Count attendance for this class */
-               ( SELECT count(clatt.id) as count_att
-                 FROM classes_attendance clatt
-                 WHERE clatt.classes_id = cla.id AND
-                       clatt.ClassDAte ='{class_date}' AND
-                       clatt.BookingStatus != 'cancelled') AS count_attendance,
-               /* Count of online bookings for this class */
-               ( SELECT COUNT(clatt.id) as count_atto
-                 FROM classes_attendance clatt
-                 WHERE clatt.classes_id = cla.id AND
-                       clatt.ClassDate = '{class_date}' AND
-                       clatt.BookingStatus != 'cancelled' AND
-                       clatt.online_booking = 'T'
-                 GROUP BY clatt.classes_id ) as count_clatto,
+               /* Attendance & online bookings for this class */
+               clac.Attendance,
+               clac.OnlineBooking,
                /* Count of enrollments (reservations) for this class */
                ( SELECT COUNT(clr.id) as count_clr
                  FROM classes_reservation clr
@@ -822,6 +829,8 @@ class ClassSchedule:
               WHERE sh.Startdate <= '{class_date}' AND
                     sh.Enddate >= '{class_date}') sho
             ON sho.school_locations_id = cla.school_locations_id
+        LEFT JOIN classes_attendance_count clac
+            ON clac.classes_id = cla.id AND clac.ClassDate = '{class_date}'
         WHERE cla.Week_day = '{week_day}' AND
               cla.Startdate <= '{class_date}' AND
               (cla.Enddate >= '{class_date}' OR cla.Enddate IS NULL)
@@ -856,11 +865,348 @@ class ClassSchedule:
         #     cache_key = 'openstudio_classschedule_get_day_rows_' + self.date.strftime(DATE_FORMAT)
         #     rows = cache.ram(cache_key , lambda: self._get_day_rows(), time_expire=CACHE_LONG)
 
-        rows = self._get_day_rows()
+        from .os_classes_occurrences import ClassesOccurrences
+
+        if ClassesOccurrences().covers(self.date, self.date):
+            rows = self.get_range_rows(self.date, self.date)
+        else:
+            rows = self._get_day_rows()
+
+        return rows
+
+
+    def _get_range_dates_query(self, date_from, date_until):
+        """
+            Returns a derived table containing one row for each date in the range
+            (ClassDate, Week_day), to join classes against
+        """
+        delta = datetime.timedelta(days=1)
+
+        selects = []
+        date = date_from
+        while date <= date_until:
+            selects.append("SELECT '{class_date}' AS ClassDate, {week_day} AS Week_day".format(
+                class_date=date,
+                week_day=date.isoweekday()
+            ))
+            date += delta
+
+        return ' UNION ALL '.join(selects)
+
+
+    def get_range_rows(self, date_from, date_until):
+        """
+            Returns the same rows as get_day_rows() for each day from date_from until
+            and including date_until, using one query for the whole range.
+            Attendance, online bookings and enrollments are pre-aggregated per class
+            and date, instead of using sub queries for each class.
+            The date of each class is available as row['ClassDate']
+            :param date_from: datetime.date
+            :param date_until: datetime.date
+            :return: gluon.dal.rows
+        """
+        db = current.db
+
+        if self.sorting == 'location':
+            orderby_sql = 'location_name, Starttime'
+        elif self.sorting == 'starttime':
+            orderby_sql = 'Starttime, location_name'
+
+        fields = [
+            db.classes.id,
+            db.classes_otc.Status,
+            db.classes_otc.Description,
+            db.classes.school_locations_id,
+            db.school_locations.Name,
+            db.classes.school_classtypes_id,
+            db.classes.school_levels_id,
+            db.classes.Week_day,
+            db.classes.Starttime,
+            db.classes.Endtime,
+            db.classes.Startdate,
+            db.classes.Enddate,
+            db.classes.Maxstudents,
+            db.classes.WalkInSpaces,
+            db.classes.MaxReservationsRecurring,
+            db.classes.AllowAPI,
+            db.classes.sys_organizations_id,
+            db.classes_otc.id,
+            db.classes_teachers.id,
+            db.classes_teachers.auth_teacher_id,
+            db.classes_teachers.teacher_role,
+            db.classes_teachers.auth_teacher_id2,
+            db.classes_teachers.teacher_role2,
+            db.school_holidays.id,
+            db.school_holidays.Description,
+            db.classes_schedule_count.Attendance,
+            db.classes_schedule_count.OnlineBooking,
+            db.classes_schedule_count.Reservations
+        ]
+        colnames = [field.tablename + '.' + field.name for field in fields]
+
+        # The date of each class isn't a column of a table in the result
+        fields.append(db.classes_attendance.ClassDate.with_alias('ClassDate'))
+        colnames.append('ClassDate')
+
+        from .os_classes_occurrences import ClassesOccurrences
+
+        if ClassesOccurrences().covers(date_from, date_until):
+            query = self._get_range_rows_occurrences_query(date_from, date_until, orderby_sql)
+        else:
+            query = self._get_range_rows_query(date_from, date_until, orderby_sql)
+
+        rows = db.executesql(query, fields=fields, colnames=colnames)
 
         return rows
 
 
+    def _get_range_rows_query(self, date_from, date_until, orderby_sql):
+        """
+            Returns query for get_range_rows(), deriving the classes on each date
+            from db.classes, db.classes_otc and db.classes_teachers
+        """
+        where_filter = self._get_day_filter_query()
+        dates = self._get_range_dates_query(date_from, date_until)
+
+        return """
+        SELECT cla.id,
+               CASE WHEN cotc.Status IS NOT NULL
+                    THEN cotc.Status
+                    ELSE 'normal'
+                    END AS Status,
+               cotc.Description,
+               CASE WHEN cotc.school_locations_id IS NOT NULL
+                    THEN cotc.school_locations_id
+                    ELSE cla.school_locations_id
+                    END AS school_locations_id,
+               CASE WHEN cotc.school_locations_id IS NOT NULL
+                    THEN slcotc.Name
+                    ELSE sl.Name
+                    END AS location_name,
+               CASE WHEN cotc.school_classtypes_id IS NOT NULL
+                    THEN cotc.school_classtypes_id
+                    ELSE cla.school_classtypes_id
+                    END AS school_classtypes_id,
+               cla.school_levels_id,
+               cla.Week_day,
+               CASE WHEN cotc.Starttime IS NOT NULL
+                    THEN cotc.Starttime
+                    ELSE cla.Starttime
+                    END AS Starttime,
+               CASE WHEN cotc.Endtime IS NOT NULL
+                    THEN cotc.Endtime
+                    ELSE cla.Endtime
+                    END AS Endtime,
+               cla.Startdate,
+               cla.Enddate,
+               CASE WHEN cotc.Maxstudents IS NOT NULL
+                    THEN cotc.Maxstudents
+                    ELSE cla.Maxstudents
+                    END AS Maxstudents,
+               CASE WHEN cotc.WalkInSpaces IS NOT NULL
+                    THEN cotc.WalkInSpaces
+                    ELSE cla.WalkInSpaces
+                    END AS WalkInSpaces,
+               cla.MaxReservationsRecurring,
+               cla.AllowAPI,
+               cla.sys_organizations_id,
+               cotc.id,
+               clt.id,
+               CASE WHEN cotc.auth_teacher_id IS NOT NULL
+                    THEN cotc.auth_teacher_id
+                    ELSE clt.auth_teacher_id
+                    END AS auth_teacher_id,
+               CASE WHEN cotc.auth_teacher_id IS NOT NULL
+                    THEN cotc.teacher_role
+                    ELSE clt.teacher_role
+                    END AS teacher_role,
+               CASE WHEN cotc.auth_teacher_id2 IS NOT NULL
+                    THEN cotc.auth_teacher_id2
+                    ELSE clt.auth_teacher_id2
+                    END AS auth_teacher_id2,
+               CASE WHEN cotc.auth_teacher_id2 IS NOT NULL
+                    THEN cotc.teacher_role2
+                    ELSE clt.teacher_role2
+                    END AS teacher_role2,
+               sho.id,
+               sho.Description,
+               clac.Attendance,
+               clac.OnlineBooking,
+               clr.count_reservations,
+               d.ClassDate
+        FROM ( {dates} ) d
+        INNER JOIN classes cla
+            ON cla.Week_day = d.Week_day AND
+               cla.Startdate <= d.ClassDate AND
+               (cla.Enddate >= d.ClassDate OR cla.Enddate IS NULL)
+        LEFT JOIN
+            ( SELECT id,
+                     classes_id,
+                     ClassDate,
+                     Status,
+                     Description,
+                     school_locations_id,
+                     school_classtypes_id,
+                     Starttime,
+                     Endtime,
+                     auth_teacher_id,
+                     teacher_role,
+                     auth_teacher_id2,
+                     teacher_role2,
+                     Maxstudents,
+                     WalkInSpaces
+              FROM classes_otc
+              WHERE ClassDate >= '{date_from}' AND ClassDate <= '{date_until}' ) cotc
+            ON cla.id = cotc.classes_id AND cotc.ClassDate = d.ClassDate
+        LEFT JOIN school_locations sl
+            ON sl.id = cla.school_locations_id
+        LEFT JOIN school_classtypes sct
+            ON sct.id = cla.school_classtypes_id
+        LEFT JOIN school_locations slcotc
+            ON slcotc.id = cotc.school_locations_id
+        LEFT JOIN
+            ( SELECT id,
+                     classes_id,
+                     Startdate,
+                     Enddate,
+                     auth_teacher_id,
+                     teacher_role,
+                     auth_teacher_id2,
+                     teacher_role2
+              FROM classes_teachers
+              WHERE Startdate <= '{date_until}' AND (
+                    Enddate >= '{date_from}' OR Enddate IS NULL)
+              ) clt
+            ON clt.classes_id = cla.id AND
+               clt.Startdate <= d.ClassDate AND
+               (clt.Enddate >= d.ClassDate OR clt.Enddate IS NULL)
+        LEFT JOIN
+            ( SELECT sh.id, sh.Description, sh.Startdate, sh.Enddate, shl.school_locations_id
+              FROM school_holidays sh
+              LEFT JOIN
+                school_holidays_locations shl
+                ON shl.school_holidays_id = sh.id
+              WHERE sh.Startdate <= '{date_until}' AND
+                    sh.Enddate >= '{date_from}') sho
+            ON sho.school_locations_id = cla.school_locations_id AND
+               sho.Startdate <= d.ClassDate AND
+               sho.Enddate >= d.ClassDate
+        /* Attendance and online bookings for each class on each date */
+        LEFT JOIN classes_attendance_count clac
+            ON clac.classes_id = cla.id AND clac.ClassDate = d.ClassDate
+        /* Count enrollments (reservations) for each class on each date */
+        LEFT JOIN
+            ( {reservations} ) clr
+            ON clr.classes_id = cla.id AND clr.ClassDate = d.ClassDate
+        WHERE 1 = 1
+              {where_filter}
+        ORDER BY d.ClassDate, {orderby_sql}
+        """.format(dates = dates,
+                   reservations = self._get_range_reservations_query(dates, date_from, date_until),
+                   date_from = date_from,
+                   date_until = date_until,
+                   orderby_sql = orderby_sql,
+                   where_filter = where_filter)
+
+
+    def _get_range_rows_occurrences_query(self, date_from, date_until, orderby_sql):
+        """
+            Returns query for get_range_rows(), reading the classes on each date
+            from db.classes_occurrences
+        """
+        where_filter = self._get_day_filter_query(occurrences=True)
+        dates = self._get_range_dates_query(date_from, date_until)
+
+        return """
+        SELECT cla.id,
+               co.Status,
+               co.Description,
+               co.school_locations_id,
+               slco.Name AS location_name,
+               co.school_classtypes_id,
+               co.school_levels_id,
+               cla.Week_day,
+               co.Starttime,
+               co.Endtime,
+               cla.Startdate,
+               cla.Enddate,
+               co.Maxstudents,
+               co.WalkInSpaces,
+               cla.MaxReservationsRecurring,
+               cla.AllowAPI,
+               co.sys_organizations_id,
+               cotc.id,
+               NULL AS classes_teachers_id,
+               co.auth_teacher_id,
+               co.teacher_role,
+               co.auth_teacher_id2,
+               co.teacher_role2,
+               sho.id,
+               sho.Description,
+               clac.Attendance,
+               clac.OnlineBooking,
+               clr.count_reservations,
+               co.ClassDate
+        FROM classes_occurrences co
+        INNER JOIN classes cla
+            ON cla.id = co.classes_id
+        LEFT JOIN classes_otc cotc
+            ON cotc.classes_id = co.classes_id AND cotc.ClassDate = co.ClassDate
+        LEFT JOIN school_locations sl
+            ON sl.id = cla.school_locations_id
+        LEFT JOIN school_classtypes sct
+            ON sct.id = cla.school_classtypes_id
+        LEFT JOIN school_locations slco
+            ON slco.id = co.school_locations_id
+        LEFT JOIN school_holidays sho
+            ON sho.id = co.school_holidays_id
+        /* Attendance and online bookings for each class on each date */
+        LEFT JOIN classes_attendance_count clac
+            ON clac.classes_id = co.classes_id AND clac.ClassDate = co.ClassDate
+        /* Count enrollments (reservations) for each class on each date */
+        LEFT JOIN
+            ( {reservations} ) clr
+            ON clr.classes_id = co.classes_id AND clr.ClassDate = co.ClassDate
+        WHERE co.ClassDate >= '{date_from}' AND
+              co.ClassDate <= '{date_until}'
+              {where_filter}
+        ORDER BY co.ClassDate, {orderby_sql}
+        """.format(reservations = self._get_range_reservations_query(dates, date_from, date_until),
+                   date_from = date_from,
+                   date_until = date_until,
+                   orderby_sql = orderby_sql,
+                   where_filter = where_filter)
+
+
+    def _get_range_reservations_query(self, dates, date_from, date_until):
+        """
+            Returns query counting enrollments (reservations) for each class on
+            each date (classes_id, ClassDate, count_reservations)
+            :param dates: string - query returned by _get_range_dates_query()
+            :param date_from: datetime.date
+            :param date_until: datetime.date
+        """
+        return """
+        SELECT clr.classes_id,
+               dr.ClassDate,
+               COUNT(clr.id) AS count_reservations
+        FROM classes_reservation clr
+        INNER JOIN ( {dates} ) dr
+          ON clr.Startdate <= dr.ClassDate AND
+             (clr.Enddate >= dr.ClassDate OR clr.Enddate IS NULL)
+        WHERE clr.Startdate <= '{date_until}' AND
+              (clr.Enddate >= '{date_from}' OR clr.Enddate IS NULL) AND
+              clr.classes_id IN
+                ( SELECT id
+                  FROM classes
+                  WHERE Startdate <= '{date_until}' AND
+                        (Enddate >= '{date_from}' OR Enddate IS NULL) )
+        GROUP BY clr.classes_id, dr.ClassDate
+        """.format(dates=dates,
+                   date_from=date_from,
+                   date_until=date_until)
+
+
     def _get_day_table(self):
         """
             Returns table for today
@@ -982,7 +1328,9 @@ class ClassSchedule:
         if web2pytest.is_running_under_test(request, request.application):
             rows = self._get_day_table()
         else:
-            cache = current.cache
+            from .os_cache_manager import OsCacheManager
+
+            ocm = OsCacheManager()
             DATE_FORMAT = current.DATE_FORMAT
             CACHE_LONG = current.globalenv['CACHE_LONG']
             cache_key = 'openstudio_classschedule_get_day_table_' + \
@@ -998,7 +1346,10 @@ class ClassSchedule:
                         str(self.trend_medium) + '_' + \
                         str(self.trend_high)
 
-            rows = cache.ram(cache_key , lambda: self._get_day_table(), time_expire=CACHE_LONG)
+            rows = ocm.get_tagged(cache_key,
+                                  lambda: self._get_day_table(),
+                                  ['classschedule'],
+                                  time_expire=CACHE_LONG)
 
         return rows
 
@@ -1007,13 +1358,57 @@ class ClassSchedule:
         """
             Format rows as list
         """
+        rows = self.get_day_rows()
+
+        return self._get_day_list_format_rows(rows)
+
+
+    def get_range_list(self, date_from, date_until):
+        """
+            Format rows for a range of dates as lists, using one query for the whole range
+            :param date_from: datetime.date
+            :param date_until: datetime.date
+            :return: dict {datetime.date: list formatted like get_day_list()}
+        """
+        rows = self.get_range_rows(date_from, date_until)
+
+        data = {}
+        delta = datetime.timedelta(days=1)
+        date = date_from
+        while date <= date_until:
+            day_rows = rows.find(lambda row: row['ClassDate'] == date)
+            class_schedule = ClassSchedule(
+                date,
+                filter_id_sys_organization=self.filter_id_sys_organization,
+                filter_id_school_classtype=self.filter_id_school_classtype,
+                filter_id_school_location=self.filter_id_school_location,
+                filter_id_school_level=self.filter_id_school_level,
+                filter_id_teacher=self.filter_id_teacher,
+                filter_id_status=self.filter_id_status,
+                filter_public=self.filter_public,
+                filter_starttime_from=self.filter_starttime_from,
+                sorting=self.sorting,
+                trend_medium=self.trend_medium,
+                trend_high=self.trend_high
+            )
+
+            data[date] = class_schedule._get_day_list_format_rows(day_rows)
+
+            date += delta
+
+        return data
+
+
+    def _get_day_list_format_rows(self, rows):
+        """
+            :param rows: get_day_rows() rows, or get_range_rows() rows for self.date
+            :return: list of classes
+        """
         os_gui = current.globalenv['os_gui']
         DATE_FORMAT = current.DATE_FORMAT
         T = current.T
         date_formatted = self.date.strftime(DATE_FORMAT)
 
-        rows = self.get_day_rows()
-
         get_status = self._get_day_row_status
 
         classes = []
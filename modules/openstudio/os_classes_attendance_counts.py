@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+from gluon import *
+
+
+class ClassesAttendanceCounts:
+    """
+        Maintains db.classes_attendance_count, which holds the number of
+        bookings for each class occurrence (classes_id, ClassDate).
+
+        The counts are updated by callbacks on db.classes_attendance, so they
+        change in the same transaction as the attendance record itself.
+        Counts are written using an upsert on the unique index on
+        (classes_id, ClassDate), so the first bookings of a class occurrence
+        made at the same time can't create 2 count rows.
+        rebuild() recounts occurrences from db.classes_attendance, in case
+        records were changed without callbacks (eg. a cascading delete).
+    """
+    # Changes to these fields in classes_attendance affect the counts
+    count_fields = ['classes_id', 'ClassDate', 'BookingStatus', 'online_booking']
+
+
+    def __init__(self):
+        # Rows selected in _before_update & _before_delete callbacks
+        self._rows_before = []
+
+
+    def _get_value(self, fields, fieldname):
+        """
+        :param fields: fields passed to a DAL callback
+        :param fieldname: string - name of field
+        :return: value of field or None when not set
+        """
+        try:
+            return fields[fieldname]
+        except KeyError:
+            return None
+
+
+    def _get_row_counts(self, classes_id, date, booking_status, online_booking):
+        """
+        :return: dict {(classes_id, ClassDate): [Attendance, OnlineBooking, Attending]}
+        for one classes_attendance record
+        """
+        # Same conditions as the queries in rebuild()
+        attendance = 1 if booking_status and booking_status != 'cancelled' else 0
+        online = 1 if attendance and online_booking else 0
+        attending = 1 if booking_status == 'attending' else 0
+
+        return {(int(classes_id), str(date)): [attendance, online, attending]}
+
+
+    def _add_counts(self, deltas, counts, sign=1):
+        """
+        :param deltas: dict {(classes_id, ClassDate): [Attendance, OnlineBooking, Attending]}
+        :param counts: dict returned by _get_row_counts()
+        :param sign: 1 to add counts, -1 to subtract them
+        :return: None
+        """
+        for key, values in counts.items():
+            delta = deltas.setdefault(key, [0, 0, 0])
+            for i, value in enumerate(values):
+                delta[i] += sign * value
+
+
+    def _apply(self, deltas):
+        """
+        Update counts in db.classes_attendance_count
+        :param deltas: dict {(classes_id, ClassDate): [Attendance, OnlineBooking, Attending]}
+        :return: None
+        """
+        db = current.db
+
+        for (clsID, date), (attendance, online, attending) in deltas.items():
+            if not (attendance or online or attending):
+                continue
+
+            query = (db.classes_attendance_count.classes_id == clsID) & \
+                    (db.classes_attendance_count.ClassDate == date)
+            updated = db(query).update(
+                Attendance=db.classes_attendance_count.Attendance + attendance,
+                OnlineBooking=db.classes_attendance_count.OnlineBooking + online,
+                Attending=db.classes_attendance_count.Attending + attending
+            )
+
+            if not updated:
+                # First change for this class occurrence
+                self.refresh(clsID, date)
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for db.classes_attendance
+        """
+        deltas = {}
+        self._add_counts(deltas, self._get_row_counts(
+            self._get_value(fields, 'classes_id'),
+            self._get_value(fields, 'ClassDate'),
+            self._get_value(fields, 'BookingStatus'),
+            self._get_value(fields, 'online_booking'),
+        ))
+
+        self._apply(deltas)
+
+
+    def before_update(self, dbset, fields):
+        """
+        _before_update callback for db.classes_attendance
+        """
+        db = current.db
+
+        rows = None
+        if [f for f in self.count_fields if not self._get_value(fields, f) is None]:
+            rows = dbset.select(*[db.classes_attendance[f] for f in self.count_fields])
+
+        self._rows_before.append(rows)
+
+        # Returning True would cancel the update
+        return False
+
+
+    def after_update(self, dbset, fields):
+        """
+        _after_update callback for db.classes_attendance
+        """
+        rows = self._rows_before.pop() if self._rows_before else None
+        if not rows:
+            return
+
+        deltas = {}
+        for row in rows:
+            self._add_counts(deltas, self._get_row_counts(
+                row.classes_id,
+                row.ClassDate,
+                row.BookingStatus,
+                row.online_booking
+            ), sign=-1)
+
+            new = {}
+            for f in self.count_fields:
+                value = self._get_value(fields, f)
+                new[f] = row[f] if value is None else value
+
+            self._add_counts(deltas, self._get_row_counts(
+                new['classes_id'],
+                new['ClassDate'],
+                new['BookingStatus'],
+                new['online_booking']
+            ))
+
+        self._apply(deltas)
+
+
+    def before_delete(self, dbset):
+        """
+        _before_delete callback for db.classes_attendance
+        """
+        db = current.db
+
+        rows = dbset.select(*[db.classes_attendance[f] for f in self.count_fields])
+        self._rows_before.append(rows)
+
+        # Returning True would cancel the delete
+        return False
+
+
+    def after_delete(self, dbset):
+        """
+        _after_delete callback for db.classes_attendance
+        """
+        rows = self._rows_before.pop() if self._rows_before else None
+        if not rows:
+            return
+
+        deltas = {}
+        for row in rows:
+            self._add_counts(deltas, self._get_row_counts(
+                row.classes_id,
+                row.ClassDate,
+                row.BookingStatus,
+                row.online_booking
+            ), sign=-1)
+
+        self._apply(deltas)
+
+
+    def get(self, clsID, date):
+        """
+        :param clsID: db.classes.id
+        :param date: datetime.date
+        :return: dict with keys Attendance, OnlineBooking & Attending
+        """
+        db = current.db
+
+        query = (db.classes_attendance_count.classes_id == clsID) & \
+                (db.classes_attendance_count.ClassDate == date)
+        row = db(query).select(db.classes_attendance_count.Attendance,
+                               db.classes_attendance_count.OnlineBooking,
+                               db.classes_attendance_count.Attending).first()
+        if row:
+            return {
+                'Attendance': row.Attendance or 0,
+                'OnlineBooking': row.OnlineBooking or 0,
+                'Attending': row.Attending or 0,
+            }
+
+        # No counts stored (yet), count attendance instead
+        query = (db.classes_attendance.classes_id == clsID) & \
+                (db.classes_attendance.ClassDate == date)
+        rows = db(query).select(db.classes_attendance.BookingStatus,
+                                db.classes_attendance.online_booking)
+
+        counts = {}
+        for row in rows:
+            self._add_counts(counts, self._get_row_counts(
+                clsID,
+                date,
+                row.BookingStatus,
+                row.online_booking
+            ))
+
+        attendance, online, attending = counts.get((int(clsID), str(date)), [0, 0, 0])
+
+        return {
+            'Attendance': attendance,
+            'OnlineBooking': online,
+            'Attending': attending,
+        }
+
+
+    def _get_upsert_clause(self):
+        """
+        :return: string - clause replacing the counts of a class occurrence that
+                 already has them, for the database engine in use
+        """
+        db = current.db
+
+        engine = db._adapter.dbengine
+        if engine == 'mysql':
+            return """ON DUPLICATE KEY UPDATE Attendance = VALUES(Attendance),
+                                              OnlineBooking = VALUES(OnlineBooking),
+                                              Attending = VALUES(Attending)"""
+        elif engine == 'sqlite':
+            return """ON CONFLICT (classes_id, ClassDate) DO UPDATE SET Attendance = excluded.Attendance,
+                                                                        OnlineBooking = excluded.OnlineBooking,
+                                                                        Attending = excluded.Attending"""
+        else:
+            # No unique index is created for other engines, see OsDbIndexes
+            return ""
+
+
+    def _rebuild_query(self, where):
+        """
+        :param where: string - conditions for classes_attendance
+        :return: string - query inserting or replacing counts for each class occurrence
+        """
+        return """
+        INSERT INTO classes_attendance_count
+            (classes_id, ClassDate, Attendance, OnlineBooking, Attending)
+        SELECT classes_id,
+               ClassDate,
+               SUM(CASE WHEN BookingStatus != 'cancelled' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN BookingStatus != 'cancelled' AND online_booking = 'T'
+                        THEN 1 ELSE 0 END),
+               SUM(CASE WHEN BookingStatus = 'attending' THEN 1 ELSE 0 END)
+        FROM classes_attendance
+        WHERE {where}
+        GROUP BY classes_id, ClassDate
+        {upsert}
+        """.format(where=where,
+                   upsert=self._get_upsert_clause())
+
+
+    def refresh(self, clsID, date):
+        """
+        Recount one class occurrence
+        :param clsID: db.classes.id
+        :param date: datetime.date
+        :return: None
+        """
+        db = current.db
+
+        db.executesql(self._rebuild_query(
+            "classes_id = {clsID} AND ClassDate = '{date}'".format(clsID=int(clsID),
+                                                                    date=date)
+        ))
+
+        # Occurrences without attendance don't have counts
+        query = (db.classes_attendance.classes_id == clsID) & \
+                (db.classes_attendance.ClassDate == date)
+        if db(query).isempty():
+            query = (db.classes_attendance_count.classes_id == clsID) & \
+                    (db.classes_attendance_count.ClassDate == date)
+            db(query).delete()
+
+
+    def rebuild(self, date_from=None, date_until=None):
+        """
+        Recount all class occurrences in a date range
+        :param date_from: datetime.date - None for no lower bound
+        :param date_until: datetime.date - None for no upper bound
+        :return: int - number of class occurrences with bookings
+        """
+        db = current.db
+
+        query = (db.classes_attendance_count.id > 0)
+        where = "1 = 1"
+        if date_from:
+            query &= (db.classes_attendance_count.ClassDate >= date_from)
+            where += " AND ClassDate >= '{date_from}'".format(date_from=date_from)
+        if date_until:
+            query &= (db.classes_attendance_count.ClassDate <= date_until)
+            where += " AND ClassDate <= '{date_until}'".format(date_until=date_until)
+
+        db(query).delete()
+        db.executesql(self._rebuild_query(where))
+
+        return db(query).count()
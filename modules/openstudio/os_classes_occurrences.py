@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from gluon import *
+
+
+class ClassesOccurrences:
+    """
+        Maintains db.classes_occurrences, which holds one row for each date a
+        class takes place, with one time changes (classes_otc), teachers
+        (classes_teachers) and holidays (school_holidays) already applied.
+
+        Occurrences are kept from weeks_back weeks ago until weeks_ahead weeks
+        from today. They're updated by callbacks on the tables they're derived
+        from and rebuilt daily by the classes_occurrences_rebuild scheduler
+        task, which also moves the window forward.
+    """
+    weeks_back = 52
+    weeks_ahead = 26
+
+    # Number of days inserted using one query
+    chunk_days = 31
+
+
+    def __init__(self):
+        # Rows selected in _before_update & _before_delete callbacks
+        self._rows_before = []
+
+
+    def get_window(self):
+        """
+        :return: tuple (datetime.date, datetime.date) - first and last date kept
+        """
+        TODAY_LOCAL = current.TODAY_LOCAL
+
+        return (TODAY_LOCAL - datetime.timedelta(weeks=self.weeks_back),
+                TODAY_LOCAL + datetime.timedelta(weeks=self.weeks_ahead))
+
+
+    def _get_insert_query(self, date_from, date_until, where):
+        """
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param where: string - additional conditions for classes (cla)
+        :return: string - query inserting occurrences of classes in range
+        """
+        from .os_class_schedule import ClassSchedule
+
+        dates = ClassSchedule(date_from)._get_range_dates_query(date_from, date_until)
+
+        return """
+        INSERT INTO classes_occurrences
+            (classes_id,
+             ClassDate,
+             Status,
+             Description,
+             school_locations_id,
+             school_classtypes_id,
+             school_levels_id,
+             sys_organizations_id,
+             Starttime,
+             Endtime,
+             Maxstudents,
+             WalkInSpaces,
+             auth_teacher_id,
+             teacher_role,
+             auth_teacher_id2,
+             teacher_role2,
+             school_holidays_id)
+        SELECT cla.id,
+               d.ClassDate,
+               CASE WHEN cotc.Status IS NOT NULL
+                    THEN cotc.Status
+                    ELSE 'normal'
+                    END AS Status,
+               cotc.Description,
+               CASE WHEN cotc.school_locations_id IS NOT NULL
+                    THEN cotc.school_locations_id
+                    ELSE cla.school_locations_id
+                    END AS school_locations_id,
+               CASE WHEN cotc.school_classtypes_id IS NOT NULL
+                    THEN cotc.school_classtypes_id
+                    ELSE cla.school_classtypes_id
+                    END AS school_classtypes_id,
+               cla.school_levels_id,
+               cla.sys_organizations_id,
+               CASE WHEN cotc.Starttime IS NOT NULL
+                    THEN cotc.Starttime
+                    ELSE cla.Starttime
+                    END AS Starttime,
+               CASE WHEN cotc.Endtime IS NOT NULL
+                    THEN cotc.Endtime
+                    ELSE cla.Endtime
+                    END AS Endtime,
+               CASE WHEN cotc.Maxstudents IS NOT NULL
+                    THEN cotc.Maxstudents
+                    ELSE cla.Maxstudents
+                    END AS Maxstudents,
+               CASE WHEN cotc.WalkInSpaces IS NOT NULL
+                    THEN cotc.WalkInSpaces
+                    ELSE cla.WalkInSpaces
+                    END AS WalkInSpaces,
+               CASE WHEN cotc.auth_teacher_id IS NOT NULL
+                    THEN cotc.auth_teacher_id
+                    ELSE clt.auth_teacher_id
+                    END AS auth_teacher_id,
+               CASE WHEN cotc.auth_teacher_id IS NOT NULL
+                    THEN cotc.teacher_role
+                    ELSE clt.teacher_role
+                    END AS teacher_role,
+               CASE WHEN cotc.auth_teacher_id2 IS NOT NULL
+                    THEN cotc.auth_teacher_id2
+                    ELSE clt.auth_teacher_id2
+                    END AS auth_teacher_id2,
+               CASE WHEN cotc.auth_teacher_id2 IS NOT NULL
+                    THEN cotc.teacher_role2
+                    ELSE clt.teacher_role2
+                    END AS teacher_role2,
+               ( SELECT MIN(sh.id)
+                 FROM school_holidays sh
+                 INNER JOIN school_holidays_locations shl
+                    ON shl.school_holidays_id = sh.id
+                 WHERE shl.school_locations_id = cla.school_locations_id AND
+                       sh.Startdate <= d.ClassDate AND
+                       sh.Enddate >= d.ClassDate ) AS school_holidays_id
+        FROM ( {dates} ) d
+        INNER JOIN classes cla
+            ON cla.Week_day = d.Week_day AND
+               cla.Startdate <= d.ClassDate AND
+               (cla.Enddate >= d.ClassDate OR cla.Enddate IS NULL)
+        LEFT JOIN classes_otc cotc
+            ON cotc.classes_id = cla.id AND cotc.ClassDate = d.ClassDate
+        /* Latest teachers record for the class on each date */
+        LEFT JOIN classes_teachers clt
+            ON clt.id = ( SELECT MAX(clt2.id)
+                          FROM classes_teachers clt2
+                          WHERE clt2.classes_id = cla.id AND
+                                clt2.Startdate <= d.ClassDate AND
+                                (clt2.Enddate >= d.ClassDate OR clt2.Enddate IS NULL) )
+        WHERE {where}
+        """.format(dates=dates,
+                   where=where)
+
+
+    def refresh(self, date_from=None, date_until=None, classes_ids=None):
+        """
+        Recompute occurrences in a range, limited to the window
+        :param date_from: datetime.date - None for the start of the window
+        :param date_until: datetime.date - None for the end of the window
+        :param classes_ids: list of db.classes.id - None for all classes
+        :return: None
+        """
+        db = current.db
+
+        window_from, window_until = self.get_window()
+        date_from = max(date_from or window_from, window_from)
+        date_until = min(date_until or window_until, window_until)
+        if date_from > date_until:
+            return
+
+        query = (db.classes_occurrences.ClassDate >= date_from) & \
+                (db.classes_occurrences.ClassDate <= date_until)
+        where = "1 = 1"
+        if classes_ids is not None:
+            classes_ids = sorted(set([int(clsID) for clsID in classes_ids if clsID]))
+            if not classes_ids:
+                return
+
+            query &= (db.classes_occurrences.classes_id.belongs(classes_ids))
+            where = "cla.id IN ({ids})".format(ids=', '.join([str(clsID) for clsID in classes_ids]))
+
+        db(query).delete()
+
+        date = date_from
+        while date <= date_until:
+            chunk_until = min(date + datetime.timedelta(days=self.chunk_days - 1), date_until)
+            db.executesql(self._get_insert_query(date, chunk_until, where))
+
+            date = chunk_until + datetime.timedelta(days=1)
+
+
+    def rebuild(self):
+        """
+        Recompute all occurrences in the window and remove occurrences outside it
+        :return: int - number of occurrences
+        """
+        db = current.db
+
+        window_from, window_until = self.get_window()
+
+        query = (db.classes_occurrences.ClassDate < window_from) | \
+                (db.classes_occurrences.ClassDate > window_until)
+        db(query).delete()
+
+        self.refresh(window_from, window_until)
+
+        # Remember the range that's complete, so schedules know when they can
+        # read from db.classes_occurrences
+        set_sys_property = current.globalenv['set_sys_property']
+        set_sys_property('classes_occurrences_from', str(window_from))
+        set_sys_property('classes_occurrences_until', str(window_until))
+
+        return db(db.classes_occurrences).count()
+
+
+    def covers(self, date_from, date_until):
+        """
+        Check whether all occurrences in a range are available
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :return: Boolean - True when the last rebuild holds the range and
+        the range is still kept up to date
+        """
+        get_sys_property = current.globalenv['get_sys_property']
+
+        built_from = get_sys_property('classes_occurrences_from')
+        built_until = get_sys_property('classes_occurrences_until')
+        if not built_from or not built_until:
+            return False
+
+        window_from, window_until = self.get_window()
+
+        return (max(self._to_date(built_from), window_from) <= date_from and
+                date_until <= min(self._to_date(built_until), window_until))
+
+
+    def get_rows(self, date_from, date_until, classes_ids=None):
+        """
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param classes_ids: list of db.classes.id - None for all classes
+        :return: gluon.dal.rows of db.classes_occurrences, ordered by date and start time
+        """
+        db = current.db
+
+        query = (db.classes_occurrences.ClassDate >= date_from) & \
+                (db.classes_occurrences.ClassDate <= date_until)
+        if classes_ids is not None:
+            query &= (db.classes_occurrences.classes_id.belongs(classes_ids))
+
+        return db(query).select(db.classes_occurrences.ALL,
+                                orderby=db.classes_occurrences.ClassDate|
+                                        db.classes_occurrences.Starttime)
+
+
+    def _pop_rows_before(self):
+        """
+        :return: rows stored by a _before_* callback
+        """
+        return self._rows_before.pop() if self._rows_before else []
+
+
+    def _get_value(self, fields, fieldname):
+        """
+        :param fields: fields passed to a DAL callback
+        :param fieldname: string - name of field
+        :return: value of field or None when not set
+        """
+        try:
+            return fields[fieldname]
+        except KeyError:
+            return None
+
+
+    def _to_date(self, value):
+        """
+        :param value: datetime.date or string formatted as YYYY-MM-DD
+        :return: datetime.date
+        """
+        if isinstance(value, datetime.date):
+            return value
+
+        return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+
+
+    # db.classes & db.classes_teachers
+
+    def classes_after_insert(self, fields, id):
+        """
+        _after_insert callback for db.classes
+        """
+        self.refresh(classes_ids=[id])
+
+
+    def classes_before_change(self, dbset, fields=None):
+        """
+        _before_update & _before_delete callback for db.classes
+        """
+        db = current.db
+
+        self._rows_before.append(dbset.select(db.classes.id))
+
+        # Returning True would cancel the update or delete
+        return False
+
+
+    def classes_after_change(self, dbset, fields=None):
+        """
+        _after_update & _after_delete callback for db.classes
+        """
+        rows = self._pop_rows_before()
+        if rows:
+            self.refresh(classes_ids=[row.id for row in rows])
+
+
+    def classes_teachers_after_insert(self, fields, id):
+        """
+        _after_insert callback for db.classes_teachers
+        """
+        self.refresh(classes_ids=[self._get_value(fields, 'classes_id')])
+
+
+    def classes_teachers_before_change(self, dbset, fields=None):
+        """
+        _before_update & _before_delete callback for db.classes_teachers
+        """
+        db = current.db
+
+        self._rows_before.append(dbset.select(db.classes_teachers.classes_id))
+
+        # Returning True would cancel the update or delete
+        return False
+
+
+    def classes_teachers_after_change(self, dbset, fields=None):
+        """
+        _after_update & _after_delete callback for db.classes_teachers
+        """
+        classes_ids = [row.classes_id for row in self._pop_rows_before()]
+        classes_id = self._get_value(fields or {}, 'classes_id')
+        if classes_id:
+            classes_ids.append(classes_id)
+
+        if classes_ids:
+            self.refresh(classes_ids=classes_ids)
+
+
+    # db.classes_otc
+
+    def _refresh_classes_otc(self, occurrences):
+        """
+        :param occurrences: list of tuples (classes_id, ClassDate)
+        :return: None
+        """
+        for clsID, date in set(occurrences):
+            if clsID and date:
+                date = self._to_date(date)
+                self.refresh(date, date, classes_ids=[clsID])
+
+
+    def classes_otc_after_insert(self, fields, id):
+        """
+        _after_insert callback for db.classes_otc
+        """
+        self._refresh_classes_otc([(self._get_value(fields, 'classes_id'),
+                                    self._get_value(fields, 'ClassDate'))])
+
+
+    def classes_otc_before_change(self, dbset, fields=None):
+        """
+        _before_update & _before_delete callback for db.classes_otc
+        """
+        db = current.db
+
+        self._rows_before.append(dbset.select(db.classes_otc.id,
+                                              db.classes_otc.classes_id,
+                                              db.classes_otc.ClassDate))
+
+        # Returning True would cancel the update or delete
+        return False
+
+
+    def classes_otc_after_change(self, dbset, fields=None):
+        """
+        _after_update & _after_delete callback for db.classes_otc
+        """
+        rows = self._pop_rows_before()
+
+        occurrences = []
+        for row in rows:
+            occurrences.append((row.classes_id, row.ClassDate))
+            if fields:
+                # Occurrence the change was moved to, if any
+                occurrences.append((self._get_value(fields, 'classes_id') or row.classes_id,
+                                    self._get_value(fields, 'ClassDate') or row.ClassDate))
+
+        self._refresh_classes_otc(occurrences)
+
+
+    # db.school_holidays & db.school_holidays_locations
+
+    def _refresh_school_holidays(self, ranges):
+        """
+        :param ranges: list of tuples (Startdate, Enddate)
+        :return: None
+        """
+        for date_from, date_until in set(ranges):
+            if date_from and date_until:
+                self.refresh(self._to_date(date_from), self._to_date(date_until))
+
+
+    def school_holidays_before_change(self, dbset, fields=None):
+        """
+        _before_update & _before_delete callback for db.school_holidays
+        """
+        db = current.db
+
+        self._rows_before.append(dbset.select(db.school_holidays.Startdate,
+                                              db.school_holidays.Enddate))
+
+        # Returning True would cancel the update or delete
+        return False
+
+
+    def school_holidays_after_change(self, dbset, fields=None):
+        """
+        _after_update & _after_delete callback for db.school_holidays
+        """
+        rows = self._pop_rows_before()
+
+        ranges = []
+        for row in rows:
+            ranges.append((row.Startdate, row.Enddate))
+            if fields:
+                ranges.append((self._get_value(fields, 'Startdate') or row.Startdate,
+                               self._get_value(fields, 'Enddate') or row.Enddate))
+
+        self._refresh_school_holidays(ranges)
+
+
+    def _get_school_holidays_ranges(self, shIDs):
+        """
+        :param shIDs: list of db.school_holidays.id
+        :return: list of tuples (Startdate, Enddate)
+        """
+        db = current.db
+
+        shIDs = [shID for shID in shIDs if shID]
+        if not shIDs:
+            return []
+
+        rows = db(db.school_holidays.id.belongs(shIDs)).select(db.school_holidays.Startdate,
+                                                              db.school_holidays.Enddate)
+
+        return [(row.Startdate, row.Enddate) for row in rows]
+
+
+    def school_holidays_locations_after_insert(self, fields, id):
+        """
+        _after_insert callback for db.school_holidays_locations
+        """
+        self._refresh_school_holidays(self._get_school_holidays_ranges(
+            [self._get_value(fields, 'school_holidays_id')]
+        ))
+
+
+    def school_holidays_locations_before_change(self, dbset, fields=None):
+        """
+        _before_update & _before_delete callback for db.school_holidays_locations
+        """
+        db = current.db
+
+        self._rows_before.append(dbset.select(db.school_holidays_locations.school_holidays_id))
+
+        # Returning True would cancel the update or delete
+        return False
+
+
+    def school_holidays_locations_after_change(self, dbset, fields=None):
+        """
+        _after_update & _after_delete callback for db.school_holidays_locations
+        """
+        shIDs = [row.school_holidays_id for row in self._pop_rows_before()]
+        if fields:
+            shIDs.append(self._get_value(fields, 'school_holidays_id'))
+
+        self._refresh_school_holidays(self._get_school_holidays_ranges(shIDs))
@@ -48,6 +48,8 @@ class Customer:
         """
             Returns subscription for a date
         """
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
         db = current.db
         cache = current.cache
         request = current.request
@@ -79,20 +81,17 @@ class Customer:
                         ssu.ReconciliationClasses,
                         ssu.Unlimited,
                         ssu.school_memberships_id,
-(IFNULL(( SELECT SUM(csc.MutationAmount)
- FROM customers_subscriptions_credits csc
- WHERE csc.customers_subscriptions_id = cs.id AND
-	   csc.MutationType = 'add'), 0) -
-IFNULL(( SELECT SUM(csc.MutationAmount)
- FROM customers_subscriptions_credits csc
- WHERE csc.customers_subscriptions_id = cs.id AND
-	   csc.MutationType = 'sub'), 0)) AS credits
+{credits} AS credits
 FROM customers_subscriptions cs
 LEFT JOIN
 school_subscriptions ssu ON cs.school_subscriptions_id = ssu.id
+LEFT JOIN
+customers_subscriptions_credits_balance cscb ON cscb.customers_subscriptions_id = cs.id
 WHERE cs.auth_customer_id = {cuID} AND
 (cs.Startdate <= '{date}' AND (cs.Enddate >= '{date}' OR cs.Enddate IS NULL))
-ORDER BY cs.Startdate""".format(cuID=self.cuID, date=date)
+ORDER BY cs.Startdate""".format(cuID=self.cuID,
+                                date=date,
+                                credits=CustomersSubscriptionsCreditsBalances().get_balance_sql())
 
         rows = db.executesql(sql, fields=fields)
 
@@ -117,13 +116,19 @@ ORDER BY cs.Startdate""".format(cuID=self.cuID, date=date)
         if web2pytest.is_running_under_test(request, request.application) or not from_cache:
             rows = self._get_subscriptions_on_date(date)
         else:
-            cache = current.cache
+            from .os_cache_manager import OsCacheManager
+
+            ocm = OsCacheManager()
             DATE_FORMAT = current.DATE_FORMAT
             CACHE_LONG = current.globalenv['CACHE_LONG']
             cache_key = 'openstudio_customer_get_subscriptions_on_date_' + \
                         str(self.cuID) + '_' + \
                         date.strftime(DATE_FORMAT)
-            rows = cache.ram(cache_key , lambda: self._get_subscriptions_on_date(date), time_expire=CACHE_LONG)
+            tags = ['customers_subscriptions', 'customers_subscriptions_' + str(self.cuID)]
+            rows = ocm.get_tagged(cache_key,
+                                  lambda: self._get_subscriptions_on_date(date),
+                                  tags,
+                                  time_expire=CACHE_LONG)
 
         return rows
 
@@ -276,13 +281,18 @@ ORDER BY cs.Startdate""".format(cuID=self.cuID, date=date)
         if web2pytest.is_running_under_test(request, request.application) or not from_cache:
             rows = self._get_memberships_on_date(date)
         else:
-            cache = current.cache
+            from .os_cache_manager import OsCacheManager
+
+            ocm = OsCacheManager()
             DATE_FORMAT = current.DATE_FORMAT
             CACHE_LONG = current.globalenv['CACHE_LONG']
             cache_key = 'openstudio_customer_get_memberships_on_date_' + \
                         str(self.cuID) + '_' + \
                         date.strftime(DATE_FORMAT)
-            rows = cache.ram(cache_key, lambda: self._get_memberships_on_date(date), time_expire=CACHE_LONG)
+            rows = ocm.get_tagged(cache_key,
+                                  lambda: self._get_memberships_on_date(date),
+                                  ['customers_memberships_' + str(self.cuID)],
+                                  time_expire=CACHE_LONG)
 
         return rows
 
@@ -361,13 +371,18 @@ ORDER BY cs.Startdate""".format(cuID=self.cuID, date=date)
         if web2pytest.is_running_under_test(request, request.application) or not from_cache:
             rows = self._get_classcards(date)
         else:
-            cache = current.cache
+            from .os_cache_manager import OsCacheManager
+
+            ocm = OsCacheManager()
             DATE_FORMAT = current.DATE_FORMAT
             CACHE_LONG = current.globalenv['CACHE_LONG']
             cache_key = 'openstudio_customer_get_classcards_' + \
                         str(self.cuID) + '_' + \
                         date.strftime(DATE_FORMAT)
-            rows = cache.ram(cache_key , lambda: self._get_classcards(date), time_expire=CACHE_LONG)
+            rows = ocm.get_tagged(cache_key,
+                                  lambda: self._get_classcards(date),
+                                  ['customers_classcards_' + str(self.cuID)],
+                                  time_expire=CACHE_LONG)
 
         return rows
 
@@ -1215,15 +1230,10 @@ ORDER BY cs.Startdate""".format(cuID=self.cuID, date=date)
         """
         Set barcode id field for customer
         """
-        from .os_cache_manager import OsCacheManager
-
         if self.row.barcode_id is None or self.row.barcode_id == '':
             self.row.barcode_id = str(self.cuID).zfill(13)
             self.row.update_record()
 
-            ocm = OsCacheManager()
-            ocm.clear_customers()
-
 
     def set_barcode(self):
         """
@@ -346,39 +346,10 @@ class CustomerClasscard:
         """
             :return: return list of class permissons (clsID: enroll, book in shop, attend)
         """
-        db = current.db
-
-        # get groups for classcard
-        query = (db.school_classcards_groups_classcards.school_classcards_id == self.scdID)
-        rows = db(query).select(db.school_classcards_groups_classcards.school_classcards_groups_id)
-
-        group_ids = []
-        for row in rows:
-            group_ids.append(row.school_classcards_groups_id)
-
-
-        # get permissions for classcard group
-        left = [db.classes.on(db.classes_school_classcards_groups.classes_id == db.classes.id)]
-        query = (db.classes_school_classcards_groups.school_classcards_groups_id.belongs(group_ids))
-
-        if public_only:
-            query &= (db.classes.AllowAPI == True)
-
-        rows = db(query).select(db.classes_school_classcards_groups.ALL,
-                                left=left)
-
-        permissions = {}
-        for row in rows:
-            clsID = row.classes_id
-            if clsID not in permissions:
-                permissions[clsID] = {}
+        os_class_permissions = current.globalenv['os_class_permissions']
 
-            if row.Enroll:
-                permissions[clsID]['Enroll'] = True
-            if row.ShopBook:
-                permissions[clsID]['ShopBook'] = True
-            if row.Attend:
-                permissions[clsID]['Attend'] = True
+        permissions = os_class_permissions.get_classcard_permissions(self.scdID,
+                                                                     public_only=public_only)
 
         if not formatted:
             return permissions
@@ -18,13 +18,12 @@ class CustomerExport:
         """
             Customer export all data
         """
-        from io import BytesIO
         import openpyxl
+        from .os_export import OsExport
 
 
         db = current.db
 
-        stream = BytesIO()
         # Create the workbook
         wb = openpyxl.workbook.Workbook(write_only=True)
 
@@ -48,8 +47,7 @@ class CustomerExport:
         self._excel_payment_batch_items(db, wb)
 
 
-        wb.save(stream)
-        return stream
+        return OsExport().excel_workbook(wb)
 
 
     def _excel_account(self, db, wb):
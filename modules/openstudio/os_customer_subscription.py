@@ -169,21 +169,11 @@ class CustomerSubscription:
 
     def get_credits_balance(self):
         """
-            Calculate total credits remaining for a subscription
+            Total credits remaining for a subscription
         """
-        db = current.db
-
-        sum = db.customers_subscriptions_credits.MutationAmount.sum()
-
-        query = (db.customers_subscriptions_credits.MutationType == 'add') & \
-                (db.customers_subscriptions_credits.customers_subscriptions_id == self.csID)
-        add_total = db(query).select(sum).first()[sum] or 0
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
 
-        query = (db.customers_subscriptions_credits.MutationType == 'sub') & \
-                (db.customers_subscriptions_credits.customers_subscriptions_id == self.csID)
-        sub_total = db(query).select(sum).first()[sum] or 0
-
-        return round(add_total - sub_total, 1)
+        return CustomersSubscriptionsCreditsBalances().get(self.csID)
 
 
     def get_credits_mutations_rows(self,
@@ -465,38 +455,10 @@ class CustomerSubscription:
         In general, for back-end usage set public_only to False
         :return: return list of class permissons (clsID: enroll, book in shop, attend)
         """
-        db = current.db
-
-        # get groups for subscription
-        query = (db.school_subscriptions_groups_subscriptions.school_subscriptions_id == self.ssuID)
-        rows = db(query).select(db.school_subscriptions_groups_subscriptions.school_subscriptions_groups_id)
-
-        group_ids = []
-        for row in rows:
-            group_ids.append(row.school_subscriptions_groups_id)
-
-        # get permissions for subscription group
-        left = [db.classes.on(db.classes_school_subscriptions_groups.classes_id == db.classes.id)]
-        query = (db.classes_school_subscriptions_groups.school_subscriptions_groups_id.belongs(group_ids))
-
-        if public_only:
-            query &= (db.classes.AllowAPI == True)
-
-        rows = db(query).select(db.classes_school_subscriptions_groups.ALL,
-                                left=left)
+        os_class_permissions = current.globalenv['os_class_permissions']
 
-        permissions = {}
-        for row in rows:
-            clsID = row.classes_id
-            if clsID not in permissions:
-                permissions[clsID] = {}
-
-            if row.Enroll:
-                permissions[clsID]['Enroll'] = True
-            if row.ShopBook:
-                permissions[clsID]['ShopBook'] = True
-            if row.Attend:
-                permissions[clsID]['Attend'] = True
+        permissions = os_class_permissions.get_subscription_permissions(self.ssuID,
+                                                                        public_only=public_only)
 
         if not formatted:
             return permissions
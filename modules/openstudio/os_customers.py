@@ -10,12 +10,18 @@ class Customers:
         This clas sontains functions for multiple customers
     """
 
-    def list_activity_after_date(self, date):
+    def list_activity_after_date(self, date, ids=None):
         """
             :param: date: datetime.date
+            :param ids: list of db.auth_user.id - None for all customers
             :return: List of all records in auth_user with activity
         """
         db = current.db
+
+        where_ids = ''
+        if ids is not None:
+            where_ids = "AND au.id IN ({ids})".format(ids=', '.join([str(int(cuID)) for cuID in ids]) or 'NULL')
+
         query = """
 SELECT au.id, 
 	   au.first_name, 
@@ -66,18 +72,18 @@ WHERE (au.last_login < '{date}' OR au.last_login IS NULL) AND
       au.employee = 'F' AND 
       au.teacher = 'F' AND
       au.id > 1
-        """.format(date=date)
+      {where_ids}
+        """.format(date=date, where_ids=where_ids)
 
         return db.executesql(query)
 
-    def list_inactive_after_date(self, date):
+    def list_inactive_after_date(self, date, ids=None):
         """
         :param date: datetime.date
+        :param ids: list of db.auth_user.id - None to check all customers
         :return: list of customers inactive after date
         """
-        from general_helpers import datestr_to_python
-
-        records = self.list_activity_after_date(date)
+        records = self.list_activity_after_date(date, ids)
 
         inactive = []
         for record in records:
@@ -98,20 +104,59 @@ WHERE (au.last_login < '{date}' OR au.last_login IS NULL) AND
 
         return inactive
 
-    def delete_inactive_after_date(self, date):
+    def list_inactive_ids_after_date(self, date):
+        """
+        :param date: datetime.date
+        :return: list of db.auth_user.id of customers inactive after date
+        """
+        return [record[0] for record in self.list_inactive_after_date(date)]
+
+
+    def delete_inactive_after_date(self, date, chunk_size=500, ids=None):
         """
         :param date: datetime.date
+        :param chunk_size: int - number of customers to delete before committing
+        :param ids: list returned by list_inactive_ids_after_date(), None to list them here
         :return: Integer - count of customers deleted
         """
+        return self.purge_inactive_after_date(date, chunk_size=chunk_size, ids=ids)['deleted']
+
+
+    def purge_inactive_after_date(self, date, chunk_size=500, dry_run=False, progress=None, ids=None):
+        """
+        Delete customers inactive after date in chunks, committing after each
+        chunk so the tables aren't locked until all customers are deleted.
+        Customers are checked again before deleting a chunk, so customers that
+        became active in the meantime are kept. When interrupted, running the
+        purge again continues with the customers that are left.
+        :param date: datetime.date
+        :param chunk_size: int - number of customers to delete before committing
+        :param dry_run: bool - True to only count inactive customers
+        :param progress: function called after each chunk with (deleted, found)
+        :param ids: list returned by list_inactive_ids_after_date(), None to list them here
+        :return: dict {'found': int, 'deleted': int}
+        """
         db = current.db
 
-        records = self.list_inactive_after_date(date)
-        ids = [record[0] for record in records]
+        if ids is None:
+            ids = self.list_inactive_ids_after_date(date)
+        found = len(ids)
+
+        deleted = 0
+        if not dry_run:
+            for i in range(0, found, chunk_size):
+                chunk = [record[0] for record in
+                         self.list_inactive_after_date(date, ids[i:i + chunk_size])]
+                if chunk:
+                    db(db.auth_user.id.belongs(chunk)).delete()
+                    db.commit()
+                    deleted += len(chunk)
 
-        query = (db.auth_user.id.belongs(ids))
-        db(query).delete()
+                if progress:
+                    progress(deleted, found)
+
+        return dict(found=found, deleted=deleted)
 
-        return len(records)
 
     def list_inactive_after_date_formatted(self, date):
         """
@@ -171,6 +216,184 @@ WHERE (au.last_login < '{date}' OR au.last_login IS NULL) AND
 
         return dict(table=table, count=len(records))
 
+
+    def count_export(self, newsletter_only=False):
+        """
+            :param newsletter_only: bool - only count customers subscribed to the newsletter
+            :return: int - number of customers in customer list & mailing list exports
+        """
+        db = current.db
+
+        query = (db.auth_user.trashed == False) & \
+                (db.auth_user.id > 1)
+        if newsletter_only:
+            query &= (db.auth_user.newsletter == True)
+
+        return db(query).count()
+
+
+    def export_list_sheets(self):
+        """
+            :return: list of sheets for OsExport.excel(), listing all customers
+                     with their latest subscription and payment info
+        """
+        return [('Customers list', self._export_list_rows())]
+
+
+    def _export_list_get_subscriptions(self, ids):
+        """
+            :param ids: list of db.auth_user.id
+            :return: dict {auth_user.id: [subscription, startdate, enddate, payment method]}
+        """
+        db = current.db
+
+        query = """SELECT cu.id,
+                          ssu.name,
+                          cs.startdate,
+                          cs.enddate,
+                          pm.Name
+                   FROM auth_user cu
+            LEFT JOIN customers_subscriptions cs
+            ON cs.auth_customer_id = cu.id
+            LEFT JOIN
+            (SELECT auth_customer_id, school_subscriptions_id, max(startdate) as startdate, enddate
+            FROM customers_subscriptions GROUP BY auth_customer_id) chk
+            ON cu.id = chk.auth_customer_id
+            LEFT JOIN
+            (SELECT id, name FROM school_subscriptions) ssu
+            ON ssu.id = cs.school_subscriptions_id
+            LEFT JOIN payment_methods pm ON cs.payment_methods_id = pm.id
+            WHERE (cs.startdate = chk.startdate OR cs.startdate IS NULL)
+              AND cu.id IN ({ids})""".format(ids=', '.join([str(int(i)) for i in ids]))
+
+        data = {}
+        for record in db.executesql(query):
+            data[record[0]] = [record[1] or "",
+                               record[2] or "",
+                               record[3] or "",
+                               record[4] or ""]
+
+        return data
+
+
+    def _export_list_rows(self, chunk_size=1000):
+        """
+            :param chunk_size: int - number of customers to select at once
+            :return: generator of lists - header followed by a row for each customer
+        """
+        from .os_export import OsExport
+
+        db = current.db
+
+        yield ["id",
+               "First name",
+               "Last name",
+               "Date of birth",
+               "Gender",
+               "Address",
+               "Postal code",
+               "City",
+               "Country",
+               "Email",
+               "Newsletter",
+               "Telephone",
+               "Mobile",
+               "Key",
+               "Location",
+               "Subscription",
+               "Startdate",
+               "Enddate",
+               "Payment",
+               "AccountNR",
+               "AccountHolder",
+               "BankName",
+               "BankLocation"]
+
+        export = OsExport()
+        query = (db.auth_user.trashed == False)
+        left = [db.school_locations.on(db.auth_user.school_locations_id ==
+                                       db.school_locations.id)]
+        chunks = export.select_chunks(query,
+                                      [db.auth_user.ALL, db.school_locations.Name],
+                                      db.auth_user.id,
+                                      left=left,
+                                      chunk_size=chunk_size)
+        for rows in chunks:
+            ids = [row.auth_user.id for row in rows]
+            subscriptions = self._export_list_get_subscriptions(ids)
+
+            payment_info = {}
+            pi_rows = db(db.customers_payment_info.auth_customer_id.belongs(ids)).select(
+                db.customers_payment_info.ALL
+            )
+            for row in pi_rows:
+                payment_info[row.auth_customer_id] = [row.AccountNumber,
+                                                      row.AccountHolder,
+                                                      row.BankName,
+                                                      row.BankLocation]
+
+            for row in rows:
+                customers_id = row.auth_user.id
+                data = [row.auth_user.id,
+                        row.auth_user.first_name,
+                        row.auth_user.last_name,
+                        row.auth_user.date_of_birth,
+                        row.auth_user.gender,
+                        row.auth_user.address,
+                        row.auth_user.postcode,
+                        row.auth_user.city,
+                        row.auth_user.country,
+                        row.auth_user.email,
+                        row.auth_user.newsletter,
+                        row.auth_user.phone,
+                        row.auth_user.mobile,
+                        row.auth_user.keynr,
+                        row.school_locations.Name]
+                data += subscriptions.get(customers_id, ["", "", "", ""])
+                data += payment_info.get(customers_id, [])
+
+                yield data
+
+
+    def export_mailinglist_sheets(self):
+        """
+            :return: list of sheets for OsExport.excel(), with names & email
+                     addresses of all customers and newsletter subscribers
+        """
+        return [('All customers', self._export_mailinglist_rows()),
+                ('Newsletter', self._export_mailinglist_rows(newsletter_only=True))]
+
+
+    def _export_mailinglist_rows(self, newsletter_only=False, chunk_size=1000):
+        """
+            :param newsletter_only: bool - only list customers subscribed to the newsletter
+            :param chunk_size: int - number of customers to select at once
+            :return: generator of lists [first name, last name, email]
+        """
+        from .os_export import OsExport
+
+        db = current.db
+
+        query = (db.auth_user.trashed == False) & \
+                (db.auth_user.id > 1)
+        if newsletter_only:
+            query &= (db.auth_user.newsletter == True)
+
+        export = OsExport()
+        chunks = export.select_chunks(query,
+                                      [db.auth_user.id,
+                                       db.auth_user.first_name,
+                                       db.auth_user.last_name,
+                                       db.auth_user.email],
+                                      db.auth_user.id,
+                                      chunk_size=chunk_size)
+        for rows in chunks:
+            for row in rows:
+                yield [row.first_name,
+                       row.last_name,
+                       row.email]
+
+
     def classes_add_get_form_date(self, cuID, date):
         """
             Get date form
@@ -410,6 +633,8 @@ WHERE (au.last_login < '{date}' OR au.last_login IS NULL) AND
         :return: Dictionary of customerID's containing current balance and total of reconcilliation credits allowed
         by all subscriptions a customer has on given date
         """
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
         db = current.db
 
         query = '''SELECT cs.id, 
@@ -418,19 +643,17 @@ WHERE (au.last_login < '{date}' OR au.last_login IS NULL) AND
                           ssu.ReconciliationClasses, 
                           cs.Startdate, 
                           cs.Enddate,
-                          IFNULL((( SELECT SUM(csc.MutationAmount)
-                                    FROM customers_subscriptions_credits csc
-                                    WHERE csc.customers_subscriptions_id = cs.id AND
-	                                csc.MutationType = 'add') - 
-                                  ( SELECT SUM(csc.MutationAmount)
-                                    FROM customers_subscriptions_credits csc
-                                    WHERE csc.customers_subscriptions_id = cs.id AND
-	                                csc.MutationType = 'sub')), 0) AS credits
+                          {credits} AS credits
                           FROM customers_subscriptions cs
                           LEFT JOIN 
                             school_subscriptions ssu ON cs.school_subscriptions_id = ssu.id
+                          LEFT JOIN
+                            customers_subscriptions_credits_balance cscb ON cscb.customers_subscriptions_id = cs.id
                           WHERE (cs.Startdate <= '{date}' AND (cs.Enddate >= '{date}' OR cs.Enddate IS NULL))
-                          ORDER BY cs.Startdate'''.format(date=date)
+                          ORDER BY cs.Startdate'''.format(
+            date=date,
+            credits=CustomersSubscriptionsCreditsBalances().get_balance_sql()
+        )
 
         result = db.executesql(query)
 
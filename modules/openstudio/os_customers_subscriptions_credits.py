@@ -22,57 +22,57 @@ class CustomersSubscriptionsCredits:
         """
             Get list of classes a customer has a reservation for in a selected month
         """
-        from .os_attendance_helper import AttendanceHelper
         from .os_class_schedule import ClassSchedule
-        from .os_classes_reservations import ClassesReservations
         db = current.db
 
-        ah = AttendanceHelper()
-        crh = ClassesReservations()
         first_day = datetime.date(year, month, 1)
         last_day = get_last_day_month(first_day)
 
+        # get list of classes for each date in month
+        cs = ClassSchedule(first_day)
+        classes_in_month = cs.get_range_list(first_day, last_day)
+
+        # Get customers with status "attending" or "booked" for each class
+        query = (db.classes_attendance.ClassDate >= first_day) & \
+                (db.classes_attendance.ClassDate <= last_day) & \
+                (db.classes_attendance.BookingStatus.belongs(['booked', 'attending']))
+        rows = db(query).select(db.classes_attendance.classes_id,
+                                db.classes_attendance.ClassDate,
+                                db.classes_attendance.auth_customer_id)
+        attending = {}
+        for row in rows:
+            key = (row.classes_id, row.ClassDate)
+            attending.setdefault(key, set()).add(row.auth_customer_id)
+
+        query = (db.classes_reservation.Startdate <= last_day) & \
+                ((db.classes_reservation.Enddate >= first_day) |
+                 (db.classes_reservation.Enddate == None)) & \
+                (db.classes_reservation.ResType == 'recurring')
+        reservations_in_month = db(query).select(db.classes_reservation.ALL,
+                                                 orderby=db.classes_reservation.id)
+
         data = {}
 
         date = first_day
         while date <= last_day:
-            # get list of classes on date
-            #print date
-
-            cs = ClassSchedule(date)
-            #print 'getting classes'
-            classes = cs.get_day_list()
-            reservations = crh.get_recurring_reservations_on_date(date)
-            for cls in classes:
+            reservations = [res for res in reservations_in_month
+                            if res.Startdate <= date and (res.Enddate is None or res.Enddate >= date)]
+
+            for cls in classes_in_month.get(date, []):
                 if cls['Cancelled'] or cls['Holiday']:
                     # Class is cancelled or in a holiday, nothing to do
                     continue
 
-                # Get list of bookings with status "attending" or "booked"
-                #print 'getting attendance for class'
-
-                attending = []
-                rows = ah.get_attendance_rows(cls['ClassesID'], date)
-                for row in rows:
-                    # print row
-                    if row.classes_attendance.BookingStatus == 'booked' or \
-                       row.classes_attendance.BookingStatus == 'attending':
-                        attending.append(row.auth_user.id)
+                attending_class = attending.get((cls['ClassesID'], date), set())
 
                 # if classes_id found on both lists, add class to reservations list for that customer
                 for res in reservations:
                     if res.classes_id == cls['ClassesID']:
                         # add customer to list in case not already attending
-                        if not res.auth_customer_id in attending:
-                            #print res.auth_customer_id
-
-
+                        if not res.auth_customer_id in attending_class:
                             value = {'clsID':cls['ClassesID'],
                                      'date':date}
 
-                            # print value
-                            # print '###############'
-
                             try:
                                 data[res.auth_customer_id].append(value)
                             except KeyError:
@@ -99,6 +99,32 @@ class CustomersSubscriptionsCredits:
         db(query).delete()
 
 
+    def _get_credits_for_period(self, year, month, p_start, p_end, classes, subscription_unit):
+        """
+            :param year: int
+            :param month: int
+            :param p_start: datetime.date (Period start)
+            :param p_end: datetime.date (Period end)
+            :param classes: int
+            :param subscription_unit: string either 'week' or 'month'
+            :return: float - credits for period
+        """
+        first_day = datetime.date(year, month, 1)
+        last_day = get_last_day_month(first_day)
+
+        t_days = (last_day - first_day) + datetime.timedelta(days=1)  # Total days (Add 1, when subsctraced it's one day less)
+        p_days = (p_end - p_start) + datetime.timedelta(days=1)  # Period days
+
+        percent = float(p_days.days) / float(t_days.days)
+        if subscription_unit == 'month':
+            credits = round(classes * percent, 1)
+        else:
+            weeks_in_month = round(t_days.days / float(7), 1)
+            credits = round((weeks_in_month * (classes or 0)) * percent, 1)
+
+        return credits
+
+
     def add_subscription_credits_month(self,
                                        csID,
                                        cuID,
@@ -132,17 +158,8 @@ class CustomersSubscriptionsCredits:
         TODAY_LOCAL = current.TODAY_LOCAL
 
         first_day = datetime.date(year, month, 1)
-        last_day = get_last_day_month(first_day)
-
-        t_days = (last_day - first_day) + datetime.timedelta(days=1)  # Total days (Add 1, when subsctraced it's one day less)
-        p_days = (p_end - p_start) + datetime.timedelta(days=1)  # Period days
 
-        percent = float(p_days.days) / float(t_days.days)
-        if subscription_unit == 'month':
-            credits = round(classes * percent, 1)
-        else:
-            weeks_in_month = round(t_days.days / float(7), 1)
-            credits = round((weeks_in_month * (classes or 0)) * percent, 1)
+        credits = self._get_credits_for_period(year, month, p_start, p_end, classes, subscription_unit)
 
         db.customers_subscriptions_credits.insert(
             customers_subscriptions_id=csID,
@@ -206,6 +223,8 @@ class CustomersSubscriptionsCredits:
             db.school_subscriptions.Classes,
             db.school_subscriptions.SubscriptionUnit,
             db.school_subscriptions.Unlimited,
+            db.school_subscriptions.id,
+            db.school_subscriptions.ClassCheckinLimit,
         ]
 
         query = """
@@ -218,7 +237,9 @@ class CustomersSubscriptionsCredits:
                    ssu.Name, 
                    ssu.Classes, 
                    ssu.subscriptionunit, 
-                   ssu.unlimited
+                   ssu.unlimited,
+                   ssu.id,
+                   ssu.ClassCheckinLimit
             FROM customers_subscriptions cs
             LEFT JOIN (	SELECT id, SubscriptionYear, SubscriptionMonth, customers_subscriptions_id
                         FROM customers_subscriptions_credits
@@ -243,9 +264,305 @@ class CustomersSubscriptionsCredits:
         return rows
 
 
-    def add_credits(self, year, month):
+    def _get_periods_in_month(self, table, first_day, last_day):
+        """
+            :param table: db.customers_subscriptions_paused or db.customers_subscriptions_blocked
+            :return: dict {customers_subscriptions_id: [(Startdate, Enddate)]}
+        """
+        db = current.db
+
+        query = (table.Startdate <= last_day) & \
+                ((table.Enddate >= first_day) |
+                 (table.Enddate == None))
+        rows = db(query).select(table.customers_subscriptions_id,
+                                table.Startdate,
+                                table.Enddate)
+
+        periods = {}
+        for row in rows:
+            periods.setdefault(row.customers_subscriptions_id, []).append(
+                (row.Startdate, row.Enddate)
+            )
+
+        return periods
+
+
+    def _in_periods(self, periods, date):
+        """
+            :param periods: list of (Startdate, Enddate)
+            :param date: datetime.date
+            :return: True when date is in one of the periods
+        """
+        for startdate, enddate in periods:
+            if startdate <= date and (enddate is None or enddate >= date):
+                return True
+
+        return False
+
+
+    def _get_checkin_counts_in_month(self, first_day, last_day):
+        """
+            :return: dict {(classes_id, ClassDate, school_subscriptions_id): count of attendance}
+        """
+        db = current.db
+
+        left = [
+            db.customers_subscriptions.on(
+                db.classes_attendance.customers_subscriptions_id ==
+                db.customers_subscriptions.id
+            )
+        ]
+
+        count = db.classes_attendance.id.count()
+        query = (db.classes_attendance.ClassDate >= first_day) & \
+                (db.classes_attendance.ClassDate <= last_day) & \
+                (db.classes_attendance.customers_subscriptions_id != None)
+        rows = db(query).select(db.classes_attendance.classes_id,
+                                db.classes_attendance.ClassDate,
+                                db.customers_subscriptions.school_subscriptions_id,
+                                count,
+                                left=left,
+                                groupby=(db.classes_attendance.classes_id,
+                                         db.classes_attendance.ClassDate,
+                                         db.customers_subscriptions.school_subscriptions_id))
+
+        counts = {}
+        for row in rows:
+            key = (row.classes_attendance.classes_id,
+                   row.classes_attendance.ClassDate,
+                   row.customers_subscriptions.school_subscriptions_id)
+            counts[key] = row[count]
+
+        return counts
+
+
+    def _get_customers_membership_periods(self, first_day, last_day):
+        """
+            :return: dict {auth_customer_id: [(Startdate, Enddate)]} of memberships in month
+        """
+        db = current.db
+
+        query = (db.customers_memberships.Startdate <= last_day) & \
+                ((db.customers_memberships.Enddate >= first_day) |
+                 (db.customers_memberships.Enddate == None))
+        rows = db(query).select(db.customers_memberships.auth_customer_id,
+                                db.customers_memberships.Startdate,
+                                db.customers_memberships.Enddate)
+
+        periods = {}
+        for row in rows:
+            periods.setdefault(row.auth_customer_id, []).append(
+                (row.Startdate, row.Enddate)
+            )
+
+        return periods
+
+
+    def _get_signed_in_in_month(self, first_day, last_day):
+        """
+            :return: set of (auth_customer_id, classes_id, ClassDate) for attendance
+            that isn't cancelled, like AttendanceHelper._attendance_sign_in_check_signed_in()
+        """
+        db = current.db
+
+        query = (db.classes_attendance.ClassDate >= first_day) & \
+                (db.classes_attendance.ClassDate <= last_day) & \
+                (db.classes_attendance.BookingStatus != 'cancelled')
+        rows = db(query).select(db.classes_attendance.auth_customer_id,
+                                db.classes_attendance.classes_id,
+                                db.classes_attendance.ClassDate)
+
+        return set((row.auth_customer_id, row.classes_id, row.ClassDate) for row in rows)
+
+
+    def _insert_credits_mutations(self, mutations, chunk_size=1000):
+        """
+            Insert mutations using multi-row inserts
+            Raw sql skips the DAL callbacks, so balances are refreshed afterwards
+            using one query for all subscriptions
+            :param mutations: list of dicts with values for db.customers_subscriptions_credits
+            :param chunk_size: int - max number of rows for each insert
+            :return: None
+        """
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
+        db = current.db
+        table = db.customers_subscriptions_credits
+        represent = db._adapter.represent
+
+        fieldnames = [
+            'customers_subscriptions_id',
+            'classes_attendance_id',
+            'MutationDateTime',
+            'MutationType',
+            'MutationAmount',
+            'Description',
+            'SubscriptionYear',
+            'SubscriptionMonth',
+            'Expiration'
+        ]
+
+        for i in range(0, len(mutations), chunk_size):
+            values = []
+            for mutation in mutations[i:i + chunk_size]:
+                values.append('(' + ', '.join([
+                    represent(mutation.get(fieldname, table[fieldname].default), table[fieldname].type)
+                    for fieldname in fieldnames
+                ]) + ')')
+
+            db.executesql("INSERT INTO customers_subscriptions_credits ({fields}) VALUES {values}".format(
+                fields=', '.join(fieldnames),
+                values=', '.join(values)
+            ))
+
+        credits_balances = CustomersSubscriptionsCreditsBalances()
+        credits_balances.refresh([mutation['customers_subscriptions_id'] for mutation in mutations])
+
+
+    def _add_credits_vectorized(self, year, month, rows):
+        """
+            Add credits and book classes based on reservations for all subscriptions in rows,
+            without running queries for each subscription. Mutations are inserted at
+            the end, in the same order as add_subscription_credits_month() would.
+            :param rows: rows returned by add_credits_get_subscription_rows_month()
+            :return: int - number of subscriptions for which credits were added
+        """
+        from .os_class import Class
+
+        T = current.T
+        db = current.db
+        now = current.NOW_LOCAL
+        TODAY_LOCAL = current.TODAY_LOCAL
+        cache_clear_customers_subscriptions = current.globalenv['cache_clear_customers_subscriptions']
+
+        first_day = datetime.date(year, month, 1)
+        last_day = get_last_day_month(first_day)
+        description = str(T('Credits') + ' ' + first_day.strftime('%B %Y'))
+
+        paused = self._get_periods_in_month(db.customers_subscriptions_paused, first_day, last_day)
+        blocked = self._get_periods_in_month(db.customers_subscriptions_blocked, first_day, last_day)
+        checkin_counts = self._get_checkin_counts_in_month(first_day, last_day)
+        signed_in = self._get_signed_in_in_month(first_day, last_day)
+        memberships = self._get_customers_membership_periods(first_day, last_day)
+        class_names = {}
+
+        mutations = []
+        customers = set()
+        for row in rows:
+            csID = row.customers_subscriptions.id
+            cuID = row.customers_subscriptions.auth_customer_id
+            ssuID = row.school_subscriptions.id
+            p_start, p_end = self._get_period(row, first_day, last_day)
+
+            credits = self._get_credits_for_period(
+                year,
+                month,
+                p_start,
+                p_end,
+                row.school_subscriptions.Classes,
+                row.school_subscriptions.SubscriptionUnit
+            )
+
+            mutations.append(dict(
+                customers_subscriptions_id=csID,
+                MutationDateTime=now,
+                MutationType='add',
+                MutationAmount=credits,
+                Description=description,
+                SubscriptionYear=year,
+                SubscriptionMonth=month
+            ))
+            customers.add(cuID)
+
+            try:
+                self.add_credits_balance[cuID] += credits
+            except KeyError:
+                self.add_credits_balance[cuID] = credits
+
+            # Book classes, same checks as AttendanceHelper.attendance_sign_in_subscription()
+            reservations = self.add_credits_reservations.get(cuID, [])
+            while len(reservations) > 0 and self.add_credits_balance[cuID] > 0:
+                reservation = reservations.pop(0)
+                clsID = reservation['clsID']
+                date = reservation['date']
+
+                # Subtract one credit from current balance in this object (self.add_credits_balance)
+                self.add_credits_balance[cuID] -= 1
+
+                if self._in_periods(paused.get(csID, []), date) or \
+                   self._in_periods(blocked.get(csID, []), date):
+                    continue
+
+                if (cuID, clsID, date) in signed_in:
+                    # Customer has already booked or is already checked-in
+                    continue
+
+                checkin_key = (clsID, date, ssuID)
+                if row.school_subscriptions.ClassCheckinLimit and \
+                   checkin_counts.get(checkin_key, 0) >= row.school_subscriptions.ClassCheckinLimit:
+                    continue
+
+                clattID = db.classes_attendance.insert(
+                    auth_customer_id=cuID,
+                    CustomerMembership=self._in_periods(memberships.get(cuID, []), date),
+                    classes_id=clsID,
+                    ClassDate=date,
+                    AttendanceType=None,  # None = subscription
+                    customers_subscriptions_id=csID,
+                    online_booking=False,
+                    BookingStatus='booked'
+                )
+                checkin_counts[checkin_key] = checkin_counts.get(checkin_key, 0) + 1
+                signed_in.add((cuID, clsID, date))
+
+                if (clsID, date) not in class_names:
+                    class_names[(clsID, date)] = Class(clsID, date).get_name(pretty_date=True)
+
+                mutations.append(dict(
+                    customers_subscriptions_id=csID,
+                    classes_attendance_id=clattID,
+                    MutationDateTime=TODAY_LOCAL,
+                    MutationType='sub',
+                    MutationAmount=1,
+                    Description=class_names[(clsID, date)],
+                    SubscriptionYear=TODAY_LOCAL.year,
+                    SubscriptionMonth=TODAY_LOCAL.month
+                ))
+
+        self._insert_credits_mutations(mutations)
+
+        # Clear cache
+        for cuID in customers:
+            cache_clear_customers_subscriptions(cuID)
+
+        return len(rows)
+
+
+    def _get_period(self, row, first_day, last_day):
+        """
+            only add partial credits if startdate != first day, add full credits if startdate < first day
+            :param row: row returned by add_credits_get_subscription_rows_month()
+            :return: tuple (period start, period end)
+        """
+        if row.customers_subscriptions.Startdate <= first_day:
+            p_start = first_day
+        else:
+            p_start = row.customers_subscriptions.Startdate
+
+        if row.customers_subscriptions.Enddate is None or row.customers_subscriptions.Enddate >= last_day:
+            p_end = last_day
+        else:
+            p_end = row.customers_subscriptions.Enddate
+
+        return p_start, p_end
+
+
+    def add_credits(self, year, month, vectorized=True):
         """
             Add subscription credits for month
+            :param vectorized: bool - compute credits & bookings for all subscriptions
+            at once and insert mutations using multi-row inserts. False to add
+            credits for one subscription at a time.
         """
         from .os_customers import Customers
 
@@ -262,12 +579,8 @@ class CustomersSubscriptionsCredits:
         customers = Customers()
         self.add_credits_balance = customers.get_credits_balance(first_day, include_reconciliation_classes=True)
 
-
-        customers_credits_added = 0
-
-        rows = self.add_credits_get_subscription_rows_month(year, month)
-
-        for row in rows:
+        rows = []
+        for row in self.add_credits_get_subscription_rows_month(year, month):
             if row.customers_subscriptions_credits.id:
                 continue
             if row.customers_subscriptions_paused.id:
@@ -279,18 +592,16 @@ class CustomersSubscriptionsCredits:
                 # or has no classes or subscription unit defined
                 continue
 
-            # calculate number of credits
-            # only add partial credits if startdate != first day, add full credits if startdate < first day
-            if row.customers_subscriptions.Startdate <= first_day:
-                p_start = first_day
-            else:
-                p_start = row.customers_subscriptions.Startdate
+            rows.append(row)
 
-            if row.customers_subscriptions.Enddate is None or row.customers_subscriptions.Enddate >= last_day:
-                p_end = last_day
-            else:
-                p_end = row.customers_subscriptions.Enddate
+        if vectorized:
+            return self._add_credits_vectorized(year, month, rows)
+
+        customers_credits_added = 0
 
+        for row in rows:
+            # calculate number of credits
+            p_start, p_end = self._get_period(row, first_day, last_day)
 
             self.add_subscription_credits_month(
                 row.customers_subscriptions.id,
@@ -307,7 +618,7 @@ class CustomersSubscriptionsCredits:
             customers_credits_added += 1
 
         return customers_credits_added or 0
-    
+
 
     def expire_credits(self, date):
         """
@@ -317,12 +628,16 @@ class CustomersSubscriptionsCredits:
         :param date: datetime.date
         :return: number of subscriptions for which credits were expired
         """
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
         T = current.T
         db = current.db
         NOW_LOCAL = current.NOW_LOCAL
         web2pytest = current.globalenv['web2pytest']
         request = current.request
 
+        credits_balance_sql = CustomersSubscriptionsCreditsBalances().get_balance_sql()
+
         # Create dictionary of expiration for school_subscriptions
         subscriptions_count_expired = 0
         query = (db.school_subscriptions.Archived == False)
@@ -366,14 +681,7 @@ class CustomersSubscriptionsCredits:
                             cs.payment_methods_id,
                             ssu.id,
                             ssu.Name,
-                            ( IFNULL((SELECT SUM(csc.MutationAmount)
-                               FROM customers_subscriptions_credits csc
-                               WHERE csc.customers_subscriptions_id = cs.id AND
-                                     csc.MutationType = 'add'), 0) - 
-                               IFNULL(( SELECT SUM(csc.MutationAmount)
-                               FROM customers_subscriptions_credits csc
-                               WHERE csc.customers_subscriptions_id = cs.id AND
-                                     csc.MutationType = 'sub'), 0)) AS credits,
+                            {credits} AS credits,
                             IFNULL(( SELECT SUM(csc.MutationAmount)
                              FROM customers_subscriptions_credits csc
                              WHERE csc.customers_subscriptions_id = cs.id AND
@@ -382,11 +690,16 @@ class CustomersSubscriptionsCredits:
                             FROM customers_subscriptions cs
                             LEFT JOIN 
                             school_subscriptions ssu ON cs.school_subscriptions_id = ssu.id
+                            LEFT JOIN
+                            customers_subscriptions_credits_balance cscb ON cscb.customers_subscriptions_id = cs.id
                             WHERE ssu.id = {ssuID} AND 
                                   (cs.Startdate <= '{date}' AND 
                                   (cs.Enddate >= '{date}' OR cs.Enddate IS NULL))
                             ORDER BY cs.Startdate
-                            """.format(date=date, ssuID=row.id, mutation_date=mutation_date_sql)
+                            """.format(date=date,
+                                       ssuID=row.id,
+                                       mutation_date=mutation_date_sql,
+                                       credits=credits_balance_sql)
 
             cs_rows = db.executesql(sql, fields=fields)
 
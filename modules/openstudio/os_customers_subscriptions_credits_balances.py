@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+from gluon import *
+
+
+class CustomersSubscriptionsCreditsBalances:
+    """
+        Maintains db.customers_subscriptions_credits_balance, which holds the
+        credit balance (credits added - credits subtracted) for each subscription.
+
+        Balances are updated by callbacks on db.customers_subscriptions_credits,
+        so they change in the same transaction as the mutation itself.
+        Mutations inserted using raw sql should be followed by a call to refresh().
+        Balances are written using an upsert on the unique index on
+        customers_subscriptions_id, so the first mutations of a subscription
+        inserted at the same time can't create 2 balance rows.
+        verify() recomputes balances from the mutations to find (and repair)
+        balances that drifted, eg. after a cascading delete.
+    """
+    # Changes to these fields in customers_subscriptions_credits affect the balance
+    balance_fields = ['customers_subscriptions_id', 'MutationType', 'MutationAmount']
+
+    # Balances differing less than this from the sum of mutations are considered equal
+    tolerance = 0.05
+
+
+    def __init__(self):
+        # Rows selected in _before_update & _before_delete callbacks
+        self._rows_before = []
+
+
+    def _get_value(self, fields, fieldname):
+        """
+        :param fields: fields passed to a DAL callback
+        :param fieldname: string - name of field
+        :return: value of field or None when not set
+        """
+        try:
+            return fields[fieldname]
+        except KeyError:
+            return None
+
+
+    def _add_mutation(self, deltas, csID, mutation_type, amount, sign=1):
+        """
+        :param deltas: dict {customers_subscriptions_id: balance change}
+        :param csID: db.customers_subscriptions.id
+        :param mutation_type: string - 'add' or 'sub'
+        :param amount: float
+        :param sign: 1 to add a mutation, -1 to undo it
+        :return: None
+        """
+        if not csID:
+            return
+
+        # Same conditions as the query in _rebuild_query()
+        if mutation_type == 'add':
+            delta = float(amount or 0)
+        elif mutation_type == 'sub':
+            delta = -float(amount or 0)
+        else:
+            delta = 0
+
+        csID = int(csID)
+        deltas[csID] = deltas.get(csID, 0) + sign * delta
+
+
+    def _apply(self, deltas):
+        """
+        Update balances in db.customers_subscriptions_credits_balance
+        :param deltas: dict {customers_subscriptions_id: balance change}
+        :return: None
+        """
+        db = current.db
+        cscb = db.customers_subscriptions_credits_balance
+
+        for csID, delta in deltas.items():
+            query = (cscb.customers_subscriptions_id == csID)
+            updated = db(query).update(Balance=cscb.Balance + delta)
+
+            if not updated:
+                # First mutation for this subscription
+                self.refresh([csID])
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for db.customers_subscriptions_credits
+        """
+        deltas = {}
+        self._add_mutation(deltas,
+                           self._get_value(fields, 'customers_subscriptions_id'),
+                           self._get_value(fields, 'MutationType'),
+                           self._get_value(fields, 'MutationAmount'))
+
+        self._apply(deltas)
+
+
+    def before_update(self, dbset, fields):
+        """
+        _before_update callback for db.customers_subscriptions_credits
+        """
+        db = current.db
+
+        rows = None
+        if [f for f in self.balance_fields if not self._get_value(fields, f) is None]:
+            rows = dbset.select(*[db.customers_subscriptions_credits[f] for f in self.balance_fields])
+
+        self._rows_before.append(rows)
+
+        # Returning True would cancel the update
+        return False
+
+
+    def after_update(self, dbset, fields):
+        """
+        _after_update callback for db.customers_subscriptions_credits
+        """
+        rows = self._rows_before.pop() if self._rows_before else None
+        if not rows:
+            return
+
+        deltas = {}
+        for row in rows:
+            self._add_mutation(deltas,
+                               row.customers_subscriptions_id,
+                               row.MutationType,
+                               row.MutationAmount,
+                               sign=-1)
+
+            new = {}
+            for f in self.balance_fields:
+                value = self._get_value(fields, f)
+                new[f] = row[f] if value is None else value
+
+            self._add_mutation(deltas,
+                               new['customers_subscriptions_id'],
+                               new['MutationType'],
+                               new['MutationAmount'])
+
+        self._apply(deltas)
+
+
+    def before_delete(self, dbset):
+        """
+        _before_delete callback for db.customers_subscriptions_credits
+        """
+        db = current.db
+
+        rows = dbset.select(*[db.customers_subscriptions_credits[f] for f in self.balance_fields])
+        self._rows_before.append(rows)
+
+        # Returning True would cancel the delete
+        return False
+
+
+    def after_delete(self, dbset):
+        """
+        _after_delete callback for db.customers_subscriptions_credits
+        """
+        rows = self._rows_before.pop() if self._rows_before else None
+        if not rows:
+            return
+
+        deltas = {}
+        for row in rows:
+            self._add_mutation(deltas,
+                               row.customers_subscriptions_id,
+                               row.MutationType,
+                               row.MutationAmount,
+                               sign=-1)
+
+        self._apply(deltas)
+
+
+    def get(self, csID):
+        """
+        :param csID: db.customers_subscriptions.id
+        :return: float - credit balance of subscription
+        """
+        db = current.db
+        cscb = db.customers_subscriptions_credits_balance
+
+        query = (cscb.customers_subscriptions_id == csID)
+        row = db(query).select(cscb.Balance).first()
+        if row:
+            return round(row.Balance or 0, 1)
+
+        # No balance stored (yet), sum the mutations instead
+        csc = db.customers_subscriptions_credits
+        query = (csc.customers_subscriptions_id == csID)
+        added = csc.MutationAmount.sum()
+        total_add = db(query & (csc.MutationType == 'add')).select(added).first()[added] or 0
+        total_sub = db(query & (csc.MutationType == 'sub')).select(added).first()[added] or 0
+
+        return round(total_add - total_sub, 1)
+
+
+    def get_balance_sql(self, csID_sql='cs.id', balance_sql='cscb.Balance'):
+        """
+        :param csID_sql: string - column holding db.customers_subscriptions.id in a query
+        :param balance_sql: string - column holding the stored balance in a query
+        :return: string - sql expression for the credit balance of a subscription,
+                 summing its mutations when no balance is stored (yet)
+        """
+        return """COALESCE({balance},
+                            ( SELECT SUM(CASE WHEN csm.MutationType = 'add' THEN csm.MutationAmount
+                                              WHEN csm.MutationType = 'sub' THEN -csm.MutationAmount
+                                              ELSE 0 END)
+                              FROM customers_subscriptions_credits csm
+                              WHERE csm.customers_subscriptions_id = {csID} ),
+                            0)""".format(balance=balance_sql, csID=csID_sql)
+
+
+    def _get_upsert_clause(self):
+        """
+        :return: string - clause replacing the balance of a subscription that
+                 already has one, for the database engine in use
+        """
+        db = current.db
+
+        engine = db._adapter.dbengine
+        if engine == 'mysql':
+            return "ON DUPLICATE KEY UPDATE Balance = VALUES(Balance)"
+        elif engine == 'sqlite':
+            return "ON CONFLICT (customers_subscriptions_id) DO UPDATE SET Balance = excluded.Balance"
+        else:
+            # No unique index is created for other engines, see OsDbIndexes
+            return ""
+
+
+    def _rebuild_query(self, where):
+        """
+        :param where: string - conditions for customers_subscriptions_credits
+        :return: string - query inserting or replacing the balance for each subscription
+        """
+        return """
+        INSERT INTO customers_subscriptions_credits_balance
+            (customers_subscriptions_id, Balance)
+        SELECT customers_subscriptions_id,
+               SUM(CASE WHEN MutationType = 'add' THEN MutationAmount
+                        WHEN MutationType = 'sub' THEN -MutationAmount
+                        ELSE 0 END)
+        FROM customers_subscriptions_credits
+        WHERE {where}
+        GROUP BY customers_subscriptions_id
+        {upsert}
+        """.format(where=where,
+                   upsert=self._get_upsert_clause())
+
+
+    def refresh(self, csIDs, chunk_size=1000):
+        """
+        Recompute balances of subscriptions
+        :param csIDs: list of db.customers_subscriptions.id
+        :param chunk_size: int - max number of subscriptions for each query
+        :return: None
+        """
+        db = current.db
+        cscb = db.customers_subscriptions_credits_balance
+
+        csIDs = sorted(set([int(csID) for csID in csIDs]))
+        for i in range(0, len(csIDs), chunk_size):
+            chunk = csIDs[i:i + chunk_size]
+
+            db.executesql(self._rebuild_query(
+                "customers_subscriptions_id IN ({ids})".format(ids=', '.join([str(csID) for csID in chunk]))
+            ))
+
+            # Subscriptions without mutations don't have a balance
+            query = (cscb.customers_subscriptions_id.belongs(chunk)) & \
+                    ~(cscb.customers_subscriptions_id.belongs(
+                        db(db.customers_subscriptions_credits.customers_subscriptions_id.belongs(chunk))._select(
+                            db.customers_subscriptions_credits.customers_subscriptions_id)))
+            db(query).delete()
+
+
+    def rebuild(self):
+        """
+        Recompute all balances
+        :return: int - number of subscriptions with a balance
+        """
+        db = current.db
+        cscb = db.customers_subscriptions_credits_balance
+
+        db(cscb).delete()
+        db.executesql(self._rebuild_query("1 = 1"))
+
+        return db(cscb).count()
+
+
+    def verify(self, repair=False):
+        """
+        Compare stored balances with the sum of mutations
+        :param repair: bool - True to refresh balances that drifted
+        :return: list of dicts {'customers_subscriptions_id', 'Balance', 'Computed'}
+        """
+        db = current.db
+
+        # Subscriptions with mutations and subscriptions with a stored balance
+        sql = """
+        SELECT ids.customers_subscriptions_id,
+               cscb.Balance,
+               csc.Computed
+        FROM ( SELECT customers_subscriptions_id FROM customers_subscriptions_credits
+               UNION
+               SELECT customers_subscriptions_id FROM customers_subscriptions_credits_balance ) ids
+        LEFT JOIN customers_subscriptions_credits_balance cscb
+            ON cscb.customers_subscriptions_id = ids.customers_subscriptions_id
+        LEFT JOIN ( SELECT customers_subscriptions_id,
+                           SUM(CASE WHEN MutationType = 'add' THEN MutationAmount
+                                    WHEN MutationType = 'sub' THEN -MutationAmount
+                                    ELSE 0 END) AS Computed
+                    FROM customers_subscriptions_credits
+                    GROUP BY customers_subscriptions_id ) csc
+            ON csc.customers_subscriptions_id = ids.customers_subscriptions_id
+        """
+
+        drift = []
+        for csID, balance, computed in db.executesql(sql):
+            if csID is None:
+                continue
+
+            # A missing balance counts as 0, so repairing stores it
+            if abs(float(balance or 0) - float(computed or 0)) >= self.tolerance:
+                drift.append({
+                    'customers_subscriptions_id': int(csID),
+                    'Balance': balance,
+                    'Computed': computed
+                })
+
+        if repair and drift:
+            self.refresh([d['customers_subscriptions_id'] for d in drift])
+
+        return drift
@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from gluon import *
+
+from general_helpers import get_last_day_month
+
+
+class CustomersSubscriptionsInvoices:
+    """
+        Class to create invoices for multiple customer subscriptions at once.
+
+        Everything needed to create the invoices for a month (prices, pauses,
+        alt. prices, existing invoices) is fetched using a few queries up front,
+        instead of running the queries in CustomerSubscription.create_invoice_for_month()
+        and Invoice.item_add_subscription() for each subscription.
+        Invoices are committed in chunks, so running again after a time out
+        continues where the previous run stopped. The invoice group row stays
+        locked by the numbering until a chunk is committed.
+    """
+    def __init__(self, year, month):
+        """
+            :param year: int
+            :param month: int
+        """
+        self.year = int(year)
+        self.month = int(month)
+        self.first_day_month = datetime.date(self.year, self.month, 1)
+        self.last_day_month = get_last_day_month(self.first_day_month)
+
+
+    def _get_subscriptions_rows(self, payment_methods_id=None):
+        """
+            :param payment_methods_id: db.payment_methods.id - only get subscriptions with this payment method
+            :return: gluon.dal.rows - subscriptions active in month
+        """
+        db = current.db
+
+        left = [
+            db.auth_user.on(
+                db.customers_subscriptions.auth_customer_id ==
+                db.auth_user.id
+            ),
+            db.school_subscriptions.on(
+                db.customers_subscriptions.school_subscriptions_id ==
+                db.school_subscriptions.id
+            )
+        ]
+
+        query = (db.customers_subscriptions.Startdate <= self.last_day_month) & \
+                ((db.customers_subscriptions.Enddate >= self.first_day_month) |
+                 (db.customers_subscriptions.Enddate == None))
+        if payment_methods_id:
+            query &= (db.customers_subscriptions.payment_methods_id == payment_methods_id)
+
+        rows = db(query).select(
+            db.customers_subscriptions.ALL,
+            db.auth_user.trashed,
+            db.auth_user.full_name,
+            db.auth_user.company,
+            db.auth_user.company_registration,
+            db.auth_user.company_tax_registration,
+            db.auth_user.address,
+            db.auth_user.city,
+            db.auth_user.postcode,
+            db.auth_user.country,
+            db.school_subscriptions.Name,
+            db.school_subscriptions.RegistrationFee,
+            left=left,
+            orderby=db.customers_subscriptions.id
+        )
+
+        return rows
+
+
+    def _get_invoiced_subscriptions(self):
+        """
+            :return: set of db.customers_subscriptions.id with an invoice for this month
+        """
+        db = current.db
+
+        left = [
+            db.invoices_items.on(
+                db.invoices_items_customers_subscriptions.invoices_items_id ==
+                db.invoices_items.id
+            ),
+            db.invoices.on(
+                db.invoices_items.invoices_id ==
+                db.invoices.id
+            )
+        ]
+
+        query = (db.invoices.SubscriptionYear == self.year) & \
+                (db.invoices.SubscriptionMonth == self.month)
+        rows = db(query).select(
+            db.invoices_items_customers_subscriptions.customers_subscriptions_id,
+            left=left
+        )
+
+        return set(row.customers_subscriptions_id for row in rows)
+
+
+    def _get_linked_subscriptions(self):
+        """
+            :return: set of db.customers_subscriptions.id with at least one invoice
+        """
+        db = current.db
+
+        rows = db().select(
+            db.invoices_items_customers_subscriptions.customers_subscriptions_id,
+            distinct=True
+        )
+
+        return set(row.customers_subscriptions_id for row in rows)
+
+
+    def _get_pauses(self):
+        """
+            :return: dict {customers_subscriptions_id: db.customers_subscriptions_paused row}
+            for the first pause overlapping with this month
+        """
+        db = current.db
+
+        query = (db.customers_subscriptions_paused.Startdate <= self.last_day_month) & \
+                ((db.customers_subscriptions_paused.Enddate >= self.first_day_month) |
+                 (db.customers_subscriptions_paused.Enddate == None))
+        rows = db(query).select(db.customers_subscriptions_paused.ALL,
+                                orderby=db.customers_subscriptions_paused.id)
+
+        pauses = {}
+        for row in rows:
+            if row.customers_subscriptions_id not in pauses:
+                pauses[row.customers_subscriptions_id] = row
+
+        return pauses
+
+
+    def _get_paused_full_month(self):
+        """
+            :return: set of db.customers_subscriptions.id paused the full month
+        """
+        db = current.db
+
+        query = (db.customers_subscriptions_paused.Startdate <= self.first_day_month) & \
+                ((db.customers_subscriptions_paused.Enddate >= self.last_day_month) |
+                 (db.customers_subscriptions_paused.Enddate == None))
+        rows = db(query).select(db.customers_subscriptions_paused.customers_subscriptions_id)
+
+        return set(row.customers_subscriptions_id for row in rows)
+
+
+    def _get_alt_prices(self):
+        """
+            :return: dict {customers_subscriptions_id: db.customers_subscriptions_alt_prices row}
+        """
+        db = current.db
+        csap = db.customers_subscriptions_alt_prices
+
+        query = (csap.SubscriptionYear == self.year) & \
+                (csap.SubscriptionMonth == self.month)
+        rows = db(query).select(csap.ALL, orderby=csap.id)
+
+        alt_prices = {}
+        for row in rows:
+            if row.customers_subscriptions_id not in alt_prices:
+                alt_prices[row.customers_subscriptions_id] = row
+
+        return alt_prices
+
+
+    def _get_prices(self, date):
+        """
+            :param date: datetime.date
+            :return: dict {school_subscriptions_id: db.school_subscriptions_price row}
+            for the prices on date
+        """
+        db = current.db
+
+        query = (db.school_subscriptions_price.Startdate <= date) & \
+                ((db.school_subscriptions_price.Enddate >= date) |
+                 (db.school_subscriptions_price.Enddate == None))
+        rows = db(query).select(db.school_subscriptions_price.ALL,
+                                orderby=db.school_subscriptions_price.Startdate)
+
+        prices = {}
+        for row in rows:
+            if row.school_subscriptions_id not in prices:
+                prices[row.school_subscriptions_id] = row
+
+        return prices
+
+
+    def _get_price(self, prices, ssuID):
+        """
+            :param prices: dict returned by _get_prices()
+            :param ssuID: db.school_subscriptions.id
+            :return: Decimal - price, same as SchoolSubscription.get_price_on_date()
+        """
+        row = prices.get(ssuID)
+        if not row or not row.Price:
+            return 0
+
+        return row.Price.quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
+
+
+    def _get_customers_registration_fee_paid(self):
+        """
+            :return: set of db.auth_user.id that have paid a registration fee
+        """
+        db = current.db
+
+        query = (db.customers_subscriptions.RegistrationFeePaid == True)
+        rows = db(query).select(db.customers_subscriptions.auth_customer_id,
+                                distinct=True)
+
+        return set(row.auth_customer_id for row in rows)
+
+
+    def _get_tax_rates(self):
+        """
+            :return: dict {db.tax_rates.id: Percentage}
+        """
+        db = current.db
+
+        rows = db().select(db.tax_rates.id, db.tax_rates.Percentage)
+
+        return {row.id: row.Percentage for row in rows}
+
+
+    def _get_item_amounts(self, price, tax_rates_id):
+        """
+            Same calculation as the computed fields in db.invoices_items
+            :param price: float or Decimal - price for 1 item
+            :param tax_rates_id: db.tax_rates.id
+            :return: dict with TotalPriceVAT, VAT & TotalPrice
+        """
+        total_vat = Decimal(str(price))
+        percentage = self.tax_rates.get(tax_rates_id)
+        if not tax_rates_id or percentage is None:
+            vat = Decimal(0)
+        else:
+            vat_rate = percentage / Decimal(100)
+            vat = total_vat - (total_vat / (Decimal(1) + vat_rate))
+        vat = vat.quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
+        total = (total_vat - vat).quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
+
+        return dict(
+            TotalPriceVAT=total_vat,
+            VAT=vat,
+            TotalPrice=total
+        )
+
+
+    def _init_invoice_numbering(self, date_created):
+        """
+            Get the invoice group & check whether numbering should be reset,
+            the same way as Invoice._get_next_invoice_id()
+            :param date_created: datetime.date - creation date of invoices
+            :return: None
+        """
+        db = current.db
+
+        igpt = db.invoices_groups_product_types(ProductType='subscription')
+        self.invoice_group = db.invoices_groups(igpt.invoices_groups_id)
+        self.reset_numbering = False
+
+        if self.invoice_group.PrefixYear:
+            # Reset numbering to 1 for first invoice in year
+            year = date_created.year
+            query = (db.invoices.DateCreated >= datetime.date(year, 1, 1)) & \
+                    (db.invoices.DateCreated <= datetime.date(year, 12, 31)) & \
+                    (db.invoices.invoices_groups_id == self.invoice_group.id)
+            if not db(query).count():
+                self.reset_numbering = True
+
+
+    def _get_next_invoice_id(self):
+        """
+            The number is taken from the invoice group in the database for each
+            invoice, so invoices created at the same time in the same group
+            (eg. from the shop) don't get the same number.
+            :return: string - number for next invoice
+        """
+        from .os_invoices import Invoices
+
+        invoice_id = self.invoice_group.InvoicePrefix or ""
+
+        if self.invoice_group.PrefixYear:
+            invoice_id += str(datetime.date.today().year)
+
+        invoice_id += str(Invoices().get_next_invoice_number(self.invoice_group.id,
+                                                             reset=self.reset_numbering))
+        self.reset_numbering = False
+
+        return invoice_id
+
+
+    def _get_customer_info(self, row):
+        """
+            Same as Invoice.set_customer_info()
+            :param row: row returned by _get_subscriptions_rows()
+            :return: dict of customer fields for db.invoices
+        """
+        customer = row.auth_user
+
+        address = ''
+        if customer.address:
+            address = ''.join([address, customer.address, '\n'])
+        if customer.city:
+            address = ''.join([address, customer.city, ' '])
+        if customer.postcode:
+            address = ''.join([address, customer.postcode, '\n'])
+        if customer.country:
+            address = ''.join([address, customer.country])
+
+        list_name = customer.full_name
+        if customer.company:
+            list_name = customer.company
+
+        return dict(
+            CustomerCompany=customer.company,
+            CustomerCompanyRegistration=customer.company_registration,
+            CustomerCompanyTaxRegistration=customer.company_tax_registration,
+            CustomerName=customer.full_name,
+            CustomerListName=list_name,
+            CustomerAddress=address,
+        )
+
+
+    def _get_items(self, row):
+        """
+            Same items as Invoice.item_add_subscription()
+            :param row: row returned by _get_subscriptions_rows()
+            :return: list of dicts with values for db.invoices_items
+        """
+        T = current.T
+        DATE_FORMAT = current.DATE_FORMAT
+
+        cs = row.customers_subscriptions
+        csID = cs.id
+        price_row = self.prices.get(cs.school_subscriptions_id)
+        tax_rates_id = price_row.tax_rates_id if price_row else None
+        glaccount = price_row.accounting_glaccounts_id if price_row else ''
+        costcenter = price_row.accounting_costcenters_id if price_row else ''
+        name = row.school_subscriptions.Name
+
+        period_start = self.first_day_month
+        period_end = self.last_day_month
+
+        alt_price = self.alt_prices.get(csID)
+        if alt_price:
+            # alt. price overrides broken period
+            price = alt_price.Amount
+            description = alt_price.Description
+        else:
+            price = self._get_price(self.prices, cs.school_subscriptions_id)
+            pause = self.pauses.get(csID)
+
+            # Calculate days to be paid
+            if cs.Startdate > period_start and cs.Startdate <= self.last_day_month:
+                # Start later in month
+                period_start = cs.Startdate
+
+            if cs.Enddate:
+                if cs.Enddate >= self.first_day_month and cs.Enddate < self.last_day_month:
+                    # End somewhere in month
+                    period_end = cs.Enddate
+
+            period_days = (period_end - period_start).days + 1
+
+            if pause:
+                # Set pause end date to period end if > period end
+                pause_end = pause.Enddate
+                if not pause_end or pause_end >= period_end:
+                    pause_end = period_end
+
+                latest_start = max(period_start, pause.Startdate)
+                earliest_end = min(period_end, pause_end)
+                overlap = max(0, (earliest_end - latest_start).days + 1)
+
+                # Subtract pause overlap from period to be paid
+                period_days = period_days - overlap
+
+            month_days = (self.last_day_month - self.first_day_month).days + 1
+
+            price = round(((float(period_days) / float(month_days)) * float(price)), 2)
+
+            description = name + ' ' + period_start.strftime(DATE_FORMAT) + ' - ' + \
+                          period_end.strftime(DATE_FORMAT)
+            if pause:
+                description += '\n'
+                description += "(" + T("Pause") + ": "
+                description += pause.Startdate.strftime(DATE_FORMAT) + " - "
+                description += pause_end.strftime(DATE_FORMAT) + " | "
+                description += T("Days paid this period: ")
+                description += str(period_days)
+                description += ")"
+
+        sorting = 1
+        items = [dict(
+            ProductName=T("Subscription") + ' ' + str(csID),
+            Description=description,
+            Quantity=1,
+            Price=price,
+            Sorting=sorting,
+            tax_rates_id=tax_rates_id,
+            accounting_glaccounts_id=glaccount,
+            accounting_costcenters_id=costcenter
+        )]
+
+        # Check if we should bill the first 2 months
+        if self.first_invoice_two_terms and csID not in self.linked_subscriptions:
+            # first invoice for this subscription... let's add the 2nd month as well.
+            period_start = self.last_day_month + datetime.timedelta(days=1)
+            period_end = get_last_day_month(period_start)
+            sorting += 1
+            items.append(dict(
+                ProductName=T("Subscription") + ' ' + str(csID),
+                Description=name + ' ' + period_start.strftime(DATE_FORMAT) + ' - ' + \
+                            period_end.strftime(DATE_FORMAT),
+                Quantity=1,
+                Price=self._get_price(self.prices_next_month, cs.school_subscriptions_id),
+                Sorting=sorting,
+                tax_rates_id=tax_rates_id,
+                accounting_glaccounts_id=glaccount,
+                accounting_costcenters_id=costcenter
+            ))
+
+        # Check if a registration fee should be added
+        # ; Add fee if a registration fee has ever been paid
+        registration_fee = row.school_subscriptions.RegistrationFee
+        if registration_fee and cs.auth_customer_id not in self.registration_fee_paid:
+            items.append(dict(
+                ProductName=T("Registration fee"),
+                Description=T('One time registration fee'),
+                Quantity=1,
+                Price=registration_fee,
+                Sorting=sorting,
+                tax_rates_id=tax_rates_id,
+            ))
+
+        return items
+
+
+    def _create_invoice(self, row, description, date_created):
+        """
+            :param row: row returned by _get_subscriptions_rows()
+            :param description: string - invoice description
+            :param date_created: datetime.date
+            :return: db.invoices.id
+        """
+        T = current.T
+        db = current.db
+
+        cs = row.customers_subscriptions
+        now = datetime.datetime.now()
+
+        invoice_values = dict(
+            invoices_groups_id=self.invoice_group.id,
+            payment_methods_id=cs.payment_methods_id,
+            SubscriptionYear=self.year,
+            SubscriptionMonth=self.month,
+            Description=description,
+            Status='sent',
+            InvoiceID=self._get_next_invoice_id(),
+            DateCreated=date_created,
+            DateDue=date_created + datetime.timedelta(days=self.invoice_group.DueDays),
+            Terms=self.invoice_group.Terms,
+            Footer=self.invoice_group.Footer,
+            Updated_at=now
+        )
+        invoice_values.update(self._get_customer_info(row))
+        iID = db.invoices.insert(**invoice_values)
+
+        db.invoices_customers.insert(
+            invoices_id=iID,
+            auth_customer_id=cs.auth_customer_id
+        )
+
+        totals = dict(TotalPriceVAT=Decimal(0), VAT=Decimal(0), TotalPrice=Decimal(0))
+        items = self._get_items(row)
+        for i, item in enumerate(items):
+            amounts = self._get_item_amounts(item['Price'], item['tax_rates_id'])
+            for key in totals:
+                totals[key] += amounts[key]
+            item.update(amounts)
+
+            iiID = db.invoices_items.insert(invoices_id=iID, **item)
+            if i == 0:
+                # Link invoice item to subscription
+                db.invoices_items_customers_subscriptions.insert(
+                    invoices_items_id=iiID,
+                    customers_subscriptions_id=cs.id
+                )
+
+        if self.first_invoice_two_terms and cs.id not in self.linked_subscriptions:
+            # Add 0 payment for 2nd month in alt. prices, to prevent duplicate payments
+            next_month = self.last_day_month + datetime.timedelta(days=1)
+            db.customers_subscriptions_alt_prices.insert(
+                customers_subscriptions_id=cs.id,
+                SubscriptionYear=next_month.year,
+                SubscriptionMonth=next_month.month,
+                Amount=0,
+                Description=T("Paid in invoice ") + invoice_values['InvoiceID']
+            )
+            self.linked_subscriptions.add(cs.id)
+
+        if row.school_subscriptions.RegistrationFee and \
+           cs.auth_customer_id not in self.registration_fee_paid:
+            # Mark registration fee as paid for subscription
+            db.customers_subscriptions[cs.id] = dict(RegistrationFeePaid=True)
+            self.registration_fee_paid.add(cs.auth_customer_id)
+
+        db.invoices_amounts.insert(
+            invoices_id=iID,
+            TotalPrice=totals['TotalPrice'],
+            VAT=totals['VAT'],
+            TotalPriceVAT=totals['TotalPriceVAT'],
+            Paid=0,
+            Balance=totals['TotalPriceVAT']
+        )
+
+        return iID
+
+
+    def create_invoices(self,
+                        description=None,
+                        invoice_date='today',
+                        chunk_size=100,
+                        payment_methods_id=None):
+        """
+            Create invoices for all subscriptions active in month, skipping
+            subscriptions that already have an invoice, are paused the full month,
+            have an alt. price or regular price of 0 or belong to a trashed customer.
+
+            :param description: string - invoice description
+            :param invoice_date: 'today' or 'first_of_month'
+            :param chunk_size: int - number of invoices to create before committing
+            :param payment_methods_id: db.payment_methods.id - only invoice subscriptions with this payment method
+            :return: int - number of invoices created
+        """
+        from .tools import OsTools
+
+        T = current.T
+        db = current.db
+        TODAY_LOCAL = current.TODAY_LOCAL
+        os_tools = OsTools()
+
+        if not description:
+            description = T("Subscription")
+
+        if invoice_date == 'first_of_month':
+            date_created = self.first_day_month
+        else:
+            date_created = TODAY_LOCAL
+
+        rows = self._get_subscriptions_rows(payment_methods_id)
+        invoiced = self._get_invoiced_subscriptions()
+        paused_full_month = self._get_paused_full_month()
+        self.pauses = self._get_pauses()
+        self.alt_prices = self._get_alt_prices()
+        self.prices = self._get_prices(self.first_day_month)
+        self.tax_rates = self._get_tax_rates()
+        self.registration_fee_paid = self._get_customers_registration_fee_paid()
+
+        self.first_invoice_two_terms = \
+            os_tools.get_sys_property('subscription_first_invoice_two_terms') == "on"
+        if self.first_invoice_two_terms:
+            self.linked_subscriptions = self._get_linked_subscriptions()
+            self.prices_next_month = self._get_prices(self.last_day_month + datetime.timedelta(days=1))
+
+        self._init_invoice_numbering(date_created)
+
+        invoices_created = 0
+        created_in_chunk = 0
+        for row in rows:
+            csID = row.customers_subscriptions.id
+            if csID in invoiced or csID in paused_full_month:
+                continue
+
+            if row.auth_user.trashed:
+                # Customer has been trashed, don't do anything
+                continue
+
+            alt_price = self.alt_prices.get(csID)
+            if alt_price and alt_price.Amount == 0:
+                continue
+
+            if self._get_price(self.prices, row.customers_subscriptions.school_subscriptions_id) == 0:
+                # No need to create an invoice
+                continue
+
+            self._create_invoice(row, description, date_created)
+            invoices_created += 1
+            created_in_chunk += 1
+
+            if created_in_chunk >= chunk_size:
+                db.commit()
+                created_in_chunk = 0
+
+        db.commit()
+
+        return invoices_created
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from gluon import *
+
+
+class CustomersSubscriptionsMolliePayments:
+    """
+        Collect payments for subscription invoices of a month using Mollie
+        recurring payments (payment method 100).
+
+        Progress is stored for each invoice in db.invoices_mollie_recurring_collection,
+        so an interrupted collection continues where it stopped. Invoices are
+        processed in chunks; calls to the Mollie API in a chunk run in a
+        bounded pool of threads. The threads only talk to Mollie, all db access
+        happens in the calling thread.
+
+        Invoices still processing after processing_timeout, eg. after a crash,
+        are queued again by retry(). Mollie might already have created a payment
+        for them, so the payments of the customer are checked before creating
+        a new one. After max_attempts, they're marked as failed.
+    """
+    payment_methods_id = 100
+    processing_timeout = datetime.timedelta(hours=1)
+    max_attempts = 3
+
+
+    def __init__(self, year, month, mollie_client=None, max_workers=8):
+        """
+            :param year: int
+            :param month: int
+            :param mollie_client: function returning a Mollie client, for testing;
+            by default a mollie.api.client.Client is used
+            :param max_workers: int - max number of simultaneous Mollie API calls
+        """
+        self.year = int(year)
+        self.month = int(month)
+        self.mollie_client = mollie_client
+        self.max_workers = max_workers
+
+
+    def _get_mollie_client(self):
+        """
+            Called from worker threads, so current can't be used here
+            :return: Mollie client
+        """
+        if self.mollie_client:
+            return self.mollie_client()
+
+        from mollie.api.client import Client
+
+        mollie = Client()
+        mollie.set_api_key(self.mollie_api_key)
+
+        return mollie
+
+
+    def create_invoices(self):
+        """
+            Create invoices for this month for subscriptions paid using Mollie
+            :return: int - number of invoices created
+        """
+        from .os_customers_subscriptions_invoices import CustomersSubscriptionsInvoices
+
+        csi = CustomersSubscriptionsInvoices(self.year, self.month)
+
+        return csi.create_invoices(payment_methods_id=self.payment_methods_id)
+
+
+    def queue_invoices(self):
+        """
+            Add invoices to collect payment for to db.invoices_mollie_recurring_collection
+            :return: list of db.invoices.id waiting to be collected
+        """
+        db = current.db
+        imrc = db.invoices_mollie_recurring_collection
+
+        query = (db.invoices.SubscriptionYear == self.year) & \
+                (db.invoices.SubscriptionMonth == self.month) & \
+                (db.invoices.payment_methods_id == self.payment_methods_id) & \
+                (db.invoices.Status == 'sent') & \
+                (db.invoices_items_customers_subscriptions.id != None) & \
+                (imrc.id == None) & \
+                (db.invoices_mollie_payment_ids.id == None)
+
+        left = [
+            db.invoices_items.on(
+                db.invoices_items.invoices_id ==
+                db.invoices.id
+            ),
+            db.invoices_items_customers_subscriptions.on(
+                db.invoices_items_customers_subscriptions.invoices_items_id ==
+                db.invoices_items.id
+            ),
+            imrc.on(imrc.invoices_id == db.invoices.id),
+            db.invoices_mollie_payment_ids.on(
+                db.invoices_mollie_payment_ids.invoices_id ==
+                db.invoices.id
+            ),
+        ]
+
+        rows = db(query).select(db.invoices.id,
+                                left=left,
+                                distinct=True,
+                                orderby=db.invoices.id)
+        for row in rows:
+            imrc.insert(
+                invoices_id=row.id,
+                SubscriptionYear=self.year,
+                SubscriptionMonth=self.month,
+                Status='queued'
+            )
+
+        db.commit()
+
+        return self._get_queued()
+
+
+    def _get_queued(self):
+        """
+            :return: list of db.invoices.id waiting to be collected
+        """
+        db = current.db
+        imrc = db.invoices_mollie_recurring_collection
+
+        query = (imrc.SubscriptionYear == self.year) & \
+                (imrc.SubscriptionMonth == self.month) & \
+                (imrc.Status == 'queued')
+        rows = db(query).select(imrc.invoices_id, orderby=imrc.invoices_id)
+
+        return [row.invoices_id for row in rows]
+
+
+    def requeue_timed_out(self):
+        """
+            Queue invoices processing for longer than processing_timeout again,
+            or mark them as failed after max_attempts
+            :return: dict {'queued': int, 'failed': int}
+        """
+        db = current.db
+        imrc = db.invoices_mollie_recurring_collection
+
+        now = datetime.datetime.now()
+        query = (imrc.SubscriptionYear == self.year) & \
+                (imrc.SubscriptionMonth == self.month) & \
+                (imrc.Status == 'processing') & \
+                (imrc.UpdatedOn < now - self.processing_timeout)
+
+        # Attempts is empty for rows processed before it was counted
+        attempts = imrc.Attempts.coalesce_zero()
+        failed = db(query & (attempts >= self.max_attempts)).update(
+            Status='failed',
+            Error='Timed out while processing',
+            UpdatedOn=now
+        )
+        queued = db(query & (attempts < self.max_attempts)).update(
+            Status='queued',
+            UpdatedOn=now
+        )
+
+        db.commit()
+
+        return {'queued': queued, 'failed': failed}
+
+
+    def _get_jobs(self, invoice_ids):
+        """
+            :param invoice_ids: list of db.invoices.id
+            :return: list of dicts with everything needed to create a payment
+        """
+        T = current.T
+        db = current.db
+        CURRENCY = current.globalenv['CURRENCY']
+        get_sys_property = current.globalenv['get_sys_property']
+        imrc = db.invoices_mollie_recurring_collection
+
+        sys_hostname = get_sys_property('sys_hostname')
+        webhook_url = URL('mollie', 'webhook', scheme='https', host=sys_hostname)
+
+        left = [
+            db.invoices.on(imrc.invoices_id == db.invoices.id),
+            db.invoices_amounts.on(
+                db.invoices_amounts.invoices_id ==
+                db.invoices.id
+            ),
+            db.invoices_customers.on(
+                db.invoices_customers.invoices_id ==
+                db.invoices.id
+            ),
+            db.auth_user.on(
+                db.invoices_customers.auth_customer_id ==
+                db.auth_user.id
+            ),
+        ]
+
+        query = (imrc.invoices_id.belongs(invoice_ids)) & \
+                (imrc.SubscriptionYear == self.year) & \
+                (imrc.SubscriptionMonth == self.month) & \
+                (imrc.Status == 'queued')
+
+        rows = db(query).select(
+            imrc.id,
+            imrc.Attempts,
+            db.invoices.id,
+            db.invoices.InvoiceID,
+            db.invoices.Description,
+            db.invoices_amounts.TotalPriceVAT,
+            db.auth_user.id,
+            db.auth_user.display_name,
+            db.auth_user.email,
+            db.auth_user.mollie_customer_id,
+            left=left,
+            orderby=db.invoices.id
+        )
+
+        jobs = []
+        for row in rows:
+            jobs.append({
+                'imrcID': row.invoices_mollie_recurring_collection.id,
+                'retry': bool(row.invoices_mollie_recurring_collection.Attempts),
+                'iID': row.invoices.id,
+                'cuID': row.auth_user.id,
+                'mollie_customer_id': row.auth_user.mollie_customer_id,
+                'customer': {
+                    'name': row.auth_user.display_name,
+                    'email': row.auth_user.email
+                },
+                'payment': {
+                    'amount': {
+                        'currency': CURRENCY,
+                        'value': str(row.invoices_amounts.TotalPriceVAT)
+                    },
+                    'sequenceType': 'recurring',  # important
+                    'description': row.invoices.Description + ' - ' + row.invoices.InvoiceID,
+                    'webhookUrl': webhook_url,
+                    'metadata': {
+                        'invoice_id': row.invoices.id,
+                        'customers_orders_id': 'invoice' # This lets the webhook function know it's dealing with an invoice
+                    }
+                },
+                'webhook_url': webhook_url
+            })
+
+        return jobs
+
+
+    def _collect(self, job):
+        """
+            Create a recurring payment for an invoice; runs in a worker thread
+            :param job: dict returned by _get_jobs()
+            :return: dict with result
+        """
+        result = {
+            'status': 'failed',
+            'mollie_customer_id': job['mollie_customer_id'],
+            'mollie_payment_id': None,
+            'error': None
+        }
+
+        try:
+            mollie = self._get_mollie_client()
+
+            if not result['mollie_customer_id']:
+                mollie_customer = mollie.customers.create(job['customer'])
+                result['mollie_customer_id'] = mollie_customer['id']
+
+            if job['retry']:
+                # A previous attempt might have created a payment already
+                payment_id = self._find_payment(mollie, result['mollie_customer_id'], job['iID'])
+                if payment_id:
+                    result['status'] = 'created'
+                    result['mollie_payment_id'] = payment_id
+                    return result
+
+            mandates = mollie.customer_mandates.with_parent_id(result['mollie_customer_id']).list()
+            if not mandates['count']:
+                result['error'] = 'No mandates'
+                return result
+
+            valid_mandate = False
+            for mandate in mandates['_embedded']['mandates']:
+                if mandate['status'] == 'valid':
+                    valid_mandate = True
+                    break
+
+            if not valid_mandate:
+                # Customer isn't asked to pay manually, the mandate might still become valid
+                result['status'] = 'skipped'
+                result['error'] = 'No valid mandate'
+                return result
+
+            payment_data = dict(job['payment'])
+            payment_data['customerId'] = result['mollie_customer_id']
+            payment = mollie.payments.create(payment_data)
+
+            result['status'] = 'created'
+            result['mollie_payment_id'] = payment['id']
+        except Exception as e:
+            result['error'] = str(e)
+
+        return result
+
+
+    def _find_payment(self, mollie, mollie_customer_id, iID):
+        """
+            Runs in a worker thread
+            :param mollie: Mollie client
+            :param mollie_customer_id: string - Mollie customer id
+            :param iID: db.invoices.id
+            :return: string - id of Mollie payment for invoice, None when not found
+        """
+        payments = mollie.customer_payments.with_parent_id(mollie_customer_id).list()
+        if not payments['count']:
+            return None
+
+        for payment in payments['_embedded']['payments']:
+            metadata = payment.get('metadata') or {}
+            if str(metadata.get('invoice_id')) == str(iID):
+                return payment['id']
+
+        return None
+
+
+    def _save_result(self, job, result):
+        """
+            Store result of _collect(), commits to save progress
+            :param job: dict returned by _get_jobs()
+            :param result: dict returned by _collect()
+            :return: None
+        """
+        from .os_mail import OsMail
+
+        db = current.db
+
+        if result['mollie_customer_id'] and not job['mollie_customer_id']:
+            db.auth_user[job['cuID']] = dict(mollie_customer_id=result['mollie_customer_id'])
+
+        if result['status'] == 'created':
+            # link invoice to mollie_payment_id
+            db.invoices_mollie_payment_ids.insert(
+                invoices_id=job['iID'],
+                mollie_payment_id=result['mollie_payment_id'],
+                RecurringType='recurring',
+                WebhookURL=job['webhook_url']
+            )
+        elif result['status'] == 'failed':
+            # send mail to ask customer to pay manually
+            os_mail = OsMail()
+            msgID = os_mail.render_email_template('payment_recurring_failed')
+            os_mail.send_and_archive(msgID, job['cuID'])
+
+        db.invoices_mollie_recurring_collection[job['imrcID']] = dict(
+            Status=result['status'],
+            mollie_payment_id=result['mollie_payment_id'],
+            Error=result['error'],
+            UpdatedOn=datetime.datetime.now()
+        )
+
+        db.commit()
+
+
+    def collect_invoices(self, invoice_ids):
+        """
+            Collect payments for a chunk of queued invoices
+            :param invoice_ids: list of db.invoices.id
+            :return: dict {'created': int, 'skipped': int, 'failed': int}
+        """
+        db = current.db
+        get_sys_property = current.globalenv['get_sys_property']
+        imrc = db.invoices_mollie_recurring_collection
+
+        self.mollie_api_key = get_sys_property('mollie_website_profile')
+
+        jobs = self._get_jobs([int(iID) for iID in invoice_ids])
+
+        # Invoices still processing after a crash are queued again by retry()
+        query = (imrc.id.belongs([job['imrcID'] for job in jobs]))
+        db(query).update(Status='processing',
+                         Attempts=imrc.Attempts.coalesce_zero() + 1,
+                         UpdatedOn=datetime.datetime.now())
+        db.commit()
+
+        counts = {'created': 0, 'skipped': 0, 'failed': 0}
+        if not jobs:
+            return counts
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._collect, job): job for job in jobs}
+            for future in as_completed(futures):
+                result = future.result()
+                self._save_result(futures[future], result)
+                counts[result['status']] += 1
+
+        return counts
+
+
+    def collect(self, chunk_size=50, queue_chunks=True):
+        """
+            Create invoices and collect payments for this month
+            :param chunk_size: int - number of invoices for each chunk
+            :param queue_chunks: bool - True to collect chunks in scheduler tasks,
+            False to collect all chunks now
+            :return: string - result
+        """
+        self.create_invoices()
+        timed_out = self.requeue_timed_out()
+        invoice_ids = self.queue_invoices()
+
+        return self._collect_chunks(invoice_ids, chunk_size, queue_chunks, timed_out)
+
+
+    def retry(self, chunk_size=50, queue_chunks=True):
+        """
+            Collect payments for invoices that timed out while processing and
+            invoices still queued for this month
+            :param chunk_size: int - number of invoices for each chunk
+            :param queue_chunks: bool - True to collect chunks in scheduler tasks,
+            False to collect all chunks now
+            :return: string - result
+        """
+        timed_out = self.requeue_timed_out()
+        invoice_ids = self._get_queued()
+
+        return self._collect_chunks(invoice_ids, chunk_size, queue_chunks, timed_out)
+
+
+    def _collect_chunks(self, invoice_ids, chunk_size, queue_chunks, timed_out):
+        """
+            :param invoice_ids: list of db.invoices.id waiting to be collected
+            :param timed_out: dict returned by requeue_timed_out()
+            :return: string - result
+        """
+        T = current.T
+
+        timed_out_result = T("Payments timed out and failed") + ': ' + str(timed_out['failed'])
+
+        chunks = [invoice_ids[i:i + chunk_size]
+                  for i in range(0, len(invoice_ids), chunk_size)]
+
+        if queue_chunks:
+            scheduler = current.globalenv['scheduler']
+            for chunk in chunks:
+                scheduler.queue_task(
+                    'customers_subscriptions_collect_mollie_recurring_chunk',
+                    pvars={
+                        'year': self.year,
+                        'month': self.month,
+                        'invoice_ids': chunk
+                    },
+                    stop_time=datetime.datetime.now() + datetime.timedelta(hours=1),
+                    last_run_time=datetime.datetime(1963, 8, 28, 14, 30),
+                    timeout=1800, # run for max. half an hour.
+                )
+
+            return T("Invoices queued for payment collection") + ': ' + str(len(invoice_ids)) + '<br>' + \
+                timed_out_result
+
+        counts = {'created': 0, 'skipped': 0, 'failed': 0}
+        for chunk in chunks:
+            chunk_counts = self.collect_invoices(chunk)
+            for status in counts:
+                counts[status] += chunk_counts[status]
+
+        return T("Payments collected") + ': ' + str(counts['created']) + '<br>' + \
+            T("Payments failed to collect") + ': ' + str(counts['failed']) + '<br>' + \
+            T("Payments skipped, no valid mandate") + ': ' + str(counts['skipped']) + '<br>' + \
+            timed_out_result
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from gluon import *
+
+
+class OsDbIndexes:
+    """
+        Secondary indexes are declared with declare() in the define functions
+        of the tables they belong to. apply() creates the indexes that don't
+        exist yet in the database. Creating indexes is supported for MySQL and
+        SQLite, other databases are skipped.
+
+        Indexes checked by apply() are remembered for each process, so only the
+        first request after starting checks the database. Upserts depend on
+        unique indexes, so those are checked even when migrations are disabled.
+
+        Before a unique index is created, duplicate rows are removed, keeping
+        the last row inserted for each value.
+    """
+    # Declared indexes {name: (tablename, [fieldnames])}
+    _indexes = {}
+    # Names of declared indexes that are unique
+    _unique = set()
+    # Indexes that are known to exist in the database, for each process
+    _applied = set()
+    _applied_lock = threading.Lock()
+
+    engines = ['mysql', 'sqlite']
+
+
+    def declare(self, table, fields, name=None, unique=False):
+        """
+        :param table: gluon.dal.Table
+        :param fields: list of strings - field names, in order of the index
+        :param name: string - name of index, generated from table & fields when None
+        :param unique: Boolean - create a unique index
+        :return: string - name of index
+        """
+        if name is None:
+            name = self.get_name(table._tablename, fields, unique=unique)
+
+        self._indexes[name] = (table._tablename, list(fields))
+        if unique:
+            self._unique.add(name)
+
+        return name
+
+
+    def get_name(self, tablename, fields, unique=False):
+        """
+        :param tablename: string - name of table
+        :param fields: list of strings - field names
+        :param unique: Boolean - name of a unique index
+        :return: string - index name, at most 64 characters (MySQL limit)
+        """
+        import hashlib
+
+        prefix = 'ux_' if unique else 'ix_'
+        name = prefix + tablename + '_' + '_'.join(fields)
+        name = name.lower()
+        if len(name) > 64:
+            digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+            name = name[:53] + '_' + digest
+
+        return name
+
+
+    def get_declared(self):
+        """
+        :return: list of tuples (name, tablename, [fieldnames]), sorted by table & name
+        """
+        return sorted(
+            [(name, tablename, fields) for name, (tablename, fields) in self._indexes.items()],
+            key=lambda index: (index[1], index[0])
+        )
+
+
+    def _get_engine(self):
+        """
+        :return: string - database engine, eg. 'mysql' or 'sqlite'
+        """
+        db = current.db
+
+        return db._adapter.dbengine
+
+
+    def exists(self, name, tablename):
+        """
+        :param name: string - name of index
+        :param tablename: string - name of table
+        :return: Boolean - True when the index exists in the database
+        """
+        db = current.db
+
+        engine = self._get_engine()
+        if engine == 'mysql':
+            query = """SELECT COUNT(*) FROM information_schema.statistics
+                       WHERE table_schema = DATABASE()
+                         AND table_name = '{tablename}'
+                         AND index_name = '{name}'""".format(tablename=tablename,
+                                                             name=name)
+        elif engine == 'sqlite':
+            query = """SELECT COUNT(*) FROM sqlite_master
+                       WHERE type = 'index'
+                         AND tbl_name = '{tablename}'
+                         AND name = '{name}'""".format(tablename=tablename,
+                                                       name=name)
+        else:
+            return False
+
+        return bool(db.executesql(query)[0][0])
+
+
+    def create(self, name, tablename, fields):
+        """
+        :param name: string - name of index
+        :param tablename: string - name of table
+        :param fields: list of strings - field names
+        :return: None
+        """
+        db = current.db
+
+        if name in self._unique:
+            self.delete_duplicates(tablename, fields)
+
+        db.executesql("CREATE {unique}INDEX {name} ON {tablename} ({fields})".format(
+            unique='UNIQUE ' if name in self._unique else '',
+            name=name,
+            tablename=tablename,
+            fields=', '.join(fields)
+        ))
+
+
+    def delete_duplicates(self, tablename, fields):
+        """
+        Delete rows with the same values for fields, keeping the last row inserted
+        :param tablename: string - name of table
+        :param fields: list of strings - field names
+        :return: None
+        """
+        db = current.db
+
+        # The derived table is required by MySQL to select from the table
+        # rows are deleted from
+        db.executesql("""
+        DELETE FROM {tablename}
+        WHERE id NOT IN ( SELECT id FROM ( SELECT MAX(id) AS id
+                                           FROM {tablename}
+                                           GROUP BY {fields} ) keep )
+        """.format(tablename=tablename,
+                   fields=', '.join(fields)))
+
+
+    def apply(self, force=False, unique_only=False):
+        """
+        Create declared indexes which don't exist in the database
+        :param force: Boolean - also check indexes checked before by this process
+        :param unique_only: Boolean - only create unique indexes
+        :return: list of strings - names of created indexes
+        """
+        db = current.db
+
+        if not self._get_engine() in self.engines:
+            return []
+
+        created = []
+        for name, tablename, fields in self.get_declared():
+            if unique_only and not name in self._unique:
+                continue
+
+            key = (db._uri_hash, name)
+            if key in self._applied and not force:
+                continue
+
+            if not self.exists(name, tablename):
+                self.create(name, tablename, fields)
+                created.append(name)
+
+            with self._applied_lock:
+                self._applied.add(key)
+
+        if created:
+            db.commit()
+
+        return created
+
+
+    def _get_hot_queries(self):
+        """
+        :return: list of tuples (description, SQL) - queries used by the schedule,
+                 bookings & subscriptions, with example values
+        """
+        import datetime
+
+        db = current.db
+        T = current.T
+
+        date = current.TODAY_LOCAL
+        now = datetime.datetime.now()
+
+        return [
+            (T("Bookings for a class"),
+             db((db.classes_attendance.classes_id == 1) &
+                (db.classes_attendance.ClassDate == date) &
+                (db.classes_attendance.BookingStatus != 'cancelled'))._select(
+                 db.classes_attendance.id)),
+            (T("Classes attended by a customer"),
+             db((db.classes_attendance.auth_customer_id == 1) &
+                (db.classes_attendance.ClassDate >= date - datetime.timedelta(days=365)) &
+                (db.classes_attendance.ClassDate <= date))._select(
+                 db.classes_attendance.id)),
+            (T("Class changes on a date"),
+             db(db.classes_otc.ClassDate == date)._select(
+                 db.classes_otc.id)),
+            (T("Teachers of a class"),
+             db((db.classes_teachers.classes_id == 1) &
+                (db.classes_teachers.Startdate <= date) &
+                ((db.classes_teachers.Enddate >= date) |
+                 (db.classes_teachers.Enddate == None)))._select(
+                 db.classes_teachers.id)),
+            (T("Subscriptions of a customer"),
+             db((db.customers_subscriptions.auth_customer_id == 1) &
+                (db.customers_subscriptions.Startdate <= date) &
+                ((db.customers_subscriptions.Enddate >= date) |
+                 (db.customers_subscriptions.Enddate == None)))._select(
+                 db.customers_subscriptions.id)),
+            (T("Credits added to a subscription"),
+             db((db.customers_subscriptions_credits.customers_subscriptions_id == 1) &
+                (db.customers_subscriptions_credits.MutationType == 'add'))._select(
+                 db.customers_subscriptions_credits.id)),
+            (T("Items of an invoice"),
+             db(db.invoices_items.invoices_id == 1)._select(
+                 db.invoices_items.id)),
+            (T("Class occurrences in a week"),
+             db((db.classes_occurrences.ClassDate >= date) &
+                (db.classes_occurrences.ClassDate <= date + datetime.timedelta(days=6)))._select(
+                 db.classes_occurrences.id)),
+            (T("Mails waiting to be sent"),
+             db((db.mail_outbox.Status == 'queued') &
+                (db.mail_outbox.NextAttemptOn <= now))._select(
+                 db.mail_outbox.id)),
+        ]
+
+
+    def explain(self):
+        """
+        Run EXPLAIN on the hot queries
+        :return: list of dicts {'description': string,
+                                'sql': string,
+                                'plan': list of dicts - one for each row returned by EXPLAIN}
+        """
+        db = current.db
+
+        engine = self._get_engine()
+        if engine == 'mysql':
+            explain = 'EXPLAIN '
+        elif engine == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            return []
+
+        data = []
+        for description, sql in self._get_hot_queries():
+            sql = sql.strip().rstrip(';')
+            data.append({
+                'description': description,
+                'sql': sql,
+                'plan': db.executesql(explain + sql, as_dict=True)
+            })
+
+        return data
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+from gluon import *
+
+
+class OsExport:
+    """
+        Shared pipeline for Excel & CSV exports.
+
+        Rows are selected in chunks and appended to write-only workbooks or csv
+        writers, which are saved to a temporary file. The file is kept in memory
+        while it's small and moved to disk when it grows, before it's streamed
+        to the client. Large exports can be created in the background by the
+        exports_create scheduler task and downloaded when they're ready.
+        Background exports contain personal data, so they're deleted by the
+        exports_delete_expired scheduler task after retention_days.
+    """
+    # Size in bytes up to which an export is kept in memory
+    max_size_in_memory = 4 * 1024 * 1024
+
+    # Exports for more rows than this are offered to run in the background
+    background_rows = 5000
+
+    # Days background exports are kept
+    retention_days = 7
+
+    content_types = {
+        'excel': 'application/vnd.ms-excel',
+        'csv': 'text/csv',
+    }
+
+
+    def select_chunks(self, query, fields, id_field, left=None, chunk_size=1000):
+        """
+        Select rows in chunks, ordered by id_field. Each chunk continues after
+        the last id of the previous chunk, so only one chunk is in memory.
+        :param query: gluon.dal.query
+        :param fields: list of gluon.dal.Field
+        :param id_field: gluon.dal.Field - id field to order & continue by, has to be in fields
+        :param left: list of left joins
+        :param chunk_size: int - number of rows to select at once
+        :return: generator of gluon.dal.Rows
+        """
+        db = current.db
+
+        last_id = 0
+        while True:
+            rows = db(query & (id_field > last_id)).select(*fields,
+                                                           left=left,
+                                                           orderby=id_field,
+                                                           limitby=(0, chunk_size))
+            if rows:
+                yield rows
+
+            if len(rows) < chunk_size:
+                break
+
+            last_id = rows.last()[id_field]
+
+
+    def get_file(self):
+        """
+        :return: tempfile.SpooledTemporaryFile - moved to disk when it grows
+                 larger than max_size_in_memory
+        """
+        import tempfile
+
+        return tempfile.SpooledTemporaryFile(max_size=self.max_size_in_memory)
+
+
+    def excel(self, sheets):
+        """
+        :param sheets: list of tuples (title, rows) - rows is an iterable of lists
+        :return: file object containing xlsx file, positioned at the start
+        """
+        import openpyxl
+
+        wb = openpyxl.workbook.Workbook(write_only=True)
+        for title, rows in sheets:
+            ws = wb.create_sheet(title=title[0:30])
+            for row in rows:
+                ws.append(row)
+
+        return self.excel_workbook(wb)
+
+
+    def excel_workbook(self, wb):
+        """
+        :param wb: openpyxl.workbook.Workbook
+        :return: file object containing xlsx file, positioned at the start
+        """
+        stream = self.get_file()
+        wb.save(stream)
+        stream.seek(0)
+
+        return stream
+
+
+    def csv(self, rows, delimiter=','):
+        """
+        :param rows: iterable of lists
+        :param delimiter: string - field delimiter
+        :return: file object containing csv file (utf-8), positioned at the start
+        """
+        import io
+        import csv
+
+        stream = self.get_file()
+
+        # Each row is written to a text buffer and copied to the binary file encoded,
+        # wrapping a SpooledTemporaryFile in a TextIOWrapper requires python 3.11
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=delimiter)
+        for row in rows:
+            writer.writerow(row)
+            stream.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+
+        stream.seek(0)
+
+        return stream
+
+
+    def stream(self, stream, fname, filetype='excel'):
+        """
+        Stream an export to the client
+        :param stream: file object returned by excel() or csv()
+        :param fname: string - file name
+        :param filetype: string - 'excel' or 'csv'
+        :return: response.stream() of the file, to be returned by the controller
+        """
+        request = current.request
+        response = current.response
+
+        response.headers['Content-Type'] = self.content_types[filetype]
+        response.headers['Content-disposition'] = 'attachment; filename=' + fname
+
+        return response.stream(stream, request=request)
+
+
+    def get_sheets(self, export_type):
+        """
+        :param export_type: string - type of export
+        :return: tuple (fname, sheets) - see excel() for sheets
+        """
+        from .os_customers import Customers
+
+        T = current.T
+
+        customers = Customers()
+        if export_type == 'customers_list':
+            return (T("Customers list") + '.xlsx',
+                    customers.export_list_sheets())
+        elif export_type == 'mailing_list':
+            return (T("Mailinglist") + '.xlsx',
+                    customers.export_mailinglist_sheets())
+
+        raise ValueError('Unknown export type: ' + str(export_type))
+
+
+    def queue(self, export_type):
+        """
+        Create an export in the background for the logged in user
+        :param export_type: string - type of export, see get_sheets()
+        :return: db.sys_exports.id
+        """
+        import datetime
+
+        db = current.db
+        auth = current.auth
+        scheduler = current.globalenv['scheduler']
+
+        seID = db.sys_exports.insert(
+            auth_user_id=auth.user.id,
+            ExportType=export_type
+        )
+
+        scheduler.queue_task(
+            'exports_create',
+            pvars={'seID': seID},
+            stop_time=datetime.datetime.now() + datetime.timedelta(hours=1),
+            last_run_time=datetime.datetime(1963, 8, 28, 14, 30),
+            timeout=3600, # run for max. one hour.
+        )
+
+        return seID
+
+
+    def create(self, seID):
+        """
+        Create a queued export and store the file
+        :param seID: db.sys_exports.id
+        :return: db.sys_exports row
+        """
+        import datetime
+
+        db = current.db
+
+        row = db.sys_exports(seID)
+        row.update_record(Status='running')
+        db.commit()
+
+        try:
+            fname, sheets = self.get_sheets(row.ExportType)
+            stream = self.excel(sheets)
+            row.update_record(
+                Status='finished',
+                FileName=fname,
+                ExportFile=db.sys_exports.ExportFile.store(stream, fname),
+                FinishedOn=datetime.datetime.now()
+            )
+            stream.close()
+        except Exception:
+            db.rollback()
+            db(db.sys_exports.id == seID).update(Status='failed')
+            db.commit()
+            raise
+
+        return row
+
+
+    def delete_expired(self):
+        """
+        Delete background exports & their files created more than
+        retention_days ago
+        :return: int - number of exports deleted
+        """
+        import os
+        import datetime
+
+        db = current.db
+        request = current.request
+
+        created_before = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+        query = (db.sys_exports.CreatedOn < created_before)
+        rows = db(query).select(db.sys_exports.id,
+                                db.sys_exports.ExportFile)
+
+        db(db.sys_exports.id.belongs([row.id for row in rows])).delete()
+        db.commit()
+
+        # Files might be removed already by autodelete of the upload field
+        for row in rows:
+            if not row.ExportFile:
+                continue
+            path = os.path.join(request.folder, 'uploads', row.ExportFile)
+            if os.path.exists(path):
+                os.remove(path)
+
+        return len(rows)
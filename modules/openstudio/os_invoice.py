@@ -98,26 +98,30 @@ class Invoice:
         """
             Returns the number for an invoice
         """
+        from .os_invoices import Invoices
+
         invoice_id = self.invoice_group.InvoicePrefix or ""
 
+        reset = False
         if self.invoice_group.PrefixYear:
             year = str(datetime.date.today().year)
             invoice_id += year
 
             # Check if NextID should be reset
-            self._get_next_invoice_id_year_prefix_reset_numbering()
+            reset = self._get_next_invoice_id_year_prefix_reset_numbering()
 
-        invoice_id += str(self.invoice_group.NextID)
+        number = Invoices().get_next_invoice_number(self.invoice_group.id, reset=reset)
+        invoice_id += str(number)
 
-        self.invoice_group.NextID += 1
-        self.invoice_group.update_record()
+        self.invoice_group.NextID = number + 1
 
         return invoice_id
 
 
     def _get_next_invoice_id_year_prefix_reset_numbering(self):
         """
-        Reset  numbering to 1 for first invoice in year
+        Check whether numbering should be reset to 1 for first invoice in year
+        :return: Boolean
         """
         db = current.db
 
@@ -132,10 +136,8 @@ class Invoice:
 
         invoices_for_this_group_in_year = db(query).count()
 
-        if invoices_for_this_group_in_year == 1:
-            # This is the first invoice in this group for this year
-            self.invoice_group.NextID = 1
-            self.invoice_group.update_record()
+        # This is the first invoice in this group for this year
+        return invoices_for_this_group_in_year == 1
 
 
     def set_status(self, status):
@@ -367,6 +369,113 @@ class Invoice:
         return rows
 
 
+    def _get_pdf_template_logo_path(self):
+        """
+            Returns path of the logo for the pdf template
+        """
+        import os
+
+        request = current.request
+
+        return os.path.join(request.folder,
+                            'static',
+                            'plugin_os-branding',
+                            'logos',
+                            'branding_logo_invoices.png')
+
+
+    def _get_pdf_template_logo(self):
+        """
+            Returns logo for pdf template, embedded as data URI so the PDF
+            doesn't depend on the host name of the request rendering it
+        """
+        import base64
+
+        try:
+            with open(self._get_pdf_template_logo_path(), 'rb') as f:
+                data = base64.b64encode(f.read()).decode('ascii')
+        except IOError:
+            return ''
+
+        return IMG(_src='data:image/png;base64,' + data)
+
+
+    def get_pdf_template(self):
+        """
+            Print friendly display of invoice
+            :return: html
+        """
+        db = current.db
+        response = current.response
+
+        items = self.get_invoice_items_rows().render()
+
+        query = (db.invoices_amounts.invoices_id == self.invoices_id)
+        amounts = db(query).select(db.invoices_amounts.ALL)
+        amounts = list(amounts[0:1].render())[0] # make the generator output stuff
+
+        amounts_vat = self.get_amounts_tax_rates(formatted=True)
+
+        studio = self.get_studio_info()
+        studio['address'] = XML(studio['address'])
+
+        html = response.render('templates/invoices/default.html',
+                               dict(invoice     = self.invoice,
+                                    items       = items,
+                                    amounts     = amounts,
+                                    amounts_vat = amounts_vat,
+                                    studio      = studio,
+                                    logo        = self._get_pdf_template_logo()))
+
+        return html
+
+
+    def get_pdf_cache_key(self):
+        """
+            Hash of everything shown on the invoice, including Updated_at and
+            the logo
+            :return: string
+        """
+        import os
+        import hashlib
+        import json
+
+        db = current.db
+
+        query = (db.invoices_amounts.invoices_id == self.invoices_id)
+        amounts = db(query).select(db.invoices_amounts.ALL).first()
+
+        content = [
+            self.invoice.as_dict(),
+            self.get_invoice_items_rows().as_list(),
+            amounts.as_dict() if amounts else None,
+            self.get_studio_info(),
+        ]
+
+        logo_path = self._get_pdf_template_logo_path()
+        if os.path.isfile(logo_path):
+            logo = os.stat(logo_path)
+            content.append([logo.st_size, logo.st_mtime])
+
+        return hashlib.sha256(
+            json.dumps(content, default=str, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+
+    def get_pdf(self):
+        """
+            Returns cached PDF file for invoice, renders it when not found in cache
+            :return: bytes
+        """
+        from .os_pdf import OsPdf
+
+        os_pdf = OsPdf()
+
+        return os_pdf.get_pdf('invoice_' + str(self.invoices_id),
+                              self.get_pdf_cache_key(),
+                              self.get_pdf_template)
+
+
     def get_payment_method(self):
         """
         :return: db.payment_methods_row for invoice
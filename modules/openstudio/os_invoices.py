@@ -648,3 +648,67 @@ class Invoices:
                                    tooltip=T('Add payment'))
 
         return button
+
+
+    def render_pdfs(self, date_from, date_until, chunk_size=20):
+        """
+            Render PDF files for all invoices created in a period and store
+            them in the PDF cache. Invoices already in cache are skipped.
+            :param date_from: datetime.date
+            :param date_until: datetime.date
+            :param chunk_size: int - number of invoices rendered in parallel
+            :return: int - number of invoices rendered
+        """
+        from .os_invoice import Invoice
+        from .os_pdf import OsPdf
+
+        db = current.db
+
+        os_pdf = OsPdf()
+
+        query = (db.invoices.DateCreated >= date_from) & \
+                (db.invoices.DateCreated <= date_until)
+        rows = db(query).select(db.invoices.id, orderby=db.invoices.id)
+
+        ids = [row.id for row in rows]
+        rendered = 0
+        for i in range(0, len(ids), chunk_size):
+            invoices = []
+            for iID in ids[i:i + chunk_size]:
+                invoice = Invoice(iID)
+                name = 'invoice_' + str(iID)
+                key = invoice.get_pdf_cache_key()
+                if os_pdf.get_cached(name, key) is None:
+                    invoices.append((name, key, invoice.get_pdf_template()))
+
+            pdfs = os_pdf.render_many([html for name, key, html in invoices])
+            for (name, key, html), pdf in zip(invoices, pdfs):
+                os_pdf.store(name, key, pdf)
+
+            rendered += len(invoices)
+
+        return rendered
+
+
+    def get_next_invoice_number(self, invoices_groups_id, reset=False):
+        """
+            Take the next number of an invoice group.
+            NextID is incremented by the database instead of writing back a value
+            read earlier. The update locks the invoice group row until commit, so
+            other transactions creating invoices in the group wait and continue
+            with the following number.
+            :param invoices_groups_id: db.invoices_groups.id
+            :param reset: Boolean - start numbering at 1 (first invoice in a year)
+            :return: int - number for invoice
+        """
+        db = current.db
+
+        query = (db.invoices_groups.id == invoices_groups_id)
+        if reset:
+            db(query).update(NextID=2)
+            return 1
+
+        db(query).update(NextID=db.invoices_groups.NextID + 1)
+        row = db(query).select(db.invoices_groups.NextID).first()
+
+        return row.NextID - 1
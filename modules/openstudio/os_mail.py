@@ -43,10 +43,12 @@ class OsMail:
         :param msg_html: html message
         :param msg_subject: email subject
         :param email: address
-        :return: boolean: True if send, False if error sending
+        :return: list of db.mail_outbox.id - one for each mail queued for sending
         """
+        from .os_mail_outbox import OsMailOutbox
+
         T = current.T
-        MAIL = current.mail
+        outbox = OsMailOutbox()
 
         emails = self._send_notification_get_email_addresses(sys_notification)
         message = self.render_sys_notification(
@@ -57,72 +59,66 @@ class OsMail:
         if sys_notification == 'order_created':
             msg_subject = T("New order")
 
-        status_report = []
+        queued = []
         for email in emails:
-            status_report = MAIL.send(
+            queued.append(outbox.queue(
                 to=email,
                 subject=msg_subject,
                 message=message
-            )
+            ))
 
-        return status_report
+        return queued
 
 
     def send_and_archive(self, msgID, cuID): # Used to be 'mail_customer()'
         """
-            Send a message to a customer
-            returns True when a mail is sent and False when it failed
+            Queue a message to a customer for sending
+            The status of the archived message is updated when the mail is sent
+            returns db.mail_outbox.id of the queued mail; the mail isn't sent yet
         """
+        from .os_mail_outbox import OsMailOutbox
+
         db = current.db
-        MAIL = current.mail
 
         customer = db.auth_user(cuID)
         message = db.messages(msgID)
 
-        check = MAIL.send(
+        cmID = db.customers_messages.insert(auth_customer_id = cuID,
+                                            messages_id = msgID,
+                                            Status = 'queued')
+
+        outbox = OsMailOutbox()
+        return outbox.queue(
             to=customer.email,
             subject=message.msg_subject,
             reply_to=None, # If reply_to is omitted, then mail.settings.sender is used
-            message=message.msg_content
+            message=message.msg_content,
+            customers_messages_id=cmID
         )
 
-        if check:
-            status = 'sent'
-            rvalue = True
-        else:
-            status = 'fail'
-            rvalue = False
-        db.customers_messages.insert(auth_customer_id = cuID,
-                                     messages_id = msgID,
-                                     Status = status)
-
-        return rvalue
-
 
     def send(self, message_html, message_subject, auth_user_id):
         """
-        Send mail without logging to an account
-
-        returns True if sending mail is successful, False otherwise
+        Queue mail for sending without logging to an account
 
         :param message_html: message content
         :param cuID: auth_user.id
-        :return: boolean
+        :return: db.mail_outbox.id of the queued mail; the mail isn't sent yet
         """
+        from .os_mail_outbox import OsMailOutbox
+
         db = current.db
-        MAIL = current.mail
 
         account = db.auth_user(auth_user_id)
 
-        result = MAIL.send(
+        outbox = OsMailOutbox()
+        return outbox.queue(
             to=account.email,
             subject=message_subject,
             reply_to=None, # If reply_to is omitted, then mail.settings.sender is used
             message=message_html
         )
 
-        return result
-
 
     def _send_notification_get_email_addresses(self, sys_notification):
         """
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import smtplib
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+from gluon import *
+
+
+logger = logging.getLogger('web2py.app.openstudio')
+
+
+class OsMailOutbox:
+    """
+        Mails are added to db.mail_outbox and sent in batches by the
+        mail_outbox_send scheduler task, so requests don't wait for the mail
+        server. One SMTP connection is used for each batch.
+
+        Mails that fail are retried with an increasing delay. Linked
+        db.customers_messages records get status sent or fail once delivery
+        succeeded or all attempts failed.
+    """
+    max_attempts = 5
+    retry_delay = 60 # seconds, doubles after each attempt
+
+
+    def queue(self, to, subject, message, reply_to=None, customers_messages_id=None):
+        """
+        :param to: string - email address
+        :param subject: string
+        :param message: string - html (starting with <html) or plain text
+        :param reply_to: string - email address; None to use the sender
+        :param customers_messages_id: db.customers_messages.id to update after sending
+        :return: db.mail_outbox.id
+        """
+        db = current.db
+
+        return db.mail_outbox.insert(
+            Recipient=to,
+            Subject=subject,
+            Message=message,
+            ReplyTo=reply_to,
+            customers_messages_id=customers_messages_id,
+            Status='queued',
+            Attempts=0,
+            NextAttemptOn=datetime.datetime.now()
+        )
+
+
+    def _get_message(self, row, sender):
+        """
+        :param row: gluon.dal.row of db.mail_outbox
+        :param sender: string - from address
+        :return: email.message
+        """
+        message = row.Message or ''
+        # Same check as gluon.tools.Mail.send()
+        if message.strip().startswith('<html') and message.strip().endswith('</html>'):
+            payload = MIMEText(message, 'html', 'utf-8')
+        else:
+            payload = MIMEText(message, 'plain', 'utf-8')
+
+        msg = MIMEMultipart('alternative')
+        msg.attach(payload)
+        msg['Subject'] = Header(row.Subject or '', 'utf-8')
+        msg['From'] = sender
+        msg['To'] = row.Recipient
+        msg['Date'] = formatdate(localtime=True)
+        msg['Message-Id'] = make_msgid()
+        if row.ReplyTo:
+            msg['Reply-To'] = row.ReplyTo
+
+        return msg
+
+
+    def _connect(self, settings):
+        """
+        :param settings: gluon.tools.Mail settings
+        :return: smtplib connection
+        """
+        host, port = settings.server.split(':')
+        if settings.ssl:
+            server = smtplib.SMTP_SSL(host, int(port), timeout=settings.timeout or 60)
+        else:
+            server = smtplib.SMTP(host, int(port), timeout=settings.timeout or 60)
+            if settings.tls:
+                server.ehlo(settings.hostname)
+                server.starttls()
+                server.ehlo(settings.hostname)
+
+        if settings.login:
+            server.login(*settings.login.split(':', 1))
+
+        return server
+
+
+    def _set_customers_message_status(self, row, status):
+        """
+        :param row: gluon.dal.row of db.mail_outbox
+        :param status: string - status for db.customers_messages
+        :return: None
+        """
+        db = current.db
+
+        if row.customers_messages_id:
+            db.customers_messages[row.customers_messages_id] = dict(Status=status)
+
+
+    def _set_sent(self, row):
+        """
+        :param row: gluon.dal.row of db.mail_outbox
+        :return: None
+        """
+        db = current.db
+
+        db.mail_outbox[row.id] = dict(
+            Status='sent',
+            Attempts=(row.Attempts or 0) + 1,
+            SentOn=datetime.datetime.now(),
+            LastError=None
+        )
+        self._set_customers_message_status(row, 'sent')
+
+        db.commit()
+
+
+    def _set_failed(self, row, error):
+        """
+        Schedule a retry or give up after max_attempts
+        :param row: gluon.dal.row of db.mail_outbox
+        :param error: string
+        :return: None
+        """
+        db = current.db
+
+        attempts = (row.Attempts or 0) + 1
+        if attempts >= self.max_attempts:
+            status = 'failed'
+            self._set_customers_message_status(row, 'fail')
+        else:
+            status = 'queued'
+
+        delay = self.retry_delay * 2 ** (attempts - 1)
+
+        db.mail_outbox[row.id] = dict(
+            Status=status,
+            Attempts=attempts,
+            NextAttemptOn=datetime.datetime.now() + datetime.timedelta(seconds=delay),
+            LastError=error
+        )
+
+        db.commit()
+
+
+    def send_queued(self, batch_size=100):
+        """
+        Send queued mails that are due, using one SMTP connection
+        :param batch_size: int - max number of mails to send
+        :return: dict {'sent': int, 'failed': int}
+        """
+        db = current.db
+        MAIL = current.mail
+        settings = MAIL.settings
+
+        query = (db.mail_outbox.Status == 'queued') & \
+                (db.mail_outbox.NextAttemptOn <= datetime.datetime.now())
+        rows = db(query).select(db.mail_outbox.ALL,
+                                orderby=db.mail_outbox.NextAttemptOn|db.mail_outbox.id,
+                                limitby=(0, batch_size))
+
+        counts = {'sent': 0, 'failed': 0}
+        if not rows:
+            return counts
+
+        server = None
+        try:
+            for i, row in enumerate(rows):
+                try:
+                    msg = self._get_message(row, settings.sender)
+
+                    if settings.server == 'logging':
+                        logger.warning('email not sent\n%s\n%s\n' % ('-' * 40, msg.as_string()))
+                    elif settings.server.startswith('gae') or not settings.server:
+                        # No SMTP server to keep a connection to
+                        if not MAIL.send(to=row.Recipient,
+                                         subject=row.Subject,
+                                         reply_to=row.ReplyTo,
+                                         message=row.Message):
+                            raise Exception(str(MAIL.error))
+                    else:
+                        if server is None:
+                            try:
+                                server = self._connect(settings)
+                            except Exception as e:
+                                # Mail server unavailable, try the whole batch again later
+                                logger.error('mail outbox: unable to connect: %s' % e)
+                                for failed_row in rows[i:]:
+                                    self._set_failed(failed_row, str(e))
+                                    counts['failed'] += 1
+                                break
+                        server.sendmail(settings.sender, [row.Recipient], msg.as_string())
+                except Exception as e:
+                    if isinstance(e, smtplib.SMTPServerDisconnected) or \
+                       (isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)):
+                        # Connection lost, connect again for the next mail
+                        server = None
+                    self._set_failed(row, str(e))
+                    counts['failed'] += 1
+                else:
+                    self._set_sent(row)
+                    counts['sent'] += 1
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except Exception:
+                    pass
+
+        return counts
@@ -760,7 +760,7 @@ class Order:
                     invoice.item_add_class_from_order(row, result['caID'])
 
                 # Clear api cache to update available spaces
-                cache_clear_classschedule_api()
+                cache_clear_classschedule_api(date=row.customers_orders_items.ClassDate)
 
             # Check for donation
             if row.customers_orders_items.Donation:
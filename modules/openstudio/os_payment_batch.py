@@ -3,6 +3,11 @@
     This file holds OpenStudio MailChimp class
 """
 
+import csv
+import io
+import datetime
+from xml.sax.saxutils import escape
+
 from gluon import *
 
 
@@ -222,3 +227,406 @@ class PaymentBatch:
                 BankName=row.customers_payment_info.BankName,
                 BankLocation=row.customers_payment_info.BankLocation
             )
+
+
+    def get_recurring_customer_ids(self):
+        """
+        :return: list of auth_user_ids that have been in previous batches of the same type
+        """
+        db = current.db
+
+        query = (db.payment_batches.id < self.id) & \
+                (db.payment_batches.BatchType == self.row.BatchType) & \
+                (db.payment_batches.Status == 'sent_to_bank')
+
+        left = [ db.payment_batches.on(db.payment_batches_items.payment_batches_id == db.payment_batches.id) ]
+
+        rows = db(query).select(db.payment_batches_items.auth_customer_id,
+                                left=left,
+                                distinct=True)
+
+        return [row.auth_customer_id for row in rows]
+
+
+    def _get_items_query(self, first=False, recurring=False, recurring_ids=None):
+        """
+        :param first: bool - only items for customers not in previous batches
+        :param recurring: bool - only items for customers in previous batches
+        :param recurring_ids: list returned by get_recurring_customer_ids()
+        :return: query for db.payment_batches_items
+        """
+        db = current.db
+
+        query = (db.payment_batches_items.payment_batches_id == self.id)
+
+        if first or recurring:
+            if recurring_ids is None:
+                recurring_ids = self.get_recurring_customer_ids()
+
+            if first:
+                query &= ~(db.payment_batches_items.auth_customer_id.belongs(recurring_ids))
+            if recurring:
+                query &= (db.payment_batches_items.auth_customer_id.belongs(recurring_ids))
+
+        return query
+
+
+    def get_items_totals(self, first=False, recurring=False, recurring_ids=None):
+        """
+        :return: dict {'count': int, 'amount': decimal} for items in batch
+        """
+        db = current.db
+
+        count = db.payment_batches_items.id.count()
+        amount = db.payment_batches_items.Amount.sum()
+
+        query = self._get_items_query(first, recurring, recurring_ids)
+        row = db(query).select(count, amount).first()
+
+        return {
+            'count': row[count] or 0,
+            'amount': row[amount] or 0
+        }
+
+
+    def get_items(self, first=False, recurring=False, recurring_ids=None, chunk_size=500):
+        """
+        Generator of batch items. Items are fetched in chunks, so memory use
+        doesn't depend on the size of the batch.
+        :param first: bool - only items for customers not in previous batches
+        :param recurring: bool - only items for customers in previous batches
+        :param chunk_size: int - number of items fetched in each query
+        :return: dict for each item in batch, ordered by db.payment_batches_items.id
+        """
+        db = current.db
+        DATE_FORMAT = current.DATE_FORMAT
+
+        if self.row.school_locations_id:
+            location = db.school_locations(self.row.school_locations_id).Name
+        else:
+            location = 'All'
+
+        execution_date = self.row.Exdate.strftime(DATE_FORMAT)
+        query = self._get_items_query(first, recurring, recurring_ids)
+
+        line = 0
+        last_id = 0
+        while True:
+            rows = db(query & (db.payment_batches_items.id > last_id)).select(
+                db.payment_batches_items.ALL,
+                orderby=db.payment_batches_items.id,
+                limitby=(0, chunk_size)
+            )
+
+            for row in rows:
+                line += 1
+
+                if row.MandateSignatureDate:
+                    msdate = row.MandateSignatureDate.strftime(DATE_FORMAT)
+                else:
+                    msdate = ''
+
+                yield {
+                    'id': row.id,
+                    'line': line,
+                    'cuID': row.auth_customer_id,
+                    'csID': row.customers_subscriptions_id or '',
+                    'account_holder': row.AccountHolder,
+                    'account_number': (row.AccountNumber or '').upper(),
+                    'bic': row.BIC,
+                    'mandate_signature_date': msdate,
+                    'mandate_signature_date_iso': row.MandateSignatureDate,
+                    'mandate_reference': row.MandateReference,
+                    'currency': row.Currency,
+                    'amount': row.Amount,
+                    'description': row.Description,
+                    'execution_date': execution_date,
+                    'bank_name': row.BankName or '',
+                    'bank_location': row.BankLocation or '',
+                    'invoice_id': row.invoices_id,
+                    'location': location
+                }
+
+            if len(rows) < chunk_size:
+                break
+
+            last_id = rows.last().id
+
+
+    def export_csv(self, first=False, recurring=False, show_location=False, chunk_size=500):
+        """
+        Generator of CSV data for this batch, one string for each chunk of items
+        :param show_location: bool - add location column
+        :return: string
+        """
+        stream = io.StringIO()
+        writer = csv.writer(stream)
+
+        header = ['customers_id',
+                  'SubscriptionID',
+                  'Account holder',
+                  'Bank Location',
+                  'Currency',
+                  'Amount',
+                  'Account number',
+                  'BIC',
+                  'Mandate Signature Date',
+                  'Mandate Reference',
+                  'Description',
+                  'Execution Date']
+        if show_location:
+            header.append('Location')
+
+        writer.writerow(header)
+
+        for item in self.get_items(first=first, recurring=recurring, chunk_size=chunk_size):
+            row = [item['cuID'],
+                   item['csID'],
+                   item['account_holder'],
+                   item['bank_location'],
+                   item['currency'],
+                   item['amount'],
+                   item['account_number'],
+                   item['bic'],
+                   item['mandate_signature_date'],
+                   item['mandate_reference'],
+                   item['description'],
+                   item['execution_date']]
+            if show_location:
+                row.append(item['location'])
+
+            writer.writerow(row)
+
+            if item['line'] % chunk_size == 0:
+                yield stream.getvalue()
+                stream.seek(0)
+                stream.truncate(0)
+
+        yield stream.getvalue()
+
+
+    def _sepa_text(self, value, length):
+        """
+        :param value: string
+        :param length: int - max length of value
+        :return: value escaped for XML
+        """
+        return escape((value or '').strip()[:length])
+
+
+    def _sepa_amount(self, amount):
+        """
+        :param amount: decimal
+        :return: string - amount formatted for SEPA
+        """
+        return format(amount or 0, '.2f')
+
+
+    def _is_iban(self, value):
+        """
+        :param value: string
+        :return: Boolean - True when value is a valid IBAN
+        """
+        import validators
+
+        return bool(value) and bool(validators.iban(value))
+
+
+    def get_sepa_errors(self, first=False, recurring=False, chunk_size=500):
+        """
+        Check the creditor settings & batch items for data required in a SEPA
+        direct debit message
+        :param first: bool - only items for customers not in previous batches
+        :param recurring: bool - only items for customers in previous batches
+        :return: list of dicts {'line': int - 0 for the creditor settings,
+                                'cuID': db.auth_user.id or None,
+                                'account_holder': string,
+                                'errors': list of strings}
+        """
+        T = current.T
+        get_sys_property = current.globalenv['get_sys_property']
+
+        invalid = []
+
+        creditor_iban = (get_sys_property('DirectDebitCreditorIBAN') or '').replace(' ', '').upper()
+        errors = []
+        if not (get_sys_property('DirectDebitCreditorName') or '').strip():
+            errors.append(T('Creditor name is not set'))
+        if not self._is_iban(creditor_iban):
+            errors.append(T('Creditor IBAN is missing or invalid'))
+        if not (get_sys_property('DirectDebitCreditorID') or '').strip():
+            errors.append(T('Creditor ID is not set'))
+        if errors:
+            invalid.append({
+                'line': 0,
+                'cuID': None,
+                'account_holder': get_sys_property('DirectDebitCreditorName') or '',
+                'errors': errors
+            })
+
+        for item in self.get_items(first=first, recurring=recurring, chunk_size=chunk_size):
+            errors = []
+            if not (item['account_holder'] or '').strip():
+                errors.append(T('Account holder is missing'))
+            if not self._is_iban(item['account_number'].replace(' ', '')):
+                errors.append(T('IBAN is missing or invalid'))
+            if not (item['mandate_reference'] or '').strip():
+                errors.append(T('Mandate reference is missing'))
+            if not item['mandate_signature_date_iso']:
+                errors.append(T('Mandate signature date is missing'))
+            if not item['amount'] or item['amount'] <= 0:
+                errors.append(T('Amount has to be greater than 0'))
+
+            if errors:
+                invalid.append({
+                    'line': item['line'],
+                    'cuID': item['cuID'],
+                    'account_holder': item['account_holder'] or '',
+                    'errors': errors
+                })
+
+        return invalid
+
+
+    def _export_sepa_payment_information(self, sequence_type, first, recurring, recurring_ids, totals, chunk_size):
+        """
+        Generator of a PmtInf block for a SEPA direct debit message.
+        Check the batch with get_sepa_errors() first, items are exported as is.
+        :param sequence_type: string - 'FRST' or 'RCUR'
+        :param totals: dict returned by get_items_totals()
+        :return: string
+        """
+        get_sys_property = current.globalenv['get_sys_property']
+
+        creditor_name = get_sys_property('DirectDebitCreditorName')
+        creditor_iban = (get_sys_property('DirectDebitCreditorIBAN') or '').replace(' ', '').upper()
+        creditor_bic = (get_sys_property('DirectDebitCreditorBIC') or '').replace(' ', '').upper()
+        creditor_id = get_sys_property('DirectDebitCreditorID')
+
+        if creditor_bic:
+            creditor_agent = '<BIC>' + self._sepa_text(creditor_bic, 11) + '</BIC>'
+        else:
+            creditor_agent = '<Othr><Id>NOTPROVIDED</Id></Othr>'
+
+        yield """<PmtInf>
+<PmtInfId>{pmt_inf_id}</PmtInfId>
+<PmtMtd>DD</PmtMtd>
+<BtchBookg>true</BtchBookg>
+<NbOfTxs>{count}</NbOfTxs>
+<CtrlSum>{amount}</CtrlSum>
+<PmtTpInf><SvcLvl><Cd>SEPA</Cd></SvcLvl><LclInstrm><Cd>CORE</Cd></LclInstrm><SeqTp>{sequence_type}</SeqTp></PmtTpInf>
+<ReqdColltnDt>{collection_date}</ReqdColltnDt>
+<Cdtr><Nm>{creditor_name}</Nm></Cdtr>
+<CdtrAcct><Id><IBAN>{creditor_iban}</IBAN></Id></CdtrAcct>
+<CdtrAgt><FinInstnId>{creditor_agent}</FinInstnId></CdtrAgt>
+<ChrgBr>SLEV</ChrgBr>
+<CdtrSchmeId><Id><PrvtId><Othr><Id>{creditor_id}</Id><SchmeNm><Prtry>SEPA</Prtry></SchmeNm></Othr></PrvtId></Id></CdtrSchmeId>
+""".format(
+            pmt_inf_id=self._sepa_text('BATCH-' + str(self.id) + '-' + sequence_type, 35),
+            count=totals['count'],
+            amount=self._sepa_amount(totals['amount']),
+            sequence_type=sequence_type,
+            collection_date=self.row.Exdate.isoformat(),
+            creditor_name=self._sepa_text(creditor_name, 70),
+            creditor_iban=self._sepa_text(creditor_iban, 34),
+            creditor_agent=creditor_agent,
+            creditor_id=self._sepa_text(creditor_id, 35)
+        )
+
+        transactions = []
+        for item in self.get_items(first=first,
+                                   recurring=recurring,
+                                   recurring_ids=recurring_ids,
+                                   chunk_size=chunk_size):
+            if item['bic']:
+                debtor_agent = '<BIC>' + self._sepa_text(item['bic'].replace(' ', '').upper(), 11) + '</BIC>'
+            else:
+                debtor_agent = '<Othr><Id>NOTPROVIDED</Id></Othr>'
+
+            transactions.append("""<DrctDbtTxInf>
+<PmtId><EndToEndId>{end_to_end_id}</EndToEndId></PmtId>
+<InstdAmt Ccy="{currency}">{amount}</InstdAmt>
+<DrctDbtTx><MndtRltdInf><MndtId>{mandate_reference}</MndtId><DtOfSgntr>{signature_date}</DtOfSgntr></MndtRltdInf></DrctDbtTx>
+<DbtrAgt><FinInstnId>{debtor_agent}</FinInstnId></DbtrAgt>
+<Dbtr><Nm>{account_holder}</Nm></Dbtr>
+<DbtrAcct><Id><IBAN>{account_number}</IBAN></Id></DbtrAcct>
+<RmtInf><Ustrd>{description}</Ustrd></RmtInf>
+</DrctDbtTxInf>
+""".format(
+                end_to_end_id=self._sepa_text(str(self.id) + '-' + str(item['id']), 35),
+                currency=self._sepa_text(item['currency'], 3),
+                amount=self._sepa_amount(item['amount']),
+                mandate_reference=self._sepa_text(item['mandate_reference'], 35),
+                signature_date=item['mandate_signature_date_iso'].isoformat(),
+                debtor_agent=debtor_agent,
+                account_holder=self._sepa_text(item['account_holder'], 70),
+                account_number=self._sepa_text(item['account_number'].replace(' ', ''), 34),
+                description=self._sepa_text(item['description'], 140)
+            ))
+
+            if len(transactions) == chunk_size:
+                yield ''.join(transactions)
+                transactions = []
+
+        yield ''.join(transactions) + '</PmtInf>\n'
+
+
+    def export_sepa(self, first=False, recurring=False, chunk_size=500):
+        """
+        Generator of a SEPA direct debit message (pain.008.001.02) for this batch.
+        When neither first or recurring are set, items for first and recurring
+        customers are exported in separate payment information blocks.
+        Only export batches for which get_sepa_errors() returns no errors.
+        :return: string
+        """
+        get_sys_property = current.globalenv['get_sys_property']
+
+        recurring_ids = self.get_recurring_customer_ids()
+
+        sequences = []
+        if first or not recurring:
+            sequences.append(['FRST', True, False])
+        if recurring or not first:
+            sequences.append(['RCUR', False, True])
+
+        count = 0
+        amount = 0
+        for sequence in sequences:
+            totals = self.get_items_totals(sequence[1], sequence[2], recurring_ids)
+            sequence.append(totals)
+            count += totals['count']
+            amount += totals['amount']
+
+        now = datetime.datetime.now()
+
+        yield """<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:pain.008.001.02" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<CstmrDrctDbtInitn>
+<GrpHdr>
+<MsgId>{message_id}</MsgId>
+<CreDtTm>{created}</CreDtTm>
+<NbOfTxs>{count}</NbOfTxs>
+<CtrlSum>{amount}</CtrlSum>
+<InitgPty><Nm>{creditor_name}</Nm></InitgPty>
+</GrpHdr>
+""".format(
+            message_id=self._sepa_text('BATCH-' + str(self.id) + '-' + now.strftime('%Y%m%d%H%M%S'), 35),
+            created=now.strftime('%Y-%m-%dT%H:%M:%S'),
+            count=count,
+            amount=self._sepa_amount(amount),
+            creditor_name=self._sepa_text(get_sys_property('DirectDebitCreditorName'), 70)
+        )
+
+        for sequence_type, seq_first, seq_recurring, totals in sequences:
+            if not totals['count']:
+                continue
+
+            for data in self._export_sepa_payment_information(sequence_type,
+                                                              seq_first,
+                                                              seq_recurring,
+                                                              recurring_ids,
+                                                              totals,
+                                                              chunk_size):
+                yield data
+
+        yield "</CstmrDrctDbtInitn>\n</Document>\n"
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from gluon import *
+
+
+def _write_pdf(html):
+    """
+    Render html as PDF; runs in a worker process of the pool
+    :param html: string
+    :return: bytes - PDF file
+    """
+    import weasyprint
+
+    return weasyprint.HTML(string=html).write_pdf()
+
+
+class OsPdf:
+    """
+        Renders PDF files using WeasyPrint in a pool of processes, so rendering
+        doesn't hold the GIL in web workers and multiple files can be rendered
+        at the same time.
+
+        Worker processes are started using the forkserver (or spawn) method,
+        so they don't inherit the database connections and other state of the
+        web worker creating the pool.
+
+        Rendered files can be stored in a cache folder under a key, usually a hash
+        of the content used to render the file. A name (eg. "invoice_1") groups
+        versions of the same document, only the latest version is kept.
+    """
+    # Shared by all requests in a process
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    max_workers = max(1, (os.cpu_count() or 2) - 1)
+    timeout = 120 # seconds
+
+
+    def _get_mp_context(self):
+        """
+        :return: multiprocessing context starting clean processes
+        """
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('forkserver')
+
+        return multiprocessing.get_context('spawn')
+
+
+    def _get_executor(self):
+        """
+        :return: ProcessPoolExecutor
+        """
+        with self._executor_lock:
+            if OsPdf._executor is None:
+                OsPdf._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                      mp_context=self._get_mp_context())
+
+        return OsPdf._executor
+
+
+    def render(self, html):
+        """
+        :param html: string
+        :return: bytes - PDF file
+        """
+        future = self._get_executor().submit(_write_pdf, html)
+
+        return future.result(timeout=self.timeout)
+
+
+    def render_many(self, htmls):
+        """
+        :param htmls: list of strings
+        :return: list of bytes - PDF files, in the same order as htmls
+        """
+        return list(self._get_executor().map(_write_pdf, htmls, timeout=self.timeout))
+
+
+    def _get_cache_folder(self):
+        """
+        :return: string - path of folder to store rendered PDF files
+        """
+        request = current.request
+
+        folder = os.path.join(request.folder, 'uploads', 'pdf_cache')
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        return folder
+
+
+    def _get_cache_path(self, name, key):
+        """
+        :param name: string - name of document
+        :param key: string - hash of document content
+        :return: string - path of cached file
+        """
+        return os.path.join(self._get_cache_folder(), name + '_' + key + '.pdf')
+
+
+    def get_cached(self, name, key):
+        """
+        :param name: string - name of document
+        :param key: string - hash of document content
+        :return: bytes - PDF file or None when not found in cache
+        """
+        try:
+            with open(self._get_cache_path(name, key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+
+    def store(self, name, key, pdf):
+        """
+        Store a PDF file in cache and remove previous versions of the document
+        :param name: string - name of document
+        :param key: string - hash of document content
+        :param pdf: bytes - PDF file
+        :return: None
+        """
+        path = self._get_cache_path(name, key)
+
+        # Write to a temporary file first, so a partial file is never served
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf)
+        os.replace(tmp_path, path)
+
+        for old_path in glob.glob(os.path.join(self._get_cache_folder(), name + '_*.pdf')):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+
+    def get_pdf(self, name, key, get_html):
+        """
+        :param name: string - name of document
+        :param key: string - hash of document content
+        :param get_html: function returning html for the document, called when not cached
+        :return: bytes - PDF file
+        """
+        pdf = self.get_cached(name, key)
+        if pdf is None:
+            pdf = self.render(get_html())
+            self.store(name, key, pdf)
+
+        return pdf
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+from gluon import *
+
+
+class OsPermissions:
+    """
+        Replaces auth.has_membership and auth.has_permission for the logged in
+        user with lookups in a compiled set of groups & permissions, so checks
+        don't query the auth tables.
+
+        The set is cached for each user under the 'permissions' tag, which is
+        cleared by callbacks on auth_group, auth_membership and auth_permission.
+        Clearing a tag in cache.ram only applies to the process making the
+        change, so without redis the set is only kept for the current request.
+        Otherwise revoked permissions would stay active on other workers.
+        Checks for other users or groups use the original auth methods.
+    """
+    def __init__(self, auth):
+        """
+        :param auth: gluon.tools.Auth
+        """
+        self.auth = auth
+        self._auth_has_membership = auth.has_membership
+        self._auth_has_permission = auth.has_permission
+
+        # Compiled sets for users, used during this request
+        self._compiled = {}
+
+
+    def install(self):
+        """
+        Use compiled permissions for auth.has_membership and auth.has_permission
+        :return: None
+        """
+        self.auth.has_membership = self.has_membership
+        self.auth.has_permission = self.has_permission
+
+
+    def _compile(self, user_id):
+        """
+        :param user_id: db.auth_user.id
+        :return: dict {'groups': set of group ids,
+                       'roles': set of role names,
+                       'permissions': set of tuples (name, table_name, record_id)}
+        """
+        db = current.db
+
+        auth = self.auth
+        membership = auth.table_membership()
+        group = auth.table_group()
+        permission = auth.table_permission()
+
+        left = [group.on(membership.group_id == group.id)]
+        rows = db(membership.user_id == user_id).select(membership.group_id,
+                                                        group.role,
+                                                        left=left)
+
+        groups = set([row[membership._tablename].group_id for row in rows])
+        roles = set([row[group._tablename].role for row in rows if row[group._tablename].role])
+
+        permission_groups = set(groups)
+        if auth.settings.everybody_group_id:
+            permission_groups.add(auth.settings.everybody_group_id)
+
+        permissions = set()
+        if permission_groups:
+            rows = db(permission.group_id.belongs(permission_groups)).select(permission.name,
+                                                                            permission.table_name,
+                                                                            permission.record_id)
+            permissions = set([(row.name, row.table_name, row.record_id or 0) for row in rows])
+
+        return {
+            'groups': groups,
+            'roles': roles,
+            'permissions': permissions
+        }
+
+
+    def get_compiled(self, user_id):
+        """
+        :param user_id: db.auth_user.id
+        :return: dict returned by _compile(), from cache when available
+        """
+        request = current.request
+        os_cache_manager = current.globalenv['os_cache_manager']
+        web2pytest = current.globalenv['web2pytest']
+        CACHE_LONG = current.globalenv['CACHE_LONG']
+
+        user_id = int(user_id)
+        if user_id in self._compiled:
+            return self._compiled[user_id]
+
+        # Don't cache between requests when running tests, permissions are
+        # changed by the tests without callbacks in this process.
+        # Don't cache between requests when the cache isn't shared by workers.
+        if web2pytest.is_running_under_test(request, request.application) or \
+           not os_cache_manager.is_shared():
+            self._compiled[user_id] = self._compile(user_id)
+        else:
+            self._compiled[user_id] = os_cache_manager.get_tagged(
+                'openstudio_permissions_user_' + str(user_id),
+                lambda: self._compile(user_id),
+                ['permissions'],
+                time_expire=CACHE_LONG
+            )
+
+        return self._compiled[user_id]
+
+
+    def _get_current_user_id(self, user_id):
+        """
+        :param user_id: user_id passed to a check
+        :return: id of logged in user when the check is for this user, otherwise None
+        """
+        auth = self.auth
+
+        if not auth.user:
+            return None
+
+        if user_id is None or int(user_id) == auth.user.id:
+            return auth.user.id
+
+        return None
+
+
+    def has_membership(self, group_id=None, user_id=None, role=None, cached=False):
+        """
+        Same as auth.has_membership, without queries for the logged in user
+        """
+        uid = self._get_current_user_id(user_id)
+        if uid is None:
+            return self._auth_has_membership(group_id=group_id,
+                                             user_id=user_id,
+                                             role=role,
+                                             cached=cached)
+
+        compiled = self.get_compiled(uid)
+
+        group = group_id or role
+        try:
+            return int(group) in compiled['groups']
+        except (TypeError, ValueError):
+            # group_id is a role name
+            return group in compiled['roles']
+
+
+    def has_permission(self, name='any', table_name='', record_id=0, user_id=None, group_id=None):
+        """
+        Same as auth.has_permission, without queries for the logged in user
+        """
+        uid = self._get_current_user_id(user_id)
+        if uid is None or group_id:
+            return self._auth_has_permission(name=name,
+                                             table_name=table_name,
+                                             record_id=record_id,
+                                             user_id=user_id,
+                                             group_id=group_id)
+
+        permissions = self.get_compiled(uid)['permissions']
+
+        record_id = record_id or 0
+        if (name, str(table_name), record_id) in permissions:
+            return True
+
+        # Permissions for a table (record_id 0) apply to all records
+        return bool(record_id) and (name, str(table_name), 0) in permissions
+
+
+    def clear(self):
+        """
+        Clear compiled permissions for all users
+        :return: None
+        """
+        os_cache_manager = current.globalenv['os_cache_manager']
+
+        self._compiled = {}
+        os_cache_manager.clear_permissions()
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for auth tables
+        """
+        self.clear()
+
+
+    def after_update(self, dbset, fields):
+        """
+        _after_update callback for auth tables
+        """
+        self.clear()
+
+
+    def after_delete(self, dbset):
+        """
+        _after_delete callback for auth tables
+        """
+        self.clear()
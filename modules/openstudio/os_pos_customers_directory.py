@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from gluon import *
+
+
+class PosCustomersDirectory:
+    """
+        Maintains db.pos_customers_directory, the list of customers used by the PoS.
+
+        Each customer has one row in the directory. Each change to a customer
+        updates its row and sets the Version of the row to the next version of
+        the directory, so the changes since a version are the rows with a
+        higher Version. Customers that are trashed, deleted or no longer a
+        customer are kept as a row with Deleted set, so clients fetching changes
+        know to remove them.
+
+        The directory is updated by callbacks on db.auth_user, in the same
+        transaction as the change to the customer.
+
+        Versions are taken from a sequence, the ids of
+        db.pos_customers_directory_version, so changes to different customers
+        don't wait for each other. Changes might be committed out of order, so
+        get_version() only returns versions allocated at least settle_seconds
+        ago. All changes up to that version are committed, so clients can't
+        miss changes committed with a lower version after fetching a higher one.
+    """
+    # Changes to these fields in auth_user affect the directory
+    directory_fields = [
+        'customer',
+        'trashed',
+        'first_name',
+        'last_name',
+        'display_name',
+        'email',
+        'date_of_birth',
+        'mobile',
+        'thumbsmall',
+        'thumblarge',
+        'barcode_id',
+    ]
+
+    # Versions allocated less than this number of seconds ago might belong to
+    # transactions that aren't committed yet
+    settle_seconds = 60
+
+    # Remove versions no longer needed each time this number of versions is allocated
+    prune_interval = 1000
+
+
+    def __init__(self):
+        # Ids selected in _before_update & _before_delete callbacks
+        self._ids_before = []
+
+
+    def _get_changed_fields(self, fields):
+        """
+        :param fields: fields passed to a DAL callback
+        :return: list of changed directory fields
+        """
+        return [f for f in self.directory_fields if f in fields]
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for db.auth_user
+        """
+        self.refresh([id])
+
+
+    def before_update(self, dbset, fields):
+        """
+        _before_update callback for db.auth_user
+        """
+        db = current.db
+
+        ids = None
+        if self._get_changed_fields(fields):
+            ids = [row.id for row in dbset.select(db.auth_user.id)]
+
+        self._ids_before.append(ids)
+
+        # Returning True would cancel the update
+        return False
+
+
+    def after_update(self, dbset, fields):
+        """
+        _after_update callback for db.auth_user
+        """
+        ids = self._ids_before.pop() if self._ids_before else None
+        if ids:
+            self.refresh(ids)
+
+
+    def before_delete(self, dbset):
+        """
+        _before_delete callback for db.auth_user
+        """
+        db = current.db
+
+        self._ids_before.append([row.id for row in dbset.select(db.auth_user.id)])
+
+        # Returning True would cancel the delete
+        return False
+
+
+    def after_delete(self, dbset):
+        """
+        _after_delete callback for db.auth_user
+        """
+        ids = self._ids_before.pop() if self._ids_before else None
+        if ids:
+            self.refresh(ids)
+
+
+    def _get_directory_values(self, row):
+        """
+        :param row: gluon.dal.row of db.auth_user
+        :return: dict - values for db.pos_customers_directory
+        """
+        display_name = row.display_name or ''
+
+        return dict(
+            auth_user_id=row.id,
+            Deleted=False,
+            first_name=row.first_name,
+            last_name=row.last_name,
+            display_name=row.display_name,
+            search_name=display_name.lower(),
+            email=(row.email or '').lower(),
+            date_of_birth=row.date_of_birth,
+            mobile=row.mobile,
+            thumbsmall=row.thumbsmall,
+            thumblarge=row.thumblarge,
+            barcode_id=row.barcode_id
+        )
+
+
+    def _select_customers(self, query):
+        """
+        :param query: query on db.auth_user
+        :return: rows of db.auth_user with fields in the directory
+        """
+        db = current.db
+
+        return db(query).select(db.auth_user.id,
+                                db.auth_user.customer,
+                                db.auth_user.trashed,
+                                db.auth_user.first_name,
+                                db.auth_user.last_name,
+                                db.auth_user.display_name,
+                                db.auth_user.email,
+                                db.auth_user.date_of_birth,
+                                db.auth_user.mobile,
+                                db.auth_user.thumbsmall,
+                                db.auth_user.thumblarge,
+                                db.auth_user.barcode_id)
+
+
+    def _get_deleted_values(self, cuID):
+        """
+        :param cuID: db.auth_user.id
+        :return: dict - values for db.pos_customers_directory of a removed customer
+        """
+        return dict(
+            auth_user_id=cuID,
+            Deleted=True,
+            first_name=None,
+            last_name=None,
+            display_name=None,
+            search_name=None,
+            email=None,
+            date_of_birth=None,
+            mobile=None,
+            thumbsmall=None,
+            thumblarge=None,
+            barcode_id=None
+        )
+
+
+    def _next_version(self):
+        """
+        Allocate the next version of the directory
+        :return: int - new version
+        """
+        db = current.db
+
+        version = db.pos_customers_directory_version.insert(
+            CreatedOn=datetime.datetime.now()
+        )
+
+        if version % self.prune_interval == 0:
+            self._prune_versions()
+
+        return version
+
+
+    def _prune_versions(self):
+        """
+        Remove versions below the current version of the directory, only the
+        last one allocated and the ones that might not be committed are needed
+        :return: None
+        """
+        db = current.db
+
+        db(db.pos_customers_directory_version.id < self.get_version()).delete()
+
+
+    def refresh(self, ids):
+        """
+        Update rows in the directory for the given customers
+        :param ids: list of db.auth_user.id
+        :return: None
+        """
+        db = current.db
+
+        ids = [int(cuID) for cuID in ids]
+
+        version = self._next_version()
+
+        rows = self._select_customers(db.auth_user.id.belongs(ids))
+        customers = {row.id: row for row in rows}
+
+        for cuID in ids:
+            row = customers.get(cuID)
+            if row and row.customer and not row.trashed:
+                values = self._get_directory_values(row)
+            else:
+                # Let clients know this customer should be removed
+                values = self._get_deleted_values(cuID)
+            values['Version'] = version
+
+            query = (db.pos_customers_directory.auth_user_id == cuID)
+            if not db(query).update(**values):
+                db.pos_customers_directory.insert(**values)
+
+
+    def rebuild(self):
+        """
+        Rebuild the directory from db.auth_user. Customers removed from the
+        directory are kept as deleted, so clients fetching changes since a
+        version before the rebuild remove them.
+        :return: int - number of customers in directory
+        """
+        db = current.db
+        pcd = db.pos_customers_directory
+
+        version = self._next_version()
+
+        query = (db.auth_user.customer == True) & \
+                (db.auth_user.trashed == False)
+        rows = self._select_customers(query)
+        ids = set([row.id for row in rows])
+
+        # Mark customers that are no longer listed as deleted
+        listed = db(pcd.Deleted == False).select(pcd.auth_user_id)
+        removed = [row.auth_user_id for row in listed if not row.auth_user_id in ids]
+        for i in range(0, len(removed), 1000):
+            values = self._get_deleted_values(None)
+            del values['auth_user_id']
+            values['Version'] = version
+            db(pcd.auth_user_id.belongs(removed[i:i + 1000])).update(**values)
+
+        # Replace rows of listed customers
+        deleted = db(pcd.Deleted == True).select(pcd.auth_user_id)
+        relisted = [row.auth_user_id for row in deleted if row.auth_user_id in ids]
+        for i in range(0, len(relisted), 1000):
+            db(pcd.auth_user_id.belongs(relisted[i:i + 1000])).delete()
+        db(pcd.Deleted == False).delete()
+
+        data = []
+        for row in rows:
+            values = self._get_directory_values(row)
+            values['Version'] = version
+            data.append(values)
+
+        pcd.bulk_insert(data)
+
+        return len(rows)
+
+
+    def get_version(self):
+        """
+        :return: int - version of the directory; all changes up to this version
+                 are committed
+        """
+        db = current.db
+        table = db.pos_customers_directory_version
+
+        settled = datetime.datetime.now() - datetime.timedelta(seconds=self.settle_seconds)
+        version = table.id.max()
+        row = db(table.CreatedOn <= settled).select(version).first()
+
+        return row[version] or 0
+
+
+    def _get_last_version(self):
+        """
+        :return: int - last version allocated
+        """
+        db = current.db
+        table = db.pos_customers_directory_version
+
+        version = table.id.max()
+        row = db(table).select(version).first()
+
+        return row[version] or 0
+
+
+    def get_changes(self, since=0):
+        """
+        :param since: int - version returned by a previous call, 0 for all customers
+        :return: dict {'version': int, 'reload': bool, 'customers': [rows], 'deleted': [auth_user_ids]}
+                 reload is True when since isn't a version of this directory (eg. after
+                 restoring a backup); customers then holds all customers and clients
+                 should drop the customers they have
+        """
+        db = current.db
+
+        since = int(since or 0)
+        version = self.get_version()
+
+        reload = since > self._get_last_version()
+        if reload:
+            since = 0
+
+        # Changes with a version above the returned version are returned again
+        # by the next call, as changes with a lower version might still be committed
+        query = (db.pos_customers_directory.Version > since)
+        if not since:
+            query &= (db.pos_customers_directory.Deleted == False)
+
+        rows = db(query).select(db.pos_customers_directory.ALL,
+                                orderby=db.pos_customers_directory.Version)
+
+        return {
+            'version': max(version, since),
+            'reload': reload,
+            'customers': [row for row in rows if not row.Deleted],
+            'deleted': [row.auth_user_id for row in rows if row.Deleted]
+        }
+
+
+    def search(self, search_value, limit=20):
+        """
+        Prefix search on search name, email and barcode id
+        :param search_value: string
+        :param limit: int - max number of customers returned
+        :return: rows of db.pos_customers_directory
+        """
+        db = current.db
+
+        search_value = (search_value or '').strip().lower()
+        if not search_value:
+            return []
+
+        query = (db.pos_customers_directory.Deleted == False) & \
+                ((db.pos_customers_directory.search_name.startswith(search_value)) |
+                 (db.pos_customers_directory.email.startswith(search_value)) |
+                 (db.pos_customers_directory.barcode_id.startswith(search_value)))
+
+        return db(query).select(db.pos_customers_directory.ALL,
+                                orderby=db.pos_customers_directory.search_name,
+                                limitby=(0, limit))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import random
+import logging
+import threading
+
+from gluon import *
+
+
+class OsQueryProfiler:
+    """
+        Records the queries executed by the DAL during a request.
+
+        Profiling is opt-in: a request is profiled when it's part of the sample
+        (sample_rate) or when profiling is enabled in the session of the user.
+        For requests that aren't profiled, the only cost is a random number.
+
+        At the end of a profiled request the number of queries, the total time,
+        the slowest statements with the places they're called from and
+        duplicate queries are written to logs/queries.log and kept in cache for
+        the query profiles page in sysadmin settings.
+    """
+    cache_key = 'openstudio_query_profiles'
+    # Number of profiles kept in cache
+    profiles_max = 50
+    # Number of statements in a profile
+    statements_max = 10
+
+    _logger = None
+    _logger_lock = threading.Lock()
+
+    _re_strings = re.compile(r"'(?:[^']|'')*'")
+    _re_numbers = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+    def __init__(self, db, sample_rate=0, slow_query_ms=500):
+        """
+        :param db: gluon.dal.DAL
+        :param sample_rate: float - fraction of requests to profile (0 - 1)
+        :param slow_query_ms: int - log queries taking longer than this
+        """
+        self.db = db
+        self.sample_rate = float(sample_rate or 0)
+        self.slow_query_ms = int(slow_query_ms or 500)
+
+        self.queries = []
+        self.started = None
+        self.enabled = False
+
+
+    def install(self, force=False):
+        """
+        Start profiling when this request is sampled
+        :param force: Boolean - always profile this request
+        :return: Boolean - True when this request is profiled
+        """
+        response = current.response
+
+        if not force and not random.random() < self.sample_rate:
+            return False
+
+        adapter = self.db._adapter
+        execute = adapter.execute
+
+        def execute_profiled(*args, **kwargs):
+            if not self.enabled:
+                return execute(*args, **kwargs)
+
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.record(args[0] if args else kwargs.get('command', ''),
+                            time.time() - start)
+
+        adapter.execute = execute_profiled
+
+        # Called by web2py at the end of the request, instead of commit
+        def custom_commit(instance):
+            self.finish()
+            instance.commit()
+
+        response.custom_commit = custom_commit
+
+        self.started = time.time()
+        self.enabled = True
+
+        return True
+
+
+    def _get_call_site(self):
+        """
+        :return: string - first controller, model or module of this app in the stack
+        """
+        request = current.request
+
+        folder = os.path.normpath(request.folder)
+        frame = sys._getframe(3)
+        while frame:
+            filename = os.path.normpath(frame.f_code.co_filename)
+            if filename.startswith(folder) and not filename == os.path.normpath(__file__):
+                return '%s:%s %s' % (os.path.relpath(filename, folder),
+                                     frame.f_lineno,
+                                     frame.f_code.co_name)
+            frame = frame.f_back
+
+        return ''
+
+
+    def record(self, sql, seconds):
+        """
+        :param sql: string - executed statement
+        :param seconds: float - duration
+        :return: None
+        """
+        self.queries.append((str(sql), seconds, self._get_call_site()))
+
+
+    def normalize(self, sql):
+        """
+        :param sql: string - SQL statement
+        :return: string - statement with values replaced by ?
+        """
+        sql = self._re_strings.sub('?', sql)
+        return self._re_numbers.sub('?', sql)
+
+
+    def get_profile(self):
+        """
+        :return: dict - profile of the queries recorded during this request
+        """
+        import datetime
+
+        request = current.request
+
+        statements = {}
+        executed = {}
+        for sql, seconds, call_site in self.queries:
+            statement = statements.setdefault(self.normalize(sql), {
+                'count': 0,
+                'seconds': 0,
+                'call_sites': set()
+            })
+            statement['count'] += 1
+            statement['seconds'] += seconds
+            statement['call_sites'].add(call_site)
+
+            executed[sql] = executed.get(sql, 0) + 1
+
+        top = sorted(statements.items(),
+                     key=lambda item: item[1]['seconds'],
+                     reverse=True)[:self.statements_max]
+
+        duplicates = sorted([(sql, count) for sql, count in executed.items() if count > 1],
+                            key=lambda item: item[1],
+                            reverse=True)
+
+        return {
+            'url': request.env.path_info or '',
+            'time': datetime.datetime.now(),
+            'count': len(self.queries),
+            'ms_queries': round(sum([q[1] for q in self.queries]) * 1000, 1),
+            'ms_request': round((time.time() - (self.started or time.time())) * 1000, 1),
+            'duplicates': sum([count - 1 for sql, count in duplicates]),
+            'duplicates_top': duplicates[:self.statements_max],
+            'statements': [{
+                'sql': sql,
+                'count': statement['count'],
+                'ms': round(statement['seconds'] * 1000, 1),
+                'call_sites': sorted(statement['call_sites'])
+            } for sql, statement in top],
+        }
+
+
+    def _get_logger(self):
+        """
+        :return: logging.Logger - writes to logs/queries.log, rotated at 5MB
+        """
+        from logging.handlers import RotatingFileHandler
+
+        request = current.request
+
+        with self._logger_lock:
+            if OsQueryProfiler._logger is None:
+                folder = os.path.join(request.folder, 'logs')
+                if not os.path.isdir(folder):
+                    os.makedirs(folder, exist_ok=True)
+
+                handler = RotatingFileHandler(os.path.join(folder, 'queries.log'),
+                                              maxBytes=5 * 1024 * 1024,
+                                              backupCount=5)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+                logger = logging.getLogger('openstudio.queries')
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(handler)
+
+                OsQueryProfiler._logger = logger
+
+        return OsQueryProfiler._logger
+
+
+    def log(self, profile):
+        """
+        :param profile: dict returned by get_profile()
+        :return: None
+        """
+        logger = self._get_logger()
+
+        logger.info('%s queries=%s query_ms=%s request_ms=%s duplicates=%s',
+                    profile['url'],
+                    profile['count'],
+                    profile['ms_queries'],
+                    profile['ms_request'],
+                    profile['duplicates'])
+
+        for sql, seconds, call_site in self.queries:
+            ms = seconds * 1000
+            if ms >= self.slow_query_ms:
+                logger.warning('%s slow query %.1fms at %s: %s',
+                               profile['url'], ms, call_site, sql)
+
+        for sql, count in profile['duplicates_top']:
+            logger.info('%s duplicate query x%s: %s', profile['url'], count, sql)
+
+
+    def store(self, profile):
+        """
+        Keep profile in cache for the query profiles page
+        :param profile: dict returned by get_profile()
+        :return: None
+        """
+        cache = current.cache
+
+        profiles = self.get_profiles()
+        profiles.insert(0, profile)
+
+        cache.ram(self.cache_key,
+                  lambda: profiles[:self.profiles_max],
+                  time_expire=0)
+
+
+    def get_profiles(self):
+        """
+        :return: list of dicts - profiles kept in cache, newest first
+        """
+        cache = current.cache
+
+        return list(cache.ram(self.cache_key, lambda: [], time_expire=None))
+
+
+    def clear(self):
+        """
+        Remove profiles from cache
+        :return: None
+        """
+        cache = current.cache
+
+        cache.ram(self.cache_key, None)
+
+
+    def finish(self):
+        """
+        Log & store the profile of this request
+        :return: dict returned by get_profile() or None when not profiling
+        """
+        if not self.enabled:
+            return None
+
+        # Don't record queries executed while storing the profile
+        self.enabled = False
+        profile = self.get_profile()
+
+        try:
+            self.log(profile)
+            self.store(profile)
+        except Exception:
+            # Profiling should never break a request
+            pass
+
+        return profile
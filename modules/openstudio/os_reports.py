@@ -575,14 +575,17 @@ class Reports:
         :return: BytesIO object containing PDF file for summary export
         """
         import io
-        import weasyprint
+        import hashlib
+        from .os_pdf import OsPdf
 
         html = self._get_class_revenue_summary_pdf_template(clsID, date, quick_stats)
 
-        stream = io.BytesIO()
-        workshop = weasyprint.HTML(string=html).write_pdf(stream)
+        os_pdf = OsPdf()
+        pdf = os_pdf.get_pdf('class_revenue_' + str(clsID) + '_' + str(date),
+                             hashlib.sha256(html.encode('utf-8')).hexdigest(),
+                             lambda: html)
 
-        return stream
+        return io.BytesIO(pdf)
 
 
     def _get_class_revenue_summary_pdf_template(self, clsID, date, quick_stats=True):
@@ -735,6 +738,332 @@ class Reports:
                     revenue_vat=revenue_vat)
 
 
+    def _get_classes_revenue_attendance(self, date_from, date_until, class_ids=None):
+        """
+        Revenue for each attendance record in a period, using a fixed number of
+        queries for the whole period.
+
+        Subscriptions: invoice amount for the month / classes taken in that month
+        Drop-in & trial: invoice item linked to the attendance record
+        Class cards: invoice amount / classes on card (unlimited: classes taken on card)
+
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param class_ids: list of db.classes.id, None for all classes
+        :return: tuple (attendance rows, dict {db.classes_attendance.id: (in_vat, ex_vat, vat)})
+                 Attendance without revenue is left out of the dict.
+        """
+        from general_helpers import get_last_day_month
+
+        db = current.db
+
+        query = (db.classes_attendance.ClassDate >= date_from) & \
+                (db.classes_attendance.ClassDate <= date_until)
+        if class_ids is not None:
+            query &= (db.classes_attendance.classes_id.belongs(class_ids))
+
+        attendance = db(query).select(db.classes_attendance.id,
+                                      db.classes_attendance.classes_id,
+                                      db.classes_attendance.ClassDate,
+                                      db.classes_attendance.AttendanceType,
+                                      db.classes_attendance.customers_subscriptions_id,
+                                      db.classes_attendance.customers_classcards_id)
+
+        subscription_ids = set()
+        classcard_ids = set()
+        dropin_trial_ids = []
+        for row in attendance:
+            if row.AttendanceType is None and row.customers_subscriptions_id:
+                subscription_ids.add(row.customers_subscriptions_id)
+            elif row.AttendanceType in (1, 2):
+                dropin_trial_ids.append(row.id)
+            elif row.AttendanceType == 3 and row.customers_classcards_id:
+                classcard_ids.add(row.customers_classcards_id)
+
+        month_start = datetime.date(date_from.year, date_from.month, 1)
+        month_end = get_last_day_month(date_until)
+
+        subscriptions_classes_taken = self._get_classes_revenue_subscriptions_classes_taken(
+            subscription_ids, month_start, month_end
+        )
+        subscriptions_amounts = self._get_classes_revenue_subscriptions_amounts(
+            subscription_ids, month_start, month_end
+        )
+        dropin_trial_amounts = self._get_classes_revenue_dropin_trial_amounts(dropin_trial_ids)
+        classcards = self._get_classes_revenue_classcards(classcard_ids)
+
+        revenue = {}
+        for row in attendance:
+            result = None
+            if row.AttendanceType is None:
+                # Subscription
+                month = (row.customers_subscriptions_id, row.ClassDate.year, row.ClassDate.month)
+                amounts = subscriptions_amounts.get(month)
+                classes_taken = subscriptions_classes_taken.get(month)
+                if amounts and classes_taken:
+                    revenue_in_vat = amounts[0] / classes_taken
+                    revenue_ex_vat = amounts[1] / classes_taken
+                    result = (revenue_in_vat, revenue_ex_vat, revenue_in_vat - revenue_ex_vat)
+            elif row.AttendanceType in (1, 2):
+                # Trial & drop in
+                result = dropin_trial_amounts.get(row.id)
+            elif row.AttendanceType == 3:
+                # Class card
+                card = classcards.get(row.customers_classcards_id)
+                if card and card['amounts'] and card['classes']:
+                    revenue_in_vat = card['amounts'][0] / card['classes']
+                    revenue_ex_vat = card['amounts'][1] / card['classes']
+                    result = (revenue_in_vat, revenue_ex_vat, revenue_in_vat - revenue_ex_vat)
+
+            if result:
+                revenue[row.id] = result
+
+        return attendance, revenue
+
+
+    def get_classes_revenue_attendance(self, date_from, date_until, class_ids=None):
+        """
+        Revenue for each attendance record in a period, as counted by
+        get_classes_revenue()
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param class_ids: list of db.classes.id, None for all classes
+        :return: dict {db.classes_attendance.id: {'revenue_in_vat', 'revenue_ex_vat', 'revenue_vat'}}
+        """
+        from decimal import Decimal
+
+        attendance, results = self._get_classes_revenue_attendance(date_from, date_until, class_ids)
+
+        revenue = {}
+        for row in attendance:
+            result = results.get(row.id, (Decimal(0), Decimal(0), Decimal(0)))
+            revenue[row.id] = dict(revenue_in_vat=result[0],
+                                   revenue_ex_vat=result[1],
+                                   revenue_vat=result[2])
+
+        return revenue
+
+
+    def get_classes_revenue(self, date_from, date_until, class_ids=None):
+        """
+        Revenue for all classes in a period, the sum of the revenue of each
+        attendance record returned by get_classes_revenue_attendance()
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param class_ids: list of db.classes.id, None for all classes
+        :return: dict {(db.classes.id, datetime.date): {'revenue_in_vat', 'revenue_ex_vat', 'revenue_vat'}}
+        """
+        from decimal import Decimal
+
+        attendance, results = self._get_classes_revenue_attendance(date_from, date_until, class_ids)
+
+        revenue = {}
+        for row in attendance:
+            key = (row.classes_id, row.ClassDate)
+            if key not in revenue:
+                revenue[key] = dict(revenue_in_vat=Decimal(0),
+                                    revenue_ex_vat=Decimal(0),
+                                    revenue_vat=Decimal(0))
+
+            result = results.get(row.id)
+            if result:
+                revenue[key]['revenue_in_vat'] += result[0]
+                revenue[key]['revenue_ex_vat'] += result[1]
+                revenue[key]['revenue_vat'] += result[2]
+
+        return revenue
+
+
+    def _get_classes_revenue_subscriptions_classes_taken(self, subscription_ids, date_from, date_until):
+        """
+        :param subscription_ids: list of db.customers_subscriptions.id
+        :param date_from: datetime.date - first day of first month
+        :param date_until: datetime.date - last day of last month
+        :return: dict {(customers_subscriptions_id, year, month): classes taken}
+        """
+        db = current.db
+
+        if not subscription_ids:
+            return {}
+
+        count = db.classes_attendance.id.count()
+        query = (db.classes_attendance.customers_subscriptions_id.belongs(subscription_ids)) & \
+                (db.classes_attendance.ClassDate >= date_from) & \
+                (db.classes_attendance.ClassDate <= date_until)
+        rows = db(query).select(db.classes_attendance.customers_subscriptions_id,
+                                db.classes_attendance.ClassDate,
+                                count,
+                                groupby=db.classes_attendance.customers_subscriptions_id|
+                                        db.classes_attendance.ClassDate)
+
+        data = {}
+        for row in rows:
+            date = row.classes_attendance.ClassDate
+            key = (row.classes_attendance.customers_subscriptions_id, date.year, date.month)
+            data[key] = data.get(key, 0) + row[count]
+
+        return data
+
+
+    def _get_classes_revenue_subscriptions_amounts(self, subscription_ids, date_from, date_until):
+        """
+        :param subscription_ids: list of db.customers_subscriptions.id
+        :param date_from: datetime.date - first day of first month
+        :param date_until: datetime.date - last day of last month
+        :return: dict {(customers_subscriptions_id, year, month): (TotalPriceVAT, TotalPrice)}
+        """
+        db = current.db
+
+        if not subscription_ids:
+            return {}
+
+        left = [
+            db.invoices_items.on(
+                db.invoices_items_customers_subscriptions.invoices_items_id ==
+                db.invoices_items.id
+            ),
+            db.invoices.on(
+                db.invoices_items.invoices_id ==
+                db.invoices.id
+            ),
+            db.invoices_amounts.on(
+                db.invoices_amounts.invoices_id ==
+                db.invoices.id
+            ),
+        ]
+
+        query = (db.invoices_items_customers_subscriptions.customers_subscriptions_id.belongs(subscription_ids)) & \
+                (db.invoices.SubscriptionYear >= date_from.year) & \
+                (db.invoices.SubscriptionYear <= date_until.year)
+        rows = db(query).select(db.invoices_items_customers_subscriptions.customers_subscriptions_id,
+                                db.invoices.SubscriptionYear,
+                                db.invoices.SubscriptionMonth,
+                                db.invoices_amounts.TotalPriceVAT,
+                                db.invoices_amounts.TotalPrice,
+                                left=left,
+                                orderby=db.invoices.id)
+
+        data = {}
+        for row in rows:
+            key = (row.invoices_items_customers_subscriptions.customers_subscriptions_id,
+                   row.invoices.SubscriptionYear,
+                   row.invoices.SubscriptionMonth)
+            # Use the first invoice for a month
+            if key not in data:
+                data[key] = (row.invoices_amounts.TotalPriceVAT or 0,
+                             row.invoices_amounts.TotalPrice or 0)
+
+        return data
+
+
+    def _get_classes_revenue_dropin_trial_amounts(self, attendance_ids):
+        """
+        :param attendance_ids: list of db.classes_attendance.id
+        :return: dict {classes_attendance_id: (TotalPriceVAT, TotalPrice, VAT)}
+        """
+        db = current.db
+
+        if not attendance_ids:
+            return {}
+
+        left = [
+            db.invoices_items.on(
+                db.invoices_items_classes_attendance.invoices_items_id ==
+                db.invoices_items.id
+            )
+        ]
+
+        query = (db.invoices_items_classes_attendance.classes_attendance_id.belongs(attendance_ids))
+        rows = db(query).select(db.invoices_items_classes_attendance.classes_attendance_id,
+                                db.invoices_items.TotalPriceVAT,
+                                db.invoices_items.TotalPrice,
+                                db.invoices_items.VAT,
+                                left=left,
+                                orderby=db.invoices_items_classes_attendance.id)
+
+        data = {}
+        for row in rows:
+            clattID = row.invoices_items_classes_attendance.classes_attendance_id
+            # Use the first invoice item for an attendance record
+            if clattID not in data:
+                data[clattID] = (row.invoices_items.TotalPriceVAT or 0,
+                                 row.invoices_items.TotalPrice or 0,
+                                 row.invoices_items.VAT or 0)
+
+        return data
+
+
+    def _get_classes_revenue_classcards(self, classcard_ids):
+        """
+        :param classcard_ids: list of db.customers_classcards.id
+        :return: dict {customers_classcards_id: {'amounts': (TotalPriceVAT, TotalPrice) or None,
+                                                 'classes': number of classes to divide amounts by}}
+        """
+        db = current.db
+
+        if not classcard_ids:
+            return {}
+
+        left = [
+            db.school_classcards.on(
+                db.customers_classcards.school_classcards_id ==
+                db.school_classcards.id
+            )
+        ]
+
+        query = (db.customers_classcards.id.belongs(classcard_ids))
+        rows = db(query).select(db.customers_classcards.id,
+                                db.school_classcards.Classes,
+                                db.school_classcards.Unlimited,
+                                left=left)
+
+        data = {}
+        unlimited_ids = []
+        for row in rows:
+            ccdID = row.customers_classcards.id
+            data[ccdID] = {'amounts': None,
+                           'classes': row.school_classcards.Classes}
+            if row.school_classcards.Unlimited:
+                unlimited_ids.append(ccdID)
+
+        # Unlimited cards: divide by all classes taken on card
+        if unlimited_ids:
+            count = db.classes_attendance.id.count()
+            query = (db.classes_attendance.customers_classcards_id.belongs(unlimited_ids))
+            rows = db(query).select(db.classes_attendance.customers_classcards_id,
+                                    count,
+                                    groupby=db.classes_attendance.customers_classcards_id)
+            for row in rows:
+                data[row.classes_attendance.customers_classcards_id]['classes'] = row[count]
+
+        left = [
+            db.invoices_items.on(
+                db.invoices_items_customers_classcards.invoices_items_id ==
+                db.invoices_items.id
+            ),
+            db.invoices_amounts.on(
+                db.invoices_amounts.invoices_id ==
+                db.invoices_items.invoices_id
+            ),
+        ]
+
+        query = (db.invoices_items_customers_classcards.customers_classcards_id.belongs(classcard_ids))
+        rows = db(query).select(db.invoices_items_customers_classcards.customers_classcards_id,
+                                db.invoices_amounts.TotalPriceVAT,
+                                db.invoices_amounts.TotalPrice,
+                                left=left,
+                                orderby=db.invoices_items_customers_classcards.id)
+
+        for row in rows:
+            ccdID = row.invoices_items_customers_classcards.customers_classcards_id
+            # Use the first invoice for a card
+            if ccdID in data and data[ccdID]['amounts'] is None:
+                data[ccdID]['amounts'] = (row.invoices_amounts.TotalPriceVAT or 0,
+                                          row.invoices_amounts.TotalPrice or 0)
+
+        return data
+
+
     def classcards_sold_summary_rows(self, date_from, date_until):
         """
         List cards sold, grouped by card name
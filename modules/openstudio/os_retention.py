@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from gluon import *
+
+
+class OsRetention:
+    """
+        Cohort retention & drop off analytics.
+
+        A cohort is the group of customers who attended their first class in
+        a month. For each cohort, the number of customers attending again is
+        counted for each of the following months. Only attendance using a
+        subscription or class card is counted, like the retention rate report.
+
+        The customers attending in a month are selected with one grouped query
+        for a range of months. For counting, each month is turned into a
+        bitset with a bit for each customer, so the customers of a cohort
+        still active in a month are counted by intersecting two integers,
+        instead of building & intersecting sets of customer ids.
+
+        Attendance in months that have closed is cached for each month.
+        The customers new in a month depend on attendance in earlier months,
+        so callbacks on db.classes_attendance clear the cache of all closed
+        months from the month of the changed attendance onward. Deleting
+        customers cascades to their attendance without calling those
+        callbacks, so a callback on db.auth_user clears all months.
+    """
+    # Changes to these fields in classes_attendance affect the activity of a month
+    activity_fields = ['auth_customer_id', 'ClassDate', 'AttendanceType']
+
+
+    def _get_query(self):
+        """
+        :return: query for attendance counted for retention
+        """
+        db = current.db
+
+        return ((db.classes_attendance.AttendanceType == None) |
+                (db.classes_attendance.AttendanceType == 3))
+
+
+    def _get_month_key(self, date):
+        """
+        :param date: datetime.date or string 'YYYY-MM-DD'
+        :return: string 'YYYY-MM'
+        """
+        return str(date)[:7]
+
+
+    def _get_month_current(self):
+        """
+        :return: datetime.date - first day of the current month
+        """
+        TODAY_LOCAL = current.TODAY_LOCAL
+
+        return datetime.date(TODAY_LOCAL.year, TODAY_LOCAL.month, 1)
+
+
+    def _is_month_closed(self, date):
+        """
+        :param date: datetime.date or string 'YYYY-MM-DD'
+        :return: Boolean - True when the month is before the current month
+        """
+        return self._get_month_key(date) < self._get_month_key(self._get_month_current())
+
+
+    def get_months(self, date_from, date_until):
+        """
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :return: list of datetime.date - first day of each month in period
+        """
+        months = []
+        index = date_from.year * 12 + date_from.month - 1
+        index_until = date_until.year * 12 + date_until.month - 1
+        while index <= index_until:
+            months.append(datetime.date(index // 12, index % 12 + 1, 1))
+            index += 1
+
+        return months
+
+
+    def _select_months(self, date_from, date_until):
+        """
+        :param date_from: datetime.date - first day of a month
+        :param date_until: datetime.date - first day of a month
+        :return: dict {'YYYY-MM': {'active': [db.auth_user.id],
+                                   'new': [db.auth_user.id]}} for each month in period
+                 active: customers attending in a month
+                 new: customers attending their first class in a month
+        """
+        from general_helpers import get_last_day_month
+
+        db = current.db
+
+        last_day = get_last_day_month(date_until)
+
+        data = {}
+        for month in self.get_months(date_from, date_until):
+            data[self._get_month_key(month)] = {'active': [], 'new': []}
+
+        # Customers attending in each month
+        year = db.classes_attendance.ClassDate.year()
+        month = db.classes_attendance.ClassDate.month()
+        query = self._get_query() & \
+                (db.classes_attendance.ClassDate >= date_from) & \
+                (db.classes_attendance.ClassDate <= last_day)
+        rows = db(query).select(db.classes_attendance.auth_customer_id,
+                                year,
+                                month,
+                                groupby=db.classes_attendance.auth_customer_id|year|month)
+
+        for row in rows:
+            key = '%04d-%02d' % (int(row[year]), int(row[month]))
+            data[key]['active'].append(row.classes_attendance.auth_customer_id)
+
+        # Customers attending their first class in each month
+        first = db.classes_attendance.ClassDate.min()
+        rows = db(self._get_query()).select(db.classes_attendance.auth_customer_id,
+                                            first,
+                                            groupby=db.classes_attendance.auth_customer_id,
+                                            having=((first >= date_from) &
+                                                    (first <= last_day)))
+
+        for row in rows:
+            key = self._get_month_key(row[first])
+            data[key]['new'].append(row.classes_attendance.auth_customer_id)
+
+        return data
+
+
+    def get_months_data(self, date_from, date_until):
+        """
+        Customers attending in each month, from cache for months that have closed
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :return: dict returned by _select_months()
+        """
+        from .os_cache_manager import OsCacheManager
+
+        request = current.request
+        web2pytest = current.globalenv['web2pytest']
+        CACHE_LONG = current.globalenv['CACHE_LONG']
+
+        months = self.get_months(date_from, date_until)
+        closed = [m for m in months if self._is_month_closed(m)]
+        months_open = [m for m in months if not self._is_month_closed(m)]
+
+        data = {}
+        if months_open:
+            data.update(self._select_months(months_open[0], months_open[-1]))
+
+        if not closed:
+            return data
+
+        # Don't cache when running tests
+        if web2pytest.is_running_under_test(request, request.application):
+            data.update(self._select_months(closed[0], closed[-1]))
+            return data
+
+        ocm = OsCacheManager()
+
+        # Months missing in cache are selected at once, from the first missing
+        # month until the last month that has closed
+        selected = {}
+        def select_month(month):
+            key = self._get_month_key(month)
+            if not key in selected:
+                selected.update(self._select_months(month, closed[-1]))
+            return selected[key]
+
+        for month in closed:
+            key = self._get_month_key(month)
+            data[key] = ocm.get_tagged('openstudio_retention_month_' + key,
+                                       lambda month=month: select_month(month),
+                                       ['retention', 'retention_' + key],
+                                       time_expire=CACHE_LONG)
+
+        return data
+
+
+    def _get_bits(self, customer_ids, index):
+        """
+        :param customer_ids: list of db.auth_user.id
+        :param index: dict {db.auth_user.id: bit}
+        :return: int - with the bits of customer_ids set
+        """
+        data = bytearray((len(index) + 7) // 8)
+        for cuID in customer_ids:
+            bit = index[cuID]
+            data[bit >> 3] |= 1 << (bit & 7)
+
+        return int.from_bytes(bytes(data), 'little')
+
+
+    def _count_bits(self, bits):
+        """
+        :param bits: int
+        :return: int - number of bits set
+        """
+        return bin(bits).count('1')
+
+
+    def get_cohorts(self, date_from, date_until, horizon=12):
+        """
+        :param date_from: datetime.date - first cohort month
+        :param date_until: datetime.date - last cohort month
+        :param horizon: int - number of months to follow each cohort
+        :return: list of dicts, one for each cohort month:
+                 {'month': datetime.date - first day of month,
+                  'size': int - number of customers in cohort,
+                  'active': list of ints - customers attending in the cohort month
+                            and each of the next [horizon] months,
+                            None for months that haven't started yet,
+                  'retention': list of floats - active / size (0 - 1)}
+        """
+        from general_helpers import get_last_day_month
+
+        month_current = self._get_month_current()
+        cohort_months = self.get_months(date_from, min(date_until, get_last_day_month(month_current)))
+        if not cohort_months:
+            return []
+
+        # Months active, from the first cohort until the horizon of the last cohort
+        last = cohort_months[-1]
+        index_last = last.year * 12 + last.month - 1 + horizon
+        last = datetime.date(index_last // 12, index_last % 12 + 1, 1)
+        months = self.get_months(cohort_months[0], min(last, month_current))
+
+        data = self.get_months_data(months[0], months[-1])
+
+        # Bit for each customer
+        index = {}
+        for month in months:
+            for cuID in data[self._get_month_key(month)]['active']:
+                index.setdefault(cuID, len(index))
+
+        active_bits = [self._get_bits(data[self._get_month_key(m)]['active'], index)
+                       for m in months]
+
+        cohorts = []
+        for i, month in enumerate(cohort_months):
+            new = data[self._get_month_key(month)]['new']
+            new_bits = self._get_bits(new, index)
+            size = len(new)
+
+            active = []
+            retention = []
+            for offset in range(horizon + 1):
+                if i + offset < len(months):
+                    count = self._count_bits(new_bits & active_bits[i + offset])
+                    active.append(count)
+                    retention.append(float(count) / size if size else 0)
+                else:
+                    active.append(None)
+                    retention.append(None)
+
+            cohorts.append({
+                'month': month,
+                'size': size,
+                'active': active,
+                'retention': retention
+            })
+
+        return cohorts
+
+
+    def get_curve(self, cohorts):
+        """
+        Retention & drop off of all cohorts together, for each month after the
+        cohort month.
+        :param cohorts: list of dicts returned by get_cohorts()
+        :return: list of dicts {'size': int - customers in cohorts which reached this month,
+                                'active': int - customers still attending,
+                                'retention': float (0 - 1),
+                                'dropoff': float (0 - 1)}
+        """
+        if not cohorts:
+            return []
+
+        curve = []
+        for offset in range(len(cohorts[0]['active'])):
+            size = 0
+            active = 0
+            for cohort in cohorts:
+                if cohort['active'][offset] is None:
+                    continue
+                size += cohort['size']
+                active += cohort['active'][offset]
+
+            retention = float(active) / size if size else 0
+            curve.append({
+                'size': size,
+                'active': active,
+                'retention': retention,
+                'dropoff': 1 - retention if size else 0
+            })
+
+        return curve
+
+
+    def clear_months(self, dates):
+        """
+        Clear cache of months that have closed, from the first month of dates
+        until the last month that has closed
+        :param dates: list of datetime.date or strings 'YYYY-MM-DD'
+        :return: None
+        """
+        from .os_cache_manager import OsCacheManager
+
+        keys = [self._get_month_key(d) for d in dates if d and self._is_month_closed(d)]
+        if not keys:
+            return
+
+        first = min(keys)
+        month_current = self._get_month_current()
+        month_last = month_current - datetime.timedelta(days=1)
+        months = self.get_months(datetime.date(int(first[:4]), int(first[5:7]), 1), month_last)
+
+        OsCacheManager().clear_retention(months=[self._get_month_key(m) for m in months])
+
+
+    def after_insert(self, fields, id):
+        """
+        _after_insert callback for db.classes_attendance
+        """
+        try:
+            self.clear_months([fields['ClassDate']])
+        except KeyError:
+            pass
+
+
+    def before_update(self, dbset, fields):
+        """
+        _before_update callback for db.classes_attendance
+        """
+        db = current.db
+
+        changed = [f for f in self.activity_fields if f in fields]
+        if changed:
+            dates = [row.ClassDate for row in dbset.select(db.classes_attendance.ClassDate,
+                                                           distinct=True)]
+            if 'ClassDate' in fields:
+                dates.append(fields['ClassDate'])
+            self.clear_months(dates)
+
+        # Returning True would cancel the update
+        return False
+
+
+    def before_delete_customers(self, dbset):
+        """
+        _before_delete callback for db.auth_user
+        """
+        from .os_cache_manager import OsCacheManager
+
+        OsCacheManager().clear_retention()
+
+        # Returning True would cancel the delete
+        return False
+
+
+    def before_delete(self, dbset):
+        """
+        _before_delete callback for db.classes_attendance
+        """
+        db = current.db
+
+        self.clear_months([row.ClassDate for row in dbset.select(db.classes_attendance.ClassDate,
+                                                                 distinct=True)])
+
+        # Returning True would cancel the delete
+        return False
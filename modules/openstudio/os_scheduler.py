@@ -31,6 +31,36 @@ class OsScheduler:
             period=24*60*60, # once a day
             repeats=0, # Every day
         )
+        self._queue_mail_outbox_send()
+
+
+    def _queue_mail_outbox_send(self):
+        """
+            Queue sending mails from the outbox, every minute
+        """
+        scheduler = current.globalenv['scheduler']
+
+        scheduler.queue_task(
+            'mail_outbox_send',
+            timeout=600, # Run for max 10 minutes
+            period=60, # every minute
+            repeats=0, # Keep sending
+        )
+
+
+    def queue_missing_tasks(self):
+        """
+            Queue recurring tasks added in later versions, which aren't
+            queued yet for installations set up before.
+            Call during upgrades
+        """
+        db = current.db
+
+        query = (db.scheduler_task.task_name == 'mail_outbox_send') & \
+                (db.scheduler_task.status.belongs(['QUEUED', 'ASSIGNED', 'RUNNING']))
+        if not db(query).count():
+            self._queue_mail_outbox_send()
+
 
     def _remove_tasks(self):
         """
@@ -20,205 +20,69 @@ class OsSchedulerTasks:
         """
             Actually create invoices for subscriptions for a given month
         """
-        from .os_customer_subscription import CustomerSubscription
-        from general_helpers import get_last_day_month
-        from .os_invoice import Invoice
+        from .os_customers_subscriptions_invoices import CustomersSubscriptionsInvoices
 
         T = current.T
-        db = current.db
-        DATE_FORMAT = current.DATE_FORMAT
 
+        csi = CustomersSubscriptionsInvoices(year, month)
+        # Commits after each chunk of invoices, as required for scheduled tasks
+        invoices_count = csi.create_invoices(description, invoice_date)
 
-        year = int(year)
-        month = int(month)
+        return T("Invoices created") + ': ' + str(invoices_count)
 
-        firstdaythismonth = datetime.date(year, month, 1)
-        lastdaythismonth  = get_last_day_month(firstdaythismonth)
 
-        invoices_count = 0
+    def customers_subscriptions_collect_mollie_recurring_current_month(self):
+        """
+            Create subscription invoices for subscriptions with payment method 100 (Mollie)
+            and queue tasks to collect payments for them
+        """
+        from .os_customers_subscriptions_mollie_payments import CustomersSubscriptionsMolliePayments
 
-        # get all active subscriptions in month
-        query = (db.customers_subscriptions.Startdate <= lastdaythismonth) & \
-                ((db.customers_subscriptions.Enddate >= firstdaythismonth) |
-                 (db.customers_subscriptions.Enddate == None))
+        TODAY_LOCAL = current.TODAY_LOCAL
 
-        rows = db(query).select(db.customers_subscriptions.ALL)
-        for row in rows:
-            cs = CustomerSubscription(row.id)
-            cs.create_invoice_for_month(year, month, description, invoice_date)
+        csmp = CustomersSubscriptionsMolliePayments(TODAY_LOCAL.year, TODAY_LOCAL.month)
 
-            invoices_count += 1
+        return csmp.collect()
 
-        ##
-        # For scheduled tasks db connection has to be committed manually
-        ##
-        db.commit()
 
-        return T("Invoices in month") + ': ' + str(invoices_count)
-
-        # csap = db.customers_subscriptions_alt_prices
-        #
-        # fields = [
-        #     db.customers_subscriptions.id,
-        #     db.customers_subscriptions.auth_customer_id,
-        #     db.customers_subscriptions.school_subscriptions_id,
-        #     db.customers_subscriptions.Startdate,
-        #     db.customers_subscriptions.Enddate,
-        #     db.customers_subscriptions.payment_methods_id,
-        #     db.school_subscriptions.Name,
-        #     db.school_subscriptions_price.Price,
-        #     db.school_subscriptions_price.tax_rates_id,
-        #     db.tax_rates.Percentage,
-        #     db.customers_subscriptions_paused.id,
-        #     db.invoices_items.id,
-        #     csap.id,
-        #     csap.Amount,
-        #     csap.Description
-        # ]
-        #
-        # rows = db.executesql(
-        #     """
-        #         SELECT cs.id,
-        #                cs.auth_customer_id,
-        #                cs.school_subscriptions_id,
-        #                cs.Startdate,
-        #                cs.Enddate,
-        #                cs.payment_methods_id,
-        #                ssu.Name,
-        #                ssp.Price,
-        #                ssp.tax_rates_id,
-        #                tr.Percentage,
-        #                csp.id,
-        #                ii.invoices_items_id,
-        #                csap.id,
-        #                csap.Amount,
-        #                csap.Description
-        #         FROM customers_subscriptions cs
-        #         LEFT JOIN auth_user au
-        #          ON au.id = cs.auth_customer_id
-        #         LEFT JOIN school_subscriptions ssu
-        #          ON cs.school_subscriptions_id = ssu.id
-        #         LEFT JOIN
-        #          (SELECT id,
-        #                  school_subscriptions_id,
-        #                  Startdate,
-        #                  Enddate,
-        #                  Price,
-        #                  tax_rates_id
-        #           FROM school_subscriptions_price
-        #           WHERE Startdate <= '{firstdaythismonth}' AND
-        #                 (Enddate >= '{firstdaythismonth}' OR Enddate IS NULL)) ssp
-        #          ON ssp.school_subscriptions_id = ssu.id
-        #         LEFT JOIN tax_rates tr
-        #          ON ssp.tax_rates_id = tr.id
-        #         LEFT JOIN
-        #          (SELECT id,
-        #                  customers_subscriptions_id
-        #           FROM customers_subscriptions_paused
-        #           WHERE Startdate <= '{firstdaythismonth}' AND
-        #                 (Enddate >= '{firstdaythismonth}' OR Enddate IS NULL)) csp
-        #          ON cs.id = csp.customers_subscriptions_id
-        #         LEFT JOIN
-        #          (SELECT iics.id,
-        #                  iics.invoices_items_id,
-        #                  iics.customers_subscriptions_id
-        #           FROM invoices_items_customers_subscriptions iics
-        #           LEFT JOIN invoices_items ON iics.invoices_items_id = invoices_items.id
-        #           LEFT JOIN invoices ON invoices_items.invoices_id = invoices.id
-        #           WHERE invoices.SubscriptionYear = {year} AND invoices.SubscriptionMonth = {month}) ii
-        #          ON ii.customers_subscriptions_id = cs.id
-        #         LEFT JOIN
-        #          (SELECT id,
-        #                  customers_subscriptions_id,
-        #                  Amount,
-        #                  Description
-        #           FROM customers_subscriptions_alt_prices
-        #           WHERE SubscriptionYear = {year} AND SubscriptionMonth = {month}) csap
-        #          ON csap.customers_subscriptions_id = cs.id
-        #         WHERE cs.Startdate <= '{lastdaythismonth}' AND
-        #               (cs.Enddate >= '{firstdaythismonth}' OR cs.Enddate IS NULL) AND
-        #               ssp.Price <> 0 AND
-        #               ssp.Price IS NOT NULL AND
-        #               au.trashed = 'F'
-        #     """.format(firstdaythismonth=firstdaythismonth,
-        #                lastdaythismonth =lastdaythismonth,
-        #                year=year,
-        #                month=month),
-        #   fields=fields)
-        #
-        # igpt = db.invoices_groups_product_types(ProductType = 'subscription')
-        # igID = igpt.invoices_groups_id
-        #
-        # invoices_created = 0
-        #
-        # # Alright, time to create some invoices
-        # for row in rows:
-        #     if row.invoices_items.id:
-        #         # an invoice already exists, do nothing
-        #         continue
-        #     if row.customers_subscriptions_paused.id:
-        #         # the subscription is paused, don't create an invoice
-        #         continue
-        #     if row.customers_subscriptions_alt_prices.Amount == 0:
-        #         # Don't create an invoice if there's an alt price for the subscription with amount 0.
-        #         continue
-        #
-        #     csID = row.customers_subscriptions.id
-        #     cuID = row.customers_subscriptions.auth_customer_id
-        #     pmID = row.customers_subscriptions.payment_methods_id
-        #
-        #     subscr_name = row.school_subscriptions.Name
-        #
-        #     if row.customers_subscriptions_alt_prices.Description:
-        #         inv_description = row.customers_subscriptions_alt_prices.Description
-        #     else:
-        #         inv_description = description
-        #
-        #     if row.customers_subscriptions.Startdate > firstdaythismonth:
-        #         period_begin = row.customers_subscriptions.Startdate
-        #     else:
-        #         period_begin = firstdaythismonth
-        #
-        #     period_end = lastdaythismonth
-        #     if row.customers_subscriptions.Enddate:
-        #         if row.customers_subscriptions.Enddate >= firstdaythismonth and \
-        #            row.customers_subscriptions.Enddate < lastdaythismonth:
-        #             period_end = row.customers_subscriptions.Enddate
-        #
-        #
-        #     item_description = period_begin.strftime(DATE_FORMAT) + ' - ' + \
-        #                        period_end.strftime(DATE_FORMAT)
-        #
-        #     iID = db.invoices.insert(
-        #         invoices_groups_id = igID,
-        #         payment_methods_id = pmID,
-        #         SubscriptionYear = year,
-        #         SubscriptionMonth = month,
-        #         Description = inv_description,
-        #         Status = 'sent'
-        #     )
-        #
-        #     # create object to set Invoice# and due date
-        #     invoice = Invoice(iID)
-        #     invoice.link_to_customer(cuID)
-        #     iiID = invoice.item_add_subscription(csID, year, month)
-        #     invoice.link_item_to_customer_subscription(csID, iiID)
-        #     invoice.set_amounts()
-        #
-        #     invoices_created += 1
-
-        # ##
-        # # For scheduled tasks db connection has to be committed manually
-        # ##
-        # db.commit()
-        #
-        # return T("Invoices created") + ': ' + unicode(invoices_created)
-
-
-    def customers_subscriptions_add_credits_for_month(self, year, month):
+    def customers_subscriptions_collect_mollie_recurring_chunk(self, year, month, invoice_ids):
+        """
+            Collect payments for a chunk of subscription invoices using Mollie
+            :param year: int
+            :param month: int
+            :param invoice_ids: list of db.invoices.id
+        """
+        from .os_customers_subscriptions_mollie_payments import CustomersSubscriptionsMolliePayments
+
+        T = current.T
+
+        csmp = CustomersSubscriptionsMolliePayments(year, month)
+        counts = csmp.collect_invoices(invoice_ids)
+
+        return T("Payments collected") + ': ' + str(counts['created']) + '<br>' + \
+            T("Payments failed to collect") + ': ' + str(counts['failed']) + '<br>' + \
+            T("Payments skipped, no valid mandate") + ': ' + str(counts['skipped'])
+
+
+    def customers_subscriptions_collect_mollie_recurring_retry(self):
+        """
+            Queue tasks to collect payments for subscription invoices of the current
+            month that timed out while processing or are still queued
+        """
+        from .os_customers_subscriptions_mollie_payments import CustomersSubscriptionsMolliePayments
+
+        TODAY_LOCAL = current.TODAY_LOCAL
+
+        csmp = CustomersSubscriptionsMolliePayments(TODAY_LOCAL.year, TODAY_LOCAL.month)
+
+        return csmp.retry()
+
+
+    def customers_subscriptions_add_credits_for_month(self, year, month, vectorized=True):
         """
         :param year: int
         :param month: int
+        :param vectorized: bool - see CustomersSubscriptionsCredits.add_credits()
         :return: Add customer subscription credits for month
         """
         from .os_customers_subscriptions_credits import CustomersSubscriptionsCredits
@@ -230,13 +94,169 @@ class OsSchedulerTasks:
         month = int(month)
 
         csch = CustomersSubscriptionsCredits()
-        added = csch.add_credits(year, month)
+        added = csch.add_credits(year, month, vectorized=vectorized)
 
         db.commit()
 
         return T("Subscriptions for which credits were added") + ': ' + str(added)
 
 
+    def classes_attendance_count_rebuild(self, date_from=None, date_until=None):
+        """
+        :param date_from: string - yyyy-mm-dd; None to start at the first class
+        :param date_until: string - yyyy-mm-dd; None to include all future classes
+        :return: Recount attendance for class occurrences in db.classes_attendance_count
+        """
+        from .os_classes_attendance_counts import ClassesAttendanceCounts
+
+        T = current.T
+        db = current.db
+
+        if date_from:
+            date_from = datetime.datetime.strptime(str(date_from), '%Y-%m-%d').date()
+        if date_until:
+            date_until = datetime.datetime.strptime(str(date_until), '%Y-%m-%d').date()
+
+        cac = ClassesAttendanceCounts()
+        rebuilt = cac.rebuild(date_from, date_until)
+
+        db.commit()
+
+        return T("Classes for which attendance was counted") + ': ' + str(rebuilt)
+
+
+    def classes_occurrences_rebuild(self):
+        """
+        :return: Rebuild class occurrences in db.classes_occurrences for the window
+        kept by ClassesOccurrences
+        """
+        from .os_classes_occurrences import ClassesOccurrences
+
+        T = current.T
+        db = current.db
+
+        occurrences = ClassesOccurrences()
+        rebuilt = occurrences.rebuild()
+
+        db.commit()
+
+        return T("Class occurrences") + ': ' + str(rebuilt)
+
+
+    def customers_inactive_delete(self, date, chunk_size=500, dry_run=False):
+        """
+        :param date: string - yyyy-mm-dd; delete customers without activity after this date
+        :param chunk_size: int - number of customers to delete before committing
+        :param dry_run: bool - True to only count inactive customers
+        :return: Delete customers without activity after date
+        """
+        from .os_customers import Customers
+
+        T = current.T
+
+        date = datetime.datetime.strptime(str(date), '%Y-%m-%d').date()
+        if str(dry_run).lower() in ('false', '0', ''):
+            dry_run = False
+
+        def progress(deleted, found):
+            # Shown in the output of the running task
+            print('!clear!' + str(deleted) + ' / ' + str(found))
+
+        customers = Customers()
+        result = customers.purge_inactive_after_date(date,
+                                                     chunk_size=int(chunk_size),
+                                                     dry_run=bool(dry_run),
+                                                     progress=progress)
+
+        if dry_run:
+            return T("Inactive customers") + ': ' + str(result['found']) + ' ' + T("(dry run)")
+
+        return T("Inactive customers") + ': ' + str(result['found']) + '<br>' + \
+               T("Customers deleted") + ': ' + str(result['deleted'])
+
+
+    def exports_create(self, seID):
+        """
+        :param seID: db.sys_exports.id
+        :return: Create an export queued by OsExport.queue()
+        """
+        from .os_export import OsExport
+
+        T = current.T
+
+        export = OsExport()
+        row = export.create(seID)
+
+        return T("Export created") + ': ' + row.FileName
+
+
+    def exports_delete_expired(self):
+        """
+        :return: Delete background exports older than OsExport.retention_days
+        """
+        from .os_export import OsExport
+
+        T = current.T
+
+        export = OsExport()
+        deleted = export.delete_expired()
+
+        return T("Exports deleted") + ': ' + str(deleted)
+
+
+    def customers_subscriptions_credits_balance_verify(self, repair=True):
+        """
+        :param repair: bool - True to refresh balances that drifted
+        :return: Compare credit balances of subscriptions with the sum of their mutations
+        """
+        from .os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
+        T = current.T
+        db = current.db
+
+        if str(repair).lower() in ('false', '0'):
+            repair = False
+
+        cscb = CustomersSubscriptionsCreditsBalances()
+        drift = cscb.verify(repair=bool(repair))
+
+        db.commit()
+
+        return T("Subscriptions with credit balance drift") + ': ' + str(len(drift))
+
+
+    def invoices_render_pdfs(self, date_from, date_until):
+        """
+        :param date_from: string - yyyy-mm-dd
+        :param date_until: string - yyyy-mm-dd
+        :return: Render PDF files for invoices created in period, so downloads are served from cache
+        """
+        from .os_invoices import Invoices
+
+        T = current.T
+
+        date_from = datetime.datetime.strptime(str(date_from), '%Y-%m-%d').date()
+        date_until = datetime.datetime.strptime(str(date_until), '%Y-%m-%d').date()
+
+        invoices = Invoices()
+        rendered = invoices.render_pdfs(date_from, date_until)
+
+        return T("Invoices rendered as PDF") + ': ' + str(rendered)
+
+
+    def mail_outbox_send(self, batch_size=100):
+        """
+        :param batch_size: int - max number of mails to send
+        :return: Send queued mails in db.mail_outbox
+        """
+        from .os_mail_outbox import OsMailOutbox
+
+        outbox = OsMailOutbox()
+        counts = outbox.send_queued(int(batch_size))
+
+        return "Sent mails: %s<br>Failed mails: %s" % (counts['sent'], counts['failed'])
+
+
     def customers_memberships_renew_expired(self, year, month):
         """
             Checks if a subscription exceeds the expiration of a membership.
@@ -325,7 +345,7 @@ class OsSchedulerTasks:
         teachers = Teachers()
         teacher_id_rows = teachers.get_teacher_ids()
 
-        mails_sent = 0
+        mails_queued = 0
         for row in teacher_id_rows:
             os_mail = OsMail()
             result = os_mail.render_email_template(
@@ -334,18 +354,18 @@ class OsSchedulerTasks:
                 return_html=True
             )
 
-            send_result = False
+            queued = False
             if not result['error']:
-                send_result = os_mail.send(
+                queued = os_mail.send(
                     message_html=result['html_message'],
                     message_subject=T("Daily summary - open classes"),
                     auth_user_id=row.id
                 )
 
-            if send_result:
-                mails_sent += 1
+            if queued:
+                mails_queued += 1
 
-        return "Sent mails: %s" % mails_sent
+        return "Queued mails: %s" % mails_queued
 
 
     def email_reminders_teachers_sub_request_open(self):
@@ -365,7 +385,7 @@ class OsSchedulerTasks:
         sys_reminders = SysEmailReminders('teachers_sub_request_open')
         reminders = sys_reminders.list()
 
-        mails_sent = 0
+        mails_queued = 0
         for reminder in reminders:
             # Get list of open classes on reminder date
             reminder_date = TODAY_LOCAL + datetime.timedelta(reminder.Days)
@@ -390,20 +410,20 @@ class OsSchedulerTasks:
                         return_html=True
                     )
 
-                    send_result = False
+                    queued = False
                     if not result['error']:
-                        send_result = os_mail.send(
+                        queued = os_mail.send(
                             message_html=result['html_message'],
                             message_subject=T("Reminder - open class"),
                             auth_user_id=auth_teacher_id
                         )
 
-                    if send_result:
-                        mails_sent += 1
+                    if queued:
+                        mails_queued += 1
 
             # send reminder to teacher
 
-        return "Sent mails: %s" % mails_sent
+        return "Queued mails: %s" % mails_queued
 
 
     def email_trailclass_follow_up(self):
@@ -433,7 +453,7 @@ class OsSchedulerTasks:
                                 db.auth_user.display_name,
                                 left=left)
 
-        mails_sent = 0
+        mails_queued = 0
 
         for row in rows:
             result = os_mail.render_email_template(
@@ -448,9 +468,9 @@ class OsSchedulerTasks:
                 auth_user_id = row.classes_attendance.auth_customer_id
             )
 
-            mails_sent += 1
+            mails_queued += 1
 
-        return "Sent trial class follow up mails: %s" % mails_sent
+        return "Queued trial class follow up mails: %s" % mails_queued
 
 
     def email_trailcard_follow_up(self):
@@ -484,7 +504,7 @@ class OsSchedulerTasks:
                                 db.auth_user.display_name,
                                 left=left)
 
-        mails_sent = 0
+        mails_queued = 0
 
         for row in rows:
             result = os_mail.render_email_template(
@@ -499,7 +519,7 @@ class OsSchedulerTasks:
                 auth_user_id = row.customers_classcards.auth_customer_id
             )
 
-            mails_sent += 1
+            mails_queued += 1
 
-        return "Sent trial card follow up mails: %s" % mails_sent
+        return "Queued trial card follow up mails: %s" % mails_queued
 
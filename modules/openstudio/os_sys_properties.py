@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import uuid
+
+from gluon import *
+
+
+class OsSysProperties:
+    """
+        Snapshot of db.sys_properties, loaded as a whole using one query.
+
+        When redis is used as cache, the snapshot is shared by all requests in a
+        process and tagged with a version stored in redis. Changing a property
+        changes the version after the change is committed, which makes each
+        process reload the snapshot on its next request. Without redis, the
+        version can't be shared between processes, so the snapshot is loaded
+        for each request.
+        An instance is created for each request in models and is available in
+        modules as current.sys_properties.
+    """
+    # {application: (version, {Property: PropertyValue})}
+    _snapshots = {}
+    _lock = threading.Lock()
+
+    version_cache_key = 'openstudio_sys_properties_version'
+
+
+    def __init__(self):
+        # Request scoped copy of the snapshot
+        self._properties = None
+        # Clear the shared snapshot when this request commits
+        self._clear_on_commit = False
+
+
+    def _load(self):
+        """
+        :return: dict {Property: PropertyValue} of all rows in db.sys_properties
+        """
+        db = current.db
+
+        rows = db().select(db.sys_properties.Property,
+                           db.sys_properties.PropertyValue)
+
+        return {row.Property: row.PropertyValue for row in rows}
+
+
+    def _get_version(self):
+        """
+        :return: string - current version of sys_properties
+        """
+        cache = current.cache
+        CACHE_LONG = current.CACHE_LONG
+
+        return cache.ram(self.version_cache_key,
+                         lambda: uuid.uuid4().hex,
+                         time_expire=CACHE_LONG)
+
+
+    def get_properties(self):
+        """
+        :return: dict {Property: PropertyValue} of all sys_properties
+        """
+        if self._properties is not None:
+            return self._properties
+
+        from .os_cache_manager import OsCacheManager
+
+        web2pytest = current.web2pytest
+        request = current.request
+
+        # Don't share the snapshot between requests when running tests or
+        # when the version can't be shared between processes
+        if web2pytest.is_running_under_test(request, request.application) or \
+           not OsCacheManager().is_shared():
+            self._properties = self._load()
+            return self._properties
+
+        version = self._get_version()
+        app = request.application
+        with self._lock:
+            snapshot = self._snapshots.get(app)
+            if snapshot is None or snapshot[0] != version:
+                snapshot = (version, self._load())
+                self._snapshots[app] = snapshot
+
+        self._properties = snapshot[1]
+
+        return self._properties
+
+
+    def get(self, property, value_type=None):
+        """
+        :param property: db.sys_properties.Property
+        :param value_type: Python data type eg. int
+        :return: db.sys_properties.PropertyValue
+        """
+        property_value = self.get_properties().get(property)
+
+        if value_type:
+            try:
+                return value_type(property_value)
+            except:
+                pass
+
+        return property_value
+
+
+    def set(self, property, value):
+        """
+        :param property: string - name of sys property
+        :param value: value of sys property
+        :return: None
+        """
+        db = current.db
+
+        row = db.sys_properties(Property=property)
+        if not row:
+            db.sys_properties.insert(Property=property,
+                                     PropertyValue=value)
+        else:
+            row.PropertyValue = value
+            row.update_record()
+
+        self.clear()
+
+
+    def _clear_shared(self):
+        """
+            Make all processes reload sys_properties on their next request
+        """
+        cache = current.cache
+        request = current.request
+
+        cache.ram(self.version_cache_key, None)
+        with self._lock:
+            self._snapshots.pop(request.application, None)
+
+
+    def _clear_after_commit(self):
+        """
+            Clear the shared snapshot again after this request commits, so
+            requests loading the snapshot before the commit don't keep the
+            old values under the new version
+        """
+        response = current.response
+
+        if self._clear_on_commit or response is None:
+            return
+
+        self._clear_on_commit = True
+        commit = response.custom_commit
+
+        # Called by web2py at the end of the request, instead of commit
+        def custom_commit(instance):
+            if commit:
+                commit(instance)
+            else:
+                instance.commit()
+            self._clear_shared()
+
+        response.custom_commit = custom_commit
+
+
+    def clear(self):
+        """
+            Make all processes reload sys_properties, including this request
+        """
+        self._clear_shared()
+        self._clear_after_commit()
+
+        self._properties = None
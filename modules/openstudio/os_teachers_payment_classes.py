@@ -9,19 +9,17 @@ class TeachersPaymentClasses:
     """
         Class that gathers useful functions for db.teachers_payments_attendance
     """
-    def check_missing(self, date_from, date_until):
+    def check_missing(self, date_from, date_until, chunk_days=92):
         """
-
-        :param date_from:
-        :param date_until:
-        :return:
+        Add classes without a verified or processed payment to Not verified
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :param chunk_days: int - number of days to check using one schedule query
+        :return: dict {'error': bool, 'message': error message or number of classes added}
         """
         from date_tools import DateTools
-        from .os_class import Class
-        from .os_class_schedule import ClassSchedule
 
         T = current.T
-        db = current.db
         dt = DateTools()
 
         error = False
@@ -33,36 +31,14 @@ class TeachersPaymentClasses:
             error = True
             message = T("From date has to be smaller then until date.")
 
-        if days_between > 92:
-            error = True
-            message = T("Gap between dates can not be more then 3 months")
-
         if not error:
             date = date_from
 
             while date <= date_until:
-                cs = ClassSchedule(date)
-                classes = cs.get_day_list()
-                for cls in classes:
-                    if not cls['Cancelled'] or cls['Holiday']:
-                        # Check if item in db.teachers_payment_classes
-                        query = (db.teachers_payment_classes.classes_id == cls['ClassesID']) & \
-                                (db.teachers_payment_classes.ClassDate == date) & \
-                                ((db.teachers_payment_classes.Status == 'verified') |
-                                 (db.teachers_payment_classes.Status == 'processed'))
-                        if db(query).count() == 0:
-                            os_cls = Class(
-                                cls['ClassesID'],
-                                date
-                            )
-
-                            # This inserts or updates the class data with status not_verified
-                            result = os_cls.get_teacher_payment()
-
-                            if not result['error']:
-                                classes_added += 1
-
-                date += datetime.timedelta(days=1)
+                chunk_until = min(date + datetime.timedelta(days=chunk_days - 1), date_until)
+                classes_added += self._check_missing_range(date, chunk_until)
+
+                date = chunk_until + datetime.timedelta(days=1)
 
             message = classes_added
 
@@ -72,6 +48,60 @@ class TeachersPaymentClasses:
         )
 
 
+    def _check_missing_range(self, date_from, date_until):
+        """
+        Compare classes in the schedule with payments for the range and get
+        payments for classes that are missing
+        :param date_from: datetime.date
+        :param date_until: datetime.date
+        :return: int - number of classes added
+        """
+        from .os_class import Class
+        from .os_class_schedule import ClassSchedule
+
+        db = current.db
+
+        # Classes with a verified or processed payment in range
+        query = (db.teachers_payment_classes.ClassDate >= date_from) & \
+                (db.teachers_payment_classes.ClassDate <= date_until) & \
+                ((db.teachers_payment_classes.Status == 'verified') |
+                 (db.teachers_payment_classes.Status == 'processed'))
+        rows = db(query).select(db.teachers_payment_classes.classes_id,
+                                db.teachers_payment_classes.ClassDate)
+        skip = set([(row.classes_id, row.ClassDate) for row in rows])
+
+        classes_added = 0
+
+        cs = ClassSchedule(date_from)
+        rows = cs.get_range_rows(date_from, date_until)
+        for row in rows:
+            clsID = row.classes.id
+            date = row['ClassDate']
+
+            if (clsID, date) in skip:
+                continue
+            skip.add((clsID, date))
+
+            cancelled = row.classes_otc.Status == 'cancelled'
+            holiday = bool(row.school_holidays.id)
+            if cancelled and not holiday:
+                continue
+
+            # A payment requires customers attending the class
+            if not row.classes_schedule_count.Attendance:
+                continue
+
+            os_cls = Class(clsID, date)
+
+            # This inserts or updates the class data with status not_verified
+            result = os_cls.get_teacher_payment()
+
+            if result and not result['error']:
+                classes_added += 1
+
+        return classes_added
+
+
     def get_rows(self,
                  status='not_verified',
                  sorting='time',
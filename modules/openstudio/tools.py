@@ -74,41 +74,7 @@ class OsTools:
         :param property: string - name of sys property
         :return: None
         """
-        db = current.db
-
-        row = db.sys_properties(Property=property)
-        if not row:
-            db.sys_properties.insert(Property=property,
-                                     PropertyValue=value)
-        else:
-            row.PropertyValue = value
-            row.update_record()
-
-        # Clear cache
-        from .os_cache_manager import OsCacheManager
-
-        ocm = OsCacheManager()
-        ocm.clear_sys_properties()
-
-
-    def _get_sys_property(self, value=None, value_type=None):
-        """
-            Returns the value of a property in db.sys_properties
-        """
-        db = current.db
-
-        property_value = None
-        row = db.sys_properties(Property=value)
-        if row:
-            property_value = row.PropertyValue
-
-        if value_type:
-            try:
-                return value_type(property_value)
-            except:
-                pass
-
-        return property_value
+        current.sys_properties.set(property, value)
 
 
     def get_sys_property(self, value=None, value_type=None):
@@ -117,22 +83,7 @@ class OsTools:
         :param value_type: Python data type eg. int
         :return: db.sys_properties.PropertyValue
         """
-        cache = current.cache
-        web2pytest = current.web2pytest
-        request = current.request
-        CACHE_LONG = current.CACHE_LONG
-
-        cache_key = 'openstudio_system_property_' + value
-
-        # Don't cache when running tests
-        if web2pytest.is_running_under_test(request, request.application):
-            sprop = self._get_sys_property(value, value_type)
-        else:
-            sprop = cache.ram(cache_key,
-                              lambda: self._get_sys_property(value, value_type),
-                              time_expire=CACHE_LONG)
-
-        return sprop
+        return current.sys_properties.get(value, value_type)
 
 
 class OsArchiver:
@@ -22,7 +22,7 @@ class OSSAULA:
 
         # Get current failed attempts
         failed_attempts = cache.ram(failed_attempts_cache_key, lambda: 0, time_expire=self.expiration)
-        cache.ram.clear(regex=failed_attempts_cache_key)
+        cache.ram(failed_attempts_cache_key, None)
         # Update failed attempts
         failed_attempts = cache.ram(failed_attempts_cache_key, lambda: failed_attempts + 1, time_expire=self.expiration)
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+''' py.test fixtures for the benchmark suite.
+
+Benchmarks only run when the OS_BENCHMARK_SCALE environment variable is set
+to one of the scales in populate_benchmark.SCALES, eg:
+
+    OS_BENCHMARK_SCALE=small py.test applications/openstudio/tests/benchmarks
+
+The dataset is populated once for each session in the SQLite test database.
+Results are written to tests/benchmarks/results/<scale>_<timestamp>.json, or to
+the file in OS_BENCHMARK_OUTPUT. When OS_BENCHMARK_BASELINE points to the
+results of an earlier run, a benchmark fails when its median time is more
+than OS_BENCHMARK_TOLERANCE (default 0.25 = 25%) slower than the baseline.
+'''
+
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controllers'))
+
+_results = {}
+
+
+def get_benchmark_scale():
+    return os.environ.get('OS_BENCHMARK_SCALE')
+
+
+@pytest.fixture(autouse=True)
+def cleanup_db():
+    '''Keep the benchmark dataset between tests, instead of truncating
+    all tables like the functional tests.
+    '''
+    pass
+
+
+@pytest.fixture(scope='session')
+def benchmark_dataset(appname):
+    '''Populate the benchmark dataset once for each session.
+    '''
+    from gluon.shell import env
+    from gluon.storage import Storage
+    from populate_benchmark import populate_benchmark
+
+    web2py_env = env(appname, import_models=True,
+                     extra_request=dict(is_local=True,
+                                        _running_under_test=True))
+    web2py = Storage(web2py_env)
+
+    for tab in web2py.db.tables:
+        web2py.db[tab].truncate()
+    web2py.db.commit()
+
+    start = time.time()
+    dataset = populate_benchmark(web2py, get_benchmark_scale())
+    dataset['populate_seconds'] = round(time.time() - start, 1)
+
+    _results['dataset'] = dict(
+        (key, str(value) if isinstance(value, datetime.date) else value)
+        for key, value in dataset.items()
+    )
+
+    return dataset
+
+
+def _load_baseline():
+    path = os.environ.get('OS_BENCHMARK_BASELINE')
+    if not path:
+        return {}
+
+    with open(path) as f:
+        return json.load(f).get('benchmarks', {})
+
+
+@pytest.fixture(scope='session')
+def benchmark_baseline():
+    return _load_baseline()
+
+
+@pytest.fixture()
+def benchmark(request, benchmark_baseline):
+    '''Time a function and record the result.
+
+    benchmark(f, rounds=5, teardown=None) calls f rounds times and returns the
+    result of the last call. teardown is called after each round, outside of
+    the timing, eg. to roll back changes made by f.
+    '''
+    def run(f, rounds=5, teardown=None):
+        timings = []
+        result = None
+        for i in range(rounds):
+            start = time.time()
+            result = f()
+            timings.append(time.time() - start)
+            if teardown:
+                teardown()
+
+        timings.sort()
+        name = request.node.name
+        median = timings[len(timings) // 2]
+        _results.setdefault('benchmarks', {})[name] = {
+            'rounds': rounds,
+            'min': round(timings[0], 4),
+            'median': round(median, 4),
+            'max': round(timings[-1], 4),
+        }
+
+        baseline = benchmark_baseline.get(name)
+        if baseline:
+            tolerance = float(os.environ.get('OS_BENCHMARK_TOLERANCE', 0.25))
+            allowed = baseline['median'] * (1 + tolerance)
+            assert median <= allowed, \
+                '%s: median %.4fs is slower than baseline %.4fs (+%d%%)' % (
+                    name, median, baseline['median'], tolerance * 100)
+
+        return result
+
+    return run
+
+
+def pytest_sessionfinish(session, exitstatus):
+    '''Write the results of this run.
+    '''
+    if not _results.get('benchmarks'):
+        return
+
+    path = os.environ.get('OS_BENCHMARK_OUTPUT')
+    if not path:
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, '%s_%s.json' % (
+            get_benchmark_scale(),
+            datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+    import sqlite3
+
+    _results['environment'] = {
+        'time': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+    with open(path, 'w') as f:
+        json.dump(_results, f, indent=4, sort_keys=True)
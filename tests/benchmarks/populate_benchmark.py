@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""Synthetic studio datasets for the benchmark suite.
+
+The dataset is generated on top of the fixtures of the functional tests
+(prepare_classes), using a seeded random generator so each run with the same
+scale creates the same data.
+"""
+
+import random
+import datetime
+from decimal import Decimal
+
+from populate_os_tables import prepare_classes
+from populate_os_tables import populate_api_users
+
+
+SCALES = {
+    'small': {
+        'customers': 2000,
+        'years': 1,
+        'subscriptions': 500,
+        'classes_per_day': 3,
+        'attendance_per_class': 8,
+        'invoice_months': 3,
+    },
+    'medium': {
+        'customers': 10000,
+        'years': 3,
+        'subscriptions': 3000,
+        'classes_per_day': 5,
+        'attendance_per_class': 12,
+        'invoice_months': 6,
+    },
+    'large': {
+        'customers': 50000,
+        'years': 5,
+        'subscriptions': 10000,
+        'classes_per_day': 8,
+        'attendance_per_class': 15,
+        'invoice_months': 12,
+    },
+}
+
+# Customers generated by the benchmark start at this id, to avoid conflicts
+# with customers & teachers of the functional test fixtures
+CUSTOMERS_ID_START = 10001
+
+CHUNK_SIZE = 1000
+
+
+def get_scale(name):
+    """
+    :param name: string - name of scale in SCALES
+    :return: dict - dataset size
+    """
+    try:
+        return SCALES[name]
+    except KeyError:
+        raise ValueError('Unknown benchmark scale: %s, use one of: %s' % (
+            name, ', '.join(sorted(SCALES))))
+
+
+def bulk_insert(table, rows):
+    """
+    Insert rows in chunks, without insert callbacks. Tables maintained by
+    callbacks are rebuilt after populating.
+    """
+    db = table._db
+
+    before_insert = table._before_insert
+    after_insert = table._after_insert
+    table._before_insert = []
+    table._after_insert = []
+    try:
+        ids = []
+        for i in range(0, len(rows), CHUNK_SIZE):
+            ids += table.bulk_insert(rows[i:i + CHUNK_SIZE])
+            db.commit()
+    finally:
+        table._before_insert = before_insert
+        table._after_insert = after_insert
+
+    return ids
+
+
+def populate_benchmark_customers(web2py, scale, rnd):
+    """
+    :return: list of db.auth_user.id
+    """
+    rows = []
+    for i in range(scale['customers']):
+        cuID = CUSTOMERS_ID_START + i
+        rows.append(dict(
+            id=cuID,
+            customer=True,
+            first_name='bench_' + str(i),
+            last_name=rnd.choice(['Jansen', 'de Vries', 'Bakker', 'Visser', 'Smit', 'Meijer']),
+            email='bench' + str(i) + '@example.com',
+            school_locations_id=rnd.choice([1, 2]),
+            newsletter=rnd.random() < 0.3,
+            created_on=datetime.datetime(2014, 1, 1) + datetime.timedelta(days=rnd.randint(0, 365 * 5)),
+        ))
+
+    return bulk_insert(web2py.db.auth_user, rows)
+
+
+def populate_benchmark_classes(web2py, scale, rnd, date_from):
+    """
+    Add classes for each day of the week, with teachers
+    :return: list of tuples (db.classes.id, Week_day)
+    """
+    db = web2py.db
+
+    rows = []
+    for week_day in range(1, 8):
+        for i in range(scale['classes_per_day']):
+            hour = 7 + i * 2
+            rows.append(dict(
+                school_locations_id=rnd.choice([1, 2]),
+                school_classtypes_id=rnd.choice([1, 2, 3]),
+                Week_day=week_day,
+                Starttime=datetime.time(hour, 0),
+                Endtime=datetime.time(hour + 1, 30),
+                Startdate=date_from,
+                Enddate=None,
+                Maxstudents=scale['attendance_per_class'] * 2,
+                MaxReservationsRecurring=5,
+                MaxReservationsDT=5,
+                WalkInSpaces=5,
+                AllowAPI=True,
+                AllowShopTrial=True,
+            ))
+
+    ids = bulk_insert(db.classes, rows)
+
+    bulk_insert(db.classes_teachers, [dict(classes_id=clsID,
+                                           auth_teacher_id=rnd.choice([2, 3]),
+                                           Startdate=date_from) for clsID in ids])
+    bulk_insert(db.classes_school_subscriptions_groups, [dict(classes_id=clsID,
+                                                              school_subscriptions_groups_id=1,
+                                                              Enroll=True,
+                                                              ShopBook=True,
+                                                              Attend=True) for clsID in ids])
+
+    return [(clsID, row['Week_day']) for clsID, row in zip(ids, rows)]
+
+
+def populate_benchmark_subscriptions(web2py, scale, rnd, customers_ids, date_from, date_until):
+    """
+    :return: list of dicts - inserted subscriptions with id
+    """
+    days = (date_until - date_from).days
+
+    rows = []
+    for cuID in rnd.sample(customers_ids, min(scale['subscriptions'], len(customers_ids))):
+        startdate = date_from + datetime.timedelta(days=rnd.randint(0, days))
+        enddate = None
+        if rnd.random() < 0.4:
+            enddate = startdate + datetime.timedelta(days=rnd.randint(90, 720))
+
+        rows.append(dict(
+            auth_customer_id=cuID,
+            school_subscriptions_id=1 if rnd.random() < 0.8 else 3,
+            Startdate=datetime.date(startdate.year, startdate.month, 1),
+            Enddate=enddate,
+            payment_methods_id=3,
+        ))
+
+    ids = bulk_insert(web2py.db.customers_subscriptions, rows)
+    for csID, row in zip(ids, rows):
+        row['id'] = csID
+
+    return rows
+
+
+def populate_benchmark_attendance(web2py, scale, rnd, classes, subscriptions, customers_ids,
+                                  date_from, date_until):
+    """
+    Book classes for subscriptions & drop in customers on every class date
+    :return: int - number of bookings
+    """
+    db = web2py.db
+
+    classes_by_week_day = {}
+    for clsID, week_day in classes:
+        classes_by_week_day.setdefault(week_day, []).append(clsID)
+
+    count = 0
+    date = date_from
+    while date <= date_until:
+        active = [cs for cs in subscriptions
+                  if cs['Startdate'] <= date and (cs['Enddate'] is None or cs['Enddate'] >= date)]
+
+        attendance = []
+        credits = []
+        for clsID in classes_by_week_day.get(date.isoweekday(), []):
+            for cs in rnd.sample(active, min(len(active), scale['attendance_per_class'])):
+                attendance.append(dict(auth_customer_id=cs['auth_customer_id'],
+                                       classes_id=clsID,
+                                       ClassDate=date,
+                                       AttendanceType=None,
+                                       customers_subscriptions_id=cs['id'],
+                                       online_booking=rnd.random() < 0.5,
+                                       BookingStatus='attending'))
+            # A few drop in & trial customers
+            for cuID in rnd.sample(customers_ids, 2):
+                attendance.append(dict(auth_customer_id=cuID,
+                                       classes_id=clsID,
+                                       ClassDate=date,
+                                       AttendanceType=rnd.choice([1, 2]),
+                                       BookingStatus=rnd.choice(['attending', 'booked', 'cancelled'])))
+
+        ids = bulk_insert(db.classes_attendance, attendance)
+        for clattID, row in zip(ids, attendance):
+            if row.get('customers_subscriptions_id'):
+                credits.append(dict(customers_subscriptions_id=row['customers_subscriptions_id'],
+                                    classes_attendance_id=clattID,
+                                    MutationDateTime=datetime.datetime.combine(date, datetime.time(0, 0)),
+                                    MutationType='sub',
+                                    MutationAmount=1,
+                                    Description='Class on ' + str(date)))
+        bulk_insert(db.customers_subscriptions_credits, credits)
+
+        count += len(attendance)
+        date += datetime.timedelta(days=1)
+
+    return count
+
+
+def populate_benchmark_credits_added(web2py, subscriptions, date_until):
+    """
+    Monthly credits added for each subscription
+    """
+    rows = []
+    for cs in subscriptions:
+        date = cs['Startdate']
+        end = cs['Enddate'] or date_until
+        while date <= min(end, date_until):
+            rows.append(dict(customers_subscriptions_id=cs['id'],
+                             MutationDateTime=datetime.datetime.combine(date, datetime.time(0, 0)),
+                             MutationType='add',
+                             MutationAmount=5,
+                             Description='Credits ' + date.strftime('%Y-%m'),
+                             SubscriptionYear=date.year,
+                             SubscriptionMonth=date.month))
+            date = (date + datetime.timedelta(days=32)).replace(day=1)
+
+    bulk_insert(web2py.db.customers_subscriptions_credits, rows)
+
+
+def populate_benchmark_invoices(web2py, scale, subscriptions, date_until):
+    """
+    Monthly subscription invoices for the last months of the dataset
+    """
+    db = web2py.db
+
+    price = Decimal('40.00')
+    total_price = (price / Decimal('1.21')).quantize(Decimal('0.01'))
+    vat = price - total_price
+
+    months = []
+    date = date_until.replace(day=1)
+    for i in range(scale['invoice_months']):
+        months.append(date)
+        date = (date - datetime.timedelta(days=1)).replace(day=1)
+
+    nr = 0
+    for month in months:
+        invoiced = [cs for cs in subscriptions
+                    if cs['Startdate'] <= month and (cs['Enddate'] is None or cs['Enddate'] >= month)]
+
+        invoices = []
+        for cs in invoiced:
+            nr += 1
+            invoices.append(dict(invoices_groups_id=100,
+                                 payment_methods_id=3,
+                                 SubscriptionYear=month.year,
+                                 SubscriptionMonth=month.month,
+                                 Status='sent',
+                                 InvoiceID='BENCH' + str(nr),
+                                 Description='Subscription ' + month.strftime('%Y-%m'),
+                                 DateCreated=month,
+                                 DateDue=month + datetime.timedelta(days=14)))
+        ids = bulk_insert(db.invoices, invoices)
+
+        bulk_insert(db.invoices_customers, [dict(invoices_id=iID,
+                                                 auth_customer_id=cs['auth_customer_id'])
+                                            for iID, cs in zip(ids, invoiced)])
+        bulk_insert(db.invoices_amounts, [dict(invoices_id=iID,
+                                               TotalPrice=total_price,
+                                               VAT=vat,
+                                               TotalPriceVAT=price)
+                                          for iID in ids])
+        items_ids = bulk_insert(db.invoices_items, [dict(invoices_id=iID,
+                                                         Sorting=1,
+                                                         ProductName='Subscription',
+                                                         Description='Subscription ' + month.strftime('%Y-%m'),
+                                                         Quantity=1,
+                                                         Price=price,
+                                                         tax_rates_id=1)
+                                                    for iID in ids])
+        bulk_insert(db.invoices_items_customers_subscriptions, [dict(invoices_items_id=iiID,
+                                                                     customers_subscriptions_id=cs['id'])
+                                                                for iiID, cs in zip(items_ids, invoiced)])
+
+
+def populate_benchmark(web2py, scale_name, seed=1):
+    """
+    Populate a synthetic studio dataset
+    :param scale_name: string - name of scale in SCALES
+    :param seed: int - seed for the random generator
+    :return: dict - information about the dataset, used by the benchmarks
+    """
+    from openstudio.os_classes_attendance_counts import ClassesAttendanceCounts
+    from openstudio.os_classes_occurrences import ClassesOccurrences
+    from openstudio.os_pos_customers_directory import PosCustomersDirectory
+    from openstudio.os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
+    scale = get_scale(scale_name)
+    rnd = random.Random(seed)
+
+    # Fixed end date, so results of different days can be compared
+    date_until = datetime.date(2019, 12, 31)
+    date_from = datetime.date(date_until.year - scale['years'] + 1, 1, 1)
+
+    prepare_classes(web2py, nr_of_customers=10)
+    populate_api_users(web2py)
+
+    customers_ids = populate_benchmark_customers(web2py, scale, rnd)
+    classes = populate_benchmark_classes(web2py, scale, rnd, date_from)
+    subscriptions = populate_benchmark_subscriptions(web2py, scale, rnd, customers_ids,
+                                                     date_from, date_until)
+    populate_benchmark_credits_added(web2py, subscriptions, date_until)
+    attendance_count = populate_benchmark_attendance(web2py, scale, rnd, classes, subscriptions,
+                                                     customers_ids, date_from, date_until)
+    populate_benchmark_invoices(web2py, scale, subscriptions, date_until)
+
+    # Rebuild tables maintained by callbacks
+    ClassesAttendanceCounts().rebuild()
+    ClassesOccurrences().rebuild()
+    PosCustomersDirectory().rebuild()
+    CustomersSubscriptionsCreditsBalances().rebuild()
+    web2py.db.commit()
+
+    # A Monday with classes of the benchmark
+    date = date_until - datetime.timedelta(days=date_until.weekday() + 7)
+
+    return {
+        'scale': scale_name,
+        'seed': seed,
+        'date_from': date_from,
+        'date_until': date_until,
+        'date': date,
+        'classes_id': [clsID for clsID, week_day in classes if week_day == 1][0],
+        'customers': len(customers_ids),
+        'subscriptions': len(subscriptions),
+        'attendance': attendance_count,
+    }
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the hot entry points of OpenStudio.
+
+See conftest.py in this folder on how to run the benchmarks and compare
+results with an earlier run.
+"""
+
+import os
+import datetime
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get('OS_BENCHMARK_SCALE'),
+                                reason='Set OS_BENCHMARK_SCALE to run benchmarks')
+
+
+def test_class_schedule_get_day_list(web2py, benchmark, benchmark_dataset):
+    """
+        Schedule for a day in the backend
+    """
+    from openstudio.os_class_schedule import ClassSchedule
+
+    def f():
+        return ClassSchedule(benchmark_dataset['date']).get_day_list()
+
+    classes = benchmark(f)
+    assert len(classes) > 0
+
+
+def test_api_schedule_get(web2py, benchmark, benchmark_dataset):
+    """
+        Schedule for a week in the API
+    """
+    year, week, weekday = benchmark_dataset['date'].isocalendar()
+
+    web2py.request.extension = 'json'
+    web2py.request.vars.update({
+        'user': 'test',
+        'key': 'test',
+        'year': year,
+        'week': week,
+    })
+
+    def f():
+        return web2py.run('api', 'schedule_get', web2py)
+
+    result = benchmark(f)
+    assert result['data']
+
+
+def test_attendance_helper_get_checkin_list_customers_booked(web2py, benchmark, benchmark_dataset):
+    """
+        Check in list for a class
+    """
+    from openstudio.os_attendance_helper import AttendanceHelper
+
+    def f():
+        return AttendanceHelper().get_checkin_list_customers_booked(benchmark_dataset['classes_id'],
+                                                                    benchmark_dataset['date'])
+
+    benchmark(f)
+
+
+def test_customers_subscriptions_credits_add_credits(web2py, benchmark, benchmark_dataset):
+    """
+        Add subscription credits for the month after the dataset
+    """
+    from openstudio.os_customers_subscriptions_credits import CustomersSubscriptionsCredits
+
+    date = benchmark_dataset['date_until'] + datetime.timedelta(days=1)
+
+    def f():
+        return CustomersSubscriptionsCredits().add_credits(date.year, date.month, vectorized=False)
+
+    benchmark(f, rounds=3, teardown=web2py.db.rollback)
+
+
+def test_customers_subscriptions_credits_add_credits_vectorized(web2py, benchmark, benchmark_dataset):
+    """
+        Add subscription credits for the month after the dataset, for all
+        subscriptions at once
+    """
+    from openstudio.os_customers_subscriptions_credits import CustomersSubscriptionsCredits
+
+    date = benchmark_dataset['date_until'] + datetime.timedelta(days=1)
+
+    def f():
+        return CustomersSubscriptionsCredits().add_credits(date.year, date.month, vectorized=True)
+
+    benchmark(f, rounds=3, teardown=web2py.db.rollback)
+
+
+def test_reports_get_classes_revenue(web2py, benchmark, benchmark_dataset):
+    """
+        Revenue for all classes in the last month of the dataset
+    """
+    from openstudio.os_reports import Reports
+
+    date_until = benchmark_dataset['date_until']
+    date_from = date_until.replace(day=1)
+
+    def f():
+        return Reports().get_classes_revenue(date_from, date_until)
+
+    revenue = benchmark(f)
+    assert len(revenue) > 0
+
+
+def test_scheduler_tasks_customers_subscriptions_create_invoices_for_month(web2py, benchmark, benchmark_dataset):
+    """
+        Create subscription invoices for the month after the dataset.
+        Invoices are committed in chunks, so this runs once and last.
+    """
+    from openstudio.os_scheduler_tasks import OsSchedulerTasks
+
+    date = benchmark_dataset['date_until'] + datetime.timedelta(days=1)
+
+    def f():
+        return OsSchedulerTasks().customers_subscriptions_create_invoices_for_month(
+            date.year,
+            date.month,
+            'Subscription ' + date.strftime('%Y-%m')
+        )
+
+    result = benchmark(f, rounds=1)
+    assert 'Invoices created' in result
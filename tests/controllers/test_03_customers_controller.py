@@ -81,6 +81,69 @@ def test_edit(client, web2py):
     assert customer.first_name == data['first_name']
 
 
+def test_edit_updates_pos_customers_directory(client, web2py):
+    """
+        Is the PoS customers directory updated when editing & trashing a customer?
+    """
+    from openstudio.os_pos_customers_directory import PosCustomersDirectory
+
+    populate_customers(web2py, 2)
+
+    query = (web2py.db.pos_customers_directory.auth_user_id == 1001)
+    version = web2py.db(query).select().first().Version
+    query_other = (web2py.db.pos_customers_directory.auth_user_id == 1002)
+    version_other = web2py.db(query_other).select().first().Version
+
+    url = '/customers/edit/1001'
+    client.get(url)
+    assert client.status == 200
+
+    data = {
+        'id'            : 1001,
+        'first_name'    : 'gorilla',
+        'last_name'     : 'monkey',
+        'email'         : 'gorilla@monkey.nl'
+    }
+
+    client.post(url, data=data)
+    assert client.status == 200
+
+    # The row for the customer gets the next version, other customers are untouched
+    rows = web2py.db(query).select()
+    assert len(rows) == 1
+    assert rows.first().Version > version
+    assert rows.first().search_name.startswith('gorilla')
+    assert rows.first().email == data['email']
+
+    assert web2py.db(query_other).select().first().Version == version_other
+
+    # Versions are allocated from a sequence
+    version_edit = rows.first().Version
+    assert web2py.db.pos_customers_directory_version(version_edit)
+
+    # Trashed customers are kept as deleted, so clients can remove them
+    client.get('/customers/trash?cuID=1001')
+    assert client.status == 200
+
+    rows = web2py.db(query).select()
+    assert len(rows) == 1
+    assert rows.first().Deleted == True
+    assert rows.first().Version > version_edit
+
+    # Rebuilding the directory keeps deleted customers
+    PosCustomersDirectory().rebuild()
+    web2py.db.commit()
+
+    rows = web2py.db(query).select()
+    assert len(rows) == 1
+    assert rows.first().Deleted == True
+
+    changes = PosCustomersDirectory().get_changes(version)
+    assert changes['reload'] == False
+    assert 1001 in changes['deleted']
+    assert 1002 in [row.auth_user_id for row in changes['customers']]
+
+
 def test_edit_teacher(client, web2py):
     """'
         Is the edit teacher page accepting submitted data?
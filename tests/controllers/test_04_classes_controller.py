@@ -1909,3 +1909,29 @@ def test_notes_delete(client, web2py):
 
     assert web2py.db(web2py.db.classes_notes).count() == 0
 
+
+
+def test_class_permissions_subscriptions_classcards(client, web2py):
+    """
+        Are the class permissions of school subscriptions & class cards
+        compiled from the groups linked to classes?
+    """
+    from openstudio.os_class_permissions import OsClassPermissions
+
+    prepare_classes(web2py)
+
+    permissions = OsClassPermissions()
+    all_permissions = {'Enroll': True, 'ShopBook': True, 'Attend': True}
+    assert permissions.get_subscription_permissions(1) == {1: all_permissions}
+    assert permissions.get_subscription_permissions(3) == {}
+    assert permissions.get_classcard_permissions(1) == {1: all_permissions}
+    assert permissions.get_allowed_subscriptions(1, [1, 2, 3], 'ShopBook') == set([1, 2])
+    assert permissions.get_allowed_classcards(2, [1, 2, 3], 'Attend') == set()
+
+    # Classes not allowed in the API are only listed when public_only is False
+    web2py.db(web2py.db.classes.id == 1).update(AllowAPI=False)
+    web2py.db.commit()
+
+    permissions = OsClassPermissions()
+    assert permissions.get_subscription_permissions(1) == {}
+    assert permissions.get_subscription_permissions(1, public_only=False) == {1: all_permissions}
@@ -82,6 +82,48 @@ def test_system_organization_edit(client, web2py):
     assert data['Name'] in client.text
 
 
+def test_system_database(client, web2py):
+    """
+        Are declared indexes created and listed with query plans?
+    """
+    url = '/settings/system_database'
+    client.get(url)
+    assert client.status == 200
+
+    assert 'ix_classes_attendance_classes_id_classdate_bookingstatus' in client.text
+    assert 'Missing' not in client.text
+    assert 'Bookings for a class' in client.text
+
+    # Check that the index is used
+    assert 'USING COVERING INDEX ix_classes_attendance_classes_id_classdate_bookingstatus' in client.text
+
+
+def test_admin_query_profiles(client, web2py):
+    """
+        Are queries of requests listed after enabling profiling?
+    """
+    url = '/settings/admin_query_profiles_toggle'
+    client.get(url)
+    assert client.status == 200
+    assert 'Stop profiling my requests' in client.text
+
+    url = '/settings/system_organizations'
+    client.get(url)
+    assert client.status == 200
+
+    url = '/settings/admin_query_profiles'
+    client.get(url)
+    assert client.status == 200
+    assert '/settings/system_organizations' in client.text
+    assert 'SELECT' in client.text
+    assert 'controllers/settings.py' in client.text
+
+    url = '/settings/admin_query_profiles_toggle'
+    client.get(url)
+    assert client.status == 200
+    assert 'Profile my requests' in client.text
+
+
 def test_shop_settings_general(client, web2py):
     """
         Is the shop general settings page working?
@@ -334,6 +376,27 @@ def test_financial_dd_categories_index(client, web2py):
     assert 'Direct debit categories' in client.text
 
 
+def test_financial_direct_debit(client, web2py):
+    """
+        Are the direct debit creditor settings saved?
+    """
+    url = '/settings/financial_direct_debit'
+    client.get(url)
+    assert client.status == 200
+
+    data = {
+        'DirectDebitCreditorName': 'OpenStudio',
+        'DirectDebitCreditorIBAN': 'NL91ABNA0417164300',
+        'DirectDebitCreditorBIC': 'ABNANL2A',
+        'DirectDebitCreditorID': 'NL00ZZZ000000000000'
+    }
+    client.post(url, data=data)
+    assert client.status == 200
+
+    for sys_property, value in data.items():
+        assert web2py.db.sys_properties(Property=sys_property).PropertyValue == value
+
+
 def test_financial_dd_categories_add(client, web2py):
     """
         Can we add a direct debit category?
@@ -596,3 +659,48 @@ def test_access_api_user(client, web2py):
     assert client.status == 200
     assert 'API users' in client.text
     assert web2py.db.sys_api_users(1).ActiveUser == True
+
+
+def test_access_group_permissions_compiled(client, web2py):
+    """
+        Are memberships & permissions of the logged in user checked using the
+        compiled set, and is the set cleared after changing permissions?
+    """
+    from setup_permisison_tests import setup_permission_tests
+
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    setup_permission_tests(web2py)
+
+    auth = web2py.auth
+    db = web2py.db
+
+    pID = db.auth_permission.insert(group_id=200,
+                                    name='read',
+                                    table_name='auth_user',
+                                    record_id=0)
+    db.commit()
+
+    auth.user = db.auth_user(200)
+    try:
+        assert auth.has_membership(group_id=200)
+        assert auth.has_membership(role='auth test')
+        assert not auth.has_membership(role='Admins')
+        assert auth.has_permission('read', 'auth_user')
+        # Permissions for a table apply to all records
+        assert auth.has_permission('read', 'auth_user', 1)
+        assert not auth.has_permission('update', 'auth_user')
+
+        # Revoke permission & membership
+        db(db.auth_permission.id == pID).delete()
+        db.commit()
+        assert not auth.has_permission('read', 'auth_user')
+
+        db(db.auth_membership.group_id == 200).delete()
+        db.commit()
+        assert not auth.has_membership(group_id=200)
+        assert not auth.has_membership(role='auth test')
+    finally:
+        auth.user = None
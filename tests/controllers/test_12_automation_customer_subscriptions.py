@@ -95,6 +95,126 @@ def test_create_monthly_invoices_inv_date_first_of_month(client, web2py):
     assert invoice.DateCreated == datetime.date(2014, 1, 1)
 
 
+def test_create_monthly_invoices_run_twice(client, web2py):
+    """
+        Are invoices created only once when creating invoices for a month again?
+    """
+    # Get random url to initialize OpenStudio environment
+    url = '/default/user/login'
+
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 10)
+
+    url = '/test_automation_customer_subscriptions/' + \
+          'test_create_invoices' + \
+          '?month=1&year=2014&description=Subscription_Jan&invoice_date=today'
+    client.get(url)
+    assert client.status == 200
+
+    invoices_count = web2py.db(web2py.db.invoices).count()
+    assert invoices_count > 0
+
+    client.get(url)
+    assert client.status == 200
+
+    assert web2py.db(web2py.db.invoices).count() == invoices_count
+
+    # check amounts & numbering
+    item = web2py.db.invoices_items(3)
+    amounts = web2py.db.invoices_amounts(invoices_id=item.invoices_id)
+    assert amounts.TotalPriceVAT == item.TotalPriceVAT
+
+    ig_100 = web2py.db.invoices_groups(100)
+    invoice = web2py.db.invoices(invoices_count)
+    assert invoice.InvoiceID == 'INV' + str(datetime.date.today().year) + str(ig_100.NextID - 1)
+
+
+def _get_subscription_invoices(web2py):
+    """
+        :return: dict {customers_subscriptions_id: invoice data to compare}
+    """
+    db = web2py.db
+
+    invoices = {}
+    rows = db(db.invoices_items_customers_subscriptions).select(
+        db.invoices_items_customers_subscriptions.ALL
+    )
+    for row in rows:
+        item = db.invoices_items(row.invoices_items_id)
+        invoice = db.invoices(item.invoices_id)
+        amounts = db.invoices_amounts(invoices_id=invoice.id)
+        customer = db.invoices_customers(invoices_id=invoice.id)
+        items = db(db.invoices_items.invoices_id == invoice.id).select(
+            orderby=db.invoices_items.Sorting|db.invoices_items.id
+        )
+
+        invoices[row.customers_subscriptions_id] = {
+            'InvoiceID': invoice.InvoiceID,
+            'Status': invoice.Status,
+            'Description': invoice.Description,
+            'DateCreated': invoice.DateCreated,
+            'DateDue': invoice.DateDue,
+            'Terms': invoice.Terms,
+            'Footer': invoice.Footer,
+            'CustomerName': invoice.CustomerName,
+            'CustomerAddress': invoice.CustomerAddress,
+            'auth_customer_id': customer.auth_customer_id,
+            'linked_item': [i.id for i in items].index(item.id),
+            'amounts': (amounts.TotalPrice, amounts.VAT, amounts.TotalPriceVAT, amounts.Balance),
+            'items': [(i.ProductName,
+                       i.Description,
+                       i.Quantity,
+                       i.Price,
+                       i.tax_rates_id,
+                       i.TotalPrice,
+                       i.VAT,
+                       i.TotalPriceVAT) for i in items]
+        }
+
+    return invoices
+
+
+def test_create_monthly_invoices_matches_per_subscription(client, web2py):
+    """
+        Are the invoices created for all subscriptions at once the same as
+        invoices created one subscription at a time?
+    """
+    # Get random url to initialize OpenStudio environment
+    url = '/default/user/login'
+
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 10)
+
+    db = web2py.db
+    next_id = db.invoices_groups(100).NextID
+    registration_fee_paid = dict((row.id, row.RegistrationFeePaid) for row in
+                                 db(db.customers_subscriptions).select())
+
+    vars = '?month=1&year=2014&description=Subscription_Jan&invoice_date=today'
+    client.get('/test_automation_customer_subscriptions/test_create_invoices_per_subscription' + vars)
+    assert client.status == 200
+
+    expected = _get_subscription_invoices(web2py)
+    assert len(expected) > 0
+
+    # Start over
+    db(db.invoices).delete()
+    db(db.invoices_groups.id == 100).update(NextID=next_id)
+    for csID, paid in registration_fee_paid.items():
+        db(db.customers_subscriptions.id == csID).update(RegistrationFeePaid=paid)
+    db.commit()
+
+    client.get('/test_automation_customer_subscriptions/test_create_invoices' + vars)
+    assert client.status == 200
+
+    assert _get_subscription_invoices(web2py) == expected
+    assert db.invoices_groups(100).NextID == next_id + len(expected)
+
+
 def test_add_subscription_credits_for_month(client, web2py):
     """
         Are credits batch-added correctly?
@@ -206,3 +326,106 @@ def test_subscription_credits_month_add_book_classes_for_recurring_reservations(
 
     query = (web2py.db.classes_attendance.ClassDate >= '2099-01-01')
     assert web2py.db(query).count() == 2
+
+
+def _get_credits_added(web2py, csc_max_id, clatt_max_id):
+    """
+        :return: mutations & bookings created after csc_max_id & clatt_max_id
+                 and all balances, to compare
+    """
+    db = web2py.db
+
+    bookings = {}
+    rows = db(db.classes_attendance.id > clatt_max_id).select()
+    for row in rows:
+        bookings[row.id] = (row.auth_customer_id,
+                            row.classes_id,
+                            row.ClassDate,
+                            row.customers_subscriptions_id,
+                            row.AttendanceType,
+                            row.CustomerMembership,
+                            row.BookingStatus)
+
+    mutations = []
+    rows = db(db.customers_subscriptions_credits.id > csc_max_id).select()
+    for row in rows:
+        mutations.append((row.customers_subscriptions_id,
+                          row.MutationType,
+                          row.MutationAmount,
+                          row.Description,
+                          row.SubscriptionYear,
+                          row.SubscriptionMonth,
+                          bookings.get(row.classes_attendance_id)))
+
+    balances = dict((row.customers_subscriptions_id, round(row.Balance, 1)) for row in
+                    db(db.customers_subscriptions_credits_balance).select())
+
+    return dict(mutations=sorted(mutations, key=str),
+                bookings=sorted(bookings.values(), key=str),
+                balances=balances)
+
+
+def test_add_subscription_credits_for_month_vectorized_matches(client, web2py):
+    """
+        Are the same credits added and classes booked for recurring reservations
+        when adding credits for all subscriptions at once?
+    """
+    # get a random url to initialize the OS environment
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    prepare_classes(web2py, credits=True)
+
+    db = web2py.db
+
+    # Recurring reservations for Monday class 1; customer 1001 already has one
+    for cuID in [1001, 1002, 1003, 1004, 1005]:
+        db.classes_reservation.insert(auth_customer_id=cuID,
+                                      classes_id=1,
+                                      Startdate='2099-01-01',
+                                      SingleClass=False,
+                                      TrialClass=False)
+    # Paused & blocked subscriptions
+    db.customers_subscriptions_paused.insert(customers_subscriptions_id=4,
+                                             Startdate='2099-01-12',
+                                             Enddate='2099-01-18',
+                                             Description='Pause')
+    db.customers_subscriptions_blocked.insert(customers_subscriptions_id=3,
+                                              Startdate='2099-01-01',
+                                              Enddate='2099-01-14',
+                                              Description='Blocked')
+    # Membership
+    db.customers_memberships.insert(auth_customer_id=1005,
+                                    school_memberships_id=1,
+                                    Startdate='2099-01-01',
+                                    Enddate='2099-01-31',
+                                    payment_methods_id=1)
+    # Check-in limit
+    db(db.school_subscriptions.id == 1).update(ClassCheckinLimit=2)
+    db.commit()
+
+    csc_max_id = db().select(db.customers_subscriptions_credits.id.max()).first()[
+        db.customers_subscriptions_credits.id.max()] or 0
+    clatt_max_id = db().select(db.classes_attendance.id.max()).first()[
+        db.classes_attendance.id.max()] or 0
+
+    url = '/test_automation_customer_subscriptions/test_add_subscription_credits_for_month' + \
+          '?year=2099&month=1&vectorized=False'
+    client.get(url)
+    assert client.status == 200
+
+    expected = _get_credits_added(web2py, csc_max_id, clatt_max_id)
+    assert len(expected['bookings']) > 0
+
+    # Start over
+    db(db.customers_subscriptions_credits.id > csc_max_id).delete()
+    db(db.classes_attendance.id > clatt_max_id).delete()
+    db.commit()
+
+    url = '/test_automation_customer_subscriptions/test_add_subscription_credits_for_month' + \
+          '?year=2099&month=1'
+    client.get(url)
+    assert client.status == 200
+
+    assert _get_credits_added(web2py, csc_max_id, clatt_max_id) == expected
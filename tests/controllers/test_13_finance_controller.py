@@ -340,6 +340,34 @@ def test_teacher_payment_find_classes_fixed_rate_default(client, web2py):
     assert tpc.tax_rates_id == default_rate.tax_rates_id
 
 
+def test_teacher_payment_find_classes_range_over_3_months(client, web2py):
+    """
+    Can classes be found for a period longer than 3 months?
+    """
+    prepare_classes(web2py)
+    populate_auth_user_teachers_fixed_rate_default(web2py)
+
+    url = '/finance/teacher_payment_find_classes'
+    client.get(url)
+    assert client.status == 200
+
+    data = {
+        'Startdate': '2013-10-01',
+        'Enddate': '2014-03-31'
+    }
+
+    client.post(url, data=data)
+    assert client.status == 200
+
+    query = (web2py.db.teachers_payment_classes.ClassDate >= datetime.date(2014, 1, 1)) & \
+            (web2py.db.teachers_payment_classes.ClassDate <= datetime.date(2014, 1, 31))
+    assert web2py.db(query).count() == 3
+
+    # Classes before the first attendance are not added
+    query = (web2py.db.teachers_payment_classes.ClassDate < datetime.date(2014, 1, 1))
+    assert web2py.db(query).count() == 0
+
+
 
 def test_teacher_payment_find_classes_travel_allowance(client, web2py):
     """
@@ -792,6 +820,119 @@ def test_add_batch_invoices_with_zero_lines(client, web2py):
     assert web2py.db(web2py.db.payment_batches_items).count() == 7
     
 
+def test_batch_export_csv(client, web2py):
+    """
+        Are all batch items exported to CSV?
+    """
+    url = '/finance/batch_add?export=collection&what=invoices'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 10)
+
+    # create invoices
+    inv_url = '/test_automation_customer_subscriptions/' + \
+              'test_create_invoices' + \
+              '?month=1&year=2014&description=Subscription_Jan'
+    client.get(inv_url)
+    assert client.status == 200
+
+    client.get(url)
+    assert client.status == 200
+
+    data = {'Name'        : 'Test export',
+            'Description' : 'Cherry shake',
+            'Exdate'      : '2014-02-01'}
+    client.post(url, data=data)
+    assert client.status == 200
+
+    url = '/finance/export_csv?pbID=1'
+    client.get(url)
+    assert client.status == 200
+
+    lines = client.text.strip().splitlines()
+    assert lines[0].startswith('customers_id,SubscriptionID,Account holder')
+    assert len(lines) == web2py.db(web2py.db.payment_batches_items).count() + 1
+
+    item = web2py.db.payment_batches_items(1)
+    assert item.AccountHolder in lines[1]
+
+    assert web2py.db(web2py.db.payment_batches_exports).count() == 1
+
+
+def test_batch_export_sepa(client, web2py):
+    """
+        Are all batch items exported to SEPA XML?
+    """
+    url = '/finance/batch_add?export=collection&what=invoices'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 10)
+
+    web2py.db.sys_properties.insert(Property='DirectDebitCreditorName',
+                                    PropertyValue='OpenStudio & Co')
+    web2py.db.sys_properties.insert(Property='DirectDebitCreditorID',
+                                    PropertyValue='NL00ZZZ000000000000')
+    web2py.db.commit()
+
+    # create invoices
+    inv_url = '/test_automation_customer_subscriptions/' + \
+              'test_create_invoices' + \
+              '?month=1&year=2014&description=Subscription_Jan'
+    client.get(inv_url)
+    assert client.status == 200
+
+    client.get(url)
+    assert client.status == 200
+
+    data = {'Name'        : 'Test export',
+            'Description' : 'Cherry shake',
+            'Exdate'      : '2014-02-01'}
+    client.post(url, data=data)
+    assert client.status == 200
+
+    # Items without IBAN & mandate are listed instead of exported
+    url = '/finance/export_sepa?pbID=1'
+    client.get(url)
+    assert client.status == 200
+    assert '<DrctDbtTxInf>' not in client.text
+    assert 'Creditor IBAN is missing or invalid' in client.text
+    assert 'IBAN is missing or invalid' in client.text
+    assert 'Mandate signature date is missing' in client.text
+    assert web2py.db(web2py.db.payment_batches_exports).count() == 0
+
+    web2py.db.sys_properties.insert(Property='DirectDebitCreditorIBAN',
+                                    PropertyValue='NL91 ABNA 0417 1643 00')
+    query = (web2py.db.payment_batches_items.id > 0)
+    web2py.db(query).update(AccountNumber='NL91ABNA0417164300',
+                            MandateReference='MANDATE-1',
+                            MandateSignatureDate=datetime.date(2013, 12, 1))
+    web2py.db(query & (web2py.db.payment_batches_items.Amount == 0)).delete()
+    web2py.db.commit()
+
+    client.get(url)
+    assert client.status == 200
+
+    count = web2py.db(web2py.db.payment_batches_items).count()
+    sum = web2py.db.payment_batches_items.Amount.sum()
+    amount = web2py.db().select(sum).first()[sum]
+
+    assert 'urn:iso:std:iso:20022:tech:xsd:pain.008.001.02' in client.text
+    assert '<NbOfTxs>' + str(count) + '</NbOfTxs>' in client.text
+    assert '<CtrlSum>' + format(amount, '.2f') + '</CtrlSum>' in client.text
+    assert client.text.count('<DrctDbtTxInf>') == count
+    # No previous batches, so all customers are first
+    assert '<SeqTp>FRST</SeqTp>' in client.text
+    assert '<SeqTp>RCUR</SeqTp>' not in client.text
+    # Check escaping
+    assert 'OpenStudio &amp; Co' in client.text
+    assert 'NL00ZZZ000000000000' in client.text
+    assert '<DtOfSgntr>2013-12-01</DtOfSgntr>' in client.text
+    assert '<IBAN>NL91ABNA0417164300</IBAN>' in client.text
+    assert web2py.db(web2py.db.payment_batches_exports).count() == 1
+
+
 def test_add_batch_invoices_location(client, web2py):
     """
         Check whether we can add an invoice based batch and items are generated
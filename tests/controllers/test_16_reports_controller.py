@@ -291,6 +291,101 @@ def test_reports_retention_dropoff_rate(client, web2py):
     assert '0.00%' in client.text
 
 
+def test_reports_retention_cohorts(client, web2py):
+    """
+        Are customers counted in the cohort of the month of their first class
+        and in the months they attend after that?
+    """
+    from openstudio.os_retention import OsRetention
+
+    # get random page to set up OpenStudio environment
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    prepare_classes(web2py)
+
+    url = '/reports/retention_cohorts?date_from=2014-01-01&date_until=2014-02-28&horizon=6'
+    client.get(url)
+    assert client.status == 200
+    assert '100.00%' in client.text
+
+    cohorts = OsRetention().get_cohorts(datetime.date(2014, 1, 1), datetime.date(2014, 2, 28), 6)
+    assert cohorts[0]['size'] == 1
+    assert cohorts[0]['active'] == [1, 0, 0, 0, 0, 0, 0]
+    assert cohorts[1]['size'] == 0
+
+    # insert a class for March
+    web2py.db.classes_attendance.insert(
+        auth_customer_id        = 1001,
+        classes_id              = 1,
+        ClassDate               = '2014-03-03',
+        AttendanceType          = 3,
+        customers_classcards_id = 1
+    )
+    web2py.db.commit()
+
+    cohorts = OsRetention().get_cohorts(datetime.date(2014, 1, 1), datetime.date(2014, 2, 28), 6)
+    assert cohorts[0]['active'] == [1, 0, 1, 0, 0, 0, 0]
+    assert cohorts[0]['retention'][2] == 1
+
+    curve = OsRetention().get_curve(cohorts)
+    assert curve[1]['dropoff'] == 1
+    assert curve[2]['retention'] == 1
+
+
+def test_reports_retention_cohorts_cache_cleared(client, web2py):
+    """
+        Are cached months cleared from the month of changed attendance
+        onward, and all months when a customer is deleted?
+    """
+    from openstudio.os_cache_manager import OsCacheManager
+
+    # get random page to set up OpenStudio environment
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    prepare_classes(web2py)
+
+    cache = web2py.cache
+    ocm = OsCacheManager()
+    months = ['2013-12', '2014-01', '2014-02', '2014-03']
+
+    def fill_cache():
+        ocm.clear_retention()
+        for key in months:
+            ocm.get_tagged('openstudio_retention_month_' + key,
+                           lambda: 'cached',
+                           ['retention', 'retention_' + key],
+                           time_expire=3600)
+
+    def get_cached():
+        return [cache.ram('openstudio_retention_month_' + key,
+                          lambda: 'cleared',
+                          time_expire=3600) for key in months]
+
+    # Backdating a first class in January changes the cohorts of later months
+    fill_cache()
+    web2py.db.classes_attendance.insert(
+        auth_customer_id        = 1001,
+        classes_id              = 1,
+        ClassDate               = '2014-01-06',
+        AttendanceType          = 3,
+        customers_classcards_id = 1
+    )
+    web2py.db.commit()
+
+    assert get_cached() == ['cached', 'cleared', 'cleared', 'cleared']
+
+    # Deleting a customer cascades to attendance without attendance callbacks
+    fill_cache()
+    web2py.db(web2py.db.auth_user.id == 1001).delete()
+    web2py.db.commit()
+
+    assert get_cached() == ['cleared', 'cleared', 'cleared', 'cleared']
+
+
 def test_reports_teacher_classes(client, web2py):
     """
         Does the page list the classes for the teacher (incl. sub classes correctly)
@@ -350,6 +445,48 @@ def test_reports_teacher_classes_class_revenue(client, web2py):
     assert '12.50' in client.text
 
 
+def test_reports_teacher_classes_class_revenue_totals(client, web2py):
+    """
+        Do the revenue of each attendance record and the total of a class match
+        the amounts calculated for each attendance type before
+    """
+    from decimal import Decimal
+    from openstudio.os_reports import Reports
+
+    # get random page to set up OpenStudio environment
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    prepare_classes(web2py, with_subscriptions=True, with_classcards=True, invoices=True)
+
+    # Totals calculated by the previous per attendance type helpers
+    totals = {
+        datetime.date(2014, 1, 6): Decimal('10.00'), # trial
+        datetime.date(2014, 1, 13): Decimal('18.00'), # drop in
+        datetime.date(2014, 1, 20): Decimal('40.00'), # subscription
+        datetime.date(2014, 1, 27): Decimal('12.50'), # class card
+    }
+
+    reports = Reports()
+    for date, total in totals.items():
+        classes_revenue = reports.get_classes_revenue(date, date, [1])
+        attendance_revenue = reports.get_classes_revenue_attendance(date, date, [1])
+
+        revenue = classes_revenue[(1, date)]
+        assert round(revenue['revenue_in_vat'], 2) == total
+        assert sum([r['revenue_in_vat'] for r in attendance_revenue.values()]) == \
+               revenue['revenue_in_vat']
+        assert sum([r['revenue_ex_vat'] for r in attendance_revenue.values()]) == \
+               revenue['revenue_ex_vat']
+
+        url = '/reports/teacher_classes_class_revenue?clsID=1&date=' + str(date)
+        client.get(url)
+        assert client.status == 200
+        assert format(revenue['revenue_ex_vat'], '.2f') in client.text
+        assert format(revenue['revenue_in_vat'], '.2f') in client.text
+
+
 def test_reports_classcards(client, web2py):
     """
         Is the page showing?
@@ -95,3 +95,26 @@ def test_selfcheckin_checkin_impossible_when_full(client, web2py):
 
     assert 'This class is full' in client.text
     assert not 'Check in</button>' in client.text
+
+
+def test_selfcheckin_checkin_search_booking_options(client, web2py):
+    """
+        Test to verify search results list subscriptions of customers and
+        a check-in button for customers not checked in yet
+    """
+    prepare_classes(web2py)
+
+    date = datetime.date(2099, 1, 5)
+
+    url = '/customers/load_list_set_search.json?name=customer_1'
+    client.get(url)
+    assert client.status == 200
+
+    url = '/customers/load_list.load?list_type=selfcheckin_checkin&items_per_page=10' + \
+          '&clsID=1&date=' + str(date) + '&pictures=False'
+    client.get(url)
+    assert client.status == 200
+
+    ssu = web2py.db.school_subscriptions(1)
+    assert ssu.Name in client.text
+    assert 'Check in' in client.text
@@ -5,10 +5,13 @@ import datetime
 from populate_os_tables import prepare_classes
 from populate_os_tables import prepare_classes_teacher_classtypes
 from populate_os_tables import populate_define_sys_email_reminders
+from populate_os_tables import populate_customers_with_subscriptions
+from populate_os_tables import populate_customers
+from populate_os_tables import populate_invoices
 
 def test_email_reminders_teachers_sub_request_open(client, web2py):
     """
-    Check if a mail is rendered and sent
+    Check if a mail is rendered and queued
     """
     prepare_classes(web2py)
     populate_define_sys_email_reminders(web2py)
@@ -25,12 +28,13 @@ def test_email_reminders_teachers_sub_request_open(client, web2py):
     client.get(url)
     assert client.status == 200
 
-    assert "Sent mails: 1" in client.text
+    assert "Queued mails: 1" in client.text
+    assert web2py.db(web2py.db.mail_outbox.Status == 'queued').count() == 1
 
 
 def test_email_teachers_sub_requests_daily_summary(client, web2py):
     """
-    Check if a mail is rendered and sent
+    Check if a mail is rendered and queued
     """
     prepare_classes(web2py)
     populate_define_sys_email_reminders(web2py)
@@ -48,11 +52,450 @@ def test_email_teachers_sub_requests_daily_summary(client, web2py):
     assert client.status == 200
 
     # No classtypes defined for teachers
-    assert "Sent mails: 0" in client.text
+    assert "Queued mails: 0" in client.text
 
     # Define classtypes and check again
     prepare_classes_teacher_classtypes(web2py)
     client.get(url)
     assert client.status == 200
 
+    assert "Queued mails: 1" in client.text
+
+
+def test_classes_attendance_count_rebuild(client, web2py):
+    """
+    Check if attendance counts are maintained and can be rebuilt
+    """
+    from openstudio.os_classes_attendance_counts import ClassesAttendanceCounts
+
+    prepare_classes(web2py)
+
+    query = (web2py.db.classes_attendance_count.classes_id == 1) & \
+            (web2py.db.classes_attendance_count.ClassDate == '2014-01-06')
+
+    # Counts are added when attendance is inserted
+    row = web2py.db(query).select().first()
+    assert row.Attendance == 1
+
+    # Remove counts and rebuild them
+    web2py.db(web2py.db.classes_attendance_count).delete()
+    web2py.db.commit()
+
+    # Without counts, attendance is counted
+    counts = ClassesAttendanceCounts().get(1, datetime.date(2014, 1, 6))
+    assert counts['Attendance'] == 1
+
+    url = '/test_os_scheduler_tasks/classes_attendance_count_rebuild'
+    client.get(url)
+    assert client.status == 200
+
+    assert "Classes for which attendance was counted: 5" in client.text
+
+    row = web2py.db(query).select().first()
+    assert row.Attendance == 1
+    assert row.OnlineBooking == 0
+
+
+def test_customers_subscriptions_collect_mollie_recurring(client, web2py):
+    """
+    Check if payments are collected once for each invoice, using a fake Mollie client
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 4)
+
+    query = (web2py.db.customers_subscriptions.id <= 3)
+    web2py.db(query).update(payment_methods_id=100)
+    web2py.db.commit()
+
+    url = '/test_os_scheduler_tasks/customers_subscriptions_collect_mollie_recurring?year=2014&month=1'
+    client.get(url)
+    assert client.status == 200
+
+    query = (web2py.db.invoices_mollie_payment_ids.RecurringType == 'recurring')
+    payments_count = web2py.db(query).count()
+    assert payments_count > 0
+    assert "Payments collected: " + str(payments_count) in client.text
+
+    # Invoices for other payment methods aren't created
+    query = (web2py.db.invoices.payment_methods_id != 100)
+    assert web2py.db(query).count() == 0
+
+    # Collected invoices are skipped when collecting again
+    client.get(url)
+    assert client.status == 200
+
+    query = (web2py.db.invoices_mollie_payment_ids.RecurringType == 'recurring')
+    assert web2py.db(query).count() == payments_count
+    assert "Payments collected: 0" in client.text
+
+    query = (web2py.db.invoices_mollie_recurring_collection.Status == 'created')
+    assert web2py.db(query).count() == payments_count
+
+    # Invoices stuck processing are collected again, or fail after the max attempts
+    imrc = web2py.db.invoices_mollie_recurring_collection
+    rows = web2py.db(imrc).select(orderby=imrc.id)
+    assert len(rows) >= 2
+    updated_on = datetime.datetime.now() - datetime.timedelta(hours=2)
+    for row, attempts in [(rows[0], 1), (rows[1], 3)]:
+        row.update_record(Status='processing',
+                          Attempts=attempts,
+                          mollie_payment_id=None,
+                          UpdatedOn=updated_on)
+        query = (web2py.db.invoices_mollie_payment_ids.invoices_id == row.invoices_id)
+        web2py.db(query).delete()
+    web2py.db.commit()
+
+    client.get(url + '&retry=T')
+    assert client.status == 200
+    assert "Payments collected: 1" in client.text
+    assert "Payments timed out and failed: 1" in client.text
+
+    assert imrc(rows[0].id).Status == 'created'
+    assert imrc(rows[0].id).Attempts == 2
+    assert imrc(rows[1].id).Status == 'failed'
+
+    query = (web2py.db.invoices_mollie_payment_ids.RecurringType == 'recurring')
+    assert web2py.db(query).count() == payments_count - 1
+
+
+def test_invoices_render_pdfs(client, web2py):
+    """
+    Check if invoices in a period are rendered once and served from cache afterwards
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers(web2py, 3)
+    populate_invoices(web2py)
+
+    today = datetime.date.today()
+    invoices_count = web2py.db(web2py.db.invoices.DateCreated == today).count()
+
+    url = '/test_os_scheduler_tasks/invoices_render_pdfs?date_from={today}&date_until={today}'.format(
+        today=today
+    )
+    client.get(url)
+    assert client.status == 200
+    assert "Invoices rendered as PDF: " + str(invoices_count) in client.text
+
+    # Rendered invoices are in cache now
+    client.get(url)
+    assert client.status == 200
+    assert "Invoices rendered as PDF: 0" in client.text
+
+    # Downloads are served from cache
+    url = '/invoices/pdf?iID=1'
+    client.get(url)
+    assert client.status == 200
+
+
+def test_mail_outbox_send(client, web2py):
+    """
+    Check if queued mails are sent and the status of archived messages is updated
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers(web2py, 1)
+
+    msgID = web2py.db.messages.insert(
+        msg_subject = 'Hello world',
+        msg_content = '<html><body>Hello world</body></html>'
+    )
+    cmID = web2py.db.customers_messages.insert(
+        auth_customer_id = 1001,
+        messages_id = msgID,
+        Status = 'queued'
+    )
+    moID = web2py.db.mail_outbox.insert(
+        Recipient = 'customer@openstudioproject.com',
+        Subject = 'Hello world',
+        Message = '<html><body>Hello world</body></html>',
+        customers_messages_id = cmID,
+        Status = 'queued',
+        Attempts = 0,
+        NextAttemptOn = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    )
+    web2py.db.commit()
+
+    url = '/test_os_scheduler_tasks/mail_outbox_send'
+    client.get(url)
+    assert client.status == 200
     assert "Sent mails: 1" in client.text
+
+    mail = web2py.db.mail_outbox(moID)
+    assert mail.Status == 'sent'
+    assert mail.SentOn is not None
+
+    cm = web2py.db.customers_messages(cmID)
+    assert cm.Status == 'sent'
+
+    # Sent mails aren't sent again
+    client.get(url)
+    assert client.status == 200
+    assert "Sent mails: 0" in client.text
+
+
+def test_mail_outbox_send_queued_on_upgrade(client, web2py):
+    """
+    Check if the mail outbox task is queued for installations set up before it existed
+    """
+    from openstudio.os_scheduler import OsScheduler
+
+    query = (web2py.db.scheduler_task.task_name == 'mail_outbox_send')
+    web2py.db(query).delete()
+    web2py.db.commit()
+
+    OsScheduler().queue_missing_tasks()
+    assert web2py.db(query).count() == 1
+
+    # Not queued twice
+    OsScheduler().queue_missing_tasks()
+    assert web2py.db(query).count() == 1
+
+
+def test_customers_subscriptions_credits_balance_verify(client, web2py):
+    """
+    Check if credit balances are maintained and drift is detected and repaired
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 2)
+
+    cscID = web2py.db.customers_subscriptions_credits.insert(
+        customers_subscriptions_id = 1,
+        MutationType = 'add',
+        MutationAmount = 10
+    )
+    web2py.db.customers_subscriptions_credits.insert(
+        customers_subscriptions_id = 1,
+        MutationType = 'sub',
+        MutationAmount = 1
+    )
+    web2py.db(web2py.db.customers_subscriptions_credits.id == cscID).update(MutationAmount = 8)
+    web2py.db.commit()
+
+    query = (web2py.db.customers_subscriptions_credits_balance.customers_subscriptions_id == 1)
+    balance = web2py.db(query).select().first()
+    assert balance.Balance == 7
+
+    url = '/test_os_scheduler_tasks/customers_subscriptions_credits_balance_verify'
+    client.get(url)
+    assert client.status == 200
+    assert "Subscriptions with credit balance drift: 0" in client.text
+
+    # Change balance without a mutation
+    web2py.db(query).update(Balance = 12)
+    web2py.db.commit()
+
+    client.get(url)
+    assert client.status == 200
+    assert "Subscriptions with credit balance drift: 1" in client.text
+
+    balance = web2py.db(query).select().first()
+    assert balance.Balance == 7
+
+    client.get(url)
+    assert client.status == 200
+    assert "Subscriptions with credit balance drift: 0" in client.text
+
+
+def test_customers_subscriptions_credits_balance_unique(client, web2py):
+    """
+    Check that a subscription can't get more than one credit balance
+    """
+    import pytest
+    from openstudio.os_customers_subscriptions_credits_balances import CustomersSubscriptionsCreditsBalances
+
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers_with_subscriptions(web2py, 2)
+
+    web2py.db.customers_subscriptions_credits.insert(
+        customers_subscriptions_id = 1,
+        MutationType = 'add',
+        MutationAmount = 10
+    )
+    web2py.db.commit()
+
+    # Balance is replaced when it's refreshed again, eg. by another request
+    # adding the first mutation at the same time
+    CustomersSubscriptionsCreditsBalances().refresh([1])
+    CustomersSubscriptionsCreditsBalances().refresh([1])
+    web2py.db.commit()
+
+    query = (web2py.db.customers_subscriptions_credits_balance.customers_subscriptions_id == 1)
+    rows = web2py.db(query).select()
+    assert len(rows) == 1
+    assert rows.first().Balance == 10
+
+    with pytest.raises(Exception):
+        web2py.db.customers_subscriptions_credits_balance.insert(
+            customers_subscriptions_id = 1,
+            Balance = 10
+        )
+    web2py.db.rollback()
+
+    # Without a stored balance, the mutations are summed
+    web2py.db(query).delete()
+    web2py.db.commit()
+    assert CustomersSubscriptionsCreditsBalances().get(1) == 10
+
+
+def test_classes_occurrences_rebuild(client, web2py):
+    """
+    Check if class occurrences are maintained and can be rebuilt
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    prepare_classes(web2py)
+
+    # A Monday in the coming weeks; class 1 takes place on Mondays
+    today = datetime.date.today()
+    date = today + datetime.timedelta(days=14 - today.weekday())
+
+    query = (web2py.db.classes_occurrences.classes_id == 1) & \
+            (web2py.db.classes_occurrences.ClassDate == date)
+    occurrence = web2py.db(query).select().first()
+    assert occurrence.Status == 'normal'
+    assert occurrence.auth_teacher_id == 2
+
+    web2py.db.classes_otc.insert(
+        classes_id = 1,
+        ClassDate = date,
+        Status = 'cancelled',
+        auth_teacher_id = 3
+    )
+    web2py.db.commit()
+
+    occurrence = web2py.db(query).select().first()
+    assert occurrence.Status == 'cancelled'
+    assert occurrence.auth_teacher_id == 3
+
+    # Remove all occurrences
+    web2py.db(web2py.db.classes_occurrences).delete()
+    web2py.db.commit()
+
+    url = '/test_os_scheduler_tasks/classes_occurrences_rebuild'
+    client.get(url)
+    assert client.status == 200
+    assert "Class occurrences" in client.text
+
+    occurrence = web2py.db(query).select().first()
+    assert occurrence.Status == 'cancelled'
+    assert occurrence.auth_teacher_id == 3
+
+    # The schedule is read from the rebuilt occurrences
+    year, week, weekday = date.isocalendar()
+    url = '/classes/schedule?year=' + str(year) + '&week=' + str(week)
+    client.get(url)
+    assert client.status == 200
+    assert 'status_marker bg_orange' in client.text
+
+
+def test_customers_inactive_delete(client, web2py):
+    """
+    Are inactive customers counted in a dry run and deleted in chunks?
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers(web2py, 10, created_on=datetime.date(2010, 1, 1))
+
+    date = datetime.date.today().strftime('%Y-%m-%d')
+
+    url = '/test_os_scheduler_tasks/customers_inactive_delete?date=' + date + '&dry_run=True'
+    client.get(url)
+    assert client.status == 200
+    assert "Inactive customers: 10" in client.text
+
+    count = web2py.db(web2py.db.auth_user.id > 1).count()
+    assert count == 10
+
+    url = '/test_os_scheduler_tasks/customers_inactive_delete?date=' + date + '&chunk_size=3'
+    client.get(url)
+    assert client.status == 200
+    assert "Customers deleted: 10" in client.text
+
+    count = web2py.db(web2py.db.auth_user.id > 1).count()
+    assert count == 0 # Only admin user remaining
+
+
+def test_exports_create(client, web2py):
+    """
+    Is a queued export created and stored?
+    """
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers(web2py, 10)
+
+    seID = web2py.db.sys_exports.insert(
+        auth_user_id=1,
+        ExportType='mailing_list'
+    )
+    web2py.db.commit()
+
+    url = '/test_os_scheduler_tasks/exports_create?seID=' + str(seID)
+    client.get(url)
+    assert client.status == 200
+    assert "Export created: Mailinglist.xlsx" in client.text
+
+    row = web2py.db.sys_exports(seID)
+    assert row.Status == 'finished'
+    assert row.FileName == 'Mailinglist.xlsx'
+    assert row.ExportFile
+
+
+def test_exports_delete_expired(client, web2py):
+    """
+    Are background exports and their files deleted after the retention period?
+    """
+    import os
+
+    url = '/default/user/login'
+    client.get(url)
+    assert client.status == 200
+
+    populate_customers(web2py, 10)
+
+    seIDs = []
+    for i in range(2):
+        seID = web2py.db.sys_exports.insert(
+            auth_user_id=1,
+            ExportType='mailing_list'
+        )
+        web2py.db.commit()
+        seIDs.append(seID)
+
+        url = '/test_os_scheduler_tasks/exports_create?seID=' + str(seID)
+        client.get(url)
+        assert client.status == 200
+
+    expired = web2py.db.sys_exports(seIDs[0])
+    expired.update_record(CreatedOn=datetime.datetime.now() - datetime.timedelta(days=8))
+    web2py.db.commit()
+    path = os.path.join(web2py.request.folder, 'uploads', expired.ExportFile)
+    assert os.path.exists(path)
+
+    url = '/test_os_scheduler_tasks/exports_delete_expired'
+    client.get(url)
+    assert client.status == 200
+    assert "Exports deleted: 1" in client.text
+
+    assert web2py.db.sys_exports(seIDs[0]) is None
+    assert not os.path.exists(path)
+    assert web2py.db.sys_exports(seIDs[1]).Status == 'finished'
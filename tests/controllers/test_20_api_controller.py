@@ -326,6 +326,64 @@ def test_schedule_get_json(client, web2py):
         'Edwin van de Ven'
 
 
+def test_schedule_get_json_count_attendance(client, web2py):
+    """
+        Check whether attendance is counted for each day of the week, when the
+        whole week is fetched at once
+    """
+    populate_schedule(web2py)
+
+    # Monday 2014-01-06: 2 bookings (1 online) + 1 cancelled, Tuesday 2014-01-07: 1 booking,
+    # Monday 2014-01-13 is in the next week
+    web2py.db.classes_attendance.insert(auth_customer_id=2,
+                                        classes_id=1,
+                                        ClassDate='2014-01-06',
+                                        AttendanceType=1,
+                                        online_booking=True,
+                                        BookingStatus='booked')
+    web2py.db.classes_attendance.insert(auth_customer_id=3,
+                                        classes_id=1,
+                                        ClassDate='2014-01-06',
+                                        AttendanceType=1,
+                                        online_booking=False,
+                                        BookingStatus='attending')
+    web2py.db.classes_attendance.insert(auth_customer_id=4,
+                                        classes_id=1,
+                                        ClassDate='2014-01-06',
+                                        AttendanceType=1,
+                                        online_booking=True,
+                                        BookingStatus='cancelled')
+    web2py.db.classes_attendance.insert(auth_customer_id=3,
+                                        classes_id=2,
+                                        ClassDate='2014-01-07',
+                                        AttendanceType=1,
+                                        online_booking=False,
+                                        BookingStatus='booked')
+    web2py.db.classes_attendance.insert(auth_customer_id=4,
+                                        classes_id=1,
+                                        ClassDate='2014-01-13',
+                                        AttendanceType=1,
+                                        online_booking=True,
+                                        BookingStatus='booked')
+    web2py.db.commit()
+
+    url = base_url + \
+        '/api/schedule_get.json?user=test&key=test&year=2014&week=2'
+    with urllib.request.urlopen(url) as page:
+        content = page.read().decode('utf-8')
+
+    json = sj.loads(content)
+
+    assert json['data']['classes']['Monday']['classes'][0]['CountAttendance'] == 2
+    assert json['data']['classes']['Monday']['classes'][0]['CountAttendanceOnlineBooking'] == 1
+    assert json['data']['classes']['Monday']['classes'][0]['BookingSpacesAvailable'] == 18
+
+    assert json['data']['classes']['Tuesday']['date'] == '2014-01-07'
+    assert json['data']['classes']['Tuesday']['classes'][0]['CountAttendance'] == 1
+    assert json['data']['classes']['Tuesday']['classes'][0]['CountAttendanceOnlineBooking'] == 0
+    assert json['data']['classes']['Tuesday']['classes'][0]['BookingSpacesAvailable'] == 19
+
+
 def test_shedule_get_days_json(client, web2py):
     """
         test schedule_get_days API endpoint
@@ -515,6 +573,40 @@ def test_school_classcards_get_json(client, web2py):
     assert json['data'][0]['Name'] == classcard.Name
 
 
+def test_school_classcards_get_json_not_modified(client, web2py):
+    """
+        Is 304 Not Modified returned when the client has the current version?
+    """
+    populate_api_users(web2py)
+
+    populate_school_classcards(web2py, 2)
+
+    url = base_url + '/api/school_classcards_get.json?user=test&key=test'
+    with urllib.request.urlopen(url) as page:
+        etag = page.headers['ETag']
+        assert page.headers['Last-Modified']
+    assert etag
+
+    request = urllib.request.Request(url, headers={'If-None-Match': etag})
+    try:
+        urllib.request.urlopen(request)
+        status = 200
+    except urllib.error.HTTPError as e:
+        status = e.code
+    assert status == 304
+
+    # A change to the class cards results in a new version
+    web2py.db(web2py.db.school_classcards.id == 1).update(Name='Changed card')
+    web2py.db.commit()
+
+    request = urllib.request.Request(url, headers={'If-None-Match': etag})
+    with urllib.request.urlopen(request) as page:
+        assert page.headers['ETag'] != etag
+        content = page.read().decode('utf-8')
+    json = sj.loads(content)
+    assert 'Changed card' in [classcard['Name'] for classcard in json['data']]
+
+
 def test_school_teachers_get_json(client, web2py):
     """
         Are the teachers returned correctly?